@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the TL model backends.
+
+The model packages (arlpy, pyat, pyram) are heavy to import and not all of
+them are installed everywhere. They are only imported the first time an
+environment class asks for them, so reading a Location or a bathymetry grid
+does not need any of them.
+"""
+
+import sys
+import importlib
+
+import UWAEnvTools.directories_and_files as _dirs
+
+
+class Backend_Error(Exception):
+    pass
+
+
+def _load_arlpy():
+    return importlib.import_module('arlpy.uwapm')
+
+def _load_pyat():
+    # pyat is not pip installable, it lives in a local checkout.
+    if _dirs.DIR_PYAT not in sys.path:
+        sys.path.insert(1,_dirs.DIR_PYAT)
+    return importlib.import_module('pyat.pyat.env')
+
+def _load_pyram():
+    return importlib.import_module('pyram.PyRAM')
+
+def _load_fake_pyram():
+    return importlib.import_module('UWAEnvTools.fake_backends').PYRAM
+
+def _load_fake_arlpy():
+    return importlib.import_module('UWAEnvTools.fake_backends').ARLPY
+
+
+# name : function returning the backend module (or module-like object)
+_REGISTRY = {
+    'arlpy' : _load_arlpy,
+    'pyat'  : _load_pyat,
+    'pyram' : _load_pyram,
+    # stand-ins for benchmarking, see fake_backends.py
+    'fake_pyram' : _load_fake_pyram,
+    'fake_arlpy' : _load_fake_arlpy,
+    }
+
+_LOADED = dict()
+
+
+def register_backend(p_name,p_loader):
+    """
+    Add or replace a backend. p_loader is called with no arguments on first
+    use and must return the backend module or a module-like object.
+    """
+    _REGISTRY[p_name] = p_loader
+    if p_name in _LOADED:
+        del _LOADED[p_name]
+
+
+def available_backends():
+    return sorted(_REGISTRY.keys())
+
+
+def is_loaded(p_name):
+    return p_name in _LOADED
+
+
+def get_backend(p_name):
+    """
+    Import (once) and return the named backend.
+    """
+    if p_name in _LOADED:
+        return _LOADED[p_name]
+    if p_name not in _REGISTRY:
+        raise Backend_Error(
+            'Unknown backend ' + str(p_name) \
+                + ', registered: ' + str(available_backends()))
+    try:
+        backend = _REGISTRY[p_name]()
+    except ImportError as e:
+        raise Backend_Error(
+            'Backend ' + str(p_name) + ' could not be imported: ' + str(e))
+    _LOADED[p_name] = backend
+    return backend
+
+
+class Lazy_Module():
+    """
+    Stands in for a module and imports it on first attribute access.
+    
+    e.g. module level 
+        pd = Lazy_Module('pandas')
+    then pd.read_csv(...) imports pandas only when first called.
+    """
+    
+    def __init__(self,p_name):
+        self.__dict__['_name'] = p_name
+        self.__dict__['_module'] = None
+        
+    def __getattr__(self,p_attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return getattr(module,p_attr)
+    
+    def __repr__(self):
+        return '<Lazy_Module ' + self.__dict__['_name'] + '>'
@@ -1,14 +1,27 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy import interpolate
-import pandas as pd
+
+from UWAEnvTools.backends import Lazy_Module
+import UWAEnvTools.instrument as instrument
+
+# Imported on first use so reading a grid does not pull in everything.
+plt = Lazy_Module('matplotlib.pyplot')
+interpolate = Lazy_Module('scipy.interpolate')
+pd = Lazy_Module('pandas')
 
 # Geographic data and manipulation packages
-from geopy import distance,units
-from netCDF4 import Dataset
-import haversine
+distance = Lazy_Module('geopy.distance')
+units = Lazy_Module('geopy.units')
+netCDF4 = Lazy_Module('netCDF4')
+haversine = Lazy_Module('haversine')
         
 
+# Source point / transect checks, see Bathymetry.check_transects.
+TRANSECT_OK = 0
+TRANSECT_OUT_OF_DOMAIN = 1
+TRANSECT_SOURCE_ON_LAND = 2
+TRANSECT_CROSSES_LAND = 3
+
+
 class Bathymetry():
     """
     All bathymetry sources must implement these methods
@@ -123,25 +136,174 @@ class Bathymetry():
         self.N_lon_steps = p_num_points_lon
         
         
-        self.read_bathy(self.the_location.fname_bathy)
-        self.sub_select_by_latlon(
-            p_lat_extent_tuple = self.the_location.LAT_EXTENT_TUPLE,
-            p_lon_extent_tuple = self.the_location.LON_EXTENT_TUPLE) #has default values for NS already
+        with instrument.stage(instrument.STAGE_BATHY_LOAD):
+            self.read_bathy(self.the_location.fname_bathy)
+            self.sub_select_by_latlon(
+                p_lat_extent_tuple = self.the_location.LAT_EXTENT_TUPLE,
+                p_lon_extent_tuple = self.the_location.LON_EXTENT_TUPLE) #has default values for NS already
         self.z_selection = self.z_selection - p_depth_offset # z positive ==> below sea level at this point.
         
-        self.interpolate_bathy() # assigns interpolation_function
+        with instrument.stage(instrument.STAGE_GRIDDING):
+            self.interpolate_bathy() # assigns interpolation_function
        
+    def spline_arrays(self):
+        """
+        The knots, coefficients and degrees of the interpolation function,
+        enough to rebuild it with spline_from_arrays without re-fitting.
+        """
+        spline = self.interpolation_function
+        tx, ty = spline.get_knots()
+        kx, ky = spline.degrees
+        return {'tx' : tx,
+                'ty' : ty,
+                'c'  : spline.get_coeffs(),
+                'kx' : kx,
+                'ky' : ky}
+
+    def hash_inputs(self):
+        """
+        What the depths along any transect depend on, for result hashing.
+        """
+        spline = self.interpolation_function
+        return [list(spline.get_knots()),spline.get_coeffs()]
+
+    def water_mask(self,p_min_depth = 0.,p_water_sign = None):
+        """
+        Boolean [lon,lat] over the trimmed grid, True where the water is
+        deeper than p_min_depth. NaN cells are not water.
+        
+        The sources disagree on sign (GEBCO is negative below sea level,
+        CHS 2 m ends up positive), so p_water_sign is the sign of z in the
+        water. None takes the sign of most of the grid, which is fine for
+        the mostly-water grids the locations trim to.
+        """
+        z = np.asarray(self.z_interped,dtype=float)
+        if p_water_sign is None:
+            p_water_sign = -1 if np.nanmedian(z) < 0 else 1
+        key = (float(p_min_depth),p_water_sign)
+        if getattr(self,'_water_mask_key',None) != key:
+            with np.errstate(invalid='ignore'):
+                self._water_mask = (p_water_sign * z) > p_min_depth
+            self._water_mask_key = key
+        return self._water_mask
+    
+    def check_transects(self,
+                        p_rx_lat_lon_tuple,
+                        p_tx_lats,
+                        p_tx_lons,
+                        p_n = 100,
+                        p_min_depth = 0.,
+                        p_water_sign = None):
+        """
+        Check each source's transect against the trimmed grid, all sources
+        at once. Each transect is sampled at p_n points on the straight
+        line from the receiver to its source, and the points are looked
+        up in water_mask (nearest cell). The receiver end is not tested, a
+        hydrophone near shore would fail every line otherwise, and the 
+        source end is the one tested for the source being on land.
+        
+        Returns a code per source: TRANSECT_OK, TRANSECT_OUT_OF_DOMAIN
+        (the line leaves the grid, where the spline extrapolates), 
+        TRANSECT_SOURCE_ON_LAND or TRANSECT_CROSSES_LAND.
+        """
+        mask = self.water_mask(p_min_depth,p_water_sign)
+        lat_basis = np.asarray(self.lat_basis_trimmed,dtype=float)
+        lon_basis = np.asarray(self.lon_basis_trimmed,dtype=float)
+        
+        # n_sources x p_n, receiver first, so dropping it leaves the 
+        # source last whichever quadrant the source is in.
+        tx_lats = np.atleast_1d(np.asarray(p_tx_lats,dtype=float))
+        tx_lons = np.atleast_1d(np.asarray(p_tx_lons,dtype=float))
+        lats = np.linspace(np.full_like(tx_lats,p_rx_lat_lon_tuple[0]),
+                           tx_lats,
+                           num=p_n + 1,
+                           axis=-1)[:,1:]
+        lons = np.linspace(np.full_like(tx_lons,p_rx_lat_lon_tuple[1]),
+                           tx_lons,
+                           num=p_n + 1,
+                           axis=-1)[:,1:]
+        
+        inside = (lats >= lat_basis.min()) & (lats <= lat_basis.max()) \
+            & (lons >= lon_basis.min()) & (lons <= lon_basis.max())
+        i_lon = np.clip(np.rint((lons - lon_basis[0]) 
+                                / (lon_basis[-1] - lon_basis[0]) 
+                                * (len(lon_basis) - 1)).astype(int),
+                        0,len(lon_basis) - 1)
+        i_lat = np.clip(np.rint((lats - lat_basis[0]) 
+                                / (lat_basis[-1] - lat_basis[0]) 
+                                * (len(lat_basis) - 1)).astype(int),
+                        0,len(lat_basis) - 1)
+        water = mask[i_lon,i_lat] & inside
+        
+        codes = np.full(len(lats),TRANSECT_OK,dtype=int)
+        codes[~np.all(water,axis=1)] = TRANSECT_CROSSES_LAND
+        codes[~water[:,-1]] = TRANSECT_SOURCE_ON_LAND
+        codes[~np.all(inside,axis=1)] = TRANSECT_OUT_OF_DOMAIN
+        return codes
+
+    def get_depth_index(self,p_tile_size = None):
+        """
+        The per-tile min/max index of the trimmed grid, built on first use
+        (or restored by load_prepared). p_tile_size None keeps the tile
+        size of an existing index, 32 for a new one.
+        """
+        index = getattr(self,'depth_index',None)
+        if index is None and p_tile_size is None:
+            p_tile_size = 32
+        if index is None or \
+            (p_tile_size is not None and index.tile_size != p_tile_size):
+            index = Depth_Index.from_grid(self.lat_basis_trimmed,
+                                          self.lon_basis_trimmed,
+                                          self.z_interped,
+                                          p_tile_size)
+            self.depth_index = index
+        return index
+
+    def z_range_in_region(self,p_lat_extent_tuple = None,p_lon_extent_tuple = None):
+        """
+        (min z, max z) over the grid nodes in the region, the whole grid
+        by default, from the depth index.
+        """
+        return self.get_depth_index().region(p_lat_extent_tuple,p_lon_extent_tuple)
+
+    def z_range_along_transect(self,p_rx_lat_lon_tuple,p_tx_lat_lon_tuple):
+        """
+        (min z, max z) over the grid nodes of the tiles the straight line
+        crosses, from the depth index. Bounds the spline only at the
+        nodes, a bicubic can overshoot them slightly in between.
+        """
+        return self.get_depth_index().along(p_rx_lat_lon_tuple,p_tx_lat_lon_tuple)
+
+    def save_prepared(self,p_fname):
+        """
+        The trimmed grid, spline knots and coefficients and the depth
+        index in one .npz, see Bathymetry_Prepared.load_prepared.
+        """
+        arrays = dict()
+        arrays['lat_basis'] = np.asarray(self.lat_basis_trimmed)
+        arrays['lon_basis'] = np.asarray(self.lon_basis_trimmed)
+        arrays['z_interped'] = np.asarray(self.z_interped)
+        for key,value in self.spline_arrays().items():
+            arrays['spline_' + key] = np.asarray(value)
+        for key,value in self.get_depth_index().to_arrays().items():
+            arrays['index_' + key] = value
+        np.savez(p_fname,**arrays)
+
     def set_constant_depth(self,p_depth):
         """
         For debugging or Pekeris investigation/comparison,
         take existing bathy function and replace with a constant function.
+        
+        The B-spline basis sums to one, so the existing knots with every
+        coefficient equal to p_depth is exactly constant. No re-fit.
         """
-        constant_depth = np.ones_like(self.z_interped) * p_depth
-        self.interpolation_function = \
-            interpolate.RectBivariateSpline(
-                self.lon_basis_trimmed,
-                self.lat_basis_trimmed,
-                constant_depth)
+        spline = self.spline_arrays()
+        spline['c'] = np.full_like(spline['c'],p_depth,dtype=float)
+        self.interpolation_function = spline_from_arrays(spline)
+        self.depth_index = Depth_Index.from_grid(
+            self.lat_basis_trimmed,
+            self.lon_basis_trimmed,
+            np.full(np.shape(self.z_interped),p_depth,dtype=float))
          
         
     def plot_bathy(self,
@@ -364,7 +526,7 @@ class Bathymetry_WOD(Bathymetry):
 
 
     def read_bathy(self,fname):
-        ds = Dataset(fname)
+        ds = netCDF4.Dataset(fname)
         
         self.lats = np.array(ds.variables['lat'][:])
         self.lons = np.array(ds.variables['lon'][:])
@@ -419,6 +581,238 @@ class Bathymetry_range_independent_pekeris(Bathymetry_WOD):
             (self.hfx_lat_lon[1],self.end_lat_lon[1])
             )
         
+class Bathymetry_Prepared(Bathymetry):
+    """
+    Bathymetry that was read, gridded, trimmed and fitted elsewhere,
+    e.g. restored from a location bundle.
+    
+    Only the trimmed grid and the spline are held, so the members used
+    by the environments (lat_basis_trimmed, lon_basis_trimmed, z_interped,
+    interpolation_function) are set but the raw data members are not.
+    """
+    
+    def set_prepared(self,
+                     p_lat_basis,
+                     p_lon_basis,
+                     p_z_interped,
+                     p_spline_arrays = None):
+        """
+        z_interped is indexed [lon,lat], as in Bathymetry_CHS_10_100.
+        If p_spline_arrays (see Bathymetry.spline_arrays) is not passed
+        the spline is fitted over the grid.
+        """
+        self.lat_basis_trimmed = p_lat_basis
+        self.lon_basis_trimmed = p_lon_basis
+        self.z_interped = p_z_interped
+        self.lats_selection = p_lat_basis
+        self.lons_selection = p_lon_basis
+        self.z_selection = p_z_interped
+        if p_spline_arrays is None:
+            self.interpolate_bathy()
+        else:
+            self.interpolation_function = spline_from_arrays(p_spline_arrays)
+    
+    def load_prepared(self,p_fname):
+        """
+        Restore what Bathymetry.save_prepared wrote, without re-fitting.
+        """
+        with np.load(p_fname) as data:
+            spline = dict()
+            for key in ['tx','ty','c','kx','ky']:
+                spline[key] = data['spline_' + key]
+            self.set_prepared(data['lat_basis'],
+                              data['lon_basis'],
+                              data['z_interped'],
+                              spline)
+            self.depth_index = Depth_Index.from_arrays(
+                dict([(key[len('index_'):],data[key]) 
+                      for key in data.files if key.startswith('index_')]))
+            
+
+def spline_from_arrays(p_spline_arrays):
+    """
+    Rebuild a bivariate spline from stored knots and coefficients.
+    No fitting is done so this is cheap for any grid size.
+    """
+    return Stored_Spline(p_spline_arrays['tx'],
+                         p_spline_arrays['ty'],
+                         p_spline_arrays['c'],
+                         p_spline_arrays['kx'],
+                         p_spline_arrays['ky'])
+
+
+class Stored_Spline():
+    """
+    A bivariate spline held as its knots, coefficients and degrees, with
+    the parts of the interpolate.RectBivariateSpline interface the
+    bathymetry uses: calling on a grid or on points, get_knots, get_coeffs
+    and degrees.
+    
+    Grids are evaluated with interpolate.bisplev, points with
+    interpolate.NdBSpline (the same tensor product B-spline).
+    """
+    
+    def __init__(self,p_tx,p_ty,p_c,p_kx,p_ky):
+        self.tck = (np.asarray(p_tx,dtype=float),
+                    np.asarray(p_ty,dtype=float),
+                    np.asarray(p_c,dtype=float),
+                    int(p_kx),
+                    int(p_ky))
+        self._points = None
+        
+    @property
+    def degrees(self):
+        return self.tck[3], self.tck[4]
+    
+    def get_knots(self):
+        return self.tck[0], self.tck[1]
+    
+    def get_coeffs(self):
+        return self.tck[2]
+    
+    def __call__(self,x,y,grid = True):
+        x = np.asarray(x,dtype=float)
+        y = np.asarray(y,dtype=float)
+        if grid:
+            x = np.atleast_1d(x)
+            y = np.atleast_1d(y)
+            z = interpolate.bisplev(x,y,self.tck)
+            return np.reshape(z,(len(x),len(y)))
+        return self.ev(x,y)
+    
+    def ev(self,x,y):
+        """
+        Values at the points (x[i],y[i]).
+        """
+        tx, ty, c, kx, ky = self.tck
+        if self._points is None:
+            self._points = interpolate.NdBSpline(
+                (tx,ty),
+                c.reshape(len(tx) - kx - 1,len(ty) - ky - 1),
+                (kx,ky))
+        # Clamped to the fitted domain, as FITPACK does for the grids.
+        x = np.clip(np.asarray(x,dtype=float),tx[kx],tx[len(tx) - kx - 1])
+        y = np.clip(np.asarray(y,dtype=float),ty[ky],ty[len(ty) - ky - 1])
+        x, y = np.broadcast_arrays(x,y)
+        return self._points(np.stack((x,y),axis = -1))
+
+
+class Depth_Index():
+    """
+    Min and max z per square tile of nodes of a regular [lon,lat] grid.
+    Tiles share their edge nodes, so every grid cell is inside one tile.
+    
+    Region and transect queries read only the tile summaries.
+    """
+    
+    def __init__(self,p_lat_0,p_lon_0,p_d_lat,p_d_lon,p_n_lat,p_n_lon,
+                 p_tile_size,p_z_min,p_z_max):
+        self.lat_0 = float(p_lat_0)
+        self.lon_0 = float(p_lon_0)
+        self.d_lat = float(p_d_lat)
+        self.d_lon = float(p_d_lon)
+        self.n_lat = int(p_n_lat)
+        self.n_lon = int(p_n_lon)
+        self.tile_size = int(p_tile_size)
+        self.z_min = np.asarray(p_z_min,dtype=float) # [tile lon, tile lat]
+        self.z_max = np.asarray(p_z_max,dtype=float)
+        
+    @staticmethod
+    def from_grid(p_lat_basis,p_lon_basis,p_z,p_tile_size = 32):
+        lat_basis = np.asarray(p_lat_basis,dtype=float)
+        lon_basis = np.asarray(p_lon_basis,dtype=float)
+        z = np.asarray(p_z,dtype=float)
+        T = int(p_tile_size)
+        n_i = max(int(np.ceil((len(lon_basis) - 1) / T)),1)
+        n_j = max(int(np.ceil((len(lat_basis) - 1) / T)),1)
+        z_min = np.full((n_i,n_j),np.nan)
+        z_max = np.full((n_i,n_j),np.nan)
+        for i in range(n_i):
+            for j in range(n_j):
+                block = z[i * T:i * T + T + 1,j * T:j * T + T + 1]
+                if np.any(np.isfinite(block)):
+                    z_min[i,j] = np.nanmin(block)
+                    z_max[i,j] = np.nanmax(block)
+        return Depth_Index(lat_basis[0],
+                           lon_basis[0],
+                           (lat_basis[-1] - lat_basis[0]) / max(len(lat_basis) - 1,1),
+                           (lon_basis[-1] - lon_basis[0]) / max(len(lon_basis) - 1,1),
+                           len(lat_basis),
+                           len(lon_basis),
+                           T,
+                           z_min,
+                           z_max)
+    
+    def to_arrays(self):
+        return {'geometry' : np.array([self.lat_0,self.lon_0,
+                                       self.d_lat,self.d_lon,
+                                       self.n_lat,self.n_lon,
+                                       self.tile_size],dtype=float),
+                'z_min' : self.z_min,
+                'z_max' : self.z_max}
+    
+    @staticmethod
+    def from_arrays(p_arrays):
+        g = p_arrays['geometry']
+        return Depth_Index(g[0],g[1],g[2],g[3],g[4],g[5],g[6],
+                           p_arrays['z_min'],p_arrays['z_max'])
+    
+    def tile_of(self,p_lats,p_lons):
+        """
+        Tile indices (i lon, j lat) of points, clipped to the grid.
+        """
+        i = np.floor((np.asarray(p_lons) - self.lon_0) / self.d_lon 
+                     / self.tile_size).astype(int)
+        j = np.floor((np.asarray(p_lats) - self.lat_0) / self.d_lat 
+                     / self.tile_size).astype(int)
+        return (np.clip(i,0,self.z_min.shape[0] - 1),
+                np.clip(j,0,self.z_min.shape[1] - 1))
+    
+    def region(self,p_lat_extent_tuple = None,p_lon_extent_tuple = None):
+        i0,i1 = 0,self.z_min.shape[0] - 1
+        j0,j1 = 0,self.z_min.shape[1] - 1
+        if p_lat_extent_tuple is not None:
+            _,(j0,j1) = self.tile_of(np.sort(p_lat_extent_tuple),[self.lon_0]*2)
+        if p_lon_extent_tuple is not None:
+            (i0,i1),_ = self.tile_of([self.lat_0]*2,np.sort(p_lon_extent_tuple))
+        return (np.nanmin(self.z_min[i0:i1+1,j0:j1+1]),
+                np.nanmax(self.z_max[i0:i1+1,j0:j1+1]))
+    
+    def along(self,p_rx_lat_lon_tuple,p_tx_lat_lon_tuple):
+        # enough points that no tile along the line is stepped over
+        span = max(
+            abs(p_tx_lat_lon_tuple[0] - p_rx_lat_lon_tuple[0]) / self.d_lat,
+            abs(p_tx_lat_lon_tuple[1] - p_rx_lat_lon_tuple[1]) / self.d_lon)
+        n = int(np.ceil(2 * span / self.tile_size)) + 2
+        lats = np.linspace(p_tx_lat_lon_tuple[0],p_rx_lat_lon_tuple[0],n)
+        lons = np.linspace(p_tx_lat_lon_tuple[1],p_rx_lat_lon_tuple[1],n)
+        i,j = self.tile_of(lats,lons)
+        return (np.nanmin(self.z_min[i,j]),np.nanmax(self.z_max[i,j]))
+
+
+def transect_bases(p_rx_lat_lon_tuple,p_tx_lats,p_tx_lons,p_n):
+    """
+    The lat and lon sample points of transects from one receiver to many
+    sources, p_n points each, as two (n_sources x p_n) arrays.
+
+    Each basis runs south to north and west to east, whichever end the
+    receiver is at (the ordering create_basis_common has always used).
+    """
+    tx_lats = np.atleast_1d(np.asarray(p_tx_lats,dtype=float))
+    tx_lons = np.atleast_1d(np.asarray(p_tx_lons,dtype=float))
+    rx_lats = np.full_like(tx_lats,p_rx_lat_lon_tuple[0])
+    rx_lons = np.full_like(tx_lons,p_rx_lat_lon_tuple[1])
+    lat_bases = np.linspace(np.minimum(rx_lats,tx_lats),
+                            np.maximum(rx_lats,tx_lats),
+                            num=p_n,
+                            axis=-1)
+    lon_bases = np.linspace(np.minimum(rx_lons,tx_lons),
+                            np.maximum(rx_lons,tx_lons),
+                            num=p_n,
+                            axis=-1)
+    return lat_bases, lon_bases
+
+        
 # Test the module as top level script
 if __name__ == '__main__':
     from locations import Location
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Location bundles: the fully prepared inputs for one location in one file.
+
+Preparing a location (reading the raw bathymetry, gridding, trimming,
+fitting the spline, evaluating the SSP and reading the sediment table) is
+the same work every run. bake_environment_bundle writes the result of
+that work to a single versioned .npz file, and Location_Bundle rebuilds
+the Location, Bathymetry, SSP and SeaBed objects from it without any
+re-gridding or re-fitting.
+"""
+
+import json
+import time
+
+import numpy as np
+
+from UWAEnvTools.bathymetry import Bathymetry_Prepared
+from UWAEnvTools.locations import Location
+from UWAEnvTools.ssp import SSP
+from UWAEnvTools.seabed import SeaBed
+
+
+BUNDLE_VERSION = 1
+
+
+class Bundle_Error(Exception):
+    pass
+
+
+def bake_location_bundle(p_fname,
+                         p_location,
+                         p_bathymetry,
+                         p_ssp,
+                         p_bottom_profile):
+    """
+    Write the prepared state to p_fname (.npz).
+
+    p_bathymetry must have been trimmed and fitted (lat_basis_trimmed,
+    lon_basis_trimmed, z_interped, interpolation_function).
+    p_ssp must have its depths and profiles set (read_profile called).
+    p_bottom_profile must have read its dictionary and been assigned a type.
+    """
+    arrays = dict()
+    arrays['lat_basis'] = np.asarray(p_bathymetry.lat_basis_trimmed)
+    arrays['lon_basis'] = np.asarray(p_bathymetry.lon_basis_trimmed)
+    arrays['z_interped'] = np.asarray(p_bathymetry.z_interped)
+    for key,value in p_bathymetry.spline_arrays().items():
+        arrays['spline_' + key] = np.asarray(value)
+
+    arrays['ssp_depths'] = np.asarray(p_ssp.depths,dtype=float)
+    seasons = sorted(p_ssp.dict.keys())
+    for season in seasons:
+        arrays['ssp_' + season] = np.asarray(p_ssp.dict[season],dtype=float)
+
+    meta = dict()
+    meta['version'] = BUNDLE_VERSION
+    meta['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    meta['location'] = _location_to_dict(p_location)
+    meta['bathymetry_class'] = type(p_bathymetry).__name__
+    meta['ssp_class'] = type(p_ssp).__name__
+    meta['ssp_source'] = str(p_ssp.source)
+    meta['ssp_seasons'] = seasons
+    meta['bottom_id'] = p_location.bottom_id
+    meta['sediment'] = p_bottom_profile.sediment_dictionary[p_location.bottom_id]
+    arrays['meta'] = np.array(json.dumps(meta))
+
+    np.savez(p_fname,**arrays)
+
+
+def bake_environment_bundle(p_fname,p_env):
+    """
+    Bake from an environment that has had its location, bathymetry, SSP
+    and seabed set up the usual way.
+    """
+    bake_location_bundle(p_fname,
+                         p_env.location,
+                         p_env.bathymetry,
+                         p_env.ssp,
+                         p_env.bottom_profile)
+
+
+def _location_to_dict(p_location):
+    result = dict()
+    for key,value in p_location.__dict__.items():
+        if isinstance(value,(str,int,float,tuple,list)):
+            result[key] = value
+    return result
+
+
+def _location_from_dict(p_dict):
+    # Location.__init__ needs one of its known strings, bypass it.
+    location = Location.__new__(Location)
+    for key,value in p_dict.items():
+        if isinstance(value,list):
+            value = tuple(value)
+        setattr(location,key,value)
+    return location
+
+
+class Location_Bundle():
+    """
+    The prepared inputs for a location, loaded from a baked bundle.
+
+    Members: location, bathymetry, ssp, bottom_profile, meta.
+    """
+
+    def __init__(self,p_fname,p_bathymetry = None):
+        """
+        p_bathymetry : optional, the bundle's bathymetry already prepared
+            elsewhere (e.g. attached with shared.attach_bathymetry), used
+            in place of reading the grid from the file.
+        """
+        self.fname = p_fname
+        self.load(p_fname,p_bathymetry)
+
+    def load(self,p_fname,p_bathymetry = None):
+        with np.load(p_fname,allow_pickle = False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta['version'] != BUNDLE_VERSION:
+                raise Bundle_Error(
+                    'Bundle ' + str(p_fname) + ' is version ' \
+                        + str(meta['version']) + ', expected ' \
+                        + str(BUNDLE_VERSION) + '. Re-bake it.')
+            self.meta = meta
+            self.location = _location_from_dict(meta['location'])
+
+            if p_bathymetry is None:
+                spline = dict()
+                for key in ['tx','ty','c','kx','ky']:
+                    spline[key] = data['spline_' + key]
+                p_bathymetry = Bathymetry_Prepared()
+                p_bathymetry.set_prepared(data['lat_basis'],
+                                          data['lon_basis'],
+                                          data['z_interped'],
+                                          spline)
+            self.bathymetry = p_bathymetry
+
+            self.ssp = SSP()
+            self.ssp.depths = data['ssp_depths']
+            for season in meta['ssp_seasons']:
+                self.ssp.dict[season] = data['ssp_' + season]
+            self.ssp.source = meta['ssp_source']
+
+        self.bottom_profile = SeaBed(self.bathymetry.lat_basis_trimmed,
+                                     self.bathymetry.lon_basis_trimmed,
+                                     self.bathymetry.z_interped)
+        self.bottom_profile.sediment_dictionary = \
+            {meta['bottom_id'] : meta['sediment']}
+        self.bottom_profile.assign_single_bottom_type(meta['bottom_id'])
+
+    def configure_environment(self,p_env):
+        """
+        Set the bathymetry, SSP and seabed of an environment from the
+        bundle. Use in place of set_bathymetry_common, set_ssp_common and
+        set_seabed_common.
+        """
+        p_env.set_location_common(self.location)
+        p_env.set_bathymetry_common(self.bathymetry)
+        p_env.ssp = self.ssp
+        p_env.set_ssp()
+        p_env.bottom_profile = self.bottom_profile
+        p_env.set_seabed()
+        return p_env
+
+    def make_environment(self,p_env_class,**kwargs):
+        """
+        A new environment of the passed class (e.g. Environment_RAM)
+        configured from the bundle. kwargs go to the class constructor.
+        """
+        env = p_env_class(self.location,**kwargs)
+        return self.configure_environment(env)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+CTD cast ingestion and a compact store of depth-binned casts.
+
+Casts are read concurrently, each normalized to a fixed depth bin grid,
+and kept as one (casts x bins) float32 matrix with the cast timestamp and
+position alongside. Means, percentiles and seasonal profiles are computed
+from that matrix in chunks; none of it plots. Plotting is in
+SSP_Measured.plot_ssps.
+"""
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from UWAEnvTools.backends import Lazy_Module
+
+pd = Lazy_Module('pandas')
+
+
+CTD_SKIP_ROWS = 28          # header lines in the Pat Bay CTD exports
+CTD_DEPTH_COLUMN = 1
+CTD_SOUND_SPEED_COLUMN = 6
+
+STORE_VERSION = 1
+
+
+def cast_timestamp(p_fname):
+    """
+    Pat Bay CTD files are named like <name>_<YYYYMMDD>_<HHMM>.csv
+    """
+    strs = os.path.basename(p_fname).split('_')
+    if len(strs) < 3:
+        return os.path.basename(p_fname)
+    return strs[1] + strs[2].split('.')[0]
+
+
+def cast_position(p_fname,p_skiprows = CTD_SKIP_ROWS):
+    """
+    Latitude and longitude from the file header, NaN if not present.
+    """
+    lat = np.nan
+    lon = np.nan
+    with open(p_fname,errors='ignore') as f:
+        for n in range(p_skiprows):
+            line = f.readline().lower()
+            if ('latitude' not in line) and ('longitude' not in line):
+                continue
+            try:
+                value = float(line.replace(',',' ').replace(':',' ') \
+                              .replace('=',' ').split()[-1])
+            except ValueError:
+                continue
+            if 'latitude' in line:
+                lat = value
+            else:
+                lon = value
+    return lat, lon
+
+
+def bin_cast(p_depths,p_values,p_depth_edges):
+    """
+    Mean of p_values in each depth bin, NaN for empty bins.
+    """
+    n_bins = len(p_depth_edges) - 1
+    index = np.digitize(p_depths,p_depth_edges) - 1
+    valid = (index >= 0) & (index < n_bins) & np.isfinite(p_values)
+    sums = np.bincount(index[valid],weights=p_values[valid],minlength=n_bins)
+    counts = np.bincount(index[valid],minlength=n_bins)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        binned = sums / counts
+    binned[counts == 0] = np.nan
+    return binned
+
+
+def read_cast(p_fname,
+              p_depth_edges,
+              p_skiprows = CTD_SKIP_ROWS,
+              p_depth_column = CTD_DEPTH_COLUMN,
+              p_value_column = CTD_SOUND_SPEED_COLUMN):
+    df = pd.read_csv(p_fname,skiprows = p_skiprows)
+    depths = np.asarray(df[df.columns[p_depth_column]],dtype=float)
+    values = np.asarray(df[df.columns[p_value_column]],dtype=float)
+    lat, lon = cast_position(p_fname,p_skiprows)
+    return {'fname' : os.path.basename(p_fname),
+            'time' : cast_timestamp(p_fname),
+            'lat' : lat,
+            'lon' : lon,
+            'binned' : bin_cast(depths,values,p_depth_edges)}
+
+
+class CTD_Cast_Store():
+    """
+    Depth-binned casts, sorted by timestamp.
+
+    speeds : n_casts x n_bins float32, NaN where a cast has no data
+    times, lats, lons, fnames : per cast
+    depth_edges, depths (bin centres)
+    """
+
+    def __init__(self,p_bin_size = 0.5,p_max_depth = 200.):
+        self.depth_edges = np.arange(0,p_max_depth + p_bin_size,p_bin_size)
+        self.depths = 0.5 * (self.depth_edges[1:] + self.depth_edges[:-1])
+        self.speeds = np.zeros((0,len(self.depths)),dtype=np.float32)
+        self.times = np.array([],dtype=str)
+        self.lats = np.array([])
+        self.lons = np.array([])
+        self.fnames = np.array([],dtype=str)
+
+    def __len__(self):
+        return self.speeds.shape[0]
+
+    def ingest(self,
+               p_source_dir,
+               p_filter = '',
+               p_n_workers = 8,
+               **kwargs):
+        """
+        Read every csv in p_source_dir with p_filter in its name (skipping
+        previously written means) concurrently, and add them to the store.
+        kwargs go to read_cast.
+
+        Returns the number of casts added.
+        """
+        files = [os.path.join(p_source_dir,f)
+                 for f in sorted(os.listdir(p_source_dir))
+                 if (p_filter in f) and ('mean' not in f)
+                 and f.lower().endswith('.csv')]
+        if len(files) == 0:
+            return 0
+        with ThreadPoolExecutor(max_workers = p_n_workers) as pool:
+            casts = list(pool.map(
+                lambda f : read_cast(f,self.depth_edges,**kwargs),
+                files))
+        self.add_casts(casts)
+        return len(casts)
+
+    def add_casts(self,p_casts):
+        speeds = np.array([c['binned'] for c in p_casts],dtype=np.float32)
+        self.speeds = np.concatenate((self.speeds,speeds))
+        self.times = np.concatenate((self.times,[c['time'] for c in p_casts]))
+        self.lats = np.concatenate((self.lats,[c['lat'] for c in p_casts]))
+        self.lons = np.concatenate((self.lons,[c['lon'] for c in p_casts]))
+        self.fnames = np.concatenate((self.fnames,[c['fname'] for c in p_casts]))
+        order = np.argsort(self.times,kind='stable')
+        self.speeds = self.speeds[order]
+        self.times = self.times[order]
+        self.lats = self.lats[order]
+        self.lons = self.lons[order]
+        self.fnames = self.fnames[order]
+
+    def save(self,p_fname):
+        meta = {'version' : STORE_VERSION}
+        np.savez(p_fname,
+                 meta = np.array(json.dumps(meta)),
+                 depth_edges = self.depth_edges,
+                 speeds = self.speeds,
+                 times = self.times,
+                 lats = self.lats,
+                 lons = self.lons,
+                 fnames = self.fnames)
+
+    @staticmethod
+    def load(p_fname):
+        store = CTD_Cast_Store()
+        with np.load(p_fname,allow_pickle = False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta['version'] != STORE_VERSION:
+                raise ValueError('CTD_Cast_Store: unsupported store version '\
+                                 + str(meta['version']))
+            store.depth_edges = data['depth_edges']
+            store.depths = 0.5 * (store.depth_edges[1:] + store.depth_edges[:-1])
+            store.speeds = data['speeds']
+            store.times = data['times']
+            store.lats = data['lats']
+            store.lons = data['lons']
+            store.fnames = data['fnames']
+        return store
+
+    def select(self,
+               p_time_filter = '',
+               p_months = None,
+               p_lat_tuple = None,
+               p_lon_tuple = None):
+        """
+        Boolean mask over casts. p_time_filter is a substring of the
+        timestamp (e.g. '2019'), p_months a list of month numbers.
+        Casts without a position are kept by the lat/lon filters.
+        """
+        mask = np.array([p_time_filter in t for t in self.times],dtype=bool)
+        if p_months is not None:
+            months = np.array([int(t[4:6]) if t[:6].isdigit() else -1
+                               for t in self.times])
+            mask = mask & np.isin(months,p_months)
+        if p_lat_tuple is not None:
+            mask = mask & ~((self.lats < p_lat_tuple[0]) | (self.lats > p_lat_tuple[1]))
+        if p_lon_tuple is not None:
+            mask = mask & ~((self.lons < p_lon_tuple[0]) | (self.lons > p_lon_tuple[1]))
+        return mask
+
+    def mean(self,p_mask = None,p_chunk = 1024):
+        """
+        Per-bin mean and standard deviation over the selected casts,
+        accumulated in chunks of casts. Bins with no data are NaN.
+        """
+        rows = self._rows(p_mask)
+        n_bins = len(self.depths)
+        sums = np.zeros(n_bins)
+        squares = np.zeros(n_bins)
+        counts = np.zeros(n_bins)
+        for start in range(0,len(rows),p_chunk):
+            block = self.speeds[rows[start:start+p_chunk]].astype(float)
+            finite = np.isfinite(block)
+            block = np.where(finite,block,0.)
+            sums = sums + block.sum(axis=0)
+            squares = squares + (block ** 2).sum(axis=0)
+            counts = counts + finite.sum(axis=0)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean = sums / counts
+            std = np.sqrt(np.maximum(squares / counts - mean ** 2,0.))
+        mean[counts == 0] = np.nan
+        std[counts == 0] = np.nan
+        return mean, std
+
+    def percentile(self,p_q,p_mask = None):
+        """
+        Per-bin percentile(s) over the selected casts, ignoring NaN.
+        """
+        rows = self._rows(p_mask)
+        if len(rows) == 0:
+            return np.full((np.size(p_q),len(self.depths)),np.nan).squeeze()
+        import warnings
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',RuntimeWarning) # all-NaN bins
+            return np.nanpercentile(self.speeds[rows].astype(float),p_q,axis=0)
+
+    def seasonal_profiles(self,p_mask = None):
+        """
+        Mean profile per calendar month present, keyed by month number.
+        """
+        if p_mask is None:
+            p_mask = np.ones(len(self),dtype=bool)
+        result = dict()
+        for month in range(1,13):
+            mask = p_mask & self.select(p_months = [month])
+            if np.any(mask):
+                result[month] = self.mean(mask)[0]
+        return result
+
+    def _rows(self,p_mask):
+        if p_mask is None:
+            return np.arange(len(self))
+        return np.nonzero(p_mask)[0]
@@ -5,6 +5,8 @@ Created on Mon Apr 24 10:16:25 2023
 @author: Jasper
 """
 
+import os
+
 FNAME_BOTTOM_TYPE_DICTIONARY = \
     r'C:/Users/Jasper/Documents/Repo/pyDal/UWAEnvTools/data/seabed_numbers_from_saleh_rabah.txt'
     
@@ -22,3 +24,10 @@ FNAME_GEBCO_FERGUSON_10M = \
 
 
 
+
+# pyat is not pip installable, backends.py imports pyat.pyat.env from a
+# local checkout. UWAENVTOOLS_PYAT_DIR names the directory to put on
+# sys.path for that, the default is the original author's.
+DIR_PYAT = os.environ.get(
+    'UWAENVTOOLS_PYAT_DIR',
+    r'C:\Users\Jasper\Desktop\MASC\python-packages\pyat')
@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+"""
+Batch runs spread over several hosts through a shared task queue.
+
+A run is split in to tasks of one (location, receiver, frequency, chunk of
+source points) each. Any number of workers, on any host that sees the
+queue and the result directory, pull tasks, run them and write the rows
+to a part file of the result, keyed by the task. Once the queue is done
+the parts are merged in to the usual result files (Result_Store):
+
+    # where the run is set up
+    env = Location_Bundle(bundle_fname).make_environment(Environment_RAM)
+    ... # hydrophone, receiver, source, freqs, dr, output as usual
+    queue = Directory_Queue('/shared/queue')
+    submit(queue,make_tasks(env,bundle_fname,p_chunk_size = 500,
+                            POINT_OR_LINE_STR = 'LINE',
+                            BASIS_SIZE_DEPTH = 100,
+                            BASIS_SIZE_DISTANCE = 100))
+
+    # on each host, as many as wanted (--processes N to run N worker
+    # processes sharing one copy of the bathymetry)
+    python -m UWAEnvTools.distributed worker /shared/queue
+
+    # once status shows nothing pending or claimed
+    python -m UWAEnvTools.distributed merge /shared/queue
+
+The bundle and the model save directory must be at the same path on every
+host. Task ids are hashes of the environment, frequency and sources, so
+submitting the same run twice adds nothing, and a task that is run twice
+(after its worker was presumed dead) writes the same part file again.
+
+Recovery: a claimed task carries a lease, renewed by its worker while the
+task runs. Workers put tasks whose lease has run out back in the queue
+when they look for work, up to p_max_attempts claims per task, after
+which the task goes to the failed state with its last error.
+
+Task_Queue is the interface; Directory_Queue keeps each task as a JSON
+file in a directory per state and claims by atomic rename, so it needs
+nothing but a shared (POSIX rename atomic) file system. Each claim gets
+its own file name, so an expired lease can only ever requeue the claim
+it was read from, never a newer claim of the same task.
+"""
+
+import os
+import sys
+import abc
+import json
+import time
+import uuid
+import socket
+import argparse
+import threading
+import multiprocessing
+
+from UWAEnvTools.backends import Lazy_Module
+from UWAEnvTools.bundle import Location_Bundle
+from UWAEnvTools.guard import classify
+from UWAEnvTools.results import Result_Store, hash_items, source_key
+from UWAEnvTools.shared import Shared_Bathymetry
+from UWAEnvTools.workers import Environment_Cache, environment_spec
+
+pd = Lazy_Module('pandas')
+
+
+STATE_PENDING = 'pending'
+STATE_CLAIMED = 'claimed'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+STATES = (STATE_PENDING,STATE_CLAIMED,STATE_DONE,STATE_FAILED)
+
+
+def make_tasks(p_env,
+               p_bundle_fname,
+               p_chunk_size = 500,
+               p_incremental = True,
+               p_store = None,
+               **kwargs):
+    """
+    The tasks of p_env.calculate_exact_TLs(**kwargs): every frequency of
+    p_env times chunks of p_chunk_size points of its valid course. p_env
+    must have been configured from p_bundle_fname.
+
+    With p_incremental, source points already in the result file or its
+    parts for the same environment are left out.
+    """
+    if p_store is None:
+        p_store = Result_Store()
+    spec = environment_spec(p_env,p_bundle_fname)
+    env_hash = p_env.environment_hash(**kwargs)
+    course = [(float(tx[0]),float(tx[1]))
+              for tx in p_env.source.valid_course(p_env.rx_latlon)]
+    tasks = []
+    for freq in p_env.freqs:
+        result_fname = os.path.abspath(p_env.results_fname(freq))
+        todo = course
+        if p_incremental:
+            done = p_store.completed_sources(result_fname,env_hash)
+            done.update(p_store.part_sources(result_fname,env_hash))
+            todo = [tx for tx in course if source_key(tx[0],tx[1]) not in done]
+        for n in range(0,len(todo),p_chunk_size):
+            sources = todo[n:n + p_chunk_size]
+            tasks.append({'id' : hash_items(env_hash,float(freq),sources),
+                          'spec' : spec,
+                          'freq' : freq,
+                          'sources' : sources,
+                          'env_hash' : env_hash,
+                          'kwargs' : kwargs,
+                          'result_fname' : result_fname,
+                          'attempts' : 0})
+    return tasks
+
+
+def submit(p_queue,p_tasks):
+    """
+    Put the tasks in the queue. Returns the number actually added (tasks
+    already queued, running or done are skipped, failed ones are queued
+    again).
+    """
+    return sum([1 for task in p_tasks if p_queue.put(task)])
+
+
+class Task_Queue(abc.ABC):
+    """
+    The queue interface the runner uses. Tasks are JSON-able dictionaries
+    with an 'id'.
+    """
+
+    @abc.abstractmethod
+    def put(self,p_task):
+        """
+        Add a task unless its id is already pending, claimed or done.
+        A failed task with the id is replaced. Returns True if added.
+        """
+        pass
+
+    @abc.abstractmethod
+    def claim(self,p_worker_id):
+        """
+        Take the next pending task (after requeueing expired leases), or
+        None if there is none.
+        """
+        pass
+
+    @abc.abstractmethod
+    def heartbeat(self,p_task):
+        """
+        Renew the lease. Returns False if the task is no longer ours.
+        """
+        pass
+
+    @abc.abstractmethod
+    def complete(self,p_task,**kwargs):
+        pass
+
+    @abc.abstractmethod
+    def fail(self,p_task,p_error):
+        """
+        Back to pending if attempts remain, else to failed.
+        """
+        pass
+
+    @abc.abstractmethod
+    def requeue_expired(self):
+        pass
+
+    @abc.abstractmethod
+    def counts(self):
+        """
+        Number of tasks in each state.
+        """
+        pass
+
+    @abc.abstractmethod
+    def tasks(self,p_state):
+        pass
+
+
+def _to_json(p_value):
+    # numpy scalars and arrays
+    if hasattr(p_value,'tolist'):
+        return p_value.tolist()
+    return str(p_value)
+
+
+def _write_json(p_fname,p_dict):
+    with open(p_fname + '.tmp','w') as f:
+        json.dump(p_dict,f,default=_to_json)
+    os.replace(p_fname + '.tmp',p_fname)
+
+
+def _read_json(p_fname):
+    with open(p_fname) as f:
+        return json.load(f)
+
+
+class Directory_Queue(Task_Queue):
+    """
+    <p_dir>/pending, claimed, done and failed, one JSON file per task:
+    <id>.json, except in claimed where it is <id>@<claim>.json with a new
+    claim token for every claim. The lease of a claimed task is the
+    modification time of its file.
+    """
+
+    def __init__(self,
+                 p_dir,
+                 p_lease_s = 600,
+                 p_max_attempts = 3):
+        self.dir = p_dir
+        self.lease_s = p_lease_s
+        self.max_attempts = p_max_attempts
+        for state in STATES:
+            os.makedirs(os.path.join(p_dir,state),exist_ok=True)
+
+    def _fname(self,p_state,p_task_id):
+        return os.path.join(self.dir,p_state,p_task_id + '.json')
+
+    def _claim_fname(self,p_task):
+        return os.path.join(self.dir,STATE_CLAIMED,
+                            p_task['id'] + '@' + p_task['claim'] + '.json')
+
+    def _names(self,p_state):
+        return sorted([f for f in os.listdir(os.path.join(self.dir,p_state))
+                       if f.endswith('.json')])
+
+    def _is_claimed(self,p_task_id):
+        prefix = p_task_id + '@'
+        return any([name.startswith(prefix) 
+                    for name in self._names(STATE_CLAIMED)])
+
+    def put(self,p_task):
+        for state in (STATE_PENDING,STATE_DONE):
+            if os.path.exists(self._fname(state,p_task['id'])):
+                return False
+        if self._is_claimed(p_task['id']):
+            return False
+        _write_json(self._fname(STATE_PENDING,p_task['id']),p_task)
+        try:
+            os.remove(self._fname(STATE_FAILED,p_task['id']))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def claim(self,p_worker_id):
+        self.requeue_expired()
+        for name in self._names(STATE_PENDING):
+            task_id = name[:-len('.json')]
+            pending = self._fname(STATE_PENDING,task_id)
+            claim = uuid.uuid4().hex[:16]
+            fname = os.path.join(self.dir,STATE_CLAIMED,
+                                 task_id + '@' + claim + '.json')
+            try:
+                # Start the lease before the rename, so the task never sits
+                # in claimed with the old time of its pending file.
+                os.utime(pending)
+                # only one of the workers racing for a task gets it
+                os.rename(pending,fname)
+                task = _read_json(fname)
+            except FileNotFoundError:
+                continue
+            task['attempts'] = task.get('attempts',0) + 1
+            task['worker'] = p_worker_id
+            task['claim'] = claim
+            if task['attempts'] > self.max_attempts:
+                self._move(task,fname,STATE_FAILED)
+                continue
+            _write_json(fname,task)
+            return task
+        return None
+
+    def heartbeat(self,p_task):
+        try:
+            os.utime(self._claim_fname(p_task))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _move(self,p_task,p_from_fname,p_to):
+        task = dict(p_task)
+        task.pop('claim',None)
+        _write_json(self._fname(p_to,task['id']),task)
+        try:
+            os.remove(p_from_fname)
+        except FileNotFoundError:
+            pass
+
+    def complete(self,p_task,**kwargs):
+        task = dict(p_task)
+        task.update(kwargs)
+        task['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        self._move(task,self._claim_fname(p_task),STATE_DONE)
+
+    def fail(self,p_task,p_error):
+        task = dict(p_task)
+        task['error'] = type(p_error).__name__ + ': ' + str(p_error)
+        task['error_kind'] = classify(p_error)
+        if task.get('attempts',0) < self.max_attempts:
+            self._move(task,self._claim_fname(p_task),STATE_PENDING)
+        else:
+            self._move(task,self._claim_fname(p_task),STATE_FAILED)
+
+    def requeue_expired(self):
+        """
+        Put claimed tasks whose lease has run out back to pending.
+        Returns how many.
+        
+        The rename is of the expired claim's own file, so a claim of the
+        same task made since (another requeue, then a claim) is untouched.
+        """
+        n = 0
+        now = time.time()
+        for name in self._names(STATE_CLAIMED):
+            fname = os.path.join(self.dir,STATE_CLAIMED,name)
+            task_id = name[:-len('.json')].split('@')[0]
+            try:
+                if now - os.path.getmtime(fname) < self.lease_s:
+                    continue
+                os.rename(fname,self._fname(STATE_PENDING,task_id))
+                n = n + 1
+            except FileNotFoundError: # finished or requeued meanwhile
+                continue
+        return n
+
+    def counts(self):
+        return dict([(state,len(self._names(state))) for state in STATES])
+
+    def tasks(self,p_state):
+        result = []
+        for name in self._names(p_state):
+            try:
+                result.append(_read_json(os.path.join(self.dir,p_state,name)))
+            except FileNotFoundError:
+                continue
+        return result
+
+
+class _Heartbeat():
+    """
+    Renews a task's lease from a background thread while it runs.
+    """
+
+    def __init__(self,p_queue,p_task,p_interval_s):
+        self.queue = p_queue
+        self.task = p_task
+        self.interval_s = p_interval_s
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target = self._run,daemon = True)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval_s):
+            if not self.queue.heartbeat(self.task):
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self,*args):
+        self.stop_event.set()
+        self.thread.join()
+        return False
+
+
+def run_task(p_task,p_cache,p_store = None,p_guard = None):
+    """
+    Run one task and write its part file. Returns the number of rows.
+    """
+    if p_store is None:
+        p_store = Result_Store()
+    kwargs = p_task['kwargs']
+    env, _ = p_cache.checked_environment(p_task['spec'],
+                                         p_task['env_hash'],
+                                         kwargs)
+    env.set_guard(p_guard)
+    course = [tuple(tx) for tx in p_task['sources']]
+    env.prepare_transects([course],kwargs['BASIS_SIZE_DISTANCE'])
+    TL_RES = env.run_transects(p_task['freq'],course,p_task['env_hash'],**kwargs)
+    df = pd.DataFrame(data = TL_RES.to_dict())
+    p_store.write_part(p_task['result_fname'],p_task['id'],df,p_task['env_hash'])
+    return len(df)
+
+
+def default_worker_id():
+    return socket.gethostname() + ':' + str(os.getpid())
+
+
+def run_worker(p_queue,
+               p_worker_id = None,
+               p_poll_s = 5.,
+               p_max_tasks = None,
+               p_guard = None,
+               p_shared_bathymetry = None):
+    """
+    Claim and run tasks until nothing is pending or claimed (or
+    p_max_tasks are done). While other workers hold tasks, keep polling,
+    so their tasks are picked up if their leases run out.
+    
+    p_shared_bathymetry : optional, as for workers.Environment_Cache.
+
+    Returns the number of tasks completed.
+    """
+    if p_worker_id is None:
+        p_worker_id = default_worker_id()
+    cache = Environment_Cache(p_shared_bathymetry)
+    store = Result_Store()
+    interval_s = max(getattr(p_queue,'lease_s',60) / 3.,1.)
+    n_done = 0
+    while p_max_tasks is None or n_done < p_max_tasks:
+        task = p_queue.claim(p_worker_id)
+        if task is None:
+            counts = p_queue.counts()
+            if counts[STATE_PENDING] == 0 and counts[STATE_CLAIMED] == 0:
+                break
+            time.sleep(p_poll_s)
+            continue
+        start = time.perf_counter()
+        try:
+            with _Heartbeat(p_queue,task,interval_s):
+                n_rows = run_task(task,cache,store,p_guard)
+        except Exception as e:
+            print(p_worker_id + ': task ' + task['id'] + ' failed, ' \
+                  + type(e).__name__ + ': ' + str(e))
+            p_queue.fail(task,e)
+            continue
+        p_queue.complete(task,
+                         n_rows = n_rows,
+                         wall_s = time.perf_counter() - start)
+        n_done = n_done + 1
+    return n_done
+
+
+def run_workers(p_queue,
+                p_n_workers,
+                p_poll_s = 5.,
+                p_max_tasks = None):
+    """
+    p_n_workers run_worker processes on this host. The bathymetry of each
+    bundle of the queued tasks is published once in shared memory
+    (shared.py) and attached by every worker, rather than each loading
+    its own copy. p_max_tasks is per worker.
+
+    Returns the number of tasks completed.
+    """
+    bundles = set()
+    for state in (STATE_PENDING,STATE_CLAIMED):
+        for task in p_queue.tasks(state):
+            bundles.add(task['spec']['bundle'])
+    shared = []
+    try:
+        descriptors = dict()
+        for fname in sorted(bundles):
+            shared.append(Shared_Bathymetry())
+            descriptors[fname] = shared[-1].publish(
+                Location_Bundle(fname).bathymetry)
+        with multiprocessing.Pool(p_n_workers) as pool:
+            results = [pool.apply_async(run_worker,
+                                        (p_queue,),
+                                        {'p_poll_s' : p_poll_s,
+                                         'p_max_tasks' : p_max_tasks,
+                                         'p_shared_bathymetry' : descriptors})
+                       for n in range(p_n_workers)]
+            return sum([result.get() for result in results])
+    finally:
+        for item in shared:
+            item.close()
+
+
+def merge_results(p_queue,p_store = None):
+    """
+    Merge the part files of every done task in to its result file.
+    Run once the queue has drained. Returns {result file : rows}.
+    """
+    if p_store is None:
+        p_store = Result_Store()
+    targets = set()
+    for task in p_queue.tasks(STATE_DONE):
+        targets.add((task['result_fname'],task['env_hash']))
+    result = dict()
+    for fname,env_hash in sorted(targets):
+        df = p_store.merge_parts(fname,env_hash)
+        result[fname] = 0 if df is None else len(df)
+    return result
+
+
+def main(p_args = None):
+    parser = argparse.ArgumentParser(
+        description = 'Work on, merge or inspect a directory task queue.')
+    parser.add_argument('command',choices = ['worker','merge','status'])
+    parser.add_argument('queue_dir')
+    parser.add_argument('--lease',type = float,default = 600.)
+    parser.add_argument('--max-attempts',type = int,default = 3)
+    parser.add_argument('--poll',type = float,default = 5.)
+    parser.add_argument('--max-tasks',type = int,default = None)
+    parser.add_argument('--processes',type = int,default = 1,
+                        help = 'worker processes, sharing the bathymetry')
+    args = parser.parse_args(p_args)
+
+    queue = Directory_Queue(args.queue_dir,args.lease,args.max_attempts)
+    if args.command == 'worker':
+        if args.processes > 1:
+            n = run_workers(queue,args.processes,args.poll,args.max_tasks)
+        else:
+            n = run_worker(queue,p_poll_s = args.poll,p_max_tasks = args.max_tasks)
+        print(default_worker_id() + ': ' + str(n) + ' tasks done')
+    elif args.command == 'merge':
+        for fname,n_rows in merge_results(queue).items():
+            print(fname + ': ' + str(n_rows) + ' rows')
+    else:
+        print(queue.counts())
+        for task in queue.tasks(STATE_FAILED):
+            print(task['id'] + ': ' + str(task.get('error')))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -5,33 +5,29 @@ Created on Thu Oct 21 12:11:39 2021
 @author: Jasper
 """
 
-import sys
 import ast
+import time
 import numpy as np
-import pandas as pd
-from scipy import interpolate
-import matplotlib.pyplot as plt
-
-import geopy.distance as Distance
 
 import UWAEnvTools.bathymetry as bathymetry
 import UWAEnvTools.seabed as seabed
 import UWAEnvTools.surface as surface
 import UWAEnvTools.directories_and_files as _dirs
+import UWAEnvTools.backends as backends
+import UWAEnvTools.instrument as instrument
+import UWAEnvTools.events as events
+from UWAEnvTools.guard import failure_key
+from UWAEnvTools.results import TL_Accumulator, Result_Store, \
+    Incremental_Planner, hash_items
 
+# The model packages (arlpy, pyat, pyram) come from backends.get_backend.
+# These are also only imported on first use, see backends.py.
+pd = backends.Lazy_Module('pandas')
+interpolate = backends.Lazy_Module('scipy.interpolate')
+plt = backends.Lazy_Module('matplotlib.pyplot')
+Distance = backends.Lazy_Module('geopy.distance')
 
 
-# ARL extra modules
-import arlpy.uwapm as pm
-import haversine
-
-# PYAT extra modules
-sys.path.insert(1,r'C:\Users\Jasper\Desktop\MASC\python-packages\pyat')
-import pyat.pyat.env
-
-# PyRAM includes
-from pyram.PyRAM import PyRAM
-
 def create_basis_common(bathy, #custom class in this module
                      rx_lat_lon_tuple,
                      tx_lat_lon_tuple,
@@ -42,40 +38,30 @@ def create_basis_common(bathy, #custom class in this module
         self.distances, self.z_interp in meters.
         """
         
-        # the basis needs to be arranged in increasing order, so some logic.
-        if rx_lat_lon_tuple[0] > tx_lat_lon_tuple[0]:
-            north_most = rx_lat_lon_tuple[0]
-            south_most = tx_lat_lon_tuple[0]
-        else:
-            north_most = tx_lat_lon_tuple[0]
-            south_most = rx_lat_lon_tuple[0]
-    
-        #Be careful of sign for lon: -180,180.
-        if rx_lat_lon_tuple[1] > tx_lat_lon_tuple[1]:
-            east_most = rx_lat_lon_tuple[1]
-            west_most = tx_lat_lon_tuple[1]
-        else:
-            east_most = tx_lat_lon_tuple[1]
-            west_most = rx_lat_lon_tuple[1]
-    
-    
-        lat_basis = np.linspace(south_most,north_most,num=BASIS_SIZE_distance)
-        lon_basis = np.linspace(west_most,east_most,num=BASIS_SIZE_distance)
-        z_interped = bathy.calculate_interp_bathy(
-            lat_basis,
-            lon_basis,
-            p_grid=False)
-        
-        #Calculate the distance this environment spans, this is where meters is set
-        basis_min = (min(lat_basis),min(lon_basis))
-        basis_max = (max(lat_basis),max(lon_basis))
-        total_distance = Distance.distance(
-            basis_min,
-            basis_max ).m
-        distances = np.arange(len(z_interped))
-        distances = distances * total_distance/(len(z_interped)-2)
+        with instrument.stage(instrument.STAGE_BASIS):
+            # the basis needs to be arranged in increasing order.
+            lat_bases, lon_bases = bathymetry.transect_bases(
+                rx_lat_lon_tuple,
+                tx_lat_lon_tuple[0],
+                tx_lat_lon_tuple[1],
+                BASIS_SIZE_distance)
+            lat_basis = lat_bases[0]
+            lon_basis = lon_bases[0]
+            z_interped = bathy.calculate_interp_bathy(
+                lat_basis,
+                lon_basis,
+                p_grid=False)
+        
+            #Calculate the distance this environment spans, this is where meters is set
+            basis_min = (min(lat_basis),min(lon_basis))
+            basis_max = (max(lat_basis),max(lon_basis))
+            total_distance = Distance.distance(
+                basis_min,
+                basis_max ).m
+            distances = np.arange(len(z_interped))
+            distances = distances * total_distance/(len(z_interped)-2)
             
-        depths = np.abs(np.linspace(0,np.max(z_interped),BASIS_SIZE_depth))
+            depths = np.abs(np.linspace(0,np.max(z_interped),BASIS_SIZE_depth))
         
         #distances in m, depths in m
         return total_distance,distances, z_interped, depths    
@@ -92,6 +78,9 @@ class Environment():
     but underlying environment will not change. Derived classes can implement
     methods for specific requirements.
     """
+    
+    EVENTS = None # progress events.Event_Stream, see set_event_stream
+    GUARD = None  # guard.Solver_Guard for the solver calls, see set_guard
         
     def __init__(self,
                  p_location,
@@ -124,11 +113,11 @@ class Environment():
     def set_ssp_common(self,p_ssp):
         """
         self.bathymetry must already be assigned before using this.
+        The deepest point comes from the bathymetry depth index, the 
+        spline is not evaluated over the grid.
         """
-        z = self.bathymetry.calculate_interp_bathy(
-            self.bathymetry.lat_basis_trimmed,
-            self.bathymetry.lon_basis_trimmed)
-        MAX_DEPTH = np.abs (np.min( z ) - 1)  # negative is below sea level.
+        z_min,_ = self.bathymetry.z_range_in_region()
+        MAX_DEPTH = np.abs (z_min - 1)  # negative is below sea level.
         p_ssp.set_depths(np.linspace(0, MAX_DEPTH+2, self.SSP_N_PTS))
         p_ssp.read_profile(self.location.ssp_file)
         self.ssp = p_ssp
@@ -136,13 +125,20 @@ class Environment():
         
         
     def set_seabed_common(
-            self            
+            self,
+            p_sediment_map = None
             ):
+        """
+        p_sediment_map is an optional seabed.Sediment_Map (or 
+        Sediment_Raster) of mapped zones, whose types are keys of the 
+        default dictionary. The location bottom_id fills any gaps.
+        """
         bottom_profile = seabed.SeaBed(self.bathymetry.lat_basis_trimmed,
                                 self.bathymetry.lon_basis_trimmed,
                                 self.bathymetry.z_interped)
         bottom_profile.read_default_dictionary()
         bottom_profile.assign_single_bottom_type(self.location.bottom_id)
+        bottom_profile.set_map(p_sediment_map)
         self.bottom_profile = bottom_profile
         self.set_seabed()
 
@@ -196,13 +192,153 @@ class Environment():
     
     def set_hydrophone_name(self,p_name):
         self.hydro_name = p_name
+        
+    def set_backend(self,p_name):
+        """
+        Name of the registered backend (see backends.py) the model is built
+        with. Each derived class has its own default.
+        """
+        self.BACKEND = p_name
+
+    def set_event_stream(self,p_stream):
+        """
+        An events.Event_Stream for per-transect progress of the model runs.
+        None falls back to the UWAENVTOOLS_EVENTS file, if set.
+        """
+        self.EVENTS = p_stream
+
+    def event_stream(self):
+        """
+        The stream set with set_event_stream, else the UWAENVTOOLS_EVENTS
+        file, else None.
+        """
+        if self.EVENTS is not None:
+            return self.EVENTS
+        return events.default_stream()
+
+    def progress(self,p_freq,p_n_points):
+        """
+        Progress tracker for one frequency over p_n_points transects.
+        """
+        stream = self.event_stream()
+        if stream is None:
+            return events.NULL_PROGRESS
+        return stream.progress(self.hydro_name,p_freq,p_n_points)
+
+    def set_guard(self,p_guard):
+        """
+        A guard.Solver_Guard to run each transect's solver call through
+        (timeouts, fallbacks, NaN for points given up on). None runs the
+        solver directly, failures then stop the run.
+        """
+        self.GUARD = p_guard
+
+    def hash_inputs(self,**kwargs):
+        """
+        Everything other than frequency and source point that the results
+        depend on. Derived classes add their model specific inputs.
+        """
+        inputs = dict()
+        inputs['class'] = type(self).__name__
+        inputs['location'] = self.location.location_title
+        inputs['hydrophone'] = self.hydro_name
+        inputs['rx_latlon'] = self.rx_latlon
+        inputs['rx_depth'] = self.rx_depth
+        inputs['tx_depth'] = self.source.depth
+        inputs['bathymetry'] = self.bathymetry.hash_inputs()
+        inputs['kwargs'] = kwargs
+        return inputs
+    
+    def environment_hash(self,**kwargs):
+        return hash_items(self.hash_inputs(**kwargs))
 
     
 class Environment_RAM(Environment):
     
+    # Which PyRAM outputs to keep, see set_output_params.
+    OUTPUT_LINE = 'LINE'    # TL Line only, the grids are never filled.
+    OUTPUT_GRID = 'GRID'    # TL Line and decimated TL and CP grids.
+    OUTPUT_FULL = 'FULL'    # everything at solver resolution (PyRAM default)
+    
+    BACKEND = 'pyram'
+    RAM_OUTPUT = OUTPUT_FULL
+    RAM_NDR = 1
+    RAM_NDZ = 1
+    RAM_ZMPLT = None
+    
+    # Range dependent SSP, see set_ssp_field. None uses self.ssp everywhere.
+    SSP_FIELD = None
+    SSP_FIELD_N_RANGES = 8
+    SSP_FIELD_SEASON = 'Summer'
+    
     def set_calc_params(self,
                         dr):
         self.DELTA_R_RAM = dr
+        
+    def set_output_params(self,
+                          p_output = OUTPUT_FULL,
+                          p_ndr = 1,
+                          p_ndz = 1,
+                          p_zmplt = None):
+        """
+        Choose which outputs PyRAM produces and returns.
+
+        Parameters
+        ----------
+        p_output : str
+            'LINE' : only TL Line / CP Line. The grids are allocated with
+                zero depth rows so are never materialized, and are removed
+                from the result dictionary.
+            'GRID' : line and grids, grids decimated by p_ndr and p_ndz.
+            'FULL' : all outputs at solver resolution (the default, as
+                when set_output_params is never called).
+        p_ndr : int
+            Range steps between outputs. Note this also thins TL Line.
+        p_ndz : int
+            Depth steps between grid outputs.
+        p_zmplt : float, optional
+            Maximum grid output depth (m). Default is the deepest bathymetry.
+
+        """
+        if p_output not in (Environment_RAM.OUTPUT_LINE,
+                            Environment_RAM.OUTPUT_GRID,
+                            Environment_RAM.OUTPUT_FULL):
+            raise ValueError(
+                'Environment_RAM.set_output_params: unknown output ' \
+                    + str(p_output))
+        self.RAM_OUTPUT = p_output
+        self.RAM_NDR = int(p_ndr)
+        self.RAM_NDZ = int(p_ndz)
+        self.RAM_ZMPLT = p_zmplt
+        
+    def get_output_kwargs(self):
+        """
+        The PyRAM keyword arguments that implement the output settings.
+        """
+        if self.RAM_OUTPUT == Environment_RAM.OUTPUT_FULL:
+            return dict()
+        kwargs = dict()
+        kwargs['ndr'] = self.RAM_NDR
+        if self.RAM_OUTPUT == Environment_RAM.OUTPUT_LINE:
+            kwargs['zmplt'] = 0 # no grid depth rows at all.
+            return kwargs
+        kwargs['ndz'] = self.RAM_NDZ
+        if self.RAM_ZMPLT is not None:
+            kwargs['zmplt'] = self.RAM_ZMPLT
+        return kwargs
+    
+    def hash_inputs(self,**kwargs):
+        inputs = Environment.hash_inputs(self,**kwargs)
+        if self.SSP_FIELD is None:
+            inputs['ssp'] = [self.ssp_depths,self.ssp_r,self.ssp_c]
+        else:
+            inputs['ssp'] = [self.SSP_FIELD.hash_inputs(),
+                             self.SSP_FIELD_N_RANGES,
+                             self.SSP_FIELD_SEASON]
+        inputs['seabed'] = self.bottom_profile.hash_inputs()
+        inputs['dr'] = self.DELTA_R_RAM
+        inputs['output'] = self.get_output_kwargs()
+        return inputs
     
     def set_ssp(self,
                 roughness = [0.5,0.5],
@@ -217,14 +353,52 @@ class Environment_RAM(Environment):
         self.ssp_c = np.reshape(self.ssp_c,
                                 (len(self.ssp_c),len(self.ssp_r))
                                 )
+        
+    def set_ssp_field(self,
+                      p_field,
+                      p_n_ranges = 8,
+                      p_season = 'Summer'):
+        """
+        Use a range dependent ssp.SSP_Field: each transect gets p_n_ranges
+        profiles sampled from the field along it. Pass None to go back to
+        the single profile of self.ssp.
+        """
+        self.SSP_FIELD = p_field
+        self.SSP_FIELD_N_RANGES = p_n_ranges
+        self.SSP_FIELD_SEASON = p_season
+        if p_field is not None:
+            self.ssp_depths = p_field.depths
+            
+    def prepare_transects(self,p_courses,p_n_distance):
+        """
+        Sample the SSP field and the seabed map (where set) along every
+        transect of the passed courses in one batch each, so the model 
+        runs (every frequency) only read the caches.
+        """
+        sources = []
+        for course in p_courses:
+            sources.extend(course)
+        if len(sources) == 0:
+            return
+        sources = np.unique(np.reshape(sources,(-1,2)),axis=0)
+        if self.SSP_FIELD is not None:
+            self.SSP_FIELD.sample_transects(self.rx_latlon,
+                                            sources,
+                                            self.SSP_FIELD_N_RANGES,
+                                            self.SSP_FIELD_SEASON)
+        if self.bottom_profile.map is not None:
+            self.bottom_profile.sample_transects(self.rx_latlon,
+                                                 sources,
+                                                 p_n_distance)
        
         
     def set_seabed(self):
         """
         Takes the arrays in seabed_drdc.bottom_type_profile and takes the first value
-        In the future may want to account for non-uniformity.
-        But, parameter studies by others 
-        indicate that isn't an issue compared to geometry and SSP
+        These are the uniform values. The per-range arrays the model is run
+        with come from bottom_profile.sample_along in 
+        create_environment_model, so a seabed map (SeaBed.set_map) is used
+        when one is set.
         
         """      
         self.seabed_rho = self.bottom_profile.bottom_type_profile['Rho'][0][0]
@@ -257,6 +431,14 @@ class Environment_RAM(Environment):
                 kwargs['BASIS_SIZE_DISTANCE'])
             
         self.z_interped = np.abs(self.z_interped)
+        
+        if self.SSP_FIELD is not None:
+            self.ssp_r,self.ssp_c = self.SSP_FIELD.transect(
+                rx_lat_lon_tuple,
+                tx_lat_lon_tuple,
+                total_distance,
+                self.SSP_FIELD_N_RANGES,
+                self.SSP_FIELD_SEASON)
             
         # zips two equal length 1D vectors
         # add the .T argument at end to take transpose
@@ -267,23 +449,32 @@ class Environment_RAM(Environment):
         self.sb_update_z = np.zeros(1)
         self.sb_update_r = self.distances
             
-        self.sb_rho_arr = self.seabed_rho * np.ones(len(self.distances))
-        self.sb_rho_arr = np.reshape(
-            self.sb_rho_arr,
-            (len(self.sb_update_z),len(self.sb_update_r)))
+        # One seabed column per bathymetry range, sampled along the
+        # same points as the bathymetry.
+        sb = self.bottom_profile.transect(rx_lat_lon_tuple,
+                                          tx_lat_lon_tuple,
+                                          len(self.distances))
+        shape = (len(self.sb_update_z),len(self.sb_update_r))
+        self.sb_rho_arr = np.reshape(sb['Rho'],shape)
+        self.sb_c_arr = np.reshape(sb['c'],shape)
+        self.sb_alpha_arr = np.reshape(sb['alpha'],shape)
+
+
+        self.pyram_obj = self.build_model()
         
-        self.sb_c_arr = self.seabed_c * np.ones(len(self.distances))
-        self.sb_c_arr = np.reshape(
-            self.sb_c_arr,
-            (len(self.sb_update_z),len(self.sb_update_r)))
-        
-        self.sb_alpha_arr = self.seabed_alpha * np.ones(len(self.distances))
-        self.sb_alpha_arr = np.reshape(
-            self.sb_alpha_arr,
-            (len(self.sb_update_z),len(self.sb_update_r)))
-
-
-        self.pyram_obj = PyRAM(
+        return
+    
+    def build_model(self,p_dr = None):
+        """
+        A new PyRAM object for the transect set up by the last
+        create_environment_model, at range step p_dr (default
+        self.DELTA_R_RAM). Nothing on the environment is changed, so
+        guarded fallback attempts can each build their own.
+        """
+        if p_dr is None:
+            p_dr = self.DELTA_R_RAM
+        pyram = backends.get_backend(self.BACKEND)
+        return pyram.PyRAM(
             self.freq,
             self.source_depth,
             self.receiver_depth,
@@ -296,13 +487,14 @@ class Environment_RAM(Environment):
             self.sb_rho_arr,
             self.sb_alpha_arr,
             self.bathy_2d_profile,
-            dr = self.DELTA_R_RAM
+            dr = p_dr,
+            **self.get_output_kwargs()
             )
-        
-        return
     
-    def run_model(self):
+    def run_model(self,p_model = None):
         """
+        Run p_model (see build_model), default self.pyram_obj.
+        
         From PyRAM module:
         results = {'ID': self._id,
               'Proc Time': self.proc_time,
@@ -314,56 +506,144 @@ class Environment_RAM(Environment):
               'CP Line': self.cpl,
               'c0': self._c0}
         """
-        result = self.pyram_obj.run()
+        if p_model is None:
+            p_model = self.pyram_obj
+        with instrument.stage(instrument.STAGE_SOLVER):
+            result = p_model.run()
+        instrument.record(instrument.STAGE_SOLVER_REPORTED,
+                          p_cpu = result['Proc Time'])
         # result is a dictionary. 
         # result['TL Line'] is the transmission loss profile at receiver depth.
+        if self.RAM_OUTPUT == Environment_RAM.OUTPUT_LINE:
+            # These are zero-row arrays, don't carry them around.
+            del result['TL Grid']
+            del result['CP Grid']
         return result
-
-    def calculate_exact_TLs(self, **kwargs):
+    
+    def run_model_guarded(self,p_tx_lat_lon_tuple,p_env_hash,p_freq):
         """
+        run_model, through self.GUARD if one is set. Returns None for a 
+        point the guard gave up on.
+        
+        The first attempt runs the model create_environment_model set up.
+        Every further attempt (a guard fallback may set 'dr') runs its own
+        model from build_model, and no attempt changes the environment, so
+        an attempt abandoned on a thread timeout cannot disturb the later
+        ones or the next transect.
+        """
+        if self.GUARD is None:
+            return self.run_model()
+        unused = [self.pyram_obj] # the transect as set up, run at most once
+        def attempt(p_overrides):
+            if len(p_overrides) == 0 and len(unused) > 0:
+                return self.run_model(unused.pop())
+            return self.run_model(self.build_model(p_overrides.get('dr')))
+        key = failure_key(p_env_hash,p_freq,p_tx_lat_lon_tuple)
+        return self.GUARD.run(key,
+                              attempt,
+                              Environment_RAM.valid_result,
+                              hydrophone = self.hydro_name,
+                              freq = p_freq,
+                              tx = p_tx_lat_lon_tuple)
+    
+    @staticmethod
+    def valid_result(p_result):
+        TL = np.asarray(p_result['TL Line'])
+        return len(TL) > 0 and bool(np.all(np.isfinite(TL)))
 
-        Parameters
-        ----------
-        **kwargs : TYPE
-            DESCRIPTION.
+    def run_transects(self,p_freq,p_course,p_env_hash,**kwargs):
+        """
+        Run the model from every source in p_course to the receiver at
+        p_freq. kwargs as calculate_exact_TLs (POINT_OR_LINE_STR, 
+        BASIS_SIZE_DEPTH, BASIS_SIZE_DISTANCE, and DEPTHS from
+        calculate_exact_TLs_multi_depth). p_env_hash keys the guard
+        registry.
+        
+        With DEPTHS, TL is read from the grid output at each depth (see
+        TL_at_depths), one block of rows per depth with a Depth column.
 
         Returns
         -------
-        None.
-
+        TL_Accumulator of the results, nothing is written.
         """
-        flat_earth_approx = Approximations() # didnt define static method
-
-        for freq in self.freqs:
-            TL_RES = []
+        flat_earth_approx = Approximations()
+        depths = kwargs.get('DEPTHS')
+        columns = TL_Accumulator.COLUMNS
+        n_depths = 1
+        if depths is not None:
+            depths = np.asarray(depths,dtype=float)
+            columns = columns + ('Depth',)
+            n_depths = len(depths)
+        # Results are copied in to preallocated columns as each run
+        # finishes, so the grids of a run are released right away.
+        TL_RES = TL_Accumulator(p_capacity = len(p_course) * n_depths,
+                                p_columns = columns)
+        progress = self.progress(p_freq,len(p_course))
+        model_kwargs = {'TX_DEPTH' : self.source.depth,
+                        'FREQ_TO_RUN' : p_freq,
+                        'RX_DEPTH' : self.rx_depth,
+                        'BASIS_SIZE_DEPTH' : kwargs['BASIS_SIZE_DEPTH'],
+                        'BASIS_SIZE_DISTANCE' : kwargs['BASIS_SIZE_DISTANCE']}
+
+        def append(p_x,p_y,p_tx,p_TL):
+            # a row of p_TL per depth (one row, TL Line, without DEPTHS)
+            for n,TL in enumerate(p_TL):
+                extra = dict()
+                if depths is not None:
+                    extra['Depth'] = depths[n]
+                TL_RES.append_RAM_result({'X' : p_x,
+                                          'Y' : p_y,
+                                          'TX Lat' : p_tx[0],
+                                          'TX Lon' : p_tx[1],
+                                          'TL Line' : TL},
+                                         **extra)
 
-            for TX_SOURCE in self.source.course:
+        try:
+            for TX_SOURCE in p_course:
                 # South hydrophone
-                self.create_environment_model(
-                            self.rx_latlon,
-                            TX_SOURCE,
-                            TX_DEPTH = self.source.depth,
-                            FREQ_TO_RUN = freq,
-                            RX_DEPTH = self.rx_depth,
-                            BASIS_SIZE_DEPTH = kwargs['BASIS_SIZE_DEPTH'],
-                            BASIS_SIZE_DISTANCE = kwargs['BASIS_SIZE_DISTANCE'],
+                with instrument.stage(instrument.STAGE_ENVIRONMENT):
+                    self.create_environment_model(
+                                self.rx_latlon,
+                                TX_SOURCE,
+                                **model_kwargs)
+            
+                try:
+                    results_RAM = self.run_model_guarded(
+                        TX_SOURCE,
+                        p_env_hash,
+                        p_freq)
+                except Exception as e:
+                    progress.failed(TX_SOURCE,e)
+                    raise
+            
+                if results_RAM is None: # given up on, a NaN at the source
+                    progress.failed(TX_SOURCE,self.GUARD.last_failure)
+                    (tx_x, tx_y) = flat_earth_approx.latlon_to_xy(
+                        p_cpa = (self.location.LAT,self.location.LON), 
+                        p_latlon = TX_SOURCE
                         )
-                
-                results_RAM = self.run_model()
+                    append([tx_x],[tx_y],TX_SOURCE,np.full((n_depths,1),np.nan))
+                    continue
+
+                if depths is None:
+                    TL = np.asarray(results_RAM['TL Line'])[None,:]
+                else:
+                    TL = Environment_RAM.TL_at_depths(results_RAM,depths)
 
                 if kwargs['POINT_OR_LINE_STR'] == 'LINE':
-                    results_RAM['X'],results_RAM['Y'] = \
-                        flat_earth_approx.RAM_distances_to_latlon(
+                    x,y = flat_earth_approx.RAM_distances_to_latlon(
                             p_cpa = (self.location.LAT,self.location.LON), 
                             p_rx = self.rx_latlon, 
                             p_tx = TX_SOURCE, 
                             p_r = results_RAM['Ranges'])
-                    
-                    results_RAM['TX Lat'] = TX_SOURCE[0]
-                    results_RAM['TX Lon'] = TX_SOURCE[1]
-                    
-                    TL_RES.append(results_RAM)
-                    
+                
+                    if len(TL_RES) == 0: # now the line length is known
+                        TL_RES.reserve(
+                            len(p_course)       \
+                                * n_depths      \
+                                * len(results_RAM['Ranges']))
+                    append(x,y,TX_SOURCE,TL)
+                
                 if kwargs['POINT_OR_LINE_STR'] == 'POINT':
                     # extract just the TL from TX to RX, and make sure
                     # The correct geometries are extracted for later processing.
@@ -371,44 +651,181 @@ class Environment_RAM(Environment):
                         p_cpa = (self.location.LAT,self.location.LON), 
                         p_latlon = TX_SOURCE
                         )                                        
-                    
-                    result = dict()
-                    
-                    result['X'] = [tx_x]
-                    result['Y'] = [tx_y]
-                    result['TX Lat'] = [TX_SOURCE[0]]
-                    result['TX Lon'] = [TX_SOURCE[1]]
-                    result['TL Line'] = [results_RAM['TL Line'][-1]]
-                    
-                    TL_RES.append(result)
-                        
-            self.RAM_dictionaries_to_unstruc(TL_RES)
-
-                        
-            df_res = pd.DataFrame(
-                data= {'X' : self.X_unstruc,
-                       'Y' : self.Y_unstruc,
-                       'TL': self.TL_unstruc,
-                       'Lats TX' : self.lats_TX_unstruc,
-                       'Lons TX' : self.lons_TX_unstruc,
-                       })
-            if not (self.hydro_name == r'not set'):
-                # Writing two files.
-                df_res.to_csv(
-                    self.model_target_dir       \
-                        + str(freq).zfill(4)    \
-                        + '_'                   \
-                        + self.hydro_name       \
-                        + '.csv')
-            else: 
-                df_res.to_csv(
-                    self.model_target_dir       \
-                        + str(freq).zfill(4)    \
-                        + '_'                   \
-                        + self.hydro_name     \
-                        + '.csv')
+                    append([tx_x],[tx_y],TX_SOURCE,TL[:,-1:])
+            
+                progress.transect_done(TX_SOURCE,results_RAM['Proc Time'])
+                del results_RAM # drop the heavy grids before the next run.
+        finally:
+            progress.end()
+        return TL_RES
+
+    def calculate_exact_TLs(self, **kwargs):
+        """
+
+        Parameters
+        ----------
+        **kwargs : 
+            POINT_OR_LINE_STR, BASIS_SIZE_DEPTH, BASIS_SIZE_DISTANCE.
+            INCREMENTAL : optional, default False. If True, only the source 
+            points missing from the existing result files (for the same
+            environment hash) are run, and merged in to those files.
+            The plan is emitted as a 'plan' event on the event stream.
+            RUNNER : optional, default self.run_transects. Called as 
+            RUNNER(freq, course, env_hash, **kwargs) and returns a 
+            TL_Accumulator, e.g. workers.Worker_Pool.transect_runner to run
+            the transects on a warm pool.
+            DEPTHS : set by calculate_exact_TLs_multi_depth, see there.
+
+        Returns
+        -------
+        None.
+
+        """
+        incremental = kwargs.pop('INCREMENTAL',False)
+        runner = kwargs.pop('RUNNER',self.run_transects)
+        columns = TL_Accumulator.COLUMNS
+        suffix = ''
+        if kwargs.get('DEPTHS') is not None:
+            columns = columns + ('Depth',)
+            suffix = '_depths'
+        def results_fname(p_freq):
+            return self.results_fname(p_freq,suffix)
+        store = Result_Store()
+        env_hash = self.environment_hash(**kwargs)
+        course = self.source.valid_course(self.rx_latlon)
+        courses = dict()
+        for freq in self.freqs:
+            courses[freq] = course
+        if incremental:
+            # Only run what is not already in the result files for this
+            # exact environment, then merge in to those files.
+            planner = Incremental_Planner(store)
+            courses = planner.plan(
+                results_fname,
+                self.freqs,
+                course,
+                env_hash)
+            stream = self.event_stream()
+            if stream is not None:
+                n_missing, n_requested = planner.counts(courses,course)
+                stream.emit(events.EVENT_PLAN,
+                            hydrophone = self.hydro_name,
+                            n_requested = n_requested,
+                            n_missing = n_missing)
+        self.prepare_transects(courses.values(),kwargs['BASIS_SIZE_DISTANCE'])
+
+        for freq in self.freqs:
+            TL_RES = runner(freq,courses[freq],env_hash,**kwargs)
+
+            with instrument.stage(instrument.STAGE_WRITE):
+                df_res = pd.DataFrame(data = TL_RES.to_dict())
+                if incremental:
+                    df_res = store.merge_write(
+                        results_fname(freq),
+                        df_res,
+                        env_hash)
+                    TL_RES = TL_Accumulator.from_frame(df_res,columns)
+                else:
+                    df_res.to_csv(results_fname(freq))
+                    store.write_meta(results_fname(freq),env_hash,len(df_res))
+
+            self.RAM_accumulator_to_unstruc(TL_RES)
+            if 'Depth' in columns:
+                self.depths_unstruc = TL_RES.column('Depth')
                 
 
+    def results_fname(self,p_freq,p_suffix = ''):
+        """
+        The per-frequency result file for this hydrophone.
+        """
+        return self.model_target_dir    \
+            + str(p_freq).zfill(4)      \
+            + '_'                       \
+            + self.hydro_name           \
+            + p_suffix                  \
+            + '.csv'
+
+
+    def calculate_exact_TLs_multi_depth(self, p_depths, **kwargs):
+        """
+        Same as calculate_exact_TLs (INCREMENTAL and RUNNER included), but
+        fills TL at every depth in p_depths from a single run per transect,
+        using the PyRAM grid output. The transects are run by 
+        run_transects as there, so through the guard (see set_guard), and
+        a point given up on is NaN at every depth.
+        
+        The model source is at self.source.depth, so by reciprocity the
+        depths can be read as either receiver or source depths.
+        
+        If the output setting is LINE, a grid at full depth resolution is
+        used for these runs only, down to PyRAM's default plot depth (the
+        deepest bathymetry on each transect). The output settings are put
+        back afterwards, also when a run raises.
+
+        Parameters
+        ----------
+        p_depths : array-like
+            Depths in m, positive down, all > 0.
+        **kwargs : 
+            As calculate_exact_TLs.
+
+        Returns
+        -------
+        None.
+        (One file per frequency with suffix _depths, with a Depth column
+        and a Result_Store sidecar whose hash includes the depths.
+        The depth of each row is in self.depths_unstruc.)
+
+        """
+        p_depths = np.asarray(p_depths,dtype=float)
+        if np.any(p_depths <= 0):
+            raise ValueError(
+                'Environment_RAM.calculate_exact_TLs_multi_depth: depths '\
+                    'must be positive (m, positive down).')
+        
+        saved_output = (self.RAM_OUTPUT,self.RAM_NDR,self.RAM_NDZ,self.RAM_ZMPLT)
+        if self.RAM_OUTPUT == Environment_RAM.OUTPUT_LINE:
+            self.set_output_params(Environment_RAM.OUTPUT_GRID,
+                                   p_ndr = self.RAM_NDR,
+                                   p_ndz = 1,
+                                   p_zmplt = None)
+        try:
+            self.calculate_exact_TLs(DEPTHS = p_depths.tolist(),**kwargs)
+        finally:
+            self.set_output_params(*saved_output)
+        
+        
+    @staticmethod
+    def TL_at_depths(p_result,p_depths):
+        """
+        Linear interpolation of the complex pressure grid on result['Depths'],
+        then conversion to TL the same way PyRAM builds its TL Line.
+        
+        The first grid row is one depth step below the surface; above it the
+        pressure is interpolated towards zero at the pressure-release
+        surface. Depths below the deepest grid row are NaN.
+        
+        Returns a len(p_depths) x len(result['Ranges']) array.
+        """
+        eps = 1e-20 # as in pyram outpt
+        vz = np.asarray(p_result['Depths'])
+        vr = np.asarray(p_result['Ranges'])
+        cpg = p_result['CP Grid']
+        if len(vz) < 2:
+            raise ValueError(
+                'Environment_RAM.TL_at_depths: result has no depth grid, '\
+                    'check the output settings.')
+        vz = np.concatenate(([0.],vz))
+        cpg = np.vstack((np.zeros((1,cpg.shape[1]),dtype=cpg.dtype),cpg))
+        index = np.clip(np.searchsorted(vz,p_depths) - 1, 0, len(vz) - 2)
+        weight = (p_depths - vz[index]) / (vz[index+1] - vz[index])
+        cp = (1 - weight[:,None]) * cpg[index,:] + weight[:,None] * cpg[index+1,:]
+        TL = -20 * np.log10(np.abs(cp) + eps) + 10 * np.log10(vr + eps)
+        outside = (p_depths < 0) | (p_depths > vz[-1])
+        TL[outside,:] = np.nan
+        return TL
+        
+
     def RAM_dictionaries_to_unstruc(self,p_dictionary_list):
         """
         The provided dictionaries are the default RAM outputs
@@ -416,11 +833,14 @@ class Environment_RAM(Environment):
 
         Upon generation the unstructured data is assigned to 
         object instance members.
+        
+        calculate_exact_TLs no longer builds such a list, it streams in to
+        a TL_Accumulator instead. This is kept for existing callers.
 
         Parameters
         ----------
-        p_dictionary_list : TYPE
-            DESCRIPTION.
+        p_dictionary_list : list of dict
+            RAM result dictionaries.
 
         Returns
         -------
@@ -429,32 +849,26 @@ class Environment_RAM(Environment):
         self.X_unstruc, self.Y_unstruc, self.TL_unstruc)
 
         """
-        
-        X_unstruc = []
-        Y_unstruc = []
-        TL_unstruc = []
-        TX_lat = []
-        TX_lon = []
+        n_total = 0
         for dictionary in p_dictionary_list:
-            X_unstruc.append(dictionary['X'])
-            Y_unstruc.append(dictionary['Y'])
-            TL_unstruc.append(dictionary['TL Line'])
-            ones = np.ones_like(dictionary['X'])
-            TX_lat.append(ones * dictionary['TX Lat'])
-            TX_lon.append(ones * dictionary['TX Lon'])
-        
-        x = [item for sublist in X_unstruc for item in sublist]
-        y = [item for sublist in Y_unstruc for item in sublist]
-        TL = [item for sublist in TL_unstruc for item in sublist]
-        lats = [item for sublist in TX_lat for item in sublist]
-        lons = [item for sublist in TX_lon for item in sublist]
-        
+            n_total = n_total + np.size(dictionary['X'])
+        accumulator = TL_Accumulator(p_capacity = n_total)
+        for dictionary in p_dictionary_list:
+            accumulator.append_RAM_result(dictionary)
+        self.RAM_accumulator_to_unstruc(accumulator)
         
-        self.X_unstruc = x
-        self.Y_unstruc = y
-        self.TL_unstruc = TL        
-        self.lats_TX_unstruc = lats
-        self.lons_TX_unstruc = lons
+
+    def RAM_accumulator_to_unstruc(self,p_accumulator):
+        """
+        Assign the unstructured data members as views on the columns of
+        the passed TL_Accumulator, no copies are made.
+        """
+        self.TL_accumulator = p_accumulator
+        self.X_unstruc = p_accumulator.column('X')
+        self.Y_unstruc = p_accumulator.column('Y')
+        self.TL_unstruc = p_accumulator.column('TL')
+        self.lats_TX_unstruc = p_accumulator.column('Lats TX')
+        self.lons_TX_unstruc = p_accumulator.column('Lons TX')
         
 
     def interpolate_RAM_data_obj(self,p_xlim,p_ylim):
@@ -492,11 +906,12 @@ class Environment_RAM(Environment):
     
         source_points = ( x , y )
         xi = ( x_target , y_target )
-        TL_interp = interpolate.griddata(
-            source_points,
-            TL,
-            xi
-            )
+        with instrument.stage(instrument.STAGE_INTERPOLATION):
+            TL_interp = interpolate.griddata(
+                source_points,
+                TL,
+                xi
+                )
         return TL_interp,xi
         
     def plot_TL_interpolation_with_comex_circle_and_nominal_track(self,
@@ -538,13 +953,16 @@ class Environment_RAM(Environment):
     
 class Environment_PYAT(Environment):
     
+    BACKEND = 'pyat'
+    
     def set_ssp(self,
                 roughness = [0.5,0.5],
                 ssp_selection = 'Summer'):   
         """
         """
+        pyat_env = backends.get_backend(self.BACKEND)
         depths = [0,self.ssp.depths[-1]]
-        ssp1 = pyat.pyat.env.SSPraw(
+        ssp1 = pyat_env.SSPraw(
             self.ssp.depths, 
             self.ssp.dict[ssp_selection],
             0*np.ones(self.ssp.depths.shape), # water has no shear speed, betaR
@@ -557,7 +975,7 @@ class Environment_PYAT(Environment):
         Opt			=	'CVW'	
         N			=	[self.ssp.depths.size]
         sigma		=	[.5,.5]	 # roughness at each layer. only effects attenuation (imag part)
-        self.ssp_pyat = pyat.pyat.env.SSP(raw, depths, NMedia, Opt, N, sigma)
+        self.ssp_pyat = pyat_env.SSP(raw, depths, NMedia, Opt, N, sigma)
     
     def set_seabed(self,
                    seabed_drdc,
@@ -571,17 +989,18 @@ class Environment_PYAT(Environment):
         ALSO SETS SURFACE BOUNDARY CONDITION
         #TODO: Separate this from the bottom setting.
         """
+        pyat_env = backends.get_backend(self.BACKEND)
         self.set_seabed_common(seabed_drdc)
-        hs = pyat.pyat.env.HS(
+        hs = pyat_env.HS(
             alphaR=seabed_drdc.bottom_type_profile['c'][0][0],
             betaR=p_betaR, #unknown what this is
             rho = seabed_drdc.bottom_type_profile['Rho'][0][0],
             alphaI=seabed_drdc.bottom_type_profile['alpha'][0][0],
             betaI=p_betaI) #unknow what this is
         Opt = 'A~'
-        bottom = pyat.pyat.env.BotBndry(Opt, hs)
-        top = pyat.pyat.env.TopBndry('CVW')
-        self.bdy = pyat.pyat.env.Bndry(top, bottom)
+        bottom = pyat_env.BotBndry(Opt, hs)
+        top = pyat_env.TopBndry('CVW')
+        self.bdy = pyat_env.Bndry(top, bottom)
 
         self.cInt = Empty()
         self.cInt.High = seabed_drdc.bottom_type_profile['c'][0][0]+1 #assumes 2d array passed.
@@ -603,6 +1022,7 @@ class Environment_PYAT(Environment):
         
         #Takes np.abs of the depth and distances, as model takes down to be positive.
         """
+        pyat_env = backends.get_backend(self.BACKEND)
         self.freq = kwargs['freq']
         self.beam = p_beam
         total_distance,self.distances,self.z_interped,self.depths = \
@@ -615,9 +1035,9 @@ class Environment_PYAT(Environment):
         self.Z = np.abs( self.depths )# in m
         # self.Z = np.abs( self.z_interped )# in m
         self.X = np.abs( self.distances / 1000 )# in m converted to km
-        self.s = pyat.pyat.env.Source(source_drdc.depth)
-        self.r = pyat.pyat.env.Dom(self.X, self.Z) #needs to be in km, m
-        self.pos = pyat.pyat.env.Pos(self.s,self.r)
+        self.s = pyat_env.Source(source_drdc.depth)
+        self.r = pyat_env.Dom(self.X, self.Z) #needs to be in km, m
+        self.pos = pyat_env.Pos(self.s,self.r)
         self.pos.s.depth	= [source_drdc.depth]
         self.pos.r.depth	 = self.Z
         self.pos.r.range		=	self.X
@@ -627,6 +1047,7 @@ class Environment_PYAT(Environment):
     
 class Environment_ARL(Environment):
 
+    BACKEND = 'arlpy'
         
     def set_surface(self,surface):
         self.set_surface_common(surface)
@@ -650,6 +1071,7 @@ class Environment_ARL(Environment):
             TX_DEPTH
         
         """
+        pm = backends.get_backend(self.BACKEND)
         env = pm.create_env2d()        
         
         total_distance,self.distances,self.z_interped,self.depths = \
@@ -700,43 +1122,92 @@ class Environment_ARL(Environment):
         self.env = env    
         return env
     
+    def run_model_guarded(self,p_tx_lat_lon_tuple,p_env_hash,p_env):
+        """
+        compute_transmission_loss for the arlpy environment p_env, through 
+        self.GUARD if one is set. Returns None for a point the guard gave
+        up on. The guard fallbacks may set 'N_BEAMS'.
+        
+        With a guard, a result the receiver pressure cannot be read from 
+        counts as a failure, so it is retried.
+        """
+        pm = backends.get_backend(self.BACKEND)
+        if self.GUARD is None:
+            return pm.compute_transmission_loss(p_env,mode=pm.coherent)
+        def attempt(p_overrides):
+            env = p_env
+            if 'N_BEAMS' in p_overrides:
+                env = dict(p_env)
+                env['nbeams'] = p_overrides['N_BEAMS']
+            TL = pm.compute_transmission_loss(env,mode=pm.coherent)
+            TL.iloc(0)[0].iloc(0)[0] # raises if there is no pressure
+            return TL
+        key = failure_key(p_env_hash,p_env['frequency'],p_tx_lat_lon_tuple)
+        return self.GUARD.run(key,
+                              attempt,
+                              hydrophone = self.hydro_name,
+                              freq = p_env['frequency'],
+                              tx = p_tx_lat_lon_tuple)
+    
     def calculate_exact_TLs(self,
                             **kwargs):
-        count = 0
+        """
+        TL at the receiver for every course point, in course order. Points
+        prefilter_course flagged, that failed, or that the guard gave up
+        on are NaN, so the results keep the grid shape.
+        """
         TL_RES = []
         LAT = []
         LON = []
+        env_hash = None
+        if self.GUARD is not None:
+            env_hash = self.environment_hash(**kwargs)
         for freq in self.freqs:
-            for TX_SOURCE in self.source.course:
-                env_bellhop_S = self.create_environment_model(
-                        self.rx_latlon,
-                        TX_SOURCE,
-                        FREQ_TO_RUN = freq,
-                        RX_HYD_DEPTH = self.rx_depth, 
-                        TX_DEPTH = self.source.depth, 
-                        N_BEAMS = kwargs['N_BEAMS'], 
-                        BASIS_SIZE_DEPTH = kwargs['BASIS_SIZE_DEPTH'],
-                        BASIS_SIZE_DISTANCE = kwargs['BASIS_SIZE_DISTANCE'],
-                    )
-                TL = pm.compute_transmission_loss(
-                    env_bellhop_S,
-                    mode=pm.coherent,
-                    )
-                
-                try:
-                    x_cmplx = TL.iloc(0)[0].iloc(0)[0]
-                    # TL_RES_BELL_S[index] = np.abs(x_cmplx)
-                    TL_RES.append(np.abs(x_cmplx))
+            course = self.source.course
+            valid = self.source.course_mask(self.rx_latlon)
+            progress = self.progress(freq,int(np.sum(valid)))
+            try:
+                for TX_SOURCE,ok in zip(course,valid):
                     LAT.append(TX_SOURCE[0])
                     LON.append(TX_SOURCE[1])
-                except:
-                    print('BELLHOP: error at range: ' +str(env_bellhop_S['rx_range']))
-                    print ('BELLHOP: This is actually lat-lon: ' + str(TX_SOURCE[0]) + ' , ' + str (TX_SOURCE[1]))
+                    if not ok: # see Source.prefilter_course
+                        TL_RES.append(np.nan)
+                        continue
+                    with instrument.stage(instrument.STAGE_ENVIRONMENT):
+                        env_bellhop_S = self.create_environment_model(
+                                self.rx_latlon,
+                                TX_SOURCE,
+                                FREQ_TO_RUN = freq,
+                                RX_HYD_DEPTH = self.rx_depth, 
+                                TX_DEPTH = self.source.depth, 
+                                N_BEAMS = kwargs['N_BEAMS'], 
+                                BASIS_SIZE_DEPTH = kwargs['BASIS_SIZE_DEPTH'],
+                                BASIS_SIZE_DISTANCE = kwargs['BASIS_SIZE_DISTANCE'],
+                            )
+                    solver_start = time.perf_counter()
+                    with instrument.stage(instrument.STAGE_SOLVER):
+                        TL = self.run_model_guarded(
+                            TX_SOURCE,
+                            env_hash,
+                            env_bellhop_S)
+                    solver_s = time.perf_counter() - solver_start
+                
+                    if TL is None: # given up on, see set_guard
+                        progress.failed(TX_SOURCE,self.GUARD.last_failure)
+                        TL_RES.append(np.nan)
+                        continue
                 
-                if count % 100 == 0: 
-                    print('Still working on BELLHOP! Currently at:')
-                    print('Freq: \t' + str ( freq ) + '\t Count: \t:' + str ( count ) )
-                count = count + 1
+                    try:
+                        x_cmplx = TL.iloc(0)[0].iloc(0)[0]
+                        # TL_RES_BELL_S[index] = np.abs(x_cmplx)
+                        TL_RES.append(np.abs(x_cmplx))
+                        progress.transect_done(TX_SOURCE,solver_s)
+                    except Exception as e:
+                        # the failure event has the lat-lon
+                        progress.failed(TX_SOURCE,e)
+                        TL_RES.append(np.nan)
+            finally:
+                progress.end()
 
         self.LAT = LAT
         self.LON = LON
@@ -744,6 +1215,12 @@ class Environment_ARL(Environment):
 
     def reshape_1d_to_surface(self):
         
+        if len(self.TL) != self.LAT_N_PTS * self.LON_N_PTS:
+            raise ValueError(
+                'Environment_ARL.reshape_1d_to_surface: ' + str(len(self.TL))\
+                    + ' results for a ' + str(self.LAT_N_PTS) + ' x ' \
+                    + str(self.LON_N_PTS) + ' grid, prefilter_course with '\
+                    + "p_mode = 'flag' keeps the grid.")
         X,Y = \
             self.bathymetry.convert_latlon_to_xy_m(
                 self.location, 
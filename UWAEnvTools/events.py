@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Structured progress events for long model runs.
+
+An Event_Stream writes one JSON object per line to a file and/or passes
+each event dictionary to a callback. Every event has 'event', 'time'
+(unix seconds), 'host' and 'pid', plus its own fields:
+
+    plan        hydrophone, n_requested, n_missing (incremental runs)
+    run_start   hydrophone, freq, n_points
+    transect    hydrophone, freq, index, n_points, tx_lat, tx_lon,
+                solver_s, wall_s, points_per_s, eta_s
+    failure     hydrophone, freq, index, tx_lat, tx_lon, error
+    run_end     hydrophone, freq, n_points, n_done, n_failed, wall_s,
+                points_per_s
+    prefilter   rx_lat, rx_lon, mode, n_points, n_dropped, n_skipped,
+                n_out_of_domain, n_on_land, n_crossing_land
+
+points_per_s is a rolling rate over the last p_window transects, and eta_s
+the remaining points of that (hydrophone, freq) at that rate, so a
+scheduler tailing the file sees a stalled or degraded worker as the rate
+falls or the events stop.
+
+Environments emit to the stream set with Environment.set_event_stream, or
+else to a file named by the UWAENVTOOLS_EVENTS environment variable. With
+neither, progress() returns a do-nothing tracker.
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+from collections import deque
+
+
+ENV_VAR = 'UWAENVTOOLS_EVENTS'
+
+EVENT_PLAN = 'plan'
+EVENT_RUN_START = 'run_start'
+EVENT_TRANSECT = 'transect'
+EVENT_FAILURE = 'failure'
+EVENT_RUN_END = 'run_end'
+EVENT_PREFILTER = 'prefilter'
+
+
+class Event_Stream():
+
+    def __init__(self,
+                 p_fname = None,
+                 p_callback = None,
+                 p_window = 50):
+        self.fname = p_fname
+        self.callback = p_callback
+        self.window = p_window
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._file = None
+        if p_fname is not None:
+            self._file = open(p_fname,'a')
+
+    def emit(self,p_event,**kwargs):
+        event = {'event' : p_event,
+                 'time' : time.time(),
+                 'host' : self.host,
+                 'pid' : self.pid}
+        event.update(kwargs)
+        if self._file is not None:
+            line = json.dumps(event,default=_to_json)
+            with self._lock:
+                self._file.write(line + '\n')
+                self._file.flush() # tailed while the run goes on
+        if self.callback is not None:
+            self.callback(event)
+
+    def progress(self,p_hydrophone,p_freq,p_n_points):
+        return Run_Progress(self,p_hydrophone,p_freq,p_n_points,self.window)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _to_json(p_value):
+    # numpy scalars and arrays
+    if hasattr(p_value,'tolist'):
+        return p_value.tolist()
+    return str(p_value)
+
+
+class Run_Progress():
+    """
+    Progress of one (hydrophone, frequency) run over n_points transects.
+    """
+
+    def __init__(self,p_stream,p_hydrophone,p_freq,p_n_points,p_window = 50):
+        self.stream = p_stream
+        self.hydrophone = p_hydrophone
+        self.freq = p_freq
+        self.n_points = p_n_points
+        self.n_done = 0
+        self.n_failed = 0
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.times = deque([self.start],maxlen = p_window + 1)
+        self.stream.emit(EVENT_RUN_START,
+                         hydrophone = p_hydrophone,
+                         freq = p_freq,
+                         n_points = p_n_points)
+
+    def rate(self):
+        """
+        Points per second over the rolling window.
+        """
+        if len(self.times) < 2 or self.times[-1] <= self.times[0]:
+            return 0.
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+    def _step(self):
+        now = time.perf_counter()
+        wall = now - self.last
+        self.last = now
+        self.times.append(now)
+        rate = self.rate()
+        remaining = self.n_points - self.n_done - self.n_failed
+        eta = remaining / rate if rate > 0 else None
+        return wall, rate, eta
+
+    def transect_done(self,p_tx,p_solver_s = None):
+        self.n_done = self.n_done + 1
+        wall, rate, eta = self._step()
+        self.stream.emit(EVENT_TRANSECT,
+                         hydrophone = self.hydrophone,
+                         freq = self.freq,
+                         index = self.n_done + self.n_failed - 1,
+                         n_points = self.n_points,
+                         tx_lat = p_tx[0],
+                         tx_lon = p_tx[1],
+                         solver_s = p_solver_s,
+                         wall_s = wall,
+                         points_per_s = rate,
+                         eta_s = eta)
+
+    def failed(self,p_tx,p_error):
+        self.n_failed = self.n_failed + 1
+        self._step()
+        self.stream.emit(EVENT_FAILURE,
+                         hydrophone = self.hydrophone,
+                         freq = self.freq,
+                         index = self.n_done + self.n_failed - 1,
+                         tx_lat = p_tx[0],
+                         tx_lon = p_tx[1],
+                         error = type(p_error).__name__ + ': ' + str(p_error))
+
+    def end(self):
+        wall = time.perf_counter() - self.start
+        self.stream.emit(EVENT_RUN_END,
+                         hydrophone = self.hydrophone,
+                         freq = self.freq,
+                         n_points = self.n_points,
+                         n_done = self.n_done,
+                         n_failed = self.n_failed,
+                         wall_s = wall,
+                         points_per_s = self.n_done / wall if wall > 0 else 0.)
+
+
+class _Null_Progress():
+
+    def transect_done(self,p_tx,p_solver_s = None):
+        return
+
+    def failed(self,p_tx,p_error):
+        return
+
+    def end(self):
+        return
+
+NULL_PROGRESS = _Null_Progress()
+
+
+_DEFAULT = {'stream' : None,'checked' : False}
+
+
+def default_stream():
+    """
+    The stream named by UWAENVTOOLS_EVENTS, opened on first use, or None.
+    """
+    if not _DEFAULT['checked']:
+        _DEFAULT['checked'] = True
+        fname = os.environ.get(ENV_VAR,'').strip()
+        if fname != '':
+            _DEFAULT['stream'] = Event_Stream(fname)
+    return _DEFAULT['stream']
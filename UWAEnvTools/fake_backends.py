@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in solvers, to time everything around the models without them.
+
+Registered in backends.py as 'fake_pyram' and 'fake_arlpy', so an
+environment uses them with
+
+    env.set_backend('fake_pyram')   # Environment_RAM
+    env.set_backend('fake_arlpy')   # Environment_ARL
+
+The fakes take the same inputs as the real solvers and return results of
+the same shapes and types: PyRAM's Ranges / Depths / TL Line / TL Grid /
+CP Line / CP Grid from the same dr, dz, ndr, ndz and zmplt rules, and
+arlpy's complex pressure DataFrame. The values are spherical spreading
+plus seabed absorption, so they are smooth and plausible, not physical.
+
+How long a run takes is set with set_fake_cost. 'sleep' costs wall time
+only, 'spin' burns CPU the way a solver does (use it when timing parallel
+runners). Time spent is totalled in FAKE_STATS, so the orchestration
+overhead is the wall time less FAKE_STATS['seconds'].
+"""
+
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from UWAEnvTools.backends import Lazy_Module
+
+pd = Lazy_Module('pandas')
+
+
+COST_SLEEP = 'sleep'
+COST_SPIN = 'spin'
+
+# seconds_per_run : fixed cost of every run
+# seconds_per_cell : per solver grid cell, range steps x depth steps, so
+#   runs get dearer with range, depth and frequency as the real ones do.
+FAKE_COST = {'seconds_per_run' : 0.,
+             'seconds_per_cell' : 0.,
+             'mode' : COST_SLEEP}
+
+FAKE_STATS = {'runs' : 0,
+              'seconds' : 0.}
+
+
+def set_fake_cost(p_seconds_per_run = 0.,
+                  p_seconds_per_cell = 0.,
+                  p_mode = COST_SLEEP):
+    if p_mode not in (COST_SLEEP,COST_SPIN):
+        raise ValueError('set_fake_cost: unknown mode ' + str(p_mode))
+    FAKE_COST['seconds_per_run'] = float(p_seconds_per_run)
+    FAKE_COST['seconds_per_cell'] = float(p_seconds_per_cell)
+    FAKE_COST['mode'] = p_mode
+
+
+def reset_fake_stats():
+    FAKE_STATS['runs'] = 0
+    FAKE_STATS['seconds'] = 0.
+
+
+def _spend(p_n_cells):
+    """
+    Take as long as the cost settings say a run of p_n_cells takes.
+    Returns the seconds spent.
+    """
+    seconds = FAKE_COST['seconds_per_run'] \
+        + FAKE_COST['seconds_per_cell'] * p_n_cells
+    t0 = time.perf_counter()
+    if seconds > 0:
+        if FAKE_COST['mode'] == COST_SLEEP:
+            time.sleep(seconds)
+        else:
+            deadline = t0 + seconds
+            while time.perf_counter() < deadline:
+                pass
+    spent = time.perf_counter() - t0
+    FAKE_STATS['runs'] = FAKE_STATS['runs'] + 1
+    FAKE_STATS['seconds'] = FAKE_STATS['seconds'] + spent
+    return spent
+
+
+def _loss(p_r,p_z,p_zs,p_alpha,p_freq,p_c0):
+    """
+    TL (dB) and complex pressure at ranges p_r and depths p_z (broadcast).
+    The pressure is scaled the way PyRAM scales it, so that
+    TL = -20 log10|cp| + 10 log10 r, as in its output routine.
+    """
+    R = np.sqrt(p_r ** 2 + (p_z - p_zs) ** 2) + 1.
+    wavelength = p_c0 / p_freq
+    TL = 20 * np.log10(R) + p_alpha * R / wavelength / 1000.
+    cp = 10 ** (-(TL - 10 * np.log10(p_r)) / 20) \
+        * np.exp(2j * np.pi * R / wavelength)
+    return TL, cp
+
+
+class Fake_PyRAM():
+    """
+    PyRAM's constructor and run(), without the parabolic equation.
+    The defaults and output grid rules are PyRAM's.
+    """
+
+    _np_default = 8
+    _dzf = 0.1
+    _lyrw_default = 20
+
+    def __init__(self, freq, zs, zr, z_ss, rp_ss, cw, z_sb, rp_sb, cb, rhob,
+                 attn, rbzb, **kwargs):
+        self._freq, self._zs, self._zr = freq, zs, zr
+        self._rbzb = np.asarray(rbzb,dtype=float)
+        rp_ss = np.atleast_1d(rp_ss)
+        rp_sb = np.atleast_1d(rp_sb)
+        cw = np.asarray(cw,dtype=float)
+        self._np = kwargs.get('np',Fake_PyRAM._np_default)
+        self._c0 = kwargs.get('c0',np.mean(cw[:,0])
+                              if len(cw.shape) > 1 else np.mean(cw))
+        self._dr = kwargs.get('dr',self._np * 1500 / self._freq)
+        self._dz = kwargs.get('dz',Fake_PyRAM._dzf * 1500 / self._freq)
+        self._ndr = kwargs.get('ndr',1)
+        self._ndz = kwargs.get('ndz',1)
+        self._zmplt = kwargs.get('zmplt',self._rbzb[:,1].max())
+        self._rmax = kwargs.get('rmax',np.max([rp_ss.max(),
+                                               rp_sb.max(),
+                                               self._rbzb[:,0].max()]))
+        self._lyrw = kwargs.get('lyrw',Fake_PyRAM._lyrw_default)
+        self._id = kwargs.get('id',0)
+        self._alpha = float(np.mean(attn))
+        self.proc_time = None
+
+    def run(self):
+        t0 = time.process_time()
+
+        nvr = int(np.floor(self._rmax / (self._dr * self._ndr)))
+        nzplt = int(np.floor(self._zmplt / self._dz))
+        nvz = int(np.floor(nzplt / self._ndz))
+        self.vr = np.arange(1,nvr + 1) * self._dr * self._ndr
+        self.vz = np.arange(1,nvz + 1) * self._dz * self._ndz
+
+        self.tll, self.cpl = _loss(self.vr,self._zr,self._zs,self._alpha,
+                                   self._freq,self._c0)
+        self.tlg, self.cpg = _loss(self.vr[None,:],self.vz[:,None],self._zs,
+                                   self._alpha,self._freq,self._c0)
+
+        # The solver grid: to the deepest point plus the absorbing layer.
+        zmax = self._rbzb[:,1].max() + self._lyrw * self._c0 / self._freq
+        n_cells = int(self._rmax / self._dr) * int(zmax / self._dz)
+        _spend(n_cells)
+
+        self.proc_time = time.process_time() - t0
+        return {'ID' : self._id,
+                'Proc Time' : self.proc_time,
+                'Ranges' : self.vr,
+                'Depths' : self.vz,
+                'TL Grid' : self.tlg,
+                'TL Line' : self.tll,
+                'CP Grid' : self.cpg,
+                'CP Line' : self.cpl,
+                'c0' : self._c0}
+
+
+def create_env2d(**kwargs):
+    """
+    arlpy.uwapm.create_env2d, with its defaults.
+    """
+    env = {'name' : 'arlpy',
+           'type' : '2D',
+           'frequency' : 25000,
+           'soundspeed' : 1500,
+           'soundspeed_interp' : 'spline',
+           'bottom_soundspeed' : 1600,
+           'bottom_density' : 1600,
+           'bottom_absorption' : 0.1,
+           'bottom_roughness' : 0,
+           'surface' : None,
+           'surface_interp' : 'linear',
+           'tx_depth' : 5,
+           'tx_directionality' : None,
+           'rx_depth' : 10,
+           'rx_range' : 1000,
+           'depth' : 25,
+           'depth_interp' : 'linear',
+           'min_angle' : -80,
+           'max_angle' : 80,
+           'nbeams' : 0}
+    for key,value in kwargs.items():
+        env[key] = value
+    return env
+
+
+def compute_transmission_loss(env,
+                              tx_depth_ndx = 0,
+                              mode = 'coherent',
+                              debug = False):
+    """
+    arlpy.uwapm.compute_transmission_loss: complex pressure, a DataFrame
+    indexed by receiver depth with a column per receiver range.
+    The cost is per beam and receiver.
+    """
+    rx_depth = np.atleast_1d(env['rx_depth']).astype(float)
+    rx_range = np.atleast_1d(env['rx_range']).astype(float)
+    # a scalar (arlpy's default) or a [depth, speed] profile
+    c0 = np.mean(np.atleast_1d(np.asarray(env['soundspeed'],dtype=float))[...,-1])
+    _,cp = _loss(rx_range[None,:],rx_depth[:,None],env['tx_depth'],
+                 env['bottom_absorption'],env['frequency'],c0)
+    # back to plain spreading, as arlpy does not divide out the range.
+    cp = cp / np.sqrt(rx_range[None,:])
+    _spend(max(int(env['nbeams']),1) * np.size(cp))
+    return pd.DataFrame(cp,index=rx_depth,columns=rx_range)
+
+
+# Module-like objects, as backends.get_backend returns them.
+PYRAM = SimpleNamespace(PyRAM = Fake_PyRAM)
+ARLPY = SimpleNamespace(create_env2d = create_env2d,
+                        compute_transmission_loss = compute_transmission_loss,
+                        coherent = 'coherent',
+                        incoherent = 'incoherent',
+                        semicoherent = 'semicoherent')
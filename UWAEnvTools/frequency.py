@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Frequency planning for TL sweeps.
+
+Rather than running the model at every frequency bin, run it at a coarse
+set of anchor frequencies, add anchors only where TL changes faster than a
+tolerance between neighbours, and interpolate (or band average) in between.
+"""
+
+import numpy as np
+
+
+class Frequency_Plan():
+    """
+    A set of anchor frequencies, the TL computed at each, and an estimate of
+    the interpolation error between them.
+
+    Interpolation is linear in TL (dB) over log frequency.
+
+    TL values at an anchor are arrays over the same points (e.g. the
+    X,Y points of a corridor run, or a spectrogram grid), so the
+    refinement criterion is a statistic over those points.
+    """
+
+    def __init__(self,
+                 p_f_min,
+                 p_f_max,
+                 p_n_anchors = 8,
+                 p_tolerance = 1.,           # dB
+                 p_resolution = 1.,          # Hz, anchors snap to this
+                 p_max_anchors = 64,
+                 p_percentile = 90,
+                 p_anchors = None):
+        """
+        p_anchors can be passed to use a specific starting set, e.g.
+        the 1/3 octave centres. Otherwise p_n_anchors log-spaced values
+        between p_f_min and p_f_max are used.
+        """
+        self.f_min = p_f_min
+        self.f_max = p_f_max
+        self.tolerance = p_tolerance
+        self.resolution = p_resolution
+        self.max_anchors = p_max_anchors
+        self.percentile = p_percentile
+        if p_anchors is None:
+            p_anchors = np.geomspace(p_f_min,p_f_max,p_n_anchors)
+        self.anchors = sorted(set([self.snap(f) for f in p_anchors]))
+        self.TL = dict()
+        # (f_low, f_high) : estimated error in dB on interpolating inside.
+        self.interval_error = dict()
+        # Anchors with no usable TL (e.g. model failures), never bracketed.
+        self.failed = set()
+        self.errors = dict() # anchor : why refine excluded it
+
+    def snap(self,p_f):
+        """
+        Round to the resolution. Integer resolutions give int frequencies,
+        so result file names match the ones written for integer runs.
+        """
+        f = np.round(p_f / self.resolution) * self.resolution
+        f = max(f,self.resolution)
+        if float(self.resolution).is_integer():
+            return int(f)
+        return float(f)
+
+    def statistic(self,p_abs_difference):
+        return float(np.nanpercentile(p_abs_difference,self.percentile))
+
+    def refine(self,p_TL_function):
+        """
+        p_TL_function(freq) must return TL (dB) array for that frequency.
+        It is called once per anchor, including the anchors added where
+        neighbouring anchors differ by more than the tolerance.
+
+        Refinement is by bisection in log frequency, and stops when the
+        tolerance is met (or the midpoint of the parent interval was
+        interpolated within tolerance), the interval cannot be split at the
+        resolution, or max_anchors is reached.
+        
+        An anchor whose run raises, or returns no finite TL, is excluded
+        (see exclude, the error is kept in self.errors) and the intervals
+        either side of it are checked as one.
+        """
+        for f in self.anchors:
+            if f not in self.TL and f not in self.failed:
+                self.run_anchor(p_TL_function,f)
+
+        usable = self.usable_anchors()
+        to_check = list(zip(usable[:-1],usable[1:]))
+        parent_error = dict()
+        while len(to_check) > 0:
+            f_low, f_high = to_check.pop(0)
+            delta = self.statistic(np.abs(self.TL[f_high] - self.TL[f_low]))
+            f_mid = self.snap(np.sqrt(f_low * f_high))
+            can_split = (f_mid > f_low) and (f_mid < f_high) \
+                and len(self.anchors) < self.max_anchors
+            # A large neighbour difference is fine if the parent split
+            # already showed interpolation is within tolerance here.
+            interp_ok = (f_low,f_high) in parent_error \
+                and parent_error[(f_low,f_high)] <= 0.5 * self.tolerance
+            if can_split and not (delta <= self.tolerance or interp_ok):
+                self.anchors = sorted(self.anchors + [f_mid])
+                # a failed midpoint leaves the interval as it is
+                can_split = self.run_anchor(p_TL_function,f_mid)
+            if delta <= self.tolerance or interp_ok or not can_split:
+                # Half the neighbour difference, unless a parent split
+                # measured the interpolation error directly.
+                estimate = 0.5 * delta
+                if (f_low,f_high) in parent_error:
+                    estimate = min(estimate, parent_error[(f_low,f_high)])
+                self.interval_error[(f_low,f_high)] = estimate
+                continue
+            # How wrong interpolating over the whole interval would have been
+            # at its midpoint, halved for each child interval.
+            measured = self.statistic(np.abs(
+                self.TL[f_mid] - self.interpolate_one(f_mid,f_low,f_high)))
+            parent_error[(f_low,f_mid)] = 0.5 * measured
+            parent_error[(f_mid,f_high)] = 0.5 * measured
+            to_check.append((f_low,f_mid))
+            to_check.append((f_mid,f_high))
+        return self.anchors
+
+    def run_anchor(self,p_TL_function,p_f):
+        """
+        TL at anchor p_f from p_TL_function. Returns False, having
+        excluded the anchor, if the run raised or no TL value is finite.
+        """
+        try:
+            TL = np.asarray(p_TL_function(p_f),dtype=float)
+        except Exception as e:
+            self.errors[p_f] = type(e).__name__ + ': ' + str(e)
+            self.exclude(p_f)
+            return False
+        if not np.any(np.isfinite(TL)):
+            self.errors[p_f] = 'no finite TL'
+            self.exclude(p_f)
+            return False
+        self.TL[p_f] = TL
+        return True
+
+    def interpolate_one(self,p_f,p_f_low,p_f_high,p_values = None):
+        if p_values is None:
+            p_values = self.TL
+        w = np.log(p_f / p_f_low) / np.log(p_f_high / p_f_low)
+        return (1 - w) * p_values[p_f_low] + w * p_values[p_f_high]
+
+    def exclude(self,p_freqs):
+        """
+        Mark anchors as failed. They are skipped by bracket, so frequencies
+        near them are interpolated between the nearest usable anchors.
+        """
+        self.failed.update(np.atleast_1d(p_freqs).tolist())
+
+    def usable_anchors(self):
+        return [f for f in self.anchors if f not in self.failed]
+
+    def bracket(self,p_f):
+        """
+        The usable anchors either side of p_f. Outside their range, the
+        nearest one is returned twice (no extrapolation).
+        """
+        anchors = np.array(self.usable_anchors())
+        if len(anchors) == 0:
+            raise ValueError(
+                'Frequency_Plan.bracket: every anchor has been excluded.')
+        if p_f <= anchors[0]:
+            return anchors[0], anchors[0]
+        if p_f >= anchors[-1]:
+            return anchors[-1], anchors[-1]
+        index = np.searchsorted(anchors,p_f)
+        return anchors[index-1], anchors[index]
+
+    def interpolate(self,p_freqs,p_values = None):
+        """
+        TL at each passed frequency. p_values defaults to self.TL but can
+        be any dictionary keyed by anchor, e.g. TL gridded on to another
+        XY set.
+
+        Returns a dictionary keyed by frequency.
+        """
+        if p_values is None:
+            p_values = self.TL
+        result = dict()
+        for f in np.atleast_1d(p_freqs):
+            f_low, f_high = self.bracket(f)
+            if f_low == f_high:
+                result[f] = p_values[f_low]
+            elif f in p_values and f not in self.failed:
+                result[f] = p_values[f]
+            else:
+                result[f] = self.interpolate_one(f,f_low,f_high,p_values)
+        return result
+
+    def band_average(self,p_f_low,p_f_high,p_n_samples = 32,p_values = None):
+        """
+        Intensity-average TL over the band [p_f_low,p_f_high], using
+        log-spaced samples interpolated from the anchors.
+        """
+        freqs = np.geomspace(p_f_low,p_f_high,p_n_samples)
+        values = self.interpolate(freqs,p_values)
+        intensity = np.mean(
+            [10 ** (-1 * values[f] / 10) for f in freqs], axis = 0)
+        return -10 * np.log10(intensity)
+
+    def estimate_error(self,p_freqs):
+        """
+        Estimated interpolation error (dB) at each passed frequency.
+        Zero at anchors, the interval estimate in between. NaN across an
+        excluded anchor, where no estimate was made.
+        """
+        result = dict()
+        usable = self.usable_anchors()
+        for f in np.atleast_1d(p_freqs):
+            f_low, f_high = self.bracket(f)
+            if f_low == f_high or f in usable:
+                result[f] = 0.
+            else:
+                result[f] = self.interval_error.get((f_low,f_high),np.nan)
+        return result
+
+    def max_error(self):
+        if len(self.interval_error) == 0:
+            return 0.
+        return max(self.interval_error.values())
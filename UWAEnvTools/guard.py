@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Guarded solver calls: timeouts, failure classes, fallbacks and a registry
+of points that failed for good.
+
+    guard = Solver_Guard(p_timeout_s = 120,
+                         p_fallbacks = [{'dr' : 5.},{'dr' : 2.}],
+                         p_registry = Failure_Registry(dir + 'failed.json'))
+    env_RAM.set_guard(guard)
+
+An environment with a guard runs each transect through Solver_Guard.run:
+the first attempt is the transect as set up, then each fallback in turn
+(Environment_RAM understands 'dr', Environment_ARL 'N_BEAMS'). Failures
+are classified (see classify) and only the classes in p_retry_on are
+retried. If every attempt fails the point is written as NaN and the loop
+moves on. If the last failure is of a class in p_register_on the key also
+goes in the registry, and later runs with the same environment skip the
+point without calling the solver. By default only the failures that
+repeat for the same inputs are registered, not timeouts, crashes,
+memory errors or unclassified errors, which can happen once.
+
+Timeouts:
+    'thread'  : the call runs in a daemon thread that is abandoned if it
+                times out. Cheap, works everywhere, but a hung call keeps
+                its CPU until it returns.
+    'process' : the call runs in a forked process that is killed if it
+                times out. Needs fork (not Windows); the result is pickled
+                back to the parent.
+"""
+
+import os
+import json
+import time
+import threading
+import multiprocessing
+
+import numpy as np
+
+from UWAEnvTools.results import hash_items, source_key
+
+
+TIMEOUT_THREAD = 'thread'
+TIMEOUT_PROCESS = 'process'
+
+FAIL_TIMEOUT = 'timeout'
+FAIL_CRASH = 'crash'            # process mode: the child died
+FAIL_INVALID = 'invalid result' # returned, but failed validation
+FAIL_NUMERICAL = 'numerical'
+FAIL_INPUT = 'input'
+FAIL_MEMORY = 'memory'
+FAIL_ERROR = 'error'
+FAIL_KNOWN = 'known failure'    # in the registry, not run
+
+RETRY_DEFAULT = (FAIL_TIMEOUT,
+                 FAIL_CRASH,
+                 FAIL_INVALID,
+                 FAIL_NUMERICAL,
+                 FAIL_INPUT,
+                 FAIL_ERROR)
+
+
+# Failures that repeat for the same inputs, kept in the registry. An
+# unclassified error may be transient (I/O, a backend hiccup), so it is
+# retried but not registered.
+REGISTER_DEFAULT = (FAIL_INVALID,
+                    FAIL_NUMERICAL,
+                    FAIL_INPUT)
+
+
+class Guard_Timeout(Exception):
+    pass
+
+class Guard_Crash(Exception):
+    pass
+
+class Guard_Invalid_Result(Exception):
+    pass
+
+
+def classify(p_exception):
+    if isinstance(p_exception,Guard_Timeout):
+        return FAIL_TIMEOUT
+    if isinstance(p_exception,Guard_Crash):
+        return FAIL_CRASH
+    if isinstance(p_exception,Guard_Invalid_Result):
+        return FAIL_INVALID
+    if isinstance(p_exception,MemoryError):
+        return FAIL_MEMORY
+    if isinstance(p_exception,(FloatingPointError,
+                               ZeroDivisionError,
+                               OverflowError,
+                               np.linalg.LinAlgError)):
+        return FAIL_NUMERICAL
+    if isinstance(p_exception,(ValueError,IndexError,KeyError)):
+        return FAIL_INPUT
+    return FAIL_ERROR
+
+
+def failure_key(p_env_hash,p_freq,p_tx_lat_lon_tuple):
+    """
+    The registry key of one point: environment, frequency and source.
+    """
+    return hash_items(p_env_hash,
+                      float(p_freq),
+                      source_key(p_tx_lat_lon_tuple[0],p_tx_lat_lon_tuple[1]))
+
+
+class Failure_Registry():
+    """
+    Keys of points given up on, persisted as JSON after every addition.
+    """
+
+    def __init__(self,p_fname = None):
+        self.fname = p_fname
+        self.entries = dict()
+        if p_fname is not None and os.path.exists(p_fname):
+            with open(p_fname) as f:
+                self.entries = json.load(f)
+
+    def __contains__(self,p_key):
+        return p_key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self,p_key,p_kind,p_error,**kwargs):
+        entry = {'kind' : p_kind,
+                 'error' : str(p_error),
+                 'time' : time.strftime('%Y-%m-%d %H:%M:%S')}
+        entry.update(kwargs)
+        self.entries[p_key] = entry
+        self.save()
+
+    def remove(self,p_key):
+        if p_key in self.entries:
+            del self.entries[p_key]
+            self.save()
+
+    def save(self):
+        if self.fname is None:
+            return
+        temp = self.fname + '.tmp'
+        with open(temp,'w') as f:
+            json.dump(self.entries,f,indent=1,default=str)
+        os.replace(temp,self.fname)
+
+
+def _call_in_child(p_conn,p_function,p_args):
+    try:
+        value = (True,p_function(*p_args))
+    except BaseException as e:
+        value = (False,e)
+    try:
+        p_conn.send(value)
+    except Exception as e: # unpicklable result or exception
+        p_conn.send((False,RuntimeError(repr(value[1])[:1000] + ' / ' + repr(e))))
+    p_conn.close()
+
+
+class Solver_Guard():
+
+    def __init__(self,
+                 p_timeout_s = None,
+                 p_mode = TIMEOUT_THREAD,
+                 p_fallbacks = (),
+                 p_retry_on = RETRY_DEFAULT,
+                 p_give_up_nan = True,
+                 p_registry = None,
+                 p_register_on = REGISTER_DEFAULT):
+        """
+        p_timeout_s : per attempt, None for no timeout.
+        p_fallbacks : list of dicts of overrides, tried in order.
+        p_give_up_nan : True, a point that fails every attempt is NaN.
+            False, the last failure is raised.
+        p_registry : Failure_Registry, default an in-memory one.
+        p_register_on : failure classes that put a given up point in the
+            registry, so it is skipped from then on.
+        """
+        if p_mode not in (TIMEOUT_THREAD,TIMEOUT_PROCESS):
+            raise ValueError('Solver_Guard: unknown timeout mode ' + str(p_mode))
+        self.timeout_s = p_timeout_s
+        self.mode = p_mode
+        self.fallbacks = list(p_fallbacks)
+        self.retry_on = tuple(p_retry_on)
+        self.give_up_nan = p_give_up_nan
+        self.registry = Failure_Registry() if p_registry is None else p_registry
+        self.register_on = tuple(p_register_on)
+        self.last_failure = None
+        self.stats = {'calls' : 0,
+                      'retries' : 0,
+                      'recovered' : 0,
+                      'given_up' : 0,
+                      'skipped' : 0,
+                      'failures' : dict()}
+
+    def call(self,p_function,*args):
+        """
+        p_function(*args) with the timeout applied.
+        """
+        if self.timeout_s is None:
+            return p_function(*args)
+        if self.mode == TIMEOUT_THREAD:
+            return self._call_thread(p_function,args)
+        return self._call_process(p_function,args)
+
+    def _call_thread(self,p_function,p_args):
+        box = dict()
+        def target():
+            try:
+                box['value'] = p_function(*p_args)
+            except BaseException as e:
+                box['error'] = e
+        thread = threading.Thread(target = target,daemon = True)
+        thread.start()
+        thread.join(self.timeout_s)
+        if thread.is_alive():
+            raise Guard_Timeout('no result after ' + str(self.timeout_s) + ' s')
+        if 'error' in box:
+            raise box['error']
+        return box['value']
+
+    def _call_process(self,p_function,p_args):
+        context = multiprocessing.get_context('fork')
+        receiver,sender = context.Pipe(duplex = False)
+        process = context.Process(target = _call_in_child,
+                                  args = (sender,p_function,p_args),
+                                  daemon = True)
+        process.start()
+        sender.close()
+        try:
+            if not receiver.poll(self.timeout_s):
+                process.kill()
+                raise Guard_Timeout('no result after ' + str(self.timeout_s) + ' s')
+            try:
+                ok,value = receiver.recv()
+            except EOFError:
+                raise Guard_Crash('solver process exited with code ' \
+                                  + str(process.exitcode))
+        finally:
+            receiver.close()
+            process.join()
+        if not ok:
+            raise value
+        return value
+
+    def run(self,p_key,p_attempt,p_validate = None,**kwargs):
+        """
+        p_attempt(overrides) for {} then each fallback until one returns
+        a result that p_validate (if passed) accepts.
+
+        Returns the result, or None if the point was given up on (now or,
+        if registered, in an earlier run). kwargs are stored with a 
+        registry entry.
+        """
+        if p_key in self.registry:
+            self.stats['skipped'] = self.stats['skipped'] + 1
+            self.last_failure = Guard_Invalid_Result(
+                FAIL_KNOWN + ': ' + self.registry.entries[p_key]['kind'])
+            return None
+        self.stats['calls'] = self.stats['calls'] + 1
+        error = None
+        for n,overrides in enumerate([dict()] + self.fallbacks):
+            if n > 0:
+                self.stats['retries'] = self.stats['retries'] + 1
+            try:
+                result = self.call(p_attempt,overrides)
+                if p_validate is not None and not p_validate(result):
+                    raise Guard_Invalid_Result('result failed validation')
+                if n > 0:
+                    self.stats['recovered'] = self.stats['recovered'] + 1
+                return result
+            except Exception as e:
+                error = e
+                kind = classify(e)
+                failures = self.stats['failures']
+                failures[kind] = failures.get(kind,0) + 1
+                if kind not in self.retry_on:
+                    break
+        self.stats['given_up'] = self.stats['given_up'] + 1
+        self.last_failure = error
+        if classify(error) in self.register_on:
+            self.registry.add(p_key,classify(error),
+                              type(error).__name__ + ': ' + str(error),
+                              **kwargs)
+        if not self.give_up_nan:
+            raise error
+        return None
+
+    def summary(self):
+        return 'Solver_Guard: ' + str(self.stats['calls']) + ' calls, '\
+            + str(self.stats['retries']) + ' retries, '\
+            + str(self.stats['recovered']) + ' recovered, '\
+            + str(self.stats['given_up']) + ' given up, '\
+            + str(self.stats['skipped']) + ' skipped as known failures. '\
+            + 'Failures by kind: ' + str(self.stats['failures'])
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage wall time, CPU time and peak allocation.
+
+Off by default. Turn it on with the environment variable
+
+    UWAENVTOOLS_INSTRUMENT=1        wall and CPU time
+    UWAENVTOOLS_INSTRUMENT=memory   also peak allocation (tracemalloc)
+
+or with enable(). While off, stage() returns a shared do-nothing context
+and record() returns at once, so the hooks left in the library cost a
+function call each.
+
+The library marks its stages with
+
+    with instrument.stage(instrument.STAGE_SOLVER):
+        ...
+
+Stages can nest (environment construction includes basis building), and
+times are inclusive. Each stage accumulates its count, total and max wall
+time, CPU time and the largest peak allocation above the level at entry,
+in the current Report. start_run / end_run (or the run context) start a
+fresh Report per run and keep the finished ones in runs().
+"""
+
+import os
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+ENV_VAR = 'UWAENVTOOLS_INSTRUMENT'
+
+STAGE_BATHY_LOAD = 'bathy load'
+STAGE_GRIDDING = 'gridding'
+STAGE_BASIS = 'basis'
+STAGE_ENVIRONMENT = 'environment'
+STAGE_SOLVER = 'solver'
+STAGE_SOLVER_REPORTED = 'solver (reported)' # the solver's own timing
+STAGE_INTERPOLATION = 'interpolation'
+STAGE_WRITE = 'write'
+
+
+class Report():
+    """
+    Accumulated stage statistics for one run.
+    """
+
+    def __init__(self,p_name = ''):
+        self.name = p_name
+        self.started = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.stages = dict()
+        self._lock = threading.Lock()
+
+    def add(self,p_stage,p_wall = 0.,p_cpu = 0.,p_peak = 0):
+        with self._lock:
+            if p_stage not in self.stages:
+                self.stages[p_stage] = {'count' : 0,
+                                        'wall_s' : 0.,
+                                        'wall_max_s' : 0.,
+                                        'cpu_s' : 0.,
+                                        'peak_bytes' : 0}
+            stats = self.stages[p_stage]
+            stats['count'] = stats['count'] + 1
+            stats['wall_s'] = stats['wall_s'] + p_wall
+            stats['wall_max_s'] = max(stats['wall_max_s'],p_wall)
+            stats['cpu_s'] = stats['cpu_s'] + p_cpu
+            stats['peak_bytes'] = max(stats['peak_bytes'],int(p_peak))
+
+    def to_dict(self):
+        return {'name' : self.name,
+                'started' : self.started,
+                'stages' : {k : dict(v) for k,v in self.stages.items()}}
+
+    def to_json(self,p_fname):
+        with open(p_fname,'w') as f:
+            json.dump(self.to_dict(),f,indent=1)
+
+    def summary_table(self):
+        lines = []
+        lines.append('Instrumentation: ' + str(self.name) + ' (' + self.started + ')')
+        lines.append('stage'.ljust(20) + 'count'.rjust(8) + 'wall s'.rjust(11)
+                     + 'mean ms'.rjust(11) + 'max ms'.rjust(11)
+                     + 'cpu s'.rjust(11) + 'peak MB'.rjust(10))
+        for name,stats in self.stages.items():
+            mean_ms = 1000 * stats['wall_s'] / max(stats['count'],1)
+            lines.append(name.ljust(20)
+                         + str(stats['count']).rjust(8)
+                         + format(stats['wall_s'],'.3f').rjust(11)
+                         + format(mean_ms,'.3f').rjust(11)
+                         + format(1000 * stats['wall_max_s'],'.3f').rjust(11)
+                         + format(stats['cpu_s'],'.3f').rjust(11)
+                         + format(stats['peak_bytes'] / 2**20,'.1f').rjust(10))
+        return '\n'.join(lines)
+
+
+def _from_environment():
+    value = os.environ.get(ENV_VAR,'').strip().lower()
+    enabled = value not in ('','0','false','off','no')
+    return enabled, value == 'memory'
+
+
+_ENABLED, _MEMORY = _from_environment()
+_STATE = {'enabled' : _ENABLED,
+          'memory' : _MEMORY,
+          'report' : Report(),
+          'runs' : [],
+          'tracing' : False} # tracemalloc started here
+_LOCAL = threading.local() # per thread stack of open stages, for the peaks
+
+
+def enable(p_memory = False):
+    _STATE['enabled'] = True
+    _STATE['memory'] = bool(p_memory)
+    if p_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _STATE['tracing'] = True
+
+
+def disable():
+    _STATE['enabled'] = False
+    _STATE['memory'] = False
+    if _STATE['tracing']: # tracing slows everything, stop it if ours
+        tracemalloc.stop()
+        _STATE['tracing'] = False
+
+
+def is_enabled():
+    return _STATE['enabled']
+
+
+if _STATE['memory']:
+    enable(p_memory = True)
+
+
+class _Null_Stage():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        return False
+
+_NULL_STAGE = _Null_Stage()
+
+
+class _Stage():
+
+    def __init__(self,p_name):
+        self.name = p_name
+        self.memory = _STATE['memory'] and tracemalloc.is_tracing()
+
+    def __enter__(self):
+        if self.memory:
+            stack = _stack()
+            current, peak = tracemalloc.get_traced_memory()
+            if len(stack) > 0: # keep the parent's peak before resetting
+                stack[-1].peak = max(stack[-1].peak,peak)
+            tracemalloc.reset_peak()
+            self.start_bytes = current
+            self.peak = current
+            stack.append(self)
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self,*args):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        peak_bytes = 0
+        if self.memory:
+            stack = _stack()
+            if len(stack) > 0 and stack[-1] is self:
+                stack.pop()
+                peak = max(self.peak,tracemalloc.get_traced_memory()[1])
+                peak_bytes = peak - self.start_bytes
+                if len(stack) > 0:
+                    stack[-1].peak = max(stack[-1].peak,peak)
+        _STATE['report'].add(self.name,wall,cpu,peak_bytes)
+        return False
+
+
+def _stack():
+    if not hasattr(_LOCAL,'stack'):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+def stage(p_name):
+    """
+    Context manager timing the block as stage p_name.
+    """
+    if not _STATE['enabled']:
+        return _NULL_STAGE
+    return _Stage(p_name)
+
+
+def record(p_name,p_wall = 0.,p_cpu = 0.,p_peak = 0):
+    """
+    Add an externally measured stage, e.g. a solver's own processing time.
+    """
+    if not _STATE['enabled']:
+        return
+    _STATE['report'].add(p_name,p_wall,p_cpu,p_peak)
+
+
+def report():
+    return _STATE['report']
+
+
+def runs():
+    return list(_STATE['runs'])
+
+
+def start_run(p_name = ''):
+    """
+    Start a fresh Report. Stages recorded since the last run are dropped.
+    """
+    _STATE['report'] = Report(p_name)
+    return _STATE['report']
+
+
+def end_run():
+    """
+    Finish the current Report, keep it in runs() and return it.
+    """
+    finished = _STATE['report']
+    _STATE['runs'].append(finished)
+    _STATE['report'] = Report()
+    return finished
+
+
+@contextmanager
+def run(p_name = ''):
+    start_run(p_name)
+    try:
+        yield _STATE['report']
+    finally:
+        end_run()
+
+
+def export_json(p_fname,p_reports = None):
+    """
+    All finished runs (or the passed Reports) to one JSON file.
+    """
+    if p_reports is None:
+        p_reports = _STATE['runs']
+    with open(p_fname,'w') as f:
+        json.dump({'runs' : [r.to_dict() for r in p_reports]},f,indent=1)
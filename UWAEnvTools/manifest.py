@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+"""
+Declarative run manifests.
+
+A manifest (JSON, or YAML if PyYAML is installed) lists what to run, and
+Manifest_Planner expands it in to a Task_Graph in which every shared stage
+appears once: a location's bathymetry, SSP and seabed are prepared once
+and baked in to one bundle (bundle.py), a source course is built and
+prefiltered once per receiver, and each (receiver, model, frequency)
+run is one node however many times the manifest asks for it. The graph
+estimates its cost before anything runs, and execute runs it.
+
+    {
+     "name" : "Pat Bay sweep",
+     "output_dir" : "/data/RAM/",
+     "defaults" : {"frequencies" : [40,100,200],
+                   "models" : [{"backend" : "pyram","dr" : 1.0}]},
+     "locations" : [
+        {"location" : "Patricia Bay",
+         "receivers" : [{"name" : "North","hydrophone" : 1},
+                        {"name" : "South","hydrophone" : 2}],
+         "sources" : {"grid" : [100,100],"depth" : 1.7,"prefilter" : true}}
+        ]
+    }
+
+    graph = Manifest_Planner().plan(load_manifest('sweep.json'))
+    print(graph.summary(p_n_workers = 8))
+    execute(graph)                 # or execute(graph,p_pool = pool)
+
+Keys, at the top level, under "defaults", or per location (the most
+specific wins):
+
+    frequencies  list of Hz
+    models       list of {"name", "backend", "dr", "output", "mode",
+                 "basis_size_depth", "basis_size_distance"}; missing keys
+                 from MODEL_DEFAULTS. name defaults to <backend>_dr<dr>.
+    bathymetry   {"class" : key of BATHYMETRY_CLASSES, "n_points_lat",
+                 "n_points_lon", "depth_offset"}
+    ssp          {"class" : key of SSP_CLASSES}, the profile file is the
+                 location's.
+    depth_estimate  m, for the cost estimate when there is no bundle yet.
+    incremental  true to only run points missing from the result files.
+
+Per location only: "location" (a locations.Location string) or "bundle"
+(an already baked bundle file), "receivers" (each {"name" and either
+"hydrophone" : 1 or 2, or "lat", "lon", "depth"}) and "sources"
+({"grid" : [n_lat,n_lon]} over the location corridor, or "points" :
+[[lat,lon],...]; optional "depth" and "prefilter").
+
+Results go to <output_dir>/<location>/<model name>/ as the usual per
+frequency files. Only Environment_RAM models are planned, so the backend
+must provide PyRAM (RAM_BACKENDS, or a registered backend that does).
+"""
+
+import os
+import re
+import json
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from UWAEnvTools.backends import Lazy_Module, Backend_Error, get_backend
+from UWAEnvTools.results import hash_items
+
+yaml = Lazy_Module('yaml')
+
+
+STAGE_BATHYMETRY = 'bathymetry'
+STAGE_SSP = 'ssp'
+STAGE_SEABED = 'seabed'
+STAGE_BUNDLE = 'bundle'
+STAGE_TRANSECTS = 'transects'
+STAGE_RUN = 'run'
+STAGES = (STAGE_BATHYMETRY,
+          STAGE_SSP,
+          STAGE_SEABED,
+          STAGE_BUNDLE,
+          STAGE_TRANSECTS,
+          STAGE_RUN)
+
+MODEL_DEFAULTS = {'backend' : 'pyram',
+                  'dr' : 1.,
+                  'output' : 'LINE',
+                  'mode' : 'LINE',
+                  'basis_size_depth' : 100,
+                  'basis_size_distance' : 100}
+
+# Backends known to provide PyRAM without importing them to check.
+RAM_BACKENDS = ('pyram','fake_pyram')
+
+BATHYMETRY_DEFAULTS = {'class' : 'CHS_2',
+                       'n_points_lat' : 80,
+                       'n_points_lon' : 200,
+                       'depth_offset' : 0}
+
+SSP_DEFAULTS = {'class' : 'Blouin_2015'}
+
+# names in bathymetry.py and ssp.py, imported when a stage runs
+BATHYMETRY_CLASSES = {'CHS_2' : 'Bathymetry_CHS_2',
+                      'CHS_10_100' : 'Bathymetry_CHS_10_100',
+                      'WOD' : 'Bathymetry_WOD'}
+
+SSP_CLASSES = {'Blouin_2015' : 'SSP_Blouin_2015',
+               'Munk' : 'SSP_Munk',
+               'Isovelocity' : 'SSP_Isovelocity',
+               'Measured' : 'SSP_Measured'}
+
+SOURCE_DEPTH_DEFAULT = 1.7
+DEPTH_ESTIMATE_DEFAULT = 100. # m
+
+# Rough, from PyRAM on one machine; PyRAM's time is mostly per range step.
+# Change with set_cost_model.
+COST_MODEL = {'seconds_per_transect' : 2e-3,
+              'seconds_per_step' : 3e-4,
+              'seconds_per_cell' : 2e-8, # per step and depth point
+              'seconds_bathymetry' : 30.,
+              'seconds_ssp' : 1.,
+              'seconds_seabed' : 1.,
+              'seconds_bundle' : 2.,
+              'seconds_transects_per_point' : 1e-4}
+
+
+def set_cost_model(**kwargs):
+    for key,value in kwargs.items():
+        if key not in COST_MODEL:
+            raise KeyError('set_cost_model: unknown key ' + str(key))
+        COST_MODEL[key] = float(value)
+
+
+class Manifest_Error(Exception):
+    pass
+
+
+def load_manifest(p_fname):
+    """
+    A manifest dictionary from a .json, .yaml or .yml file.
+    """
+    with open(p_fname) as f:
+        if p_fname.lower().endswith(('.yaml','.yml')):
+            try:
+                return yaml.safe_load(f)
+            except ImportError:
+                raise Manifest_Error('YAML manifests need PyYAML, '\
+                                     'or write the manifest as JSON.')
+        return json.load(f)
+
+
+def _slug(p_string):
+    return re.sub(r'[^A-Za-z0-9_.-]+','_',str(p_string)).strip('_')
+
+
+class Stage():
+    """
+    One node of the graph. key is a hash of the inputs, so equal stages
+    have equal keys.
+    """
+
+    def __init__(self,p_kind,p_key,p_inputs,p_depends,p_cost_s,p_cached = False):
+        self.kind = p_kind
+        self.key = p_key
+        self.inputs = p_inputs
+        self.depends = list(p_depends)
+        self.cost_s = p_cost_s
+        self.cached = p_cached
+
+    def to_dict(self):
+        return {'kind' : self.kind,
+                'key' : self.key,
+                'depends' : self.depends,
+                'cost_s' : self.cost_s,
+                'cached' : self.cached,
+                'inputs' : self.inputs}
+
+
+class Task_Graph():
+    """
+    Stages in dependency order (every stage after the ones it depends on).
+    """
+
+    def __init__(self,p_name = ''):
+        self.name = p_name
+        self.stages = OrderedDict()
+        self.requested = dict([(kind,0) for kind in STAGES])
+
+    def add(self,p_kind,p_inputs,p_depends = (),p_cost_s = 0.,p_cached = False):
+        """
+        Add a stage, or find the equal one already there. Returns its key.
+        A stage is cached only if every request for it is: a bathymetry
+        shared by a baked bundle and one still to bake has to run.
+        """
+        self.requested[p_kind] = self.requested[p_kind] + 1
+        key = p_kind + ':' + hash_items(p_kind,p_inputs)[:16]
+        if key not in self.stages:
+            self.stages[key] = Stage(p_kind,key,p_inputs,p_depends,p_cost_s,p_cached)
+        else:
+            self.stages[key].cached = self.stages[key].cached and p_cached
+        return key
+
+    def by_kind(self,p_kind):
+        return [s for s in self.stages.values() if s.kind == p_kind]
+
+    def estimate(self):
+        """
+        Estimated seconds by stage kind, cached stages excluded. Runs are
+        costed in full, also incremental ones.
+        """
+        result = dict([(kind,0.) for kind in STAGES])
+        for stage in self.stages.values():
+            if not stage.cached:
+                result[stage.kind] = result[stage.kind] + stage.cost_s
+        return result
+
+    def summary(self,p_n_workers = 1):
+        """
+        Table of stages requested, unique after deduplication, points and
+        estimated time, with the wall time on p_n_workers workers (runs
+        spread evenly, preparation serial). Points and costs are counted
+        on the course before any prefilter, which only runs in execute.
+        """
+        estimate = self.estimate()
+        lines = ['Plan: ' + str(self.name)]
+        lines.append('stage'.ljust(12) + 'requested'.rjust(11) + 'unique'.rjust(9)
+                     + 'cached'.rjust(9) + 'points'.rjust(10) + 'est. s'.rjust(12))
+        for kind in STAGES:
+            stages = self.by_kind(kind)
+            points = sum([s.inputs.get('n_points',0) for s in stages])
+            lines.append(kind.ljust(12)
+                         + str(self.requested[kind]).rjust(11)
+                         + str(len(stages)).rjust(9)
+                         + str(sum([1 for s in stages if s.cached])).rjust(9)
+                         + (str(points) if points > 0 else '').rjust(10)
+                         + format(estimate[kind],'.1f').rjust(12))
+        preparation = sum([estimate[k] for k in STAGES if k != STAGE_RUN])
+        wall = preparation + estimate[STAGE_RUN] / max(int(p_n_workers),1)
+        lines.append('Estimated total ' + format(sum(estimate.values()),'.0f') \
+                     + ' s, about ' + format(wall,'.0f') + ' s wall on ' \
+                     + str(p_n_workers) + ' worker(s).')
+        if any([s.inputs.get('prefilter',False) 
+                for s in self.by_kind(STAGE_TRANSECTS)]):
+            lines.append('Points and run estimates are before prefiltering, '\
+                         'so an upper bound where prefilter is set.')
+        return '\n'.join(lines)
+
+    def to_json(self,p_fname):
+        with open(p_fname,'w') as f:
+            json.dump({'name' : self.name,
+                       'created' : time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'estimate_s' : self.estimate(),
+                       'stages' : [s.to_dict() for s in self.stages.values()]},
+                      f,indent=1,default=str)
+
+
+class Manifest_Planner():
+
+    def __init__(self,p_cost_model = None):
+        """
+        p_cost_model : overrides of COST_MODEL for this planner.
+        """
+        self.cost = dict(COST_MODEL)
+        if p_cost_model is not None:
+            self.cost.update(p_cost_model)
+
+    def plan(self,p_manifest):
+        graph = Task_Graph(p_manifest.get('name',''))
+        if 'locations' not in p_manifest or len(p_manifest['locations']) == 0:
+            raise Manifest_Error('Manifest: no locations.')
+        output_dir = p_manifest.get('output_dir','.')
+        for n,entry in enumerate(p_manifest['locations']):
+            settings = dict(p_manifest)
+            settings.update(p_manifest.get('defaults',dict()))
+            settings.update(entry)
+            try:
+                self._plan_location(graph,settings,output_dir)
+            except KeyError as e:
+                raise Manifest_Error('Manifest location ' + str(n) \
+                                     + ': missing ' + str(e))
+        return graph
+
+    def _location(self,p_settings):
+        # Building a Location is only attribute assignments.
+        if 'bundle' in p_settings and os.path.exists(p_settings['bundle']):
+            from UWAEnvTools.bundle import Location_Bundle
+            return Location_Bundle(p_settings['bundle']).location
+        from UWAEnvTools.locations import Location
+        location = Location(p_settings['location'])
+        if not hasattr(location,'location_title'):
+            raise Manifest_Error('Manifest: unknown location ' \
+                                 + str(p_settings['location']))
+        return location
+
+    def _plan_location(self,p_graph,p_settings,p_output_dir):
+        location = self._location(p_settings)
+        title = location.location_title
+        dir_location = os.path.join(p_output_dir,_slug(title))
+
+        bundle_key = self._plan_bundle(p_graph,p_settings,dir_location)
+        bundle = p_graph.stages[bundle_key].inputs['fname']
+
+        receivers = [self._receiver(location,r) for r in p_settings['receivers']]
+        course = self._course(location,p_settings['sources'])
+        sources = p_settings['sources']
+        depth = float(p_settings.get('depth_estimate',DEPTH_ESTIMATE_DEFAULT))
+        incremental = bool(p_settings.get('incremental',False))
+        models = [self._model(m) for m in p_settings['models']]
+        names = dict()
+        for model in models:
+            if names.setdefault(model['name'],model) != model:
+                raise Manifest_Error('Manifest: two different models named ' \
+                                     + model['name'])
+        for receiver in receivers:
+            # The course as seen from one receiver (prefiltered for it),
+            # shared by every model and frequency run to that receiver.
+            transects_key = p_graph.add(
+                STAGE_TRANSECTS,
+                {'bundle' : bundle,
+                 'course' : course,
+                 'depth' : sources.get('depth',SOURCE_DEPTH_DEFAULT),
+                 'prefilter' : bool(sources.get('prefilter',False)),
+                 'receiver' : [receiver['lat'],receiver['lon']],
+                 'n_points' : len(course)},
+                [bundle_key],
+                self.cost['seconds_transects_per_point'] * len(course))
+            ranges = self._ranges((receiver['lat'],receiver['lon']),course)
+            for model in models:
+                for freq in p_settings['frequencies']:
+                    p_graph.add(
+                        STAGE_RUN,
+                        {'bundle' : bundle,
+                         'transects' : transects_key,
+                         'receiver' : receiver,
+                         'model' : model,
+                         'freq' : freq,
+                         'incremental' : incremental,
+                         'dir' : os.path.join(dir_location,_slug(model['name'])) + os.sep,
+                         'n_points' : len(course)},
+                        [bundle_key,transects_key],
+                        self._run_cost(ranges,depth,float(freq),model['dr']))
+
+    def _plan_bundle(self,p_graph,p_settings,p_dir_location):
+        if 'bundle' in p_settings:
+            fname = p_settings['bundle']
+            if not os.path.exists(fname):
+                raise Manifest_Error('Manifest: no bundle file ' + str(fname))
+            return p_graph.add(STAGE_BUNDLE,{'fname' : fname,'baked' : True},
+                               p_cached = True)
+        bathymetry = dict(BATHYMETRY_DEFAULTS)
+        bathymetry.update(p_settings.get('bathymetry',dict()))
+        ssp = dict(SSP_DEFAULTS)
+        ssp.update(p_settings.get('ssp',dict()))
+        if bathymetry['class'] not in BATHYMETRY_CLASSES:
+            raise Manifest_Error('Manifest: unknown bathymetry class ' \
+                                 + str(bathymetry['class']))
+        if ssp['class'] not in SSP_CLASSES:
+            raise Manifest_Error('Manifest: unknown ssp class ' + str(ssp['class']))
+        location = p_settings['location']
+
+        bathy_inputs = {'location' : location,'bathymetry' : bathymetry}
+        # Bundles are named by what went in to them, an existing one is
+        # reused and the stages that make it are not run.
+        key = hash_items(bathy_inputs,ssp)[:16]
+        fname = os.path.join(p_dir_location,'bundle_' + key + '.npz')
+        cached = os.path.exists(fname)
+        bathy_key = p_graph.add(STAGE_BATHYMETRY,bathy_inputs,
+                                p_cost_s = self.cost['seconds_bathymetry'],
+                                p_cached = cached)
+        ssp_key = p_graph.add(STAGE_SSP,{'location' : location,
+                                         'bathymetry' : bathy_key,
+                                         'ssp' : ssp},
+                              [bathy_key],
+                              self.cost['seconds_ssp'],
+                              cached)
+        seabed_key = p_graph.add(STAGE_SEABED,{'location' : location,
+                                               'bathymetry' : bathy_key},
+                                 [bathy_key],
+                                 self.cost['seconds_seabed'],
+                                 cached)
+        return p_graph.add(STAGE_BUNDLE,
+                           {'fname' : fname,'baked' : False},
+                           [bathy_key,ssp_key,seabed_key],
+                           self.cost['seconds_bundle'],
+                           cached)
+
+    def _receiver(self,p_location,p_receiver):
+        if 'hydrophone' in p_receiver:
+            n = str(int(p_receiver['hydrophone']))
+            return {'name' : p_receiver.get('name','hyd_' + n),
+                    'lat' : float(getattr(p_location,'hyd_' + n + '_lat')),
+                    'lon' : float(getattr(p_location,'hyd_' + n + '_lon')),
+                    'depth' : float(p_receiver.get(
+                        'depth',getattr(p_location,'hyd_' + n + '_z')))}
+        return {'name' : p_receiver['name'],
+                'lat' : float(p_receiver['lat']),
+                'lon' : float(p_receiver['lon']),
+                'depth' : float(p_receiver['depth'])}
+
+    def _course(self,p_location,p_sources):
+        if 'points' in p_sources:
+            return [[float(la),float(lo)] for la,lo in p_sources['points']]
+        from UWAEnvTools.source import Source
+        n_lat,n_lon = p_sources['grid']
+        source = Source()
+        source.generate_course_from_grid(
+            p_sources.get('lat_range',p_location.LAT_RANGE_CORRIDOR_TUPLE),
+            p_sources.get('lon_range',p_location.LON_RANGE_CORRIDOR_TUPLE),
+            int(n_lat),
+            int(n_lon))
+        return [[float(la),float(lo)] for la,lo in source.course]
+
+    def _model(self,p_model):
+        model = dict(MODEL_DEFAULTS)
+        model.update(p_model)
+        unknown = set(model.keys()) - set(MODEL_DEFAULTS.keys()) - {'name'}
+        if len(unknown) > 0:
+            raise Manifest_Error('Manifest: unknown model keys ' + str(sorted(unknown)))
+        self._check_backend(model['backend'])
+        model['dr'] = float(model['dr'])
+        if 'name' not in model:
+            model['name'] = model['backend'] + '_dr' + format(model['dr'],'g')
+        return model
+
+    def _check_backend(self,p_name):
+        """
+        Runs are Environment_RAM runs, so fail at plan time, before any
+        preparation, on a backend without PyRAM.
+        """
+        if p_name in RAM_BACKENDS:
+            return
+        try:
+            backend = get_backend(p_name)
+        except Backend_Error as e:
+            raise Manifest_Error('Manifest: backend ' + str(p_name) \
+                                 + ' cannot be used, ' + str(e))
+        if not hasattr(backend,'PyRAM'):
+            raise Manifest_Error('Manifest: backend ' + str(p_name) \
+                                 + ' has no PyRAM, only Environment_RAM runs '\
+                                     'are planned (e.g. ' + str(RAM_BACKENDS) + ').')
+
+    def _ranges(self,p_rx,p_course):
+        from UWAEnvTools.environment import Approximations
+        flat_earth_approx = Approximations()
+        return np.array([np.hypot(*flat_earth_approx.latlon_to_xy(p_rx,tx))
+                         for tx in p_course])
+
+    def _run_cost(self,p_ranges,p_depth,p_freq,p_dr):
+        # PyRAM's depth step is 0.1 wavelength, plus an absorbing layer
+        # of 20 wavelengths below the bottom.
+        steps = np.sum(p_ranges) / p_dr
+        n_depth = p_depth * p_freq / 150. + 200.
+        return len(p_ranges) * self.cost['seconds_per_transect'] \
+            + steps * self.cost['seconds_per_step'] \
+            + steps * n_depth * self.cost['seconds_per_cell']
+
+
+def execute(p_graph,p_pool = None,p_verbose = True):
+    """
+    Run the stages of p_graph in order, skipping cached ones. Runs that
+    share a receiver and model are done as one environment over their
+    frequencies. p_pool is an optional workers.Worker_Pool for the runs.
+
+    Returns {(bundle, receiver name, model name) : Environment_RAM}.
+    """
+    import UWAEnvTools.bathymetry as bathymetry_module
+    import UWAEnvTools.ssp as ssp_module
+    from UWAEnvTools.locations import Location
+    from UWAEnvTools.environment import Environment_RAM
+    from UWAEnvTools.bundle import bake_location_bundle, Location_Bundle
+    from UWAEnvTools.source import Source
+
+    artifacts = dict()
+    runs = OrderedDict()
+    for stage in p_graph.stages.values():
+        if stage.kind == STAGE_RUN:
+            inputs = stage.inputs
+            group = (inputs['bundle'],inputs['transects'],
+                     inputs['receiver']['name'],inputs['model']['name'],
+                     inputs['dir'],inputs['incremental'])
+            runs.setdefault(group,[stage,[]])[1].append(inputs['freq'])
+            continue
+        if stage.cached:
+            continue
+        if p_verbose:
+            print('Stage ' + stage.key)
+        inputs = stage.inputs
+        if stage.kind == STAGE_BATHYMETRY:
+            settings = inputs['bathymetry']
+            location = Location(inputs['location'])
+            bathy = getattr(bathymetry_module,
+                            BATHYMETRY_CLASSES[settings['class']])()
+            bathy.get_2d_bathymetry_trimmed(
+                p_location_as_object = location,
+                p_num_points_lon = settings['n_points_lon'],
+                p_num_points_lat = settings['n_points_lat'],
+                p_depth_offset = settings['depth_offset'])
+            env = Environment_RAM(location,
+                                  settings['n_points_lat'],
+                                  settings['n_points_lon'])
+            env.set_bathymetry_common(bathy)
+            artifacts[stage.key] = env
+        elif stage.kind == STAGE_SSP:
+            env = artifacts[inputs['bathymetry']]
+            env.set_ssp_common(getattr(ssp_module,
+                                       SSP_CLASSES[inputs['ssp']['class']])())
+            artifacts[stage.key] = env.ssp
+        elif stage.kind == STAGE_SEABED:
+            env = artifacts[inputs['bathymetry']]
+            env.set_seabed_common()
+            artifacts[stage.key] = env.bottom_profile
+        elif stage.kind == STAGE_BUNDLE:
+            env = artifacts[stage.depends[0]]
+            os.makedirs(os.path.dirname(os.path.abspath(inputs['fname'])),exist_ok=True)
+            bake_location_bundle(inputs['fname'],
+                                 env.location,
+                                 env.bathymetry,
+                                 artifacts[stage.depends[1]],
+                                 artifacts[stage.depends[2]])
+        elif stage.kind == STAGE_TRANSECTS:
+            bundle = Location_Bundle(inputs['bundle'])
+            source = Source()
+            source.set_name()
+            source.set_depth(inputs['depth'])
+            source.set_speed()
+            source.course = [tuple(tx) for tx in inputs['course']]
+            if inputs['prefilter']:
+                source.prefilter_course(bundle.bathymetry,[tuple(inputs['receiver'])])
+            artifacts[stage.key] = source
+
+    envs = dict()
+    bundles = dict()
+    for group,(stage,freqs) in runs.items():
+        inputs = stage.inputs
+        if inputs['bundle'] not in bundles:
+            bundles[inputs['bundle']] = Location_Bundle(inputs['bundle'])
+        receiver = inputs['receiver']
+        model = inputs['model']
+        if p_verbose:
+            print('Run ' + receiver['name'] + ', ' + model['name'] + ' at ' \
+                  + str(freqs) + ' Hz')
+        env = bundles[inputs['bundle']].make_environment(Environment_RAM)
+        env.set_hydrophone_name(receiver['name'])
+        os.makedirs(inputs['dir'],exist_ok=True)
+        env.set_model_save_directory(inputs['dir'])
+        env.set_backend(model['backend'])
+        env.set_calc_params(model['dr'])
+        env.set_output_params(model['output'])
+        env.set_freqs_common(list(freqs))
+        env.set_rx_location_common((receiver['lat'],receiver['lon']))
+        env.set_rx_depth_common(receiver['depth'])
+        env.set_source_common(artifacts[inputs['transects']])
+        kwargs = {'POINT_OR_LINE_STR' : model['mode'],
+                  'BASIS_SIZE_DEPTH' : model['basis_size_depth'],
+                  'BASIS_SIZE_DISTANCE' : model['basis_size_distance'],
+                  'INCREMENTAL' : inputs['incremental']}
+        if p_pool is not None:
+            kwargs['RUNNER'] = p_pool.transect_runner(env,inputs['bundle'])
+        env.calculate_exact_TLs(**kwargs)
+        envs[(inputs['bundle'],receiver['name'],model['name'])] = env
+    return envs
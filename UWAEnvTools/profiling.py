@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+cProfile and tracemalloc hooks, attached to objects from the outside.
+
+A Profiler replaces methods on one instance (not the class), so library
+code is not edited and other instances are not affected:
+
+    profiler = Profiler(p_dir_RAM,'0500_')
+    profiler.profile_method(bathy,'get_2d_bathymetry_trimmed')
+    profiler.sample_transects(env_RAM_S,p_every_n = 100)
+    ...
+    profiler.restore_all()
+    profiler.print_top()
+
+profile_method profiles every call of the method as a whole.
+sample_transects profiles one transect (create_environment_model through
+run_model) in every p_every_n, up to p_max_samples, so the overhead stays
+bounded on long corridor runs.
+
+Each profiled call writes <prefix><name>.pstats (read with pstats or
+snakeviz) and, with p_memory, <prefix><name>.tracemalloc (a
+tracemalloc.Snapshot.dump; load with tracemalloc.Snapshot.load). Memory
+is only traced while a profiled call runs.
+
+Only one profile runs at a time: a transect falling inside a whole-call
+profile (e.g. of calculate_exact_TLs) is not sampled separately, it is
+already in that call's profile.
+"""
+
+import os
+import cProfile
+import pstats
+import tracemalloc
+
+
+class Profiler():
+
+    def __init__(self,
+                 p_target_dir,
+                 p_prefix = '',
+                 p_memory = True):
+        self.target_dir = p_target_dir
+        self.prefix = p_prefix
+        self.memory = p_memory
+        self.files = []
+        self._wrapped = [] # (object, method name)
+        self._active = None
+        self._started_tracing = False
+
+    def fname(self,p_name,p_extension):
+        return os.path.join(self.target_dir,
+                            self.prefix + p_name + p_extension)
+
+    def _start(self,p_name):
+        if self._active is not None:
+            return False
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        profile = cProfile.Profile()
+        self._active = (p_name,profile)
+        profile.enable()
+        return True
+
+    def _stop(self):
+        name,profile = self._active
+        profile.disable()
+        self._active = None
+        fname = self.fname(name,'.pstats')
+        profile.dump_stats(fname)
+        self.files.append(fname)
+        if self.memory and tracemalloc.is_tracing():
+            fname = self.fname(name,'.tracemalloc')
+            tracemalloc.take_snapshot().dump(fname)
+            self.files.append(fname)
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+    def profile_call(self,p_name,p_function,*args,**kwargs):
+        """
+        Call p_function(*args,**kwargs) under the profilers.
+        """
+        started = self._start(p_name)
+        try:
+            return p_function(*args,**kwargs)
+        finally:
+            if started:
+                self._stop()
+
+    def profile_method(self,p_object,p_method_name,p_name = None):
+        """
+        Profile every call of p_object.<p_method_name>. Calls are numbered
+        from the second on, so repeated calls do not overwrite each other.
+        """
+        if p_name is None:
+            p_name = p_method_name
+        method = getattr(p_object,p_method_name)
+        count = [0]
+        def wrapper(*args,**kwargs):
+            name = p_name if count[0] == 0 else p_name + '_' + str(count[0])
+            count[0] = count[0] + 1
+            return self.profile_call(name,method,*args,**kwargs)
+        self._wrap(p_object,p_method_name,wrapper)
+
+    def sample_transects(self,
+                         p_env,
+                         p_every_n = 100,
+                         p_max_samples = 20,
+                         p_name = None):
+        """
+        Profile every p_every_n-th transect of p_env, from the start of
+        create_environment_model to the end of run_model (or to the end of
+        create_environment_model for environments that call their solver
+        directly, e.g. Environment_ARL).
+        """
+        if p_name is None:
+            p_name = str(p_env.hydro_name) + '_transect'
+        create = p_env.create_environment_model
+        run = getattr(p_env,'run_model',None)
+        state = {'count' : 0,'samples' : 0,'open' : False}
+
+        def create_wrapper(*args,**kwargs):
+            n = state['count']
+            state['count'] = n + 1
+            if n % p_every_n == 0 and state['samples'] < p_max_samples \
+                    and self._start(p_name + '_' + str(n).zfill(6)):
+                state['samples'] = state['samples'] + 1
+                state['open'] = True
+            try:
+                return create(*args,**kwargs)
+            finally:
+                if state['open'] and run is None:
+                    state['open'] = False
+                    self._stop()
+
+        def run_wrapper(*args,**kwargs):
+            try:
+                return run(*args,**kwargs)
+            finally:
+                if state['open']:
+                    state['open'] = False
+                    self._stop()
+
+        self._wrap(p_env,'create_environment_model',create_wrapper)
+        if run is not None:
+            self._wrap(p_env,'run_model',run_wrapper)
+
+    def _wrap(self,p_object,p_method_name,p_wrapper):
+        # An instance attribute shadows the class method; restore deletes it.
+        setattr(p_object,p_method_name,p_wrapper)
+        self._wrapped.append((p_object,p_method_name))
+
+    def restore_all(self):
+        """
+        Remove every wrapper this profiler installed.
+        """
+        for obj,name in reversed(self._wrapped):
+            if name in obj.__dict__:
+                delattr(obj,name)
+        self._wrapped = []
+
+    def merged_stats(self,p_filter = ''):
+        """
+        pstats.Stats over all written profiles with p_filter in the name.
+        """
+        fnames = [f for f in self.files
+                  if f.endswith('.pstats') and p_filter in os.path.basename(f)]
+        if len(fnames) == 0:
+            return None
+        stats = pstats.Stats(fnames[0])
+        for fname in fnames[1:]:
+            stats.add(fname)
+        return stats
+
+    def print_top(self,p_n = 20,p_filter = '',p_sort = 'cumulative'):
+        stats = self.merged_stats(p_filter)
+        if stats is None:
+            print('Profiler: no profiles written')
+            return
+        stats.sort_stats(p_sort).print_stats(p_n)
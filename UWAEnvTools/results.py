@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+Result handling for TL model runs.
+
+The models return one result per transect. Rather than keeping every result
+(including the large grids) until the end of a frequency, the columns that
+are actually written out are copied into preallocated NumPy buffers as each
+run finishes, and the run result can be released straight away.
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from UWAEnvTools.backends import Lazy_Module
+
+pd = Lazy_Module('pandas')
+
+
+SOURCE_KEY_DECIMALS = 9 # about 0.1 mm in latitude
+
+
+class TL_Accumulator():
+    """
+    Columnar, preallocated store for unstructured TL results.
+
+    Columns are named as in the CSV outputs: X, Y, TL, Lats TX, Lons TX.
+    Extra columns (e.g. Depth) can be requested at construction.
+
+    Buffers grow by doubling when the reserved capacity is exceeded, so
+    appends are amortized O(1) and no python lists of floats are built.
+    """
+
+    COLUMNS = ('X', 'Y', 'TL', 'Lats TX', 'Lons TX')
+
+    def __init__(self,
+                 p_capacity = 1024,
+                 p_columns = COLUMNS,
+                 p_dtype = np.float64):
+        self.columns = tuple(p_columns)
+        self.dtype = p_dtype
+        self.n = 0
+        self.capacity = max(int(p_capacity), 1)
+        self._buffers = dict()
+        for col in self.columns:
+            self._buffers[col] = np.empty(self.capacity, dtype = self.dtype)
+
+    def __len__(self):
+        return self.n
+
+    def reserve(self, p_n_total):
+        """
+        Make sure at least p_n_total rows fit without further reallocation.
+        """
+        if p_n_total <= self.capacity:
+            return
+        for col in self.columns:
+            new = np.empty(int(p_n_total), dtype = self.dtype)
+            new[:self.n] = self._buffers[col][:self.n]
+            self._buffers[col] = new
+        self.capacity = int(p_n_total)
+
+    def append(self, p_columns):
+        """
+        Append one block of rows.
+
+        p_columns is a dictionary keyed by column name. Array values must
+        all have the same length; scalar values are broadcast to it.
+        """
+        length = 1
+        for value in p_columns.values():
+            if np.ndim(value) > 0:
+                length = len(value)
+                break
+        if self.n + length > self.capacity:
+            self.reserve(max(2 * self.capacity, self.n + length))
+        for col in self.columns:
+            self._buffers[col][self.n:self.n + length] = p_columns[col]
+        self.n = self.n + length
+
+    def append_RAM_result(self, p_result, **kwargs):
+        """
+        Append the columns of a single (PyRAM-like) result dictionary
+        which has the added X, Y, TX Lat and TX Lon entries.
+
+        Any extra column values are passed as kwargs keyed by column name.
+        """
+        block = {'X'        : p_result['X'],
+                 'Y'        : p_result['Y'],
+                 'TL'       : p_result['TL Line'],
+                 'Lats TX'  : p_result['TX Lat'],
+                 'Lons TX'  : p_result['TX Lon']}
+        block.update(kwargs)
+        self.append(block)
+
+    @staticmethod
+    def from_frame(p_df, p_columns = COLUMNS):
+        """
+        An accumulator holding the passed columns of a DataFrame.
+        """
+        accumulator = TL_Accumulator(p_capacity = len(p_df),
+                                     p_columns = p_columns)
+        accumulator.append(
+            dict([(col, p_df[col].values) for col in p_columns]))
+        return accumulator
+
+    def column(self, p_name):
+        """
+        A view on the filled part of a column, no copy is made.
+        """
+        return self._buffers[p_name][:self.n]
+
+    def to_dict(self):
+        result = dict()
+        for col in self.columns:
+            result[col] = self.column(col)
+        return result
+
+    def trim(self):
+        """
+        Release any reserved but unused capacity.
+        """
+        if self.capacity == self.n or self.n == 0:
+            return
+        for col in self.columns:
+            self._buffers[col] = self._buffers[col][:self.n].copy()
+        self.capacity = self.n
+
+
+def hash_items(*p_items):
+    """
+    A stable hex digest over strings, numbers, arrays, and (nested) lists,
+    tuples and dictionaries of those. Used to key results on the inputs
+    that produced them.
+    """
+    digest = hashlib.sha1()
+    _hash_update(digest,p_items)
+    return digest.hexdigest()
+
+
+def _hash_update(p_digest,p_item):
+    if isinstance(p_item,dict):
+        p_digest.update(b'dict')
+        for key in sorted(p_item.keys(),key=str):
+            _hash_update(p_digest,str(key))
+            _hash_update(p_digest,p_item[key])
+    elif isinstance(p_item,(list,tuple)):
+        p_digest.update(b'list')
+        for item in p_item:
+            _hash_update(p_digest,item)
+    elif isinstance(p_item,str):
+        p_digest.update(p_item.encode('utf-8'))
+    elif p_item is None:
+        p_digest.update(b'None')
+    else:
+        arr = np.ascontiguousarray(np.asarray(p_item,dtype=float))
+        p_digest.update(str(arr.shape).encode('utf-8'))
+        p_digest.update(arr.tobytes())
+
+
+def source_key(p_lat,p_lon):
+    """
+    The source point key, rounded so it survives a CSV round trip.
+    """
+    return (round(float(p_lat),SOURCE_KEY_DECIMALS),
+            round(float(p_lon),SOURCE_KEY_DECIMALS))
+
+
+class Result_Store():
+    """
+    The per-frequency result CSV files, with a small JSON sidecar per file
+    that records the hash of the environment the rows were computed with.
+    
+    Rows are keyed by (receiver, frequency, source point, environment hash):
+    receiver and frequency are the file, the source point is the
+    (Lats TX, Lons TX) columns, and the hash is in the sidecar.
+    """
+    
+    def __init__(self):
+        return
+    
+    def meta_fname(self,p_fname):
+        return p_fname + '.json'
+    
+    def read_meta(self,p_fname):
+        fname = self.meta_fname(p_fname)
+        if not os.path.exists(fname):
+            return None
+        with open(fname) as f:
+            return json.load(f)
+        
+    def read(self,p_fname,p_env_hash):
+        """
+        The existing rows for this file if they were computed with the
+        passed environment hash, else None.
+        """
+        meta = self.read_meta(p_fname)
+        if meta is None or meta['env_hash'] != p_env_hash:
+            return None
+        if not os.path.exists(p_fname):
+            return None
+        return pd.read_csv(p_fname,index_col=0)
+    
+    def completed_sources(self,p_fname,p_env_hash):
+        df = self.read(p_fname,p_env_hash)
+        if df is None:
+            return set()
+        return set(
+            source_key(la,lo) 
+            for la,lo in zip(df['Lats TX'].values,df['Lons TX'].values))
+    
+    def merge_write(self,p_fname,p_df_new,p_env_hash):
+        """
+        Merge the new rows with the existing rows computed with the same
+        environment, replacing any rows for recomputed source points.
+        Both files are written to a temporary name and then moved in place.
+        
+        Returns the merged DataFrame.
+        """
+        df_old = self.read(p_fname,p_env_hash)
+        if df_old is not None and len(df_old) > 0:
+            new_keys = set(
+                source_key(la,lo) for la,lo in 
+                zip(p_df_new['Lats TX'].values,p_df_new['Lons TX'].values))
+            keep = [source_key(la,lo) not in new_keys for la,lo in 
+                    zip(df_old['Lats TX'].values,df_old['Lons TX'].values)]
+            df = pd.concat((df_old[keep],p_df_new),ignore_index=True)
+        else:
+            df = p_df_new.reset_index(drop=True)
+        df.to_csv(p_fname + '.tmp')
+        os.replace(p_fname + '.tmp',p_fname)
+        self.write_meta(p_fname,p_env_hash,len(df))
+        return df
+    
+    def parts_dir(self,p_fname):
+        return p_fname + '.parts'
+    
+    def write_part(self,p_fname,p_part_id,p_df,p_env_hash):
+        """
+        Write rows for p_fname as a separate part file, named by 
+        p_part_id, so several writers never touch the same file. Writing
+        the same part again replaces it. merge_parts folds the parts in.
+        """
+        dir_parts = self.parts_dir(p_fname)
+        os.makedirs(dir_parts,exist_ok=True)
+        fname = os.path.join(dir_parts,str(p_part_id) + '.csv')
+        p_df.to_csv(fname + '.tmp')
+        os.replace(fname + '.tmp',fname)
+        self.write_meta(fname,p_env_hash,len(p_df))
+        return fname
+    
+    def part_fnames(self,p_fname):
+        dir_parts = self.parts_dir(p_fname)
+        if not os.path.isdir(dir_parts):
+            return []
+        return [os.path.join(dir_parts,f) for f in sorted(os.listdir(dir_parts))
+                if f.endswith('.csv')]
+    
+    def part_sources(self,p_fname,p_env_hash):
+        """
+        Source keys in the parts of p_fname computed with p_env_hash.
+        """
+        done = set()
+        for fname in self.part_fnames(p_fname):
+            done.update(self.completed_sources(fname,p_env_hash))
+        return done
+    
+    def merge_parts(self,p_fname,p_env_hash,p_remove = True):
+        """
+        Merge the parts computed with p_env_hash in to p_fname (see 
+        merge_write), then remove them. Parts for other environments are
+        left alone. Returns the merged DataFrame, or the existing rows if
+        there were no parts.
+        """
+        fnames = []
+        dfs = []
+        for fname in self.part_fnames(p_fname):
+            df = self.read(fname,p_env_hash)
+            if df is not None:
+                fnames.append(fname)
+                dfs.append(df)
+        if len(dfs) == 0:
+            return self.read(p_fname,p_env_hash)
+        df = self.merge_write(p_fname,
+                              pd.concat(dfs,ignore_index=True),
+                              p_env_hash)
+        if p_remove:
+            for fname in fnames:
+                for f in (fname,self.meta_fname(fname)):
+                    try:
+                        os.remove(f)
+                    except FileNotFoundError: # another merge got there first
+                        pass
+        return df
+    
+    def write_meta(self,p_fname,p_env_hash,p_n_rows):
+        """
+        Must also be called when a result file is written outside the store,
+        so that a stale sidecar never vouches for rows it did not produce.
+        """
+        fname = self.meta_fname(p_fname)
+        with open(fname + '.tmp','w') as f:
+            json.dump({'env_hash' : p_env_hash,
+                       'n_rows' : int(p_n_rows)},f)
+        os.replace(fname + '.tmp',fname)
+
+
+class Incremental_Planner():
+    """
+    Compare a requested set of (frequency, source point) runs for one
+    environment and receiver against a Result_Store, and list only the
+    runs that are missing.
+    """
+    
+    def __init__(self,p_store = None):
+        if p_store is None:
+            p_store = Result_Store()
+        self.store = p_store
+        
+    def plan(self,p_fname_function,p_freqs,p_course,p_env_hash):
+        """
+        p_fname_function(freq) gives the result file for a frequency.
+        
+        Returns a dictionary keyed by frequency of the source points in
+        p_course that still need running (in course order).
+        """
+        todo = dict()
+        for freq in p_freqs:
+            done = self.store.completed_sources(
+                p_fname_function(freq),
+                p_env_hash)
+            todo[freq] = [tx for tx in p_course 
+                          if source_key(tx[0],tx[1]) not in done]
+        return todo
+    
+    def counts(self,p_todo,p_course):
+        """
+        (runs to compute, runs requested) for a plan over p_course.
+        """
+        n_requested = len(p_course) * len(p_todo)
+        n_missing = sum([len(v) for v in p_todo.values()])
+        return n_missing, n_requested
+
+    def summary(self,p_todo,p_course):
+        n_missing, n_requested = self.counts(p_todo,p_course)
+        return 'Incremental plan: ' + str(n_missing) + ' of ' \
+            + str(n_requested) + ' runs to compute.'
@@ -1,3 +1,5 @@
+import json
+
 import numpy as np
 
 import UWAEnvTools.directories_and_files as _dirs
@@ -13,10 +15,20 @@ class SeaBed():
         """
         These are the basis vectors from rx to tx
         not 2D arrays!
+        
+        Only the shape of depths is kept. Uniform properties are scalars,
+        and bottom_type_profile holds read-only broadcast views of them with
+        the bathymetry shape, so [0][0] indexing works without allocating
+        the grid. Spatially varying seabeds are set with set_map.
         """
         self.lats_selection = lats
         self.lons_selection = lons
-        self.bottom_type_profile = np.ones_like(depths) 
+        shape = np.shape(depths)
+        self.grid_shape = (1,) * (2 - len(shape)) + shape # at least 2D
+        self.properties = dict()
+        self.map = None
+        self.cache = dict()
+        self.bottom_type_profile = np.broadcast_to(1.,self.grid_shape)
 
     def read_default_dictionary(
             self,
@@ -36,8 +48,411 @@ class SeaBed():
         
         
     def assign_single_bottom_type(self,p_type = r'Sand-silt'):
-        temp = self.bottom_type_profile #has dimensinos of bathymetry in constructor
+        """
+        A uniform seabed of the passed type. Also the type used by
+        sample_along wherever a map (if set) has no data.
+        """
+        self.bottom_type = p_type
+        self.properties = dict(self.sediment_dictionary[p_type])
         self.bottom_type_profile = dict()
-        for key,value in self.sediment_dictionary[p_type].items():
-            self.bottom_type_profile[key] = temp * value
-        
\ No newline at end of file
+        for key,value in self.properties.items():
+            self.bottom_type_profile[key] = \
+                np.broadcast_to(float(value),self.grid_shape)
+
+    def set_map(self,p_map):
+        """
+        A spatially varying seabed. p_map must have type_names (a list of
+        sediment_dictionary keys) and classify(lats,lons), returning an
+        index in to type_names per point, -1 where it has no data.
+        e.g. Sediment_Raster. Pass None for a uniform seabed again.
+        """
+        if p_map is not None:
+            missing = [t for t in p_map.type_names 
+                       if t not in self.sediment_dictionary]
+            if len(missing) > 0:
+                raise KeyError(
+                    'SeaBed.set_map: types not in the sediment dictionary: '\
+                        + str(missing))
+        self.map = p_map
+        self.cache = dict()
+
+    def sample_along(self,p_lats,p_lons):
+        """
+        The seabed properties at each point, as a dictionary of arrays
+        keyed as the sediment dictionary (M_z, Rho, c, alpha).
+        """
+        n = np.size(p_lats)
+        result = dict()
+        if self.map is None:
+            for key,value in self.properties.items():
+                result[key] = np.full(n,float(value))
+            return result
+        index = np.ravel(self.map.classify(p_lats,p_lons))
+        for key,value in self.properties.items():
+            # The last entry is the uniform type, for index -1.
+            table = np.array(
+                [self.sediment_dictionary[t][key] for t in self.map.type_names] 
+                + [value],
+                dtype=float)
+            result[key] = table[index]
+        return result
+    
+    def sample_transects(self,
+                         p_rx_lat_lon_tuple,
+                         p_tx_lat_lon_list,
+                         p_n):
+        """
+        Classify the points of many transects (see 
+        bathymetry.transect_bases) in one query, and cache each transect
+        for transect(). 
+        
+        Returns a dictionary of n_sources x p_n arrays.
+        """
+        from UWAEnvTools.bathymetry import transect_bases
+        from UWAEnvTools.results import source_key
+        tx = np.reshape(np.asarray(p_tx_lat_lon_list,dtype=float),(-1,2))
+        lat_bases,lon_bases = transect_bases(p_rx_lat_lon_tuple,
+                                             tx[:,0],
+                                             tx[:,1],
+                                             p_n)
+        result = self.sample_along(lat_bases,lon_bases)
+        for key in result.keys():
+            result[key] = np.reshape(result[key],(len(tx),p_n))
+        rx_key = source_key(p_rx_lat_lon_tuple[0],p_rx_lat_lon_tuple[1])
+        for n in range(len(tx)):
+            self.cache[(rx_key,source_key(tx[n,0],tx[n,1]),int(p_n))] = \
+                dict([(key,value[n]) for key,value in result.items()])
+        return result
+    
+    def transect(self,p_rx_lat_lon_tuple,p_tx_lat_lon_tuple,p_n):
+        """
+        The properties at the p_n points of one transect, from the cache 
+        if sample_transects already did it.
+        """
+        if self.map is None:
+            return self.sample_along(np.zeros(p_n),np.zeros(p_n))
+        from UWAEnvTools.results import source_key
+        key = (source_key(p_rx_lat_lon_tuple[0],p_rx_lat_lon_tuple[1]),
+               source_key(p_tx_lat_lon_tuple[0],p_tx_lat_lon_tuple[1]),
+               int(p_n))
+        if key not in self.cache:
+            self.sample_transects(p_rx_lat_lon_tuple,[p_tx_lat_lon_tuple],p_n)
+        return self.cache[key]
+    
+    def hash_inputs(self):
+        if self.map is None:
+            return [self.properties]
+        return [self.properties,self.map.hash_inputs()]
+
+
+class Sediment_Raster():
+    """
+    A classified sediment raster on a regular lat lon grid: one small
+    integer per cell, indexing type_names (-1 is no data). Lookup is
+    nearest cell, outside the grid is no data.
+    
+    types is indexed [lon,lat], as z_interped in the bathymetry classes.
+    """
+    
+    def __init__(self,p_lat_basis,p_lon_basis,p_types,p_type_names):
+        self.lat_basis = np.asarray(p_lat_basis,dtype=float)
+        self.lon_basis = np.asarray(p_lon_basis,dtype=float)
+        self.types = np.asarray(p_types,dtype=np.int8)
+        self.type_names = list(p_type_names)
+        if self.types.shape != (len(self.lon_basis),len(self.lat_basis)):
+            raise ValueError('Sediment_Raster: types must be [lon,lat].')
+        if len(self.type_names) > np.iinfo(np.int8).max:
+            raise ValueError('Sediment_Raster: too many sediment types.')
+        
+    def cell_index(self,p_basis,p_values):
+        """
+        Nearest cell on a regular basis, -1 outside it.
+        """
+        step = (p_basis[-1] - p_basis[0]) / max(len(p_basis) - 1,1)
+        if step == 0:
+            index = np.zeros(np.shape(p_values),dtype=int)
+        else:
+            index = np.rint((p_values - p_basis[0]) / step).astype(int)
+        outside = (index < 0) | (index >= len(p_basis))
+        index[outside] = -1
+        return index
+    
+    def classify(self,p_lats,p_lons):
+        lats = np.ravel(np.asarray(p_lats,dtype=float))
+        lons = np.ravel(np.asarray(p_lons,dtype=float))
+        i_lat = self.cell_index(self.lat_basis,lats)
+        i_lon = self.cell_index(self.lon_basis,lons)
+        valid = (i_lat >= 0) & (i_lon >= 0)
+        result = np.full(len(lats),-1,dtype=int)
+        result[valid] = self.types[i_lon[valid],i_lat[valid]]
+        return result
+    
+    def hash_inputs(self):
+        return [self.lat_basis,self.lon_basis,self.types,self.type_names]
+
+
+class Sediment_Map():
+    """
+    Mapped sediment zones, from polygons or a classified raster, with a
+    grid hash index for batch classification.
+    
+    Polygons are rasterized once on to a regular lat lon grid. Cells wholly
+    inside one polygon (or none) hold that type directly; only points in
+    cells an edge passes through are tested against the few polygons
+    listed for their cell. Where polygons overlap the later one wins.
+    
+    Has type_names and classify(lats,lons), so is used with SeaBed.set_map.
+    """
+    
+    def __init__(self):
+        self.type_names = []
+        self.polygons = [] # (type index, lats, lons)
+        self.lat_basis = np.array([])
+        self.lon_basis = np.array([])
+        self.cells = np.zeros((0,0),dtype=np.int16) # [lon,lat]
+        self.candidates = dict() # flat cell index : [polygon index]
+        
+    AMBIGUOUS = -2
+    
+    def type_index(self,p_type_name):
+        if p_type_name not in self.type_names:
+            self.type_names.append(p_type_name)
+        return self.type_names.index(p_type_name)
+    
+    def add_polygon(self,p_type_name,p_lats,p_lons):
+        self.polygons.append((self.type_index(p_type_name),
+                              np.asarray(p_lats,dtype=float),
+                              np.asarray(p_lons,dtype=float)))
+    
+    def read_geojson(self,fname,p_type_property = 'sediment'):
+        """
+        Polygon and MultiPolygon features (outer rings only), typed by the
+        named feature property. Coordinates are lon, lat.
+        """
+        with open(fname) as f:
+            collection = json.load(f)
+        for feature in collection['features']:
+            geometry = feature['geometry']
+            name = feature['properties'][p_type_property]
+            if geometry['type'] == 'Polygon':
+                rings = [geometry['coordinates'][0]]
+            elif geometry['type'] == 'MultiPolygon':
+                rings = [polygon[0] for polygon in geometry['coordinates']]
+            else:
+                continue
+            for ring in rings:
+                ring = np.asarray(ring,dtype=float)
+                self.add_polygon(name,ring[:,1],ring[:,0])
+    
+    def build_index(self,p_lat_extent_tuple,p_lon_extent_tuple,p_cell_size):
+        """
+        Rasterize the polygons over the extent with cells of p_cell_size
+        decimal degrees.
+        """
+        n_lat = max(int(np.ceil(
+            (p_lat_extent_tuple[1] - p_lat_extent_tuple[0]) / p_cell_size)),1)
+        n_lon = max(int(np.ceil(
+            (p_lon_extent_tuple[1] - p_lon_extent_tuple[0]) / p_cell_size)),1)
+        self.cell_size = p_cell_size
+        self.lat_0 = p_lat_extent_tuple[0]
+        self.lon_0 = p_lon_extent_tuple[0]
+        # cell centres
+        self.lat_basis = self.lat_0 + (np.arange(n_lat) + 0.5) * p_cell_size
+        self.lon_basis = self.lon_0 + (np.arange(n_lon) + 0.5) * p_cell_size
+        self.cells = np.full((n_lon,n_lat),-1,dtype=np.int16)
+        candidates = dict()
+        
+        lat_corners = self.lat_0 + np.arange(n_lat + 1) * p_cell_size
+        lon_corners = self.lon_0 + np.arange(n_lon + 1) * p_cell_size
+        for n,(type_index,lats,lons) in enumerate(self.polygons):
+            # only the cells in the polygon bounding box
+            i0 = max(int(np.floor((lons.min() - self.lon_0) / p_cell_size)),0)
+            i1 = min(int(np.floor((lons.max() - self.lon_0) / p_cell_size)) + 1,n_lon)
+            j0 = max(int(np.floor((lats.min() - self.lat_0) / p_cell_size)),0)
+            j1 = min(int(np.floor((lats.max() - self.lat_0) / p_cell_size)) + 1,n_lat)
+            if i0 >= i1 or j0 >= j1:
+                continue
+            corner_lon,corner_lat = np.meshgrid(lon_corners[i0:i1+1],
+                                                lat_corners[j0:j1+1],
+                                                indexing='ij')
+            inside = contains_points(lats,lons,corner_lat,corner_lon)
+            n_inside = inside[:-1,:-1].astype(int) + inside[1:,:-1] \
+                + inside[:-1,1:] + inside[1:,1:]
+            edge = (n_inside > 0) & (n_inside < 4)
+            # A thin zone or a notch can cross a cell with all (or none)
+            # of its corners inside, so also every cell an edge passes
+            # through. This includes the vertices, so a polygon smaller
+            # than a cell is found too.
+            ci,cj = edge_cells(lats,lons,self.lat_0,self.lon_0,p_cell_size)
+            ci = ci - i0
+            cj = cj - j0
+            keep = (ci >= 0) & (ci < i1 - i0) & (cj >= 0) & (cj < j1 - j0)
+            edge[ci[keep],cj[keep]] = True
+            
+            block = self.cells[i0:i1,j0:j1]
+            block[(n_inside == 4) & ~edge] = type_index
+            for i,j in zip(*np.nonzero(edge)):
+                key = (i0 + i) * n_lat + (j0 + j)
+                if block[i,j] != Sediment_Map.AMBIGUOUS:
+                    # keep what was under the edge as a fall back
+                    candidates[key] = [('cell',int(block[i,j]))]
+                    block[i,j] = Sediment_Map.AMBIGUOUS
+                candidates[key].append(('polygon',n))
+            # cells covered whole by a later polygon are no longer ambiguous
+            for i,j in zip(*np.nonzero((n_inside == 4) & ~edge)):
+                candidates.pop((i0 + i) * n_lat + (j0 + j),None)
+        self.candidates = candidates
+        
+    def read_raster_asc(self,fname,p_type_names):
+        """
+        An ESRI ASCII grid of integer classes in decimal degrees, class n
+        being p_type_names[n]. Other values (and NODATA) are no data.
+        
+        The header is read by key, in any order: ncols, nrows, cellsize,
+        xllcorner or xllcenter, yllcorner or yllcenter, and optionally
+        NODATA_value (default -9999).
+        """
+        keys = ['ncols','nrows','xllcorner','yllcorner','xllcenter',
+                'yllcenter','cellsize','nodata_value']
+        header = dict()
+        with open(fname) as f:
+            lines = f.readlines()
+        n_header = 0
+        for line in lines:
+            strs = line.split()
+            if len(strs) != 2 or strs[0].lower() not in keys:
+                break
+            header[strs[0].lower()] = float(strs[1])
+            n_header = n_header + 1
+        for key in ['ncols','nrows','cellsize']:
+            if key not in header:
+                raise ValueError('Sediment_Map.read_raster_asc: no ' + key \
+                                 + ' in the header of ' + fname)
+        cell_size = header['cellsize']
+        corner = dict()
+        for axis in ['x','y']:
+            if axis + 'llcorner' in header:
+                corner[axis] = header[axis + 'llcorner']
+            elif axis + 'llcenter' in header:
+                corner[axis] = header[axis + 'llcenter'] - 0.5 * cell_size
+            else:
+                raise ValueError('Sediment_Map.read_raster_asc: no ' + axis \
+                                 + 'llcorner or ' + axis + 'llcenter in the '\
+                                     'header of ' + fname)
+        values = np.atleast_2d(np.loadtxt(lines[n_header:]))
+        if values.shape != (int(header['nrows']),int(header['ncols'])):
+            raise ValueError('Sediment_Map.read_raster_asc: ' + fname \
+                             + ' has ' + str(values.shape) + ' values, the '\
+                                 'header says nrows x ncols = ' \
+                             + str((int(header['nrows']),int(header['ncols']))))
+        nodata = header.get('nodata_value',-9999)
+        values = np.flipud(values).T # [lon,lat], south first
+        types = np.where((values == nodata) | (values < 0) 
+                         | (values >= len(p_type_names)),
+                         -1,
+                         values).astype(np.int16)
+        self.set_raster(corner['y'],
+                        corner['x'],
+                        cell_size,
+                        types,
+                        p_type_names)
+        
+    def set_raster(self,p_lat_0,p_lon_0,p_cell_size,p_types,p_type_names):
+        """
+        A classified raster, [lon,lat], with lower left corner p_lat_0,p_lon_0.
+        """
+        self.type_names = list(p_type_names)
+        self.polygons = []
+        self.cell_size = p_cell_size
+        self.lat_0 = p_lat_0
+        self.lon_0 = p_lon_0
+        self.cells = np.asarray(p_types,dtype=np.int16)
+        self.lon_basis = p_lon_0 + (np.arange(self.cells.shape[0]) + 0.5) * p_cell_size
+        self.lat_basis = p_lat_0 + (np.arange(self.cells.shape[1]) + 0.5) * p_cell_size
+        self.candidates = dict()
+    
+    def classify(self,p_lats,p_lons):
+        """
+        Type index per point (-1 no data), for any number of points in 
+        one pass.
+        """
+        lats = np.ravel(np.asarray(p_lats,dtype=float))
+        lons = np.ravel(np.asarray(p_lons,dtype=float))
+        i = np.floor((lons - self.lon_0) / self.cell_size).astype(int)
+        j = np.floor((lats - self.lat_0) / self.cell_size).astype(int)
+        valid = (i >= 0) & (i < self.cells.shape[0]) \
+            & (j >= 0) & (j < self.cells.shape[1])
+        result = np.full(len(lats),-1,dtype=int)
+        result[valid] = self.cells[i[valid],j[valid]]
+        
+        ambiguous = np.nonzero(result == Sediment_Map.AMBIGUOUS)[0]
+        if len(ambiguous) == 0:
+            return result
+        keys = i[ambiguous] * self.cells.shape[1] + j[ambiguous]
+        result[ambiguous] = -1
+        # fall back value first, then polygons in order so later ones win
+        by_polygon = dict()
+        for point,key in zip(ambiguous,keys):
+            for kind,value in self.candidates[key]:
+                if kind == 'cell':
+                    result[point] = value
+                else:
+                    by_polygon.setdefault(value,[]).append(point)
+        for n in sorted(by_polygon.keys()):
+            points = np.array(by_polygon[n])
+            type_index,poly_lats,poly_lons = self.polygons[n]
+            inside = contains_points(poly_lats,poly_lons,
+                                     lats[points],lons[points])
+            result[points[inside]] = type_index
+        return result
+    
+    def hash_inputs(self):
+        return [self.type_names,
+                [[t,la,lo] for t,la,lo in self.polygons],
+                self.cells,
+                [self.lat_0,self.lon_0,self.cell_size]]
+    
+
+def contains_points(p_poly_lats,p_poly_lons,p_lats,p_lons):
+    """
+    Whether each point is inside the polygon, same shape as p_lats.
+    """
+    from matplotlib.path import Path
+    path = Path(np.column_stack((p_poly_lons,p_poly_lats)))
+    points = np.column_stack((np.ravel(p_lons),np.ravel(p_lats)))
+    return np.reshape(path.contains_points(points),np.shape(p_lats))
+
+
+def edge_cells(p_poly_lats,p_poly_lons,p_lat_0,p_lon_0,p_cell_size):
+    """
+    (lon index, lat index) of every cell of the grid with lower left corner
+    p_lat_0,p_lon_0 that the polygon outline passes through, unclipped and
+    possibly repeated. The ring is closed if it is not already.
+    
+    A segment enters a new cell only by crossing a cell edge, so the cells
+    either side of each crossing plus the vertex cells are all of them.
+    """
+    x = (np.asarray(p_poly_lons,dtype=float) - p_lon_0) / p_cell_size
+    y = (np.asarray(p_poly_lats,dtype=float) - p_lat_0) / p_cell_size
+    x = np.append(x,x[0])
+    y = np.append(y,y[0])
+    cells_i = [np.floor(x).astype(int)]
+    cells_j = [np.floor(y).astype(int)]
+    for x0,y0,x1,y1 in zip(x[:-1],y[:-1],x[1:],y[1:]):
+        # crossings of lines of constant x, then of constant y
+        for a0,b0,a1,b1,swap in ((x0,y0,x1,y1,False),(y0,x0,y1,x1,True)):
+            if a0 == a1:
+                continue # parallel, the other pass has its crossings
+            lines = np.arange(np.ceil(min(a0,a1)),np.floor(max(a0,a1)) + 1)
+            if len(lines) == 0:
+                continue
+            b = b0 + (lines - a0) / (a1 - a0) * (b1 - b0)
+            a = lines.astype(int)
+            b = np.floor(b).astype(int)
+            i = np.concatenate((a - 1,a))
+            j = np.concatenate((b,b))
+            if swap:
+                i,j = j,i
+            cells_i.append(i)
+            cells_j.append(j)
+    return np.concatenate(cells_i), np.concatenate(cells_j)
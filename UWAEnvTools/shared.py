@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Share a prepared bathymetry grid between worker processes without copies.
+
+The owner publishes the trimmed grid, its bases and the spline knots and
+coefficients once, into OS shared memory or a memory-mapped file. Workers
+are sent only a small descriptor, attach to the same memory, and rebuild
+their interpolation function from the shared coefficients. Memory use stays
+flat as the number of workers grows.
+
+    with Shared_Bathymetry() as shared:
+        descriptor = shared.publish(bathy)
+        pool = multiprocessing.Pool(
+            initializer = init_worker_bathymetry,
+            initargs = (descriptor,))
+        ...  # in the workers, get_worker_bathymetry()
+
+workers.Worker_Pool (p_share_bathymetry) and distributed.run_workers do
+this for the bathymetry of location bundles, through
+workers.Environment_Cache.
+"""
+
+import os
+import atexit
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from UWAEnvTools.bathymetry import Bathymetry_Prepared
+
+
+BACKEND_SHM = 'shm'
+BACKEND_MEMMAP = 'memmap'
+
+_ALIGN = 64 # bytes
+
+
+class Shared_Bathymetry():
+    """
+    The owner side. Publishes one bathymetry and cleans it up on close,
+    on leaving a with block, or at interpreter exit.
+    """
+
+    def __init__(self,p_backend = BACKEND_SHM,p_dir = None):
+        """
+        p_dir is where memmap files go, default the system temp directory.
+        """
+        if p_backend not in (BACKEND_SHM,BACKEND_MEMMAP):
+            raise ValueError('Shared_Bathymetry: unknown backend ' + str(p_backend))
+        self.backend = p_backend
+        self.dir = p_dir
+        self.descriptor = None
+        self._shm = None
+        self._memmap = None
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def publish(self,p_bathymetry):
+        """
+        Copy the prepared grid and spline in to shared memory.
+        Returns the descriptor to send to workers (small, picklable).
+        """
+        if self.descriptor is not None:
+            raise RuntimeError('Shared_Bathymetry: already published, close first.')
+        spline = p_bathymetry.spline_arrays()
+        arrays = {
+            'lat_basis'  : p_bathymetry.lat_basis_trimmed,
+            'lon_basis'  : p_bathymetry.lon_basis_trimmed,
+            'z_interped' : p_bathymetry.z_interped,
+            'spline_tx'  : spline['tx'],
+            'spline_ty'  : spline['ty'],
+            'spline_c'   : spline['c'],
+            }
+        layout = dict()
+        offset = 0
+        for key,value in arrays.items():
+            value = np.ascontiguousarray(value,dtype=np.float64)
+            arrays[key] = value
+            layout[key] = (offset,value.shape)
+            offset = offset + _ALIGN * int(np.ceil(value.nbytes / _ALIGN))
+        size = max(offset,_ALIGN)
+
+        if self.backend == BACKEND_SHM:
+            from multiprocessing import shared_memory
+            self._shm = shared_memory.SharedMemory(create = True,size = size)
+            name = self._shm.name
+            buffer = self._shm.buf
+        else:
+            handle,name = tempfile.mkstemp(suffix = '.bathy',dir = self.dir)
+            os.close(handle)
+            self._memmap = np.memmap(name,dtype = np.uint8,mode = 'w+',
+                                     shape = (size,))
+            buffer = self._memmap
+
+        for key,value in arrays.items():
+            offset,shape = layout[key]
+            target = np.ndarray(shape,dtype = np.float64,buffer = buffer,
+                                offset = offset)
+            target[...] = value
+        if self._memmap is not None:
+            self._memmap.flush()
+
+        self.descriptor = {
+            'backend' : self.backend,
+            'name'    : name,
+            'size'    : size,
+            'layout'  : layout,
+            'kx'      : int(spline['kx']),
+            'ky'      : int(spline['ky']),
+            'owner'   : os.getpid(),
+            }
+        return self.descriptor
+
+    def close(self):
+        """
+        Release and remove the shared memory. Attached workers keep their
+        mapping until they detach, but no new attach is possible.
+        """
+        if self._shm is not None:
+            self._shm.close()
+            if os.name == 'posix':
+                from multiprocessing import resource_tracker
+                # A process not known to share this tracker (see
+                # _attach_shm) takes its attach back out of its tracker,
+                # which may be this one, dropping the owner's entry.
+                # Register again so unlink's unregister matches.
+                resource_tracker.register(_tracker_name(self._shm),
+                                          'shared_memory')
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+            self._shm = None
+        if self._memmap is not None:
+            name = self._memmap.filename
+            # numpy unmaps when the last reference goes, and publish keeps
+            # no views on it.
+            self._memmap = None
+            if os.path.exists(name):
+                os.remove(name)
+        self.descriptor = None
+
+
+def attach_bathymetry(p_descriptor):
+    """
+    Worker side: attach to a published bathymetry.
+
+    Returns a read-only Bathymetry_Prepared whose arrays are views on the
+    shared memory. It holds the mapping in shared_handle; call
+    detach_bathymetry when done with it.
+    """
+    if p_descriptor['backend'] == BACKEND_SHM:
+        handle = _attach_shm(p_descriptor['name'],p_descriptor['owner'])
+        buffer = handle.buf
+    else:
+        handle = np.memmap(p_descriptor['name'],dtype = np.uint8,mode = 'r',
+                           shape = (p_descriptor['size'],))
+        buffer = handle
+
+    arrays = dict()
+    for key,(offset,shape) in p_descriptor['layout'].items():
+        array = np.ndarray(tuple(shape),dtype = np.float64,buffer = buffer,
+                           offset = offset)
+        array.flags.writeable = False
+        arrays[key] = array
+
+    bathy = Bathymetry_Prepared()
+    bathy.set_prepared(arrays['lat_basis'],
+                       arrays['lon_basis'],
+                       arrays['z_interped'],
+                       {'tx' : arrays['spline_tx'],
+                        'ty' : arrays['spline_ty'],
+                        'c'  : arrays['spline_c'],
+                        'kx' : p_descriptor['kx'],
+                        'ky' : p_descriptor['ky']})
+    bathy.shared_handle = handle
+    return bathy
+
+
+def detach_bathymetry(p_bathymetry):
+    """
+    Drop the worker's arrays and mapping. Does not remove the shared
+    memory, that is the owner's job.
+    """
+    handle = getattr(p_bathymetry,'shared_handle',None)
+    p_bathymetry.interpolation_function = r'not set'
+    for key in ['lat_basis_trimmed','lon_basis_trimmed','z_interped',
+                'lats_selection','lons_selection','z_selection']:
+        setattr(p_bathymetry,key,r'not set')
+    p_bathymetry.shared_handle = None
+    if handle is not None and hasattr(handle,'unlink'): # SharedMemory
+        handle.close()
+
+
+def _tracker_name(p_shm):
+    # SharedMemory.name leaves off the leading slash of a POSIX name, the
+    # resource tracker keeps the name as opened.
+    return '/' + p_shm.name
+
+
+def _shares_owner_tracker(p_owner_pid):
+    """
+    Whether this process uses the owner's resource tracker: it is the
+    owner, or a process the owner started with multiprocessing (any start
+    method passes the tracker on).
+    """
+    if os.getpid() == p_owner_pid:
+        return True
+    parent = multiprocessing.parent_process()
+    return parent is not None and parent.pid == p_owner_pid
+
+
+def _attach_shm(p_name,p_owner_pid):
+    from multiprocessing import shared_memory
+    try:
+        # Python 3.13+: don't let the worker's resource tracker unlink it.
+        return shared_memory.SharedMemory(name = p_name,track = False)
+    except TypeError:
+        # Older Pythons register every attach with the resource tracker
+        # (POSIX only). In the owner's tracker that entry is the owner's
+        # anyway, and close removes it. A process with a tracker of its
+        # own would unlink the owner's memory on exit, so there the
+        # attach is taken back out (after which Shared_Bathymetry.close
+        # registers again before it unlinks, in case it was the owner's).
+        shm = shared_memory.SharedMemory(name = p_name)
+        if os.name == 'posix' and not _shares_owner_tracker(p_owner_pid):
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(_tracker_name(shm),'shared_memory')
+        return shm
+
+
+# Per-process worker state, for use as a Pool initializer.
+_WORKER_BATHYMETRY = None
+
+def init_worker_bathymetry(p_descriptor):
+    global _WORKER_BATHYMETRY
+    _WORKER_BATHYMETRY = attach_bathymetry(p_descriptor)
+
+def get_worker_bathymetry():
+    return _WORKER_BATHYMETRY
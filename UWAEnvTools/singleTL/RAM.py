@@ -35,6 +35,10 @@ from UWAEnvTools.seabed import SeaBed
 from UWAEnvTools.surface import Surface
 from UWAEnvTools.locations import Location
 from UWAEnvTools.source import Source
+from UWAEnvTools.frequency import Frequency_Plan
+from UWAEnvTools.bundle import bake_environment_bundle, Location_Bundle
+import UWAEnvTools.instrument as instrument
+from UWAEnvTools.profiling import Profiler
 
 def compute_RAM_corridor_to_hyd(
         p_freq, #integer or float singleton
@@ -49,11 +53,41 @@ def compute_RAM_corridor_to_hyd(
         p_depth_offset = 0, # legazy correction for bathy alignment with ssp, 0 should work but keep as parameter.
         p_N_points_lon = 200, #for 1x1 m resolution should be ~80
         p_N_points_lat = 80, # for 1x1 m resolution should be ~200 
-        p_location = 'Patricia Bay'):
+        p_location = 'Patricia Bay',
+        p_incremental = False,
+        p_prefilter = False,
+        p_instrument = False,
+        p_profile_every_n = 0,
+        p_profile_calls = False,
+        p_guard = None):
     """
     
     Build up the north and south hydrophone environments for RAM processing.
     
+    With p_incremental, only source points missing from the existing 
+    result files in p_dir_RAM (for an identical environment) are run.
+    
+    With p_prefilter, source points on land are dropped and transects that
+    cross land or leave the bathymetry grid are skipped, before any run
+    (see Source.prefilter_course).
+    
+    With p_instrument (or the UWAENVTOOLS_INSTRUMENT environment variable
+    set), per-stage timings are printed and written to 
+    <freq>_instrument.json in p_dir_RAM (see instrument.py), also for a
+    run that raises. Instrumentation enabled here is disabled again.
+    
+    With p_profile_every_n > 0, every n-th transect of each hydrophone is 
+    run under cProfile and tracemalloc. With p_profile_calls, the 
+    bathymetry preparation and each calculate_exact_TLs call are profiled
+    whole instead. The two are exclusive (only one cProfile can be active,
+    so no sample would fire inside a whole-call profile) and passing both
+    raises ValueError. The .pstats and .tracemalloc files go to p_dir_RAM
+    (see profiling.py). The profiling wrappers are removed again, also
+    when a run raises.
+    
+    p_guard is an optional guard.Solver_Guard, for timeouts and fallbacks 
+    on the PyRAM runs. Points it gives up on are NaN in the results.
+    
     Parameters
     ----------
     p_freq : TYPE
@@ -88,28 +122,188 @@ def compute_RAM_corridor_to_hyd(
 
     """
 
-    the_location = Location(p_location) 
+    if p_profile_every_n > 0 and p_profile_calls:
+        raise ValueError('compute_RAM_corridor_to_hyd: p_profile_every_n and '\
+                         'p_profile_calls are exclusive, pass one of them.')
+
+    # Leave instrumentation as it was found, also when a run raises.
+    enabled_here = p_instrument and not instrument.is_enabled()
+    if enabled_here:
+        instrument.enable()
+    instrumented = instrument.is_enabled()
+    if instrumented:
+        instrument.start_run('RAM corridor ' + str(p_freq) + ' Hz')
+
+    profiler = None
+    try:
+        if p_profile_every_n > 0 or p_profile_calls:
+            profiler = Profiler(p_dir_RAM,str(p_freq).zfill(4) + '_')
+
+        the_location = Location(p_location) 
+
+        # RECEIVER LOCATIONS (depths can be retrieved later)
+        rx_loc_N = (the_location.hyd_1_lat,the_location.hyd_1_lon)
+        rx_z_N   = the_location.hyd_1_z
+        rx_loc_S = (the_location.hyd_2_lat,the_location.hyd_2_lon)
+        rx_z_S   = the_location.hyd_2_z
+
+        bathy = Bathymetry_CHS_2()
+        if p_profile_calls:
+            profiler.profile_method(bathy,'get_2d_bathymetry_trimmed')
+        bathy.get_2d_bathymetry_trimmed( #og variable values
+            p_location_as_object = the_location,
+            p_num_points_lon = p_N_points_lon,
+            p_num_points_lat = p_N_points_lat,
+            p_depth_offset = 0
+            )
+
+        ssp = SSP_Blouin_2015()
+
+        # # DEFINE THE SOURCES FOR PYRAM
+        source_RAM = Source()
+        source_RAM.set_name()
+        source_RAM.set_depth(p_TX_depth) #Default is 1.7m
+        source_RAM.set_speed()
+        source_RAM.generate_course_from_grid(
+            p_lat_minmax_tuple  = the_location.LAT_RANGE_CORRIDOR_TUPLE,
+            p_lon_minmax_tuple  = the_location.LON_RANGE_CORRIDOR_TUPLE,
+            p_num_lat_points    = p_n_lat_pts,
+            p_num_lon_points    = p_n_lon_pts
+              )
+
+        # # DEFINE THE ENVIRONMENT FOR SOUTH HYD
+        env_RAM_S = Environment_RAM(
+            the_location,p_N_points_lat,p_N_points_lon
+            )  
+        env_RAM_S.set_hydrophone_name('South')
+        env_RAM_S.set_model_save_directory(p_dir_RAM)
+        env_RAM_S.set_bathymetry_common(bathy)
+        env_RAM_S.set_seabed_common()
+        env_RAM_S.set_ssp_common(ssp)
+        env_RAM_S.set_calc_params(p_RAM_delta_r)
+        env_RAM_S.set_output_params(Environment_RAM.OUTPUT_LINE)
+        env_RAM_S.set_freqs_common([p_freq])
+        env_RAM_S.set_rx_location_common(rx_loc_S)
+        env_RAM_S.set_rx_depth_common(rx_z_S)
+
+        # # DEFINE THE ENVIRONMENT FOR NORTH HYD    
+        env_RAM_N = Environment_RAM(
+            the_location,p_N_points_lat,p_N_points_lon
+            )  
+        env_RAM_N.set_hydrophone_name('North')
+        env_RAM_N.set_model_save_directory(p_dir_RAM)
+        env_RAM_N.set_bathymetry_common(bathy)
+        env_RAM_N.set_seabed_common()
+        env_RAM_N.set_ssp_common(ssp)
+        env_RAM_N.set_calc_params(p_RAM_delta_r)
+        env_RAM_N.set_output_params(Environment_RAM.OUTPUT_LINE)
+        env_RAM_N.set_freqs_common([p_freq])
+        env_RAM_N.set_rx_location_common(rx_loc_N)
+        env_RAM_N.set_rx_depth_common(rx_z_N)
+
+        # SET SOURCE POINTS
+        # THEN COMPUTE RESULTS
+        if p_prefilter:
+            print(source_RAM.prefilter_course(bathy,[rx_loc_S,rx_loc_N]))
+        env_RAM_S.set_source_common(source_RAM)
+        env_RAM_N.set_source_common(source_RAM)
+
+        for env in (env_RAM_S,env_RAM_N):
+            env.set_guard(p_guard)
+            if p_profile_calls:
+                profiler.profile_method(env,
+                                        'calculate_exact_TLs',
+                                        env.hydro_name + '_calculate_exact_TLs')
+            if p_profile_every_n > 0:
+                profiler.sample_transects(env,p_profile_every_n)
+
+        env_RAM_S.calculate_exact_TLs(
+            POINT_OR_LINE_STR = p_line_or_point,
+            BASIS_SIZE_DEPTH = p_BASIS_SIZE_depth, 
+            BASIS_SIZE_DISTANCE = p_BASIS_SIZE_distance,
+            INCREMENTAL = p_incremental
+            )
+        env_RAM_N.calculate_exact_TLs(
+            POINT_OR_LINE_STR = p_line_or_point,
+            BASIS_SIZE_DEPTH = p_BASIS_SIZE_depth, 
+            BASIS_SIZE_DISTANCE = p_BASIS_SIZE_distance,
+            INCREMENTAL = p_incremental
+            )
+
+        if p_guard is not None:
+            print(p_guard.summary())
+    finally:
+        if profiler is not None:
+            profiler.restore_all()
+        if instrumented:
+            report = instrument.end_run()
+            report.to_json(p_dir_RAM + str(p_freq).zfill(4) + '_instrument.json')
+            print(report.summary_table())
+        if enabled_here:
+            instrument.disable()
 
-    # RECEIVER LOCATIONS (depths can be retrieved later)
-    rx_loc_N = (the_location.hyd_1_lat,the_location.hyd_1_lon)
-    rx_z_N   = the_location.hyd_1_z
-    rx_loc_S = (the_location.hyd_2_lat,the_location.hyd_2_lon)
-    rx_z_S   = the_location.hyd_2_z
+    return env_RAM_S, env_RAM_N
+
+
+def bake_RAM_location_bundle(
+        p_fname,
+        p_N_points_lon = 200,
+        p_N_points_lat = 80,
+        p_location = 'Patricia Bay'):
+    """
+    Do the location preparation of compute_RAM_corridor_to_hyd once
+    (bathymetry gridding and fit, SSP, seabed) and save it as a bundle.
+    
+    Workers and notebooks can then start from 
+        Location_Bundle(p_fname).make_environment(Environment_RAM)
+    instead of re-reading the raw data.
+    """
+    the_location = Location(p_location) 
 
     bathy = Bathymetry_CHS_2()
-    bathy.get_2d_bathymetry_trimmed( #og variable values
+    bathy.get_2d_bathymetry_trimmed(
         p_location_as_object = the_location,
         p_num_points_lon = p_N_points_lon,
         p_num_points_lat = p_N_points_lat,
         p_depth_offset = 0
         )
 
-    ssp = SSP_Blouin_2015()
+    env_RAM = Environment_RAM(
+        the_location,p_N_points_lat,p_N_points_lon
+        )  
+    env_RAM.set_bathymetry_common(bathy)
+    env_RAM.set_seabed_common()
+    env_RAM.set_ssp_common(SSP_Blouin_2015())
+    bake_environment_bundle(p_fname,env_RAM)
+    return Location_Bundle(p_fname)
+
+
+def compute_RAM_corridor_from_bundle(
+        p_bundle_fname,
+        p_freq,
+        p_n_lat_pts,
+        p_n_lon_pts,
+        p_dir_RAM,
+        p_RAM_delta_r,
+        p_line_or_point,
+        p_TX_depth = 1.7,
+        p_BASIS_SIZE_depth = 100,
+        p_BASIS_SIZE_distance = 100,
+        p_pool = None,
+        p_incremental = False):
+    """
+    compute_RAM_corridor_to_hyd, starting from a bundle baked with
+    bake_RAM_location_bundle instead of the raw data.
+    
+    p_pool is an optional workers.Worker_Pool, kept open between calls, 
+    that the transects are run on. Result files are the same as without.
+    """
+    bundle = Location_Bundle(p_bundle_fname)
+    the_location = bundle.location
 
-    # # DEFINE THE SOURCES FOR PYRAM
     source_RAM = Source()
     source_RAM.set_name()
-    source_RAM.set_depth(p_TX_depth) #Default is 1.7m
+    source_RAM.set_depth(p_TX_depth)
     source_RAM.set_speed()
     source_RAM.generate_course_from_grid(
         p_lat_minmax_tuple  = the_location.LAT_RANGE_CORRIDOR_TUPLE,
@@ -118,51 +312,35 @@ def compute_RAM_corridor_to_hyd(
         p_num_lon_points    = p_n_lon_pts
           )
 
-    # # DEFINE THE ENVIRONMENT FOR SOUTH HYD
-    env_RAM_S = Environment_RAM(
-        the_location,p_N_points_lat,p_N_points_lon
-        )  
-    env_RAM_S.set_hydrophone_name('South')
-    env_RAM_S.set_model_save_directory(p_dir_RAM)
-    env_RAM_S.set_bathymetry_common(bathy)
-    env_RAM_S.set_seabed_common()
-    env_RAM_S.set_ssp_common(ssp)
-    env_RAM_S.set_calc_params(p_RAM_delta_r)
-    env_RAM_S.set_freqs_common([p_freq])
-    env_RAM_S.set_rx_location_common(rx_loc_S)
-    env_RAM_S.set_rx_depth_common(rx_z_S)
-
-    # # DEFINE THE ENVIRONMENT FOR NORTH HYD    
-    env_RAM_N = Environment_RAM(
-        the_location,p_N_points_lat,p_N_points_lon
-        )  
-    env_RAM_N.set_hydrophone_name('North')
-    env_RAM_N.set_model_save_directory(p_dir_RAM)
-    env_RAM_N.set_bathymetry_common(bathy)
-    env_RAM_N.set_seabed_common()
-    env_RAM_N.set_ssp_common(ssp)
-    env_RAM_N.set_calc_params(p_RAM_delta_r)
-    env_RAM_N.set_freqs_common([p_freq])
-    env_RAM_N.set_rx_location_common(rx_loc_N)
-    env_RAM_N.set_rx_depth_common(rx_z_N)
-
-    # SET SOURCE POINTS
-    # THEN COMPUTE RESULTS
-    env_RAM_S.set_source_common(source_RAM)
-    env_RAM_N.set_source_common(source_RAM)
-
-    env_RAM_S.calculate_exact_TLs(
-        POINT_OR_LINE_STR = p_line_or_point,
-        BASIS_SIZE_DEPTH = p_BASIS_SIZE_depth, 
-        BASIS_SIZE_DISTANCE = p_BASIS_SIZE_distance
-        )
-    env_RAM_N.calculate_exact_TLs(
-        POINT_OR_LINE_STR = p_line_or_point,
-        BASIS_SIZE_DEPTH = p_BASIS_SIZE_depth, 
-        BASIS_SIZE_DISTANCE = p_BASIS_SIZE_distance
-        )
-
-    return env_RAM_S, env_RAM_N
+    hydrophones = [('South',
+                    (the_location.hyd_2_lat,the_location.hyd_2_lon),
+                    the_location.hyd_2_z),
+                   ('North',
+                    (the_location.hyd_1_lat,the_location.hyd_1_lon),
+                    the_location.hyd_1_z)]
+    result = []
+    for name,rx_loc,rx_z in hydrophones:
+        env = bundle.make_environment(Environment_RAM)
+        env.set_hydrophone_name(name)
+        env.set_model_save_directory(p_dir_RAM)
+        env.set_calc_params(p_RAM_delta_r)
+        env.set_output_params(Environment_RAM.OUTPUT_LINE)
+        env.set_freqs_common([p_freq])
+        env.set_rx_location_common(rx_loc)
+        env.set_rx_depth_common(rx_z)
+        env.set_source_common(source_RAM)
+        kwargs = {'POINT_OR_LINE_STR' : p_line_or_point,
+                  'BASIS_SIZE_DEPTH' : p_BASIS_SIZE_depth,
+                  'BASIS_SIZE_DISTANCE' : p_BASIS_SIZE_distance,
+                  'INCREMENTAL' : p_incremental}
+        if p_pool is not None:
+            kwargs['RUNNER'] = p_pool.transect_runner(env,p_bundle_fname)
+        env.calculate_exact_TLs(**kwargs)
+        result.append(env)
+
+    if p_pool is not None:
+        print(p_pool.summary())
+    return result[0], result[1]
 
 
 def compute_RAM_single_latlon_to_hyd(
@@ -253,6 +431,7 @@ def compute_RAM_single_latlon_to_hyd(
     env_RAM_S.set_seabed_common()
     env_RAM_S.set_ssp_common(ssp)
     env_RAM_S.set_calc_params(p_RAM_delta_r)
+    env_RAM_S.set_output_params(Environment_RAM.OUTPUT_LINE)
     env_RAM_S.set_freqs_common([p_freq])
     env_RAM_S.set_rx_location_common(rx_loc_S)
     env_RAM_S.set_rx_depth_common(rx_z_S)
@@ -266,6 +445,7 @@ def compute_RAM_single_latlon_to_hyd(
     env_RAM_N.set_seabed_common()
     env_RAM_N.set_ssp_common(ssp)
     env_RAM_N.set_calc_params(p_RAM_delta_r)
+    env_RAM_N.set_output_params(Environment_RAM.OUTPUT_LINE)
     env_RAM_N.set_freqs_common([p_freq])
     env_RAM_N.set_rx_location_common(rx_loc_N)
     env_RAM_N.set_rx_depth_common(rx_z_N)
@@ -334,10 +514,11 @@ def interpolate_TL_over_XY_set_single_f(
     fname_TL        = p_dir_RAM + str(p_freq_target).zfill(4) + r'_' + p_hydro.capitalize() + '.csv'
     X,Y,TL          = read_XY_TL_df(fname_TL)
     
-    TL_interped     = interpolate.griddata(
-        ( X , Y ) ,
-        TL ,
-        ( p_gram_x , p_gram_y ) )
+    with instrument.stage(instrument.STAGE_INTERPOLATION):
+        TL_interped     = interpolate.griddata(
+            ( X , Y ) ,
+            TL ,
+            ( p_gram_x , p_gram_y ) )
     return TL_interped
 
 
@@ -355,6 +536,67 @@ def interpolate_TL_over_XY_set_multi_f(
     return result
 
 
+def compute_RAM_corridor_planned_f(
+        p_plan,
+        p_n_lat_pts,
+        p_n_lon_pts,
+        p_dir_RAM,
+        p_RAM_delta_r,
+        p_line_or_point,
+        **kwargs):
+    """
+    Run compute_RAM_corridor_to_hyd only at the anchor frequencies of the
+    passed Frequency_Plan, refining the anchors where TL at either
+    hydrophone changes faster than the plan tolerance.
+
+    kwargs are passed on to compute_RAM_corridor_to_hyd.
+    
+    Returns the refined plan. Its usable anchors (an anchor whose run
+    raised is excluded) have result files in p_dir_RAM,
+    use interpolate_TL_over_XY_set_planned_f for all other frequencies.
+    """
+    def TL_function(p_freq):
+        env_RAM_S, env_RAM_N = compute_RAM_corridor_to_hyd(
+            p_freq,
+            p_n_lat_pts,
+            p_n_lon_pts,
+            p_dir_RAM,
+            p_RAM_delta_r,
+            p_line_or_point,
+            **kwargs)
+        return np.concatenate((env_RAM_S.TL_unstruc,env_RAM_N.TL_unstruc))
+    p_plan.refine(TL_function)
+    return p_plan
+
+
+def interpolate_TL_over_XY_set_planned_f(
+        p_freq_targets,
+        p_plan,
+        p_gram_x,
+        p_gram_y,
+        p_dir_RAM   = _dirs.DIR_RAM_DATA,
+        p_hydro     = _vars.HYDROPHONE ):
+    """
+    As interpolate_TL_over_XY_set_multi_f, but only the anchor frequencies
+    of p_plan are read and gridded. Other frequencies are interpolated
+    between the gridded anchors. Anchors in RAM_F_FAILS are excluded from
+    the plan rather than gridded as zeros.
+
+    Returns the result dictionary and a dictionary of estimated errors (dB).
+    """
+    freqs = np.atleast_1d(p_freq_targets)
+    p_plan.exclude([f for f in p_plan.anchors if f in _vars.RAM_F_FAILS])
+    anchors = set()
+    for f in freqs:
+        anchors.update(p_plan.bracket(f))
+    gridded = dict()
+    for f in anchors:
+        gridded[f] = interpolate_TL_over_XY_set_single_f(
+            f, None, p_gram_x, p_gram_y, p_dir_RAM, p_hydro)
+    result = p_plan.interpolate(freqs,gridded)
+    return result, p_plan.estimate_error(freqs)
+
+
 if __name__ == '__main__':
     import time
     freq = 500
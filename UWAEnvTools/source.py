@@ -9,6 +9,11 @@ import numpy as np
 
 import haversine
 
+import UWAEnvTools.events as events
+from UWAEnvTools.bathymetry import TRANSECT_OK, TRANSECT_OUT_OF_DOMAIN, \
+    TRANSECT_SOURCE_ON_LAND, TRANSECT_CROSSES_LAND
+from UWAEnvTools.results import source_key
+
 class Source():
     """
     A source can be a ship, point model, or something towed.
@@ -25,6 +30,7 @@ class Source():
         self.depth = 'not set'
         self.speed = 'not set' #m/s
         self.name = 'point source'
+        self.course_valid = dict() # see prefilter_course
         
     def set_depth(self,p_z = 1.7):
         self.depth = p_z
@@ -165,11 +171,101 @@ class Source():
         self.lats = np.array(lats)
         self.lons = np.array(lats)        
         return self.course
-            
-            
-            
-            
-            
-            
+
+    def prefilter_course(self,
+                         p_bathymetry,
+                         p_rx_lat_lon_tuples,
+                         p_mode = 'drop',
+                         p_n_points = 100,
+                         p_event_stream = None,
+                         **kwargs):
+        """
+        Check every source point of the course against the bathymetry 
+        before any model run (see Bathymetry.check_transects, kwargs go 
+        there), for each of the passed receivers. The transects are
+        sampled at p_n_points on the line from the receiver to the source.
+        
+        p_mode 'drop' removes the points that are invalid for every
+        receiver (e.g. on land) from the course. 'flag' keeps the course
+        as it is, use it for gridded outputs (Environment_ARL) that need 
+        the whole grid. With either, self.course_valid holds for each 
+        receiver a boolean per course point: the RAM runs skip the
+        invalid points, and the ARL runs write NaN for them.
+        
+        Emits a prefilter event per receiver to p_event_stream (else the
+        UWAENVTOOLS_EVENTS file, if set), and returns the report.
+        """
+        if p_mode not in ('drop','flag'):
+            raise ValueError('Source.prefilter_course: unknown mode ' + str(p_mode))
+        course = np.reshape(np.asarray(self.course,dtype=float),(-1,2))
+        codes = []
+        for rx in p_rx_lat_lon_tuples:
+            codes.append(p_bathymetry.check_transects(rx,
+                                                      course[:,0],
+                                                      course[:,1],
+                                                      p_n_points,
+                                                      **kwargs))
+        codes = np.array(codes) # n_receivers x n_points
+        keep = np.ones(len(course),dtype=bool)
+        if p_mode == 'drop':
+            keep = np.any(codes == TRANSECT_OK,axis=0)
+            self.course = [tx for tx,k in zip(self.course,keep) if k]
+            for name in ['lats','lons']:
+                value = getattr(self,name,None)
+                if value is not None and len(value) == len(keep):
+                    setattr(self,name,np.asarray(value)[keep])
+        self.course_valid = dict()
+        for rx,code in zip(p_rx_lat_lon_tuples,codes):
+            self.course_valid[source_key(rx[0],rx[1])] = \
+                code[keep] == TRANSECT_OK
+        
+        stream = p_event_stream
+        if stream is None:
+            stream = events.default_stream()
+        n_dropped = int(len(course) - np.sum(keep))
+        report = 'Prefilter (' + p_mode + '): ' \
+            + str(n_dropped) + ' of ' + str(len(course)) \
+            + ' source points dropped.'
+        for rx,code in zip(p_rx_lat_lon_tuples,codes):
+            counts = {'n_skipped' : int(np.sum(code[keep] != TRANSECT_OK)),
+                      'n_out_of_domain' : int(np.sum(code == TRANSECT_OUT_OF_DOMAIN)),
+                      'n_on_land' : int(np.sum(code == TRANSECT_SOURCE_ON_LAND)),
+                      'n_crossing_land' : int(np.sum(code == TRANSECT_CROSSES_LAND))}
+            report = report + '\n    RX ' + str(rx) + ': ' \
+                + str(counts['n_skipped']) + ' skipped (' \
+                + str(counts['n_out_of_domain']) + ' out of domain, ' \
+                + str(counts['n_on_land']) + ' on land, ' \
+                + str(counts['n_crossing_land']) + ' crossing land).'
+            if stream is not None:
+                stream.emit(events.EVENT_PREFILTER,
+                            rx_lat = rx[0],
+                            rx_lon = rx[1],
+                            mode = p_mode,
+                            n_points = len(course),
+                            n_dropped = n_dropped,
+                            **counts)
+        self.prefilter_report = report
+        return report
     
-    
\ No newline at end of file
+    def course_mask(self,p_rx_lat_lon_tuple):
+        """
+        A boolean per course point, False where prefilter_course flagged
+        the point for this receiver (all True if it was not run for it).
+        """
+        key = source_key(p_rx_lat_lon_tuple[0],p_rx_lat_lon_tuple[1])
+        if key not in self.course_valid:
+            return np.ones(len(self.course),dtype=bool)
+        valid = self.course_valid[key]
+        if len(valid) != len(self.course):
+            raise ValueError(
+                'Source.course_mask: the course changed since '\
+                    'prefilter_course, run it again.')
+        return np.asarray(valid,dtype=bool)
+    
+    def valid_course(self,p_rx_lat_lon_tuple):
+        """
+        The course without the points prefilter_course flagged for this
+        receiver (the whole course if it was not run for it).
+        """
+        valid = self.course_mask(p_rx_lat_lon_tuple)
+        return [tx for tx,ok in zip(self.course,valid) if ok]
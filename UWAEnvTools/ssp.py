@@ -1,9 +1,12 @@
 import numpy as np
 import ast
-import matplotlib.pyplot as plt
-import pandas as pd
 import os
 
+from UWAEnvTools.backends import Lazy_Module
+
+plt = Lazy_Module('matplotlib.pyplot')
+pd = Lazy_Module('pandas')
+
 class SSP():
     """
     All SSP sources must map to this class.
@@ -48,37 +51,65 @@ class SSP_Blouin_2015(SSP):
                      fname,
                      summer = r'August',
                      winter = r'February'):
-        if self.depths == r'not set':
+        """
+        Evaluates every month in the coefficient file over the depth basis
+        in one pass (see seasonal_table). Each month is kept in self.dict
+        under its own name, and 'Summer' / 'Winter' are the passed months.
+        """
+        if isinstance(self.depths,str):
             raise SSP.SSP_Error("Depths must be set before calling SSP_Blouin.2015.read_profile.")
         self.source = 'Blouin 2015'
         self.lat = 44.693611
         self.lon = -63.640278
         
+        self.read_coefficients(fname)
+        self.months, self.table = self.seasonal_table(self.depths)
+        for month,profile in zip(self.months,self.table):
+            self.dict[month] = profile
+        self.dict['Summer'] = self.dict[summer]
+        self.dict['Winter'] = self.dict[winter]
+        
+    def read_coefficients(self,fname):
+        """
+        Lines of the form: Month [c0, c1, c2, c3]
+        """
         with open(fname) as f:
             data = f.readlines()
         
         coeffs_dict = dict()
         for line in data:
+            if '[' not in line:
+                continue
             strs = line.split('[')
             coefs = ast.literal_eval('['+strs[1])
-            strs[0].split(' ')[0]
             coeffs_dict[strs[0].split(' ')[0]] = coefs
-
-        summer_c = np.zeros(len(self.depths))
-        winter_c = np.zeros(len(self.depths))
-        for index in range(len(self.depths)):
-            summer_c[index] = self.third_order_estimate(
-                coeffs_dict[summer],
-                self.depths[index])
-            winter_c[index] = self.third_order_estimate(
-                coeffs_dict[winter],
-                self.depths[index])
-        self.dict['Summer'] = summer_c
-        self.dict['Winter'] = winter_c
+        self.coefficients = coeffs_dict
+        return coeffs_dict
             
+    def seasonal_table(self,p_depths):
+        """
+        Sound speed for every month at every depth, as a single
+        (months x depths) matrix product of the coefficients with the
+        depth powers.
+        
+        Returns the month names (file order) and the table.
+        """
+        months = list(self.coefficients.keys())
+        order = max([len(self.coefficients[m]) for m in months])
+        coeffs = np.zeros((len(months),order))
+        for index,month in enumerate(months):
+            coeffs[index,:len(self.coefficients[month])] = \
+                self.coefficients[month]
+        depths = np.asarray(p_depths,dtype=float)
+        powers = np.vander(depths,order,increasing=True) # depths x order
+        return months, coeffs @ powers.T
 
     def third_order_estimate(self,p_coeffs,p_depth):
-        c = 0
+        """
+        Works for scalar or array p_depth.
+        """
+        p_depth = np.asarray(p_depth,dtype=float)
+        c = np.zeros_like(p_depth)
         for index in range(len(p_coeffs)):
             c = c + (p_coeffs[index] * p_depth**(index))
         return c
@@ -101,10 +132,7 @@ class SSP_Munk(SSP):
         
         Sets both Winter and Summer profiles to be the same.
         """
-        c = []
-        for d in self.depths:
-            c.append(self.munk(d))
-        c = np.array(c)
+        c = self.munk(np.asarray(self.depths,dtype=float))
         self.dict['Summer'] = c
         self.dict['Winter'] = c
         
@@ -145,6 +173,7 @@ class SSP_Measured(SSP):
     """
     
     
+    @staticmethod
     def tolerant_mean(p_list):
         """
         For averaging together different-length arrays in a list.
@@ -160,44 +189,69 @@ class SSP_Measured(SSP):
     def set_depths(self,p_depths):
         self.depths = p_depths
     
-    def generate_mean_from_ssps_and_plot(self,
+    def generate_mean_from_ssps(self,
                       p_source_dir,
                       p_target_dir,
-                      datetime_filter='2019'):
+                      datetime_filter='2019',
+                      p_bin_size = 0.5,
+                      p_max_depth = 200.,
+                      p_n_workers = 8,
+                      p_store = None):
         """
-        For a given querty string on filenames in a source directory,
-        calculate the mean SSP.
-        Mean is calculated on the longest array length.
-        See tolerant_mean for details.
+        For a given query string on filenames in a source directory,
+        calculate the mean SSP and write it to
+        p_target_dir/mean_SSP_<datetime_filter>.csv. No plotting.
+        
+        Casts are read concurrently and binned on a common depth grid
+        (see ctd.CTD_Cast_Store), and the mean is per depth bin over the
+        casts that reach it. Bins no cast reaches are dropped.
+        
+        Pass a loaded CTD_Cast_Store as p_store to skip reading the CSVs.
+        
+        Returns the store, the selection mask, and the result DataFrame.
         """
-
-        dirname_source = r'C:\Users\Jasper\Documents\Repo\pyDal\UWAEnvTools\data\Pat Bay CTDs\\'
-        dirname_target = r'C:\Users\Jasper\Documents\Repo\pyDal\UWAEnvTools\data\interim\ssp\\'
-        files = os.listdir(dirname_source)
-        line_skip = 28
+        from UWAEnvTools.ctd import CTD_Cast_Store
+        if p_store is None:
+            p_store = CTD_Cast_Store(p_bin_size,p_max_depth)
+            p_store.ingest(p_source_dir,datetime_filter,p_n_workers)
+        mask = p_store.select(datetime_filter)
+        v, v_error = p_store.mean(mask)
+        keep = np.isfinite(v)
+        
+        df_res = pd.DataFrame(data={'Depth (m)':p_store.depths[keep],
+                                    'Sound speed(m/s)':v[keep]})
+        df_res.to_csv(os.path.join(p_target_dir,
+                                   'mean_SSP_' + datetime_filter + '.csv'),
+                      index = False)
+        self.set_depths(df_res['Depth (m)'].values)
+        self.dict['Summer'] = df_res['Sound speed(m/s)'].values
+        self.dict['Winter'] = df_res['Sound speed(m/s)'].values
+        return p_store, mask, df_res
+    
+    def plot_ssps(self,p_store,p_mask,p_df_mean):
         fig, ax = plt.subplots(1,1)
-        v_list = []
-        z_list = []
-        for f in files:
-            if 'mean' in f: continue
-            if datetime_filter in f:
-                strs = f.split('_')
-                t = strs[1] + strs[2].split('.')[0]
-                df = pd.read_csv( dirname_source + f , skiprows=line_skip)
-                x = df[df.columns[6]]
-                y = df[df.columns[1]]
-                ax.plot(x,y, label = t)
-                z_list.append(np.asarray(y))
-                v_list.append(np.asarray(x))
-        v, v_error = self.tolerant_mean(v_list)
-        z, _ = self.tolerant_mean(z_list)
-        ax.plot(v,z, label = 'MEAN')
+        for index in np.nonzero(p_mask)[0]:
+            ax.plot(p_store.speeds[index],p_store.depths,
+                    label = p_store.times[index])
+        ax.plot(p_df_mean['Sound speed(m/s)'],p_df_mean['Depth (m)'],
+                label = 'MEAN')
         ax.invert_yaxis()
         plt.legend()
+        return fig, ax
+    
+    def generate_mean_from_ssps_and_plot(self,
+                      p_source_dir,
+                      p_target_dir,
+                      datetime_filter='2019'):
+        """
+        generate_mean_from_ssps followed by plot_ssps.
+        """
+        store, mask, df_res = self.generate_mean_from_ssps(
+            p_source_dir,
+            p_target_dir,
+            datetime_filter)
+        self.plot_ssps(store,mask,df_res)
         
-        df_res = pd.DataFrame(data={'Depth (m)':z,'Sound speed(m/s)':v})
-        df_res.to_csv(dirname_target + 'mean_SSP_' + datetime_filter + '.csv')
-
         
     
     
@@ -219,4 +273,185 @@ class SSP_Measured(SSP):
 
         self.set_depths(depths)
         self.dict['Summer'] = summer_c
-        self.dict['Winter'] = winter_c
\ No newline at end of file
+        self.dict['Winter'] = winter_c
+
+class SSP_Field(SSP):
+    """
+    Several georeferenced profiles on one depth basis, for range dependent
+    SSPs along transects.
+
+    Profiles are found with a KD-tree over their (flat earth) positions and
+    combined by inverse distance weighting of the nearest few. A batch of
+    transects is sampled in one query, and the sampled fields are cached
+    by transect so that every frequency reuses them.
+
+    self.dict holds the mean of the profiles, so the field can also be used
+    wherever a single SSP is expected.
+    """
+
+    R = 6371000. # m
+
+    def __init__(self,p_n_neighbours = 4,p_power = 2.):
+        SSP.__init__(self)
+        self.N_NEIGHBOURS = p_n_neighbours
+        self.POWER = p_power
+        self.lats = np.array([])
+        self.lons = np.array([])
+        self.profiles = dict() # season : n_profiles x n_depths
+        self.tree = None
+        self.cache = dict()
+
+    def set_depths(self,p_depths):
+        if len(self.lats) > 0:
+            raise SSP.SSP_Error(
+                "SSP_Field: depths must be set before adding profiles.")
+        self.depths = np.asarray(p_depths,dtype=float)
+
+    def add_profile(self,p_lat,p_lon,p_ssp):
+        """
+        Add every season of a read SSP object at the passed position,
+        resampled on to the field depths (held constant past either end).
+        """
+        if isinstance(self.depths,str):
+            raise SSP.SSP_Error(
+                "SSP_Field: depths must be set before adding profiles.")
+        if len(self.lats) > 0 and set(p_ssp.dict.keys()) != set(self.profiles.keys()):
+            raise SSP.SSP_Error(
+                "SSP_Field: every profile must have the same seasons.")
+        z = np.asarray(p_ssp.depths,dtype=float)
+        for season,c in p_ssp.dict.items():
+            c = np.asarray(c,dtype=float)
+            valid = np.isfinite(c)
+            c = np.interp(self.depths,z[valid],c[valid])
+            if season in self.profiles:
+                self.profiles[season] = np.vstack((self.profiles[season],c))
+            else:
+                self.profiles[season] = c[np.newaxis,:]
+        self.lats = np.append(self.lats,float(p_lat))
+        self.lons = np.append(self.lons,float(p_lon))
+        for season,c in self.profiles.items():
+            self.dict[season] = np.mean(c,axis=0)
+        self.tree = None
+        self.cache = dict()
+
+    def add_cast_store(self,p_store,p_mask = None):
+        """
+        Add each cast of a ctd.CTD_Cast_Store that has a position, as both
+        Summer and Winter.
+        """
+        if p_mask is None:
+            p_mask = np.ones(len(p_store),dtype=bool)
+        p_mask = p_mask & np.isfinite(p_store.lats) & np.isfinite(p_store.lons)
+        for index in np.nonzero(p_mask)[0]:
+            cast = SSP()
+            cast.depths = p_store.depths
+            cast.dict['Summer'] = p_store.speeds[index]
+            cast.dict['Winter'] = p_store.speeds[index]
+            self.add_profile(p_store.lats[index],p_store.lons[index],cast)
+
+    def xy(self,p_lats,p_lons):
+        """
+        Flat earth x,y in m about the mean profile position.
+        """
+        DEG_TO_RAD = np.pi / 180
+        lat_0 = np.mean(self.lats)
+        lon_0 = np.mean(self.lons)
+        x = self.R * DEG_TO_RAD * (np.asarray(p_lons) - lon_0) \
+            * np.cos(lat_0 * DEG_TO_RAD)
+        y = self.R * DEG_TO_RAD * (np.asarray(p_lats) - lat_0)
+        return np.stack((np.ravel(x),np.ravel(y)),axis=-1)
+
+    def build_index(self):
+        from scipy.spatial import cKDTree
+        if len(self.lats) == 0:
+            raise SSP.SSP_Error("SSP_Field: no profiles added.")
+        self.tree = cKDTree(self.xy(self.lats,self.lons))
+
+    def sample_points(self,p_lats,p_lons,p_season = 'Summer'):
+        """
+        The field at each point, n_points x n_depths.
+        """
+        if self.tree is None:
+            self.build_index()
+        k = min(self.N_NEIGHBOURS,len(self.lats))
+        dist,index = self.tree.query(self.xy(p_lats,p_lons),k=k)
+        dist = np.reshape(dist,(-1,k))
+        index = np.reshape(index,(-1,k))
+        # A point on top of a profile takes that profile exactly.
+        with np.errstate(divide='ignore'):
+            weights = 1. / dist ** self.POWER
+        exact = dist == 0
+        on_profile = np.any(exact,axis=1)
+        weights[on_profile] = exact[on_profile]
+        weights = weights / np.sum(weights,axis=1,keepdims=True)
+        profiles = self.profiles[p_season]
+        return np.einsum('pk,pkd->pd',weights,profiles[index])
+
+    def sample_transects(self,
+                         p_rx_lat_lon_tuple,
+                         p_tx_lat_lon_list,
+                         p_n_ranges,
+                         p_season = 'Summer'):
+        """
+        Sample the field along transects from one receiver to many sources
+        in a single query, and cache each one for transect().
+
+        Points follow bathymetry.transect_bases, so range 0 is the same end
+        of the line as the bathymetry profile.
+
+        Returns n_sources x n_depths x p_n_ranges.
+        """
+        from UWAEnvTools.bathymetry import transect_bases
+        tx = np.reshape(np.asarray(p_tx_lat_lon_list,dtype=float),(-1,2))
+        lat_bases,lon_bases = transect_bases(p_rx_lat_lon_tuple,
+                                             tx[:,0],
+                                             tx[:,1],
+                                             p_n_ranges)
+        c = self.sample_points(lat_bases,lon_bases,p_season)
+        c = np.reshape(c,(len(tx),p_n_ranges,len(self.depths)))
+        c = np.transpose(c,(0,2,1))
+        for n in range(len(tx)):
+            key = self.transect_key(p_rx_lat_lon_tuple,tx[n],p_n_ranges,p_season)
+            self.cache[key] = np.ascontiguousarray(c[n])
+        return c
+
+    def transect(self,
+                 p_rx_lat_lon_tuple,
+                 p_tx_lat_lon_tuple,
+                 p_total_distance,
+                 p_n_ranges,
+                 p_season = 'Summer'):
+        """
+        ssp_r (m) and ssp_c (n_depths x p_n_ranges) for one transect, from
+        the cache if it was sampled already.
+        """
+        key = self.transect_key(p_rx_lat_lon_tuple,
+                                p_tx_lat_lon_tuple,
+                                p_n_ranges,
+                                p_season)
+        if key not in self.cache:
+            self.sample_transects(p_rx_lat_lon_tuple,
+                                  [p_tx_lat_lon_tuple],
+                                  p_n_ranges,
+                                  p_season)
+        ssp_r = np.linspace(0,p_total_distance,p_n_ranges)
+        return ssp_r, self.cache[key]
+
+    @staticmethod
+    def transect_key(p_rx,p_tx,p_n_ranges,p_season):
+        from UWAEnvTools.results import source_key
+        return (source_key(p_rx[0],p_rx[1]),
+                source_key(p_tx[0],p_tx[1]),
+                int(p_n_ranges),
+                p_season)
+
+    def clear_cache(self):
+        self.cache = dict()
+
+    def hash_inputs(self):
+        return [self.lats,
+                self.lons,
+                self.depths,
+                self.profiles,
+                self.N_NEIGHBOURS,
+                self.POWER]
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk multi-resolution bathymetry tiles, for regions too large to hold
+as one gridded array and spline.
+
+A pyramid directory holds an index.json and, per level, square tiles of
+nodes saved as .npy. Level 0 is the source grid; each further level has
+every second node of the one below, after a [1,2,1] smoothing. Tiles
+share their last row and column with the next tile, so any bilinear cell
+is inside one tile.
+
+Tile_Store reads tiles on demand through a bounded LRU cache, so memory
+is set by the cache size and not the region size. Bathymetry_Tiled
+samples transects at the coarsest level finer than the requested spacing.
+"""
+
+import os
+import json
+import atexit
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from UWAEnvTools.bathymetry import Bathymetry, Depth_Index
+from UWAEnvTools.results import hash_items
+import UWAEnvTools.instrument as instrument
+
+
+PYRAMID_VERSION = 1
+INDEX_FNAME = 'index.json'
+
+
+def build_tile_pyramid(p_dir,
+                       p_lat_basis,
+                       p_lon_basis,
+                       p_z,
+                       p_tile_size = 256,
+                       p_lat_first = False):
+    """
+    Write a pyramid for a regular grid to p_dir.
+
+    p_z is indexed [lon,lat] (as z_interped), or [lat,lon] with
+    p_lat_first (as GEBCO / WOD netCDF variables). It is only sliced a
+    tile at a time, so a np.memmap or a netCDF4 variable can be passed
+    for grids that do not fit in memory.
+
+    Levels are added until one tile covers the region.
+
+    Returns the Tile_Store.
+    """
+    lat_basis = np.asarray(p_lat_basis,dtype=float)
+    lon_basis = np.asarray(p_lon_basis,dtype=float)
+    T = int(p_tile_size)
+    os.makedirs(p_dir,exist_ok = True)
+
+    def source_window(k0,k1,m0,m1):
+        if p_lat_first:
+            return np.asarray(p_z[m0:m1+1,k0:k1+1],dtype=np.float32).T
+        return np.asarray(p_z[k0:k1+1,m0:m1+1],dtype=np.float32)
+
+    level = {'lat_0' : float(lat_basis[0]),
+             'lon_0' : float(lon_basis[0]),
+             'd_lat' : float((lat_basis[-1] - lat_basis[0]) / (len(lat_basis) - 1)),
+             'd_lon' : float((lon_basis[-1] - lon_basis[0]) / (len(lon_basis) - 1)),
+             'n_lat' : len(lat_basis),
+             'n_lon' : len(lon_basis)}
+    index = {'version' : PYRAMID_VERSION,
+             'tile_size' : T,
+             'levels' : []}
+
+    store = None
+    while True:
+        L = len(index['levels'])
+        index['levels'].append(level)
+        os.makedirs(os.path.join(p_dir,str(L)),exist_ok = True)
+        level['min'] = dict()
+        level['max'] = dict()
+        for i in range(_n_tiles(level['n_lon'],T)):
+            for j in range(_n_tiles(level['n_lat'],T)):
+                k0,k1 = i * T, min(i * T + T,level['n_lon'] - 1)
+                m0,m1 = j * T, min(j * T + T,level['n_lat'] - 1)
+                if L == 0:
+                    tile = source_window(k0,k1,m0,m1)
+                else:
+                    # nodes 2k of the level below, smoothed, 1 node halo
+                    window = store.read_window(L - 1,
+                                               2 * k0 - 1,2 * k1 + 1,
+                                               2 * m0 - 1,2 * m1 + 1)
+                    tile = _smooth_121(window)[1:-1:2,1:-1:2]
+                np.save(_tile_fname(p_dir,L,i,j),tile.astype(np.float32))
+                key = str(i) + '_' + str(j)
+                level['min'][key] = _nan_to_none(np.nanmin(tile)) \
+                    if np.any(np.isfinite(tile)) else None
+                level['max'][key] = _nan_to_none(np.nanmax(tile)) \
+                    if np.any(np.isfinite(tile)) else None
+        _write_index(p_dir,index)
+        store = Tile_Store(p_dir)
+        if level['n_lat'] <= T + 1 and level['n_lon'] <= T + 1:
+            break
+        level = {'lat_0' : level['lat_0'],
+                 'lon_0' : level['lon_0'],
+                 'd_lat' : 2 * level['d_lat'],
+                 'd_lon' : 2 * level['d_lon'],
+                 'n_lat' : (level['n_lat'] - 1) // 2 + 1,
+                 'n_lon' : (level['n_lon'] - 1) // 2 + 1}
+    return store
+
+
+def build_tile_pyramid_from_bathymetry(p_dir,p_bathymetry,p_tile_size = 256):
+    """
+    A pyramid of the trimmed grid of an already prepared Bathymetry.
+    """
+    return build_tile_pyramid(p_dir,
+                              p_bathymetry.lat_basis_trimmed,
+                              p_bathymetry.lon_basis_trimmed,
+                              p_bathymetry.z_interped,
+                              p_tile_size)
+
+
+def _n_tiles(p_n_nodes,p_tile_size):
+    return max(int(np.ceil((p_n_nodes - 1) / p_tile_size)),1)
+
+
+def _tile_fname(p_dir,p_level,p_i,p_j):
+    return os.path.join(p_dir,str(p_level),str(p_i) + '_' + str(p_j) + '.npy')
+
+
+def _write_index(p_dir,p_index):
+    fname = os.path.join(p_dir,INDEX_FNAME)
+    with open(fname + '.tmp','w') as f:
+        json.dump(p_index,f)
+    os.replace(fname + '.tmp',fname)
+
+
+def _nan_to_none(p_value):
+    return None if not np.isfinite(p_value) else float(p_value)
+
+
+def _smooth_121(p_window):
+    """
+    [1,2,1] x [1,2,1] smoothing ignoring NaN. The result is 2 smaller
+    in each dimension (the valid part).
+    """
+    w = np.array([1.,2.,1.])
+    finite = np.isfinite(p_window)
+    z = np.where(finite,p_window,0.)
+    num = np.zeros((z.shape[0] - 2,z.shape[1] - 2))
+    den = np.zeros_like(num)
+    for a in range(3):
+        for b in range(3):
+            weight = w[a] * w[b]
+            num = num + weight * z[a:a + num.shape[0],b:b + num.shape[1]]
+            den = den + weight * finite[a:a + num.shape[0],b:b + num.shape[1]]
+    with np.errstate(invalid='ignore',divide='ignore'):
+        result = num / den
+    result[den == 0] = np.nan
+    # keep the same size as the window by padding the lost edge with NaN
+    return np.pad(result,1,constant_values = np.nan)
+
+
+class Tile_Store():
+    """
+    Read access to a pyramid written by build_tile_pyramid.
+
+    At most p_cache_tiles tiles are in memory at once, least recently
+    used first out.
+    """
+
+    def __init__(self,p_dir,p_cache_tiles = 64):
+        self.dir = p_dir
+        with open(os.path.join(p_dir,INDEX_FNAME)) as f:
+            self.index = json.load(f)
+        if self.index['version'] != PYRAMID_VERSION:
+            raise ValueError('Tile_Store: pyramid ' + str(p_dir) \
+                             + ' is version ' + str(self.index['version']))
+        self.levels = self.index['levels']
+        self.tile_size = self.index['tile_size']
+        self.cache_tiles = p_cache_tiles
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_tile(self,p_level,p_i,p_j):
+        key = (p_level,p_i,p_j)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits = self.hits + 1
+            return self.cache[key]
+        self.misses = self.misses + 1
+        tile = np.load(_tile_fname(self.dir,p_level,p_i,p_j))
+        self.cache[key] = tile
+        while len(self.cache) > self.cache_tiles:
+            self.cache.popitem(last = False)
+        return tile
+
+    def basis(self,p_level):
+        """
+        The lat and lon node bases of a level.
+        """
+        level = self.levels[p_level]
+        return (level['lat_0'] + level['d_lat'] * np.arange(level['n_lat']),
+                level['lon_0'] + level['d_lon'] * np.arange(level['n_lon']))
+
+    def level_for_spacing(self,p_d_lat,p_d_lon):
+        """
+        The coarsest level with node spacing no larger than the passed
+        spacing (decimal degrees), level 0 if none is.
+        """
+        result = 0
+        for L,level in enumerate(self.levels):
+            if level['d_lat'] <= p_d_lat and level['d_lon'] <= p_d_lon:
+                result = L
+        return result
+
+    def read_window(self,p_level,p_k0,p_k1,p_m0,p_m1):
+        """
+        Nodes [p_k0..p_k1 (lon), p_m0..p_m1 (lat)] inclusive of a level,
+        NaN outside the level.
+        """
+        level = self.levels[p_level]
+        T = self.tile_size
+        window = np.full((p_k1 - p_k0 + 1,p_m1 - p_m0 + 1),np.nan,dtype=np.float32)
+        k0,k1 = max(p_k0,0),min(p_k1,level['n_lon'] - 1)
+        m0,m1 = max(p_m0,0),min(p_m1,level['n_lat'] - 1)
+        if k0 > k1 or m0 > m1:
+            return window
+        for i in range(k0 // T,min(k1 // T,_n_tiles(level['n_lon'],T) - 1) + 1):
+            for j in range(m0 // T,min(m1 // T,_n_tiles(level['n_lat'],T) - 1) + 1):
+                tile = self.get_tile(p_level,i,j)
+                a0,a1 = max(k0,i * T),min(k1,i * T + tile.shape[0] - 1)
+                b0,b1 = max(m0,j * T),min(m1,j * T + tile.shape[1] - 1)
+                window[a0 - p_k0:a1 - p_k0 + 1,b0 - p_m0:b1 - p_m0 + 1] = \
+                    tile[a0 - i * T:a1 - i * T + 1,b0 - j * T:b1 - j * T + 1]
+        return window
+
+    def sample(self,p_lats,p_lons,p_level = 0):
+        """
+        Bilinear depth at each point, loading only the tiles the points
+        fall in. NaN outside the region (no extrapolation).
+        """
+        level = self.levels[p_level]
+        T = self.tile_size
+        lats = np.ravel(np.asarray(p_lats,dtype=float))
+        lons = np.ravel(np.asarray(p_lons,dtype=float))
+        kf = (lons - level['lon_0']) / level['d_lon']
+        mf = (lats - level['lat_0']) / level['d_lat']
+        eps = 1e-9
+        inside = (kf >= -eps) & (kf <= level['n_lon'] - 1 + eps) \
+            & (mf >= -eps) & (mf <= level['n_lat'] - 1 + eps)
+        k = np.clip(np.floor(kf).astype(int),0,max(level['n_lon'] - 2,0))
+        m = np.clip(np.floor(mf).astype(int),0,max(level['n_lat'] - 2,0))
+        u = np.clip(kf - k,0,1)
+        v = np.clip(mf - m,0,1)
+        i = np.minimum(k // T,_n_tiles(level['n_lon'],T) - 1)
+        j = np.minimum(m // T,_n_tiles(level['n_lat'],T) - 1)
+
+        result = np.full(len(lats),np.nan)
+        points = np.nonzero(inside)[0]
+        if len(points) == 0:
+            return result
+        n_j = _n_tiles(level['n_lat'],T)
+        tile_keys = i[points] * n_j + j[points]
+        order = np.argsort(tile_keys,kind='stable')
+        points = points[order]
+        tile_keys = tile_keys[order]
+        starts = np.flatnonzero(np.diff(tile_keys,prepend = -1))
+        ends = np.append(starts[1:],len(points))
+        for start,end in zip(starts,ends):
+            p = points[start:end]
+            tile = self.get_tile(p_level,int(i[p[0]]),int(j[p[0]]))
+            a = k[p] - i[p[0]] * T
+            b = m[p] - j[p[0]] * T
+            a1 = np.minimum(a + 1,tile.shape[0] - 1)
+            b1 = np.minimum(b + 1,tile.shape[1] - 1)
+            result[p] = (1 - u[p]) * (1 - v[p]) * tile[a,b] \
+                + u[p] * (1 - v[p]) * tile[a1,b]              \
+                + (1 - u[p]) * v[p] * tile[a,b1]              \
+                + u[p] * v[p] * tile[a1,b1]
+        return result
+
+    def hash_inputs(self):
+        return hash_items(json.dumps(self.index,sort_keys = True))
+
+
+class Bathymetry_Tiled(Bathymetry):
+    """
+    Bathymetry sampled from a tile pyramid instead of a fitted spline.
+
+    read_bathy takes the pyramid directory. lat_basis_trimmed,
+    lon_basis_trimmed and z_interped are the coarsest level, for the
+    whole-region uses (SSP depth, masks). Transects and grids passed to
+    calculate_interp_bathy are sampled at the level that matches their
+    spacing. There is no spline, so spline_arrays (and with it bundles and
+    Shared_Bathymetry) raise TypeError; workers share the directory.
+    """
+
+    def __init__(self,p_cache_tiles = 64):
+        Bathymetry.__init__(self)
+        self.CACHE_TILES = p_cache_tiles
+        self.tiles = r'not set'
+
+    def read_bathy(self,fname):
+        self.set_tile_store(Tile_Store(fname,self.CACHE_TILES))
+
+    def set_tile_store(self,p_store):
+        self.tiles = p_store
+        self.depth_index = None
+        coarsest = len(p_store.levels) - 1
+        self.lat_basis_trimmed,self.lon_basis_trimmed = p_store.basis(coarsest)
+        level = p_store.levels[coarsest]
+        self.z_interped = p_store.read_window(coarsest,
+                                              0,level['n_lon'] - 1,
+                                              0,level['n_lat'] - 1)
+        self.lats_selection = self.lat_basis_trimmed
+        self.lons_selection = self.lon_basis_trimmed
+        self.z_selection = self.z_interped
+
+    def get_2d_bathymetry_trimmed(self,
+                                  p_location_as_object = 'not set',
+                                  p_num_points_lon = 200,
+                                  p_num_points_lat = 200,
+                                  p_depth_offset = 0):
+        """
+        The location fname_bathy is the pyramid directory. The region is
+        whatever the pyramid was built over.
+        """
+        self.the_location = p_location_as_object
+        self.N_lat_steps = p_num_points_lat
+        self.N_lon_steps = p_num_points_lon
+        with instrument.stage(instrument.STAGE_BATHY_LOAD):
+            self.read_bathy(self.the_location.fname_bathy)
+
+    def interpolate_bathy(self):
+        return # nothing to fit
+
+    def level_for_basis(self,p_lat_basis,p_lon_basis):
+        n = max(len(p_lat_basis),len(p_lon_basis),2)
+        d_lat = np.abs(p_lat_basis[-1] - p_lat_basis[0]) / (n - 1)
+        d_lon = np.abs(p_lon_basis[-1] - p_lon_basis[0]) / (n - 1)
+        # a north-south or east-west line only constrains one direction
+        if d_lat == 0:
+            d_lat = np.inf
+        if d_lon == 0:
+            d_lon = np.inf
+        return self.tiles.level_for_spacing(d_lat,d_lon)
+
+    def calculate_interp_bathy(self,p_lat_basis,p_lon_basis,p_grid=True):
+        lat_basis = np.atleast_1d(np.asarray(p_lat_basis,dtype=float))
+        lon_basis = np.atleast_1d(np.asarray(p_lon_basis,dtype=float))
+        level = self.level_for_basis(lat_basis,lon_basis)
+        if not p_grid:
+            return self.tiles.sample(lat_basis,lon_basis,level)
+        lon_x,lat_y = np.meshgrid(lon_basis,lat_basis,indexing='ij')
+        z = self.tiles.sample(lat_y,lon_x,level)
+        return np.reshape(z,lon_x.shape) # [lon,lat] as the splines give
+
+    def spline_arrays(self):
+        """
+        There is no spline to store. Bundles and shared memory need one,
+        so pass workers the pyramid directory instead.
+        """
+        raise TypeError(
+            'Bathymetry_Tiled has no spline to store or share, pass the '\
+                'pyramid directory (set_tile_store / read_bathy) instead.')
+
+    def set_constant_depth(self,p_depth,p_dir = None):
+        """
+        Replace the pyramid by a constant one over the same region, for
+        debugging or Pekeris comparison. It covers level 0 at about the
+        spacing of the coarsest level (bilinear sampling of a constant is
+        exact), and is written to p_dir, default a temporary directory
+        removed at exit.
+        """
+        if p_dir is None:
+            p_dir = tempfile.mkdtemp(suffix = '.pyramid')
+            atexit.register(shutil.rmtree,p_dir,True)
+        lat_basis,lon_basis = self.tiles.basis(0)
+        coarsest = self.tiles.levels[-1]
+        lat_basis = np.linspace(lat_basis[0],lat_basis[-1],
+                                max(coarsest['n_lat'] + 1,2))
+        lon_basis = np.linspace(lon_basis[0],lon_basis[-1],
+                                max(coarsest['n_lon'] + 1,2))
+        z = np.full((len(lon_basis),len(lat_basis)),p_depth,dtype=float)
+        self.set_tile_store(build_tile_pyramid(p_dir,
+                                               lat_basis,
+                                               lon_basis,
+                                               z,
+                                               self.tiles.tile_size))
+
+    def get_depth_index(self,p_tile_size = None):
+        """
+        The full resolution tile min/max recorded in the pyramid index.
+        """
+        if getattr(self,'depth_index',None) is None:
+            level = self.tiles.levels[0]
+            T = self.tiles.tile_size
+            z_min = np.full((_n_tiles(level['n_lon'],T),
+                             _n_tiles(level['n_lat'],T)),np.nan)
+            z_max = np.full_like(z_min,np.nan)
+            for key in level['min'].keys():
+                i,j = [int(v) for v in key.split('_')]
+                if level['min'][key] is not None:
+                    z_min[i,j] = level['min'][key]
+                    z_max[i,j] = level['max'][key]
+            self.depth_index = Depth_Index(level['lat_0'],level['lon_0'],
+                                           level['d_lat'],level['d_lon'],
+                                           level['n_lat'],level['n_lon'],
+                                           T,z_min,z_max)
+        return self.depth_index
+
+    def hash_inputs(self):
+        return [self.tiles.hash_inputs()]
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent pool of warm worker processes for transect runs.
+
+Each worker imports the solver backends and the heavy modules once, when
+the pool starts, and keeps the environments it builds (from location
+bundles, see bundle.py) for the life of the pool. Batches of transects are
+sent over a task queue and their results come back over a result queue,
+so a short job pays only for its model runs:
+
+    bundle = bake_RAM_location_bundle(dir + 'pat_bay.npz')
+    env = bundle.make_environment(Environment_RAM)
+    ... # hydrophone, receiver, source, freqs, dr, output as usual
+    with Worker_Pool(p_n_workers = 4) as pool:
+        env.calculate_exact_TLs(
+            POINT_OR_LINE_STR = 'LINE',
+            BASIS_SIZE_DEPTH = 100,
+            BASIS_SIZE_DISTANCE = 100,
+            RUNNER = pool.transect_runner(env,dir + 'pat_bay.npz'))
+        ... # more jobs on the same pool, environments stay built
+
+The worker rebuilds the environment from the bundle and the small spec
+taken from env (environment_spec), and checks its environment hash
+against the parent's before running, so results written by the parent
+are keyed exactly as a serial run would key them. With
+p_share_bathymetry the bathymetry of the start up bundles is held once in
+shared memory (shared.py) and attached by every worker.
+
+Only Environment_RAM environments are supported. A guard set on the
+parent environment is not carried to the workers (each would write its
+own copy of the failure registry); failures in a worker fail the job.
+"""
+
+import os
+import time
+import queue
+import importlib
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+import UWAEnvTools.backends as backends
+from UWAEnvTools.bundle import Location_Bundle
+from UWAEnvTools.environment import Environment_RAM
+from UWAEnvTools.results import TL_Accumulator, hash_items
+from UWAEnvTools.shared import Shared_Bathymetry, attach_bathymetry
+from UWAEnvTools.source import Source
+
+
+# Imported by each worker at start up, where installed.
+PRELOAD_MODULES = ('numpy',
+                   'scipy.interpolate',
+                   'pandas',
+                   'matplotlib')
+
+ENVIRONMENT_CLASSES = {'Environment_RAM' : Environment_RAM}
+
+POLL_S = 0.5         # result queue poll, between checks for dead workers
+MAX_ENVIRONMENTS = 16 # kept per worker, least recently used dropped
+
+_READY = 'ready'
+_DONE = 'done'
+_ERROR = 'error'
+
+
+class Worker_Error(Exception):
+    pass
+
+
+def environment_spec(p_env,p_bundle_fname):
+    """
+    What a worker needs, besides the bundle, to rebuild p_env: a small
+    picklable dictionary.
+    """
+    class_name = type(p_env).__name__
+    if class_name not in ENVIRONMENT_CLASSES:
+        raise Worker_Error('Worker_Pool: no worker support for ' + class_name)
+    return {'bundle' : os.path.abspath(p_bundle_fname),
+            'class' : class_name,
+            'hydrophone' : p_env.hydro_name,
+            'rx_latlon' : p_env.rx_latlon,
+            'rx_depth' : p_env.rx_depth,
+            'tx_depth' : p_env.source.depth,
+            'backend' : p_env.BACKEND,
+            'dr' : p_env.DELTA_R_RAM,
+            'output' : (p_env.RAM_OUTPUT,
+                        p_env.RAM_NDR,
+                        p_env.RAM_NDZ,
+                        p_env.RAM_ZMPLT)}
+
+
+def build_environment(p_spec,p_bundle):
+    """
+    The environment described by p_spec, configured from p_bundle.
+    """
+    env = p_bundle.make_environment(ENVIRONMENT_CLASSES[p_spec['class']])
+    env.set_hydrophone_name(p_spec['hydrophone'])
+    env.set_rx_location_common(p_spec['rx_latlon'])
+    env.set_rx_depth_common(p_spec['rx_depth'])
+    source = Source()
+    source.set_depth(p_spec['tx_depth'])
+    env.set_source_common(source)
+    env.set_backend(p_spec['backend'])
+    env.set_calc_params(p_spec['dr'])
+    env.set_output_params(*p_spec['output'])
+    return env
+
+
+class Environment_Cache():
+    """
+    What a worker keeps between tasks: loaded bundles and built
+    environments.
+    """
+
+    def __init__(self,p_shared_bathymetry = None):
+        """
+        p_shared_bathymetry : optional {bundle file name : descriptor} of
+            bathymetry published with shared.Shared_Bathymetry. Those
+            bundles are loaded on the attached grid, not a copy of their own.
+        """
+        self.bundles = dict()
+        self.environments = OrderedDict()
+        self.shared_bathymetry = dict()
+        if p_shared_bathymetry is not None:
+            self.shared_bathymetry = dict(p_shared_bathymetry)
+
+    def bundle(self,p_fname):
+        if p_fname not in self.bundles:
+            bathymetry = None
+            if p_fname in self.shared_bathymetry:
+                bathymetry = attach_bathymetry(self.shared_bathymetry[p_fname])
+            self.bundles[p_fname] = Location_Bundle(p_fname,bathymetry)
+        return self.bundles[p_fname]
+
+    def environment(self,p_spec):
+        """
+        Returns the environment and whether it was already built.
+        """
+        key = hash_items(p_spec)
+        if key in self.environments:
+            self.environments.move_to_end(key)
+            return self.environments[key], True
+        env = build_environment(p_spec,self.bundle(p_spec['bundle']))
+        self.environments[key] = env
+        if len(self.environments) > MAX_ENVIRONMENTS:
+            self.environments.popitem(last = False)
+        return env, False
+
+    def checked_environment(self,p_spec,p_env_hash,p_kwargs):
+        """
+        As environment, but raise Worker_Error if the environment hash
+        (with the run kwargs) is not p_env_hash. None skips the check.
+        """
+        env, warm = self.environment(p_spec)
+        if p_env_hash is not None and env.environment_hash(**p_kwargs) != p_env_hash:
+            raise Worker_Error(
+                'environment built from ' + p_spec['bundle'] \
+                    + ' does not match the submitting environment.')
+        return env, warm
+
+
+def _worker_main(p_tasks,p_results,p_backends,p_modules,p_bundles,p_shared):
+    pid = os.getpid()
+    start = time.perf_counter()
+    state = Environment_Cache(p_shared)
+    try:
+        for name in p_modules:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass # only a warm up
+        for name in p_backends:
+            backends.get_backend(name)
+        for fname in p_bundles:
+            state.bundle(os.path.abspath(fname))
+    except Exception:
+        p_results.put((_ERROR,None,pid,traceback.format_exc()))
+        return
+    p_results.put((_READY,None,pid,time.perf_counter() - start))
+
+    while True:
+        task = p_tasks.get()
+        if task is None:
+            break
+        task_id,spec,freq,course,env_hash,kwargs = task
+        try:
+            t0 = time.perf_counter()
+            env, warm = state.checked_environment(spec,env_hash,kwargs)
+            env.prepare_transects([course],kwargs['BASIS_SIZE_DISTANCE'])
+            t1 = time.perf_counter()
+            TL_RES = env.run_transects(freq,course,env_hash,**kwargs)
+            TL_RES.trim()
+            info = {'pid' : pid,
+                    'warm' : warm,
+                    'setup_s' : t1 - t0,
+                    'run_s' : time.perf_counter() - t1,
+                    'points' : len(course)}
+            p_results.put((_DONE,task_id,TL_RES.to_dict(),info))
+        except Exception:
+            p_results.put((_ERROR,task_id,pid,traceback.format_exc()))
+
+
+class Worker_Pool():
+
+    def __init__(self,
+                 p_n_workers = None,
+                 p_backends = ('pyram',),
+                 p_modules = PRELOAD_MODULES,
+                 p_bundles = (),
+                 p_share_bathymetry = False,
+                 p_start_method = None,
+                 p_startup_timeout_s = 300):
+        """
+        p_n_workers : default os.cpu_count().
+        p_backends : backend names (backends.py) each worker imports at
+            start up.
+        p_bundles : bundle file names each worker loads at start up.
+        p_share_bathymetry : True, the bathymetry of each of p_bundles is
+            published once in shared memory (shared.py) and every worker
+            attaches to it, rather than each loading its own copy.
+        p_start_method : multiprocessing start method, default the
+            platform's.
+        """
+        if p_n_workers is None:
+            p_n_workers = os.cpu_count()
+        self.n_workers = max(int(p_n_workers),1)
+        self.context = multiprocessing.get_context(p_start_method)
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        self.processes = []
+        self.stats = {'tasks' : 0,
+                      'points' : 0,
+                      'cold_tasks' : 0,
+                      'setup_s' : 0.,
+                      'run_s' : 0.}
+        self._next_id = 0
+        self._finished = dict()
+        self._failed = dict()
+        self._abandoned = set() # ids whose results are dropped on arrival
+        self._closed = False
+
+        start = time.perf_counter()
+        self.shared = []
+        descriptors = dict()
+        if p_share_bathymetry:
+            for fname in p_bundles:
+                fname = os.path.abspath(fname)
+                shared = Shared_Bathymetry()
+                self.shared.append(shared)
+                descriptors[fname] = shared.publish(
+                    Location_Bundle(fname).bathymetry)
+        for n in range(self.n_workers):
+            process = self.context.Process(
+                target = _worker_main,
+                args = (self.tasks,
+                        self.results,
+                        tuple(p_backends),
+                        tuple(p_modules),
+                        tuple(p_bundles),
+                        descriptors),
+                daemon = True)
+            process.start()
+            self.processes.append(process)
+        self._wait_ready(p_startup_timeout_s)
+        self.startup_s = time.perf_counter() - start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def _wait_ready(self,p_timeout_s):
+        n_ready = 0
+        deadline = time.perf_counter() + p_timeout_s
+        while n_ready < self.n_workers:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.close()
+                raise Worker_Error('Worker_Pool: workers not ready after ' \
+                                   + str(p_timeout_s) + ' s')
+            try:
+                kind,_,pid,value = self.results.get(timeout = min(POLL_S,remaining))
+            except queue.Empty:
+                self._check_alive()
+                continue
+            if kind == _ERROR:
+                self.close()
+                raise Worker_Error('Worker_Pool: worker ' + str(pid) \
+                                   + ' failed to start:\n' + value)
+            n_ready = n_ready + 1
+
+    def _check_alive(self):
+        dead = [p for p in self.processes if not p.is_alive()]
+        if len(dead) > 0:
+            codes = [p.exitcode for p in dead]
+            self.close()
+            raise Worker_Error('Worker_Pool: worker(s) exited, codes ' + str(codes))
+
+    def submit(self,p_spec,p_freq,p_course,p_env_hash = None,**kwargs):
+        """
+        Queue one batch of transects. kwargs as run_transects.
+        Returns the task id, to pass to collect.
+        """
+        if self._closed:
+            raise Worker_Error('Worker_Pool: closed')
+        task_id = self._next_id
+        self._next_id = self._next_id + 1
+        self.tasks.put((task_id,
+                        p_spec,
+                        p_freq,
+                        [tuple(tx) for tx in p_course],
+                        p_env_hash,
+                        kwargs))
+        return task_id
+
+    def collect(self,p_task_ids):
+        """
+        Wait for the passed tasks. Returns {task id : column dictionary}.
+        A failed task raises Worker_Error with the worker's traceback. The
+        other tasks of that call are then given up on: their results are
+        dropped, now or when they arrive.
+        """
+        wanted = set(p_task_ids)
+        while True:
+            failed = sorted(wanted.intersection(self._failed.keys()))
+            if len(failed) > 0:
+                message = self._failed[failed[0]]
+                self._abandon(wanted)
+                raise Worker_Error(message)
+            if wanted.issubset(self._finished.keys()):
+                break
+            try:
+                kind,task_id,value,info = self.results.get(timeout = POLL_S)
+            except queue.Empty:
+                self._check_alive()
+                continue
+            if task_id in self._abandoned:
+                self._abandoned.discard(task_id)
+                continue
+            if kind == _ERROR:
+                # kept for the collect that waits for it
+                self._failed[task_id] = 'Worker_Pool: task ' + str(task_id) \
+                    + ' failed in worker ' + str(value) + ':\n' + info
+                continue
+            self._finished[task_id] = value
+            self.stats['tasks'] = self.stats['tasks'] + 1
+            self.stats['points'] = self.stats['points'] + info['points']
+            self.stats['setup_s'] = self.stats['setup_s'] + info['setup_s']
+            self.stats['run_s'] = self.stats['run_s'] + info['run_s']
+            if not info['warm']:
+                self.stats['cold_tasks'] = self.stats['cold_tasks'] + 1
+        return dict([(t,self._finished.pop(t)) for t in p_task_ids])
+
+    def _abandon(self,p_task_ids):
+        for task_id in p_task_ids:
+            if task_id in self._finished:
+                del self._finished[task_id]
+            elif task_id in self._failed:
+                del self._failed[task_id]
+            else:
+                self._abandoned.add(task_id)
+
+    def run_transects(self,
+                      p_spec,
+                      p_freq,
+                      p_course,
+                      p_env_hash = None,
+                      p_batch_size = None,
+                      **kwargs):
+        """
+        Environment_RAM.run_transects on the pool: p_course is split in to
+        batches (default about four per worker, for balance), and the
+        results are joined in course order in one TL_Accumulator.
+        """
+        course = list(p_course)
+        if p_batch_size is None:
+            p_batch_size = int(np.ceil(len(course) / (4 * self.n_workers)))
+        p_batch_size = max(int(p_batch_size),1)
+        task_ids = []
+        for n in range(0,len(course),p_batch_size):
+            task_ids.append(self.submit(p_spec,
+                                        p_freq,
+                                        course[n:n + p_batch_size],
+                                        p_env_hash,
+                                        **kwargs))
+        finished = self.collect(task_ids)
+        n_rows = sum([len(finished[t]['TL']) for t in task_ids])
+        columns = TL_Accumulator.COLUMNS
+        if kwargs.get('DEPTHS') is not None:
+            columns = columns + ('Depth',)
+        TL_RES = TL_Accumulator(p_capacity = max(n_rows,1),p_columns = columns)
+        for task_id in task_ids:
+            TL_RES.append(finished[task_id])
+        return TL_RES
+
+    def transect_runner(self,p_env,p_bundle_fname,p_batch_size = None):
+        """
+        A RUNNER for p_env.calculate_exact_TLs (or _multi_depth), running
+        its transects on the pool. p_env must have been configured from
+        p_bundle_fname. The spec is taken from p_env at each call, so the
+        grid output multi_depth switches to reaches the workers.
+        """
+        def runner(p_freq,p_course,p_env_hash,**kwargs):
+            spec = environment_spec(p_env,p_bundle_fname)
+            return self.run_transects(spec,
+                                      p_freq,
+                                      p_course,
+                                      p_env_hash,
+                                      p_batch_size,
+                                      **kwargs)
+        return runner
+
+    def summary(self):
+        return 'Worker_Pool: ' + str(self.n_workers) + ' workers, started in '\
+            + format(self.startup_s,'.2f') + ' s. '\
+            + str(self.stats['tasks']) + ' tasks ('\
+            + str(self.stats['cold_tasks']) + ' built an environment), '\
+            + str(self.stats['points']) + ' points, setup '\
+            + format(self.stats['setup_s'],'.2f') + ' s, runs '\
+            + format(self.stats['run_s'],'.2f') + ' s (summed over workers).'
+
+    def close(self,p_timeout_s = 10):
+        """
+        Stop the workers after the tasks already queued.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for process in self.processes:
+            if process.is_alive():
+                self.tasks.put(None)
+        # Results nobody will collect are drained, a worker cannot exit
+        # while its queue buffer is unflushed.
+        deadline = time.perf_counter() + p_timeout_s
+        while any([p.is_alive() for p in self.processes]) \
+                and time.perf_counter() < deadline:
+            try:
+                self.results.get(timeout = 0.1)
+            except queue.Empty:
+                pass
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.tasks.cancel_join_thread()
+        for shared in self.shared:
+            shared.close()
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Timings of the data preparation and result handling hot paths, on
+synthetic inputs (see synthetic.py) across a range of sizes.
+
+    python benchmarks/bench_hotpaths.py [--sizes small,medium,large]
+        [--cases read_bathy,ssp] [--repeat N] [--json results.json]
+
+Each case has an untimed prepare step and a timed run step; the median
+and min over N repeats are reported. The JSON output carries the case
+parameters and package versions so runs can be compared release to
+release.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0,REPO_ROOT)
+
+import synthetic
+from UWAEnvTools.bathymetry import Bathymetry_CHS_2, Bathymetry_WOD, \
+    Bathymetry_Prepared
+from UWAEnvTools.ssp import SSP_Blouin_2015, SSP_Munk, SSP_Measured
+from UWAEnvTools.environment import Environment_RAM, create_basis_common
+
+
+SIZES = {
+    'small' : {'soundings' : 2000,
+               'grid' : 60,
+               'gebco' : 100,
+               'basis' : 100,
+               'ssp_depths' : 100,
+               'ram_runs' : 50,
+               'ram_ranges' : 100,
+               'unstruc' : 5000,
+               'n_step' : 50},
+    'medium' : {'soundings' : 20000,
+                'grid' : 150,
+                'gebco' : 400,
+                'basis' : 1000,
+                'ssp_depths' : 1000,
+                'ram_runs' : 500,
+                'ram_ranges' : 500,
+                'unstruc' : 50000,
+                'n_step' : 100},
+    'large' : {'soundings' : 100000,
+               'grid' : 300,
+               'gebco' : 1200,
+               'basis' : 10000,
+               'ssp_depths' : 10000,
+               'ram_runs' : 2000,
+               'ram_ranges' : 1000,
+               'unstruc' : 200000,
+               'n_step' : 200},
+    }
+
+N_TRANSECTS = 20 # per create_basis_common run
+
+
+# Each case: f(size parameters, temporary directory) ->
+#   (parameters reported, prepare(), run(state))
+
+def case_chs2_read_bathy(p,p_dir):
+    fname = synthetic.write_chs_soundings(
+        os.path.join(p_dir,'chs2_' + str(p['soundings']) + '.txt'),
+        p['soundings'])
+    def prepare():
+        return Bathymetry_CHS_2()
+    def run(bathy):
+        bathy.read_bathy(fname)
+    return {'soundings' : p['soundings']}, prepare, run
+
+
+def case_chs2_interpolate_bathy(p,p_dir):
+    fname = synthetic.write_chs_soundings(
+        os.path.join(p_dir,'chs2_' + str(p['soundings']) + '.txt'),
+        p['soundings'])
+    def prepare():
+        bathy = Bathymetry_CHS_2()
+        bathy.read_bathy(fname)
+        bathy.sub_select_by_latlon(synthetic.LAT_EXTENT,synthetic.LON_EXTENT)
+        bathy.N_lat_steps = p['grid']
+        bathy.N_lon_steps = p['grid']
+        return bathy
+    def run(bathy):
+        bathy.interpolate_bathy()
+    return {'soundings' : p['soundings'],'grid' : p['grid']}, prepare, run
+
+
+def case_wod_read_bathy(p,p_dir):
+    fname = synthetic.write_gebco_netcdf(
+        os.path.join(p_dir,'gebco_' + str(p['gebco']) + '.nc'),
+        p['gebco'],p['gebco'])
+    def prepare():
+        return Bathymetry_WOD()
+    def run(bathy):
+        bathy.read_bathy(fname)
+    return {'grid' : p['gebco']}, prepare, run
+
+
+def case_wod_interpolate_bathy(p,p_dir):
+    # read_bathy leaves its Dataset open, so not the read_bathy case's file
+    fname = synthetic.write_gebco_netcdf(
+        os.path.join(p_dir,'gebco_interp_' + str(p['gebco']) + '.nc'),
+        p['gebco'],p['gebco'])
+    def prepare():
+        bathy = Bathymetry_WOD()
+        bathy.read_bathy(fname)
+        bathy.sub_select_by_latlon(synthetic.LAT_EXTENT,synthetic.LON_EXTENT)
+        return bathy
+    def run(bathy):
+        bathy.interpolate_bathy()
+    return {'grid' : p['gebco']}, prepare, run
+
+
+def case_create_basis_common(p,p_dir):
+    lat = np.linspace(*synthetic.LAT_EXTENT,num = 200)
+    lon = np.linspace(*synthetic.LON_EXTENT,num = 200)
+    LO,LA = np.meshgrid(lon,lat,indexing='ij')
+    bathy = Bathymetry_Prepared()
+    bathy.set_prepared(lat,lon,-synthetic.basin_depth(LA,LO))
+    rng = np.random.default_rng(0)
+    rx = (synthetic.LAT_EXTENT[0] + 0.02,synthetic.LON_EXTENT[0] + 0.02)
+    txs = list(zip(rng.uniform(*synthetic.LAT_EXTENT,N_TRANSECTS),
+                   rng.uniform(*synthetic.LON_EXTENT,N_TRANSECTS)))
+    def prepare():
+        return bathy
+    def run(bathy):
+        for tx in txs:
+            create_basis_common(bathy,rx,tx,100,p['basis'])
+    return {'BASIS_SIZE_distance' : p['basis'],
+            'transects' : N_TRANSECTS}, prepare, run
+
+
+def case_ssp_blouin_read_profile(p,p_dir):
+    fname = synthetic.write_blouin_coefficients(
+        os.path.join(p_dir,'blouin.txt'))
+    def prepare():
+        ssp = SSP_Blouin_2015()
+        ssp.set_depths(np.linspace(0,100,p['ssp_depths']))
+        return ssp
+    def run(ssp):
+        ssp.read_profile(fname)
+    return {'depths' : p['ssp_depths']}, prepare, run
+
+
+def case_ssp_munk_read_profile(p,p_dir):
+    def prepare():
+        ssp = SSP_Munk()
+        ssp.set_depths(np.linspace(0,5000,p['ssp_depths']))
+        return ssp
+    def run(ssp):
+        ssp.read_profile()
+    return {'depths' : p['ssp_depths']}, prepare, run
+
+
+def case_ssp_measured_read_profile(p,p_dir):
+    fname = synthetic.write_measured_ssp(
+        os.path.join(p_dir,'measured_' + str(p['ssp_depths']) + '.csv'),
+        p['ssp_depths'])
+    def prepare():
+        return SSP_Measured()
+    def run(ssp):
+        ssp.read_profile(fname)
+    return {'depths' : p['ssp_depths']}, prepare, run
+
+
+def case_RAM_dictionaries_to_unstruc(p,p_dir):
+    results = synthetic.synthetic_RAM_results(p['ram_runs'],p['ram_ranges'])
+    def prepare():
+        return Environment_RAM.__new__(Environment_RAM)
+    def run(env):
+        env.RAM_dictionaries_to_unstruc(results)
+    return {'runs' : p['ram_runs'],'ranges' : p['ram_ranges']}, prepare, run
+
+
+def case_interpolate_RAM_data(p,p_dir):
+    rng = np.random.default_rng(0)
+    r = rng.uniform(1,1000,p['unstruc'])
+    phi = rng.uniform(0,2 * np.pi,p['unstruc'])
+    x,y = r * np.cos(phi),r * np.sin(phi)
+    TL = 20 * np.log10(r)
+    def prepare():
+        return None
+    def run(state):
+        Environment_RAM.interpolate_RAM_data(x,y,TL,700,700,p['n_step'])
+    return {'points' : p['unstruc'],'n_step' : p['n_step']}, prepare, run
+
+
+CASES = {
+    'chs2.read_bathy' : case_chs2_read_bathy,
+    'chs2.interpolate_bathy' : case_chs2_interpolate_bathy,
+    'wod.read_bathy' : case_wod_read_bathy,
+    'wod.interpolate_bathy' : case_wod_interpolate_bathy,
+    'create_basis_common' : case_create_basis_common,
+    'ssp.blouin.read_profile' : case_ssp_blouin_read_profile,
+    'ssp.munk.read_profile' : case_ssp_munk_read_profile,
+    'ssp.measured.read_profile' : case_ssp_measured_read_profile,
+    'RAM_dictionaries_to_unstruc' : case_RAM_dictionaries_to_unstruc,
+    'interpolate_RAM_data' : case_interpolate_RAM_data,
+    }
+
+
+def time_case(p_name,p_size,p_repeat,p_dir):
+    params,prepare,run = CASES[p_name](SIZES[p_size],p_dir)
+    times = []
+    for n in range(p_repeat):
+        state = prepare()
+        t0 = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - t0)
+    return {'case' : p_name,
+            'size' : p_size,
+            'params' : params,
+            'median_ms' : 1000 * float(np.median(times)),
+            'min_ms' : 1000 * float(np.min(times)),
+            'repeat' : p_repeat}
+
+
+def versions():
+    result = {'python' : platform.python_version(),
+              'platform' : platform.platform()}
+    for name in ['numpy','scipy','pandas','netCDF4','geopy']:
+        try:
+            result[name] = __import__(name).__version__
+        except (ImportError,AttributeError):
+            result[name] = None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes',default='small,medium')
+    parser.add_argument('--cases',default='',
+                        help='comma separated substrings of case names')
+    parser.add_argument('--repeat',type=int,default=3)
+    parser.add_argument('--json',default=None)
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(',')
+    filters = [c for c in args.cases.split(',') if c != '']
+    names = [n for n in CASES.keys()
+             if len(filters) == 0 or any(f in n for f in filters)]
+
+    results = []
+    tmp = tempfile.mkdtemp(prefix = 'uwaenv_bench_')
+    try:
+        for name in names:
+            for size in sizes:
+                try:
+                    r = time_case(name,size,args.repeat,tmp)
+                except Exception as e: # report and carry on
+                    r = {'case' : name,'size' : size,
+                         'error' : type(e).__name__ + ': ' + str(e)}
+                results.append(r)
+                if 'error' in r:
+                    print(name.ljust(30) + size.ljust(8) + 'FAILED: ' + r['error'])
+                    continue
+                print(name.ljust(30) + size.ljust(8)
+                      + str(round(r['median_ms'],2)).rjust(12) + ' ms   '
+                      + str(r['params']))
+    finally:
+        shutil.rmtree(tmp,ignore_errors = True)
+
+    if args.json is not None:
+        with open(args.json,'w') as f:
+            json.dump({'benchmark' : 'hotpaths',
+                       'created' : time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'versions' : versions(),
+                       'results' : results},f,indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end throughput of calculate_exact_TLs with the stand-in solvers
+(fake_backends.py), so what is measured is the orchestration around the
+model: basis building, environment construction, result handling and
+the result file write.
+
+    python benchmarks/bench_pipeline.py [--points 1000,10000,100000]
+        [--model RAM|ARL] [--mode LINE|POINT] [--cost-per-run S]
+        [--cost-mode sleep|spin] [--repeat N] [--json results.json]
+
+The environment is a synthetic basin (see synthetic.py) on a prepared
+bathymetry grid, with the source points on a square grid over it.
+Overhead per point is the wall time less the time the fake solver spent.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0,REPO_ROOT)
+
+import synthetic
+import UWAEnvTools.fake_backends as fake_backends
+from UWAEnvTools.bathymetry import Bathymetry_Prepared
+from UWAEnvTools.ssp import SSP_Blouin_2015
+from UWAEnvTools.source import Source
+from UWAEnvTools.environment import Environment_RAM, Environment_ARL
+
+
+N_GRID = 200           # bathymetry grid points per side
+BASIS_SIZE_DEPTH = 100
+BASIS_SIZE_DISTANCE = 100
+RAM_DELTA_R = 10.
+FREQ = 100
+
+
+def make_environment(p_class,p_dir,p_n_points):
+    lat = np.linspace(*synthetic.LAT_EXTENT,num = N_GRID)
+    lon = np.linspace(*synthetic.LON_EXTENT,num = N_GRID)
+    LO,LA = np.meshgrid(lon,lat,indexing='ij')
+    bathy = Bathymetry_Prepared()
+    bathy.set_prepared(lat,lon,-synthetic.basin_depth(LA,LO))
+
+    location = synthetic.synthetic_location(
+        '',synthetic.write_blouin_coefficients(os.path.join(p_dir,'blouin.txt')))
+
+    # source points on a square grid inset from the edges, the receiver
+    # in the corner margin so no transect is shorter than one range step.
+    n_side = int(np.ceil(np.sqrt(p_n_points)))
+    d_lat = 0.1 * (synthetic.LAT_EXTENT[1] - synthetic.LAT_EXTENT[0])
+    d_lon = 0.1 * (synthetic.LON_EXTENT[1] - synthetic.LON_EXTENT[0])
+    source = Source()
+    source.set_depth(2.)
+    source.generate_course_from_grid(
+        (synthetic.LAT_EXTENT[0] + d_lat,synthetic.LAT_EXTENT[1] - d_lat),
+        (synthetic.LON_EXTENT[0] + d_lon,synthetic.LON_EXTENT[1] - d_lon),
+        n_side,
+        n_side)
+    source.course = source.course[:p_n_points]
+
+    env = p_class(location,N_GRID,N_GRID)
+    env.set_hydrophone_name('Bench')
+    env.set_model_save_directory(p_dir + os.sep)
+    env.set_bathymetry_common(bathy)
+    env.bottom_profile = synthetic.synthetic_seabed(bathy)
+    env.set_seabed()
+    env.set_ssp_common(SSP_Blouin_2015())
+    env.set_freqs_common([FREQ])
+    env.set_rx_location_common((synthetic.LAT_EXTENT[0] + 0.5 * d_lat,
+                                synthetic.LON_EXTENT[0] + 0.5 * d_lon))
+    env.set_rx_depth_common(20.)
+    env.set_source_common(source)
+    if p_class is Environment_RAM:
+        env.set_calc_params(RAM_DELTA_R)
+        env.set_output_params(Environment_RAM.OUTPUT_LINE)
+        env.set_backend('fake_pyram')
+    else:
+        env.set_backend('fake_arlpy')
+    return env
+
+
+def run_case(p_model,p_mode,p_n_points,p_repeat,p_dir):
+    env_class = Environment_RAM if p_model == 'RAM' else Environment_ARL
+    env = make_environment(env_class,p_dir,p_n_points)
+    kwargs = {'BASIS_SIZE_DEPTH' : BASIS_SIZE_DEPTH,
+              'BASIS_SIZE_DISTANCE' : BASIS_SIZE_DISTANCE}
+    if p_model == 'RAM':
+        kwargs['POINT_OR_LINE_STR'] = p_mode
+    else:
+        kwargs['N_BEAMS'] = 0
+
+    walls = []
+    solver = []
+    for n in range(p_repeat):
+        fake_backends.reset_fake_stats()
+        t0 = time.perf_counter()
+        env.calculate_exact_TLs(**kwargs)
+        walls.append(time.perf_counter() - t0)
+        solver.append(fake_backends.FAKE_STATS['seconds'])
+    best = int(np.argmin(walls))
+    n_runs = len(env.source.course) * len(env.freqs)
+    return {'model' : p_model,
+            'mode' : p_mode,
+            'points' : n_runs,
+            'wall_s' : walls[best],
+            'solver_s' : solver[best],
+            'points_per_s' : n_runs / walls[best],
+            'overhead_ms_per_point' : 1000 * (walls[best] - solver[best]) / n_runs,
+            'repeat' : p_repeat}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points',default='1000,10000')
+    parser.add_argument('--model',default='RAM',choices=['RAM','ARL'])
+    parser.add_argument('--mode',default='LINE',choices=['LINE','POINT'])
+    parser.add_argument('--cost-per-run',type=float,default=0.)
+    parser.add_argument('--cost-per-cell',type=float,default=0.)
+    parser.add_argument('--cost-mode',default=fake_backends.COST_SLEEP,
+                        choices=[fake_backends.COST_SLEEP,fake_backends.COST_SPIN])
+    parser.add_argument('--repeat',type=int,default=1)
+    parser.add_argument('--json',default=None)
+    args = parser.parse_args()
+
+    fake_backends.set_fake_cost(args.cost_per_run,
+                                args.cost_per_cell,
+                                args.cost_mode)
+
+    results = []
+    tmp = tempfile.mkdtemp(prefix = 'uwaenv_pipeline_')
+    try:
+        print('model'.ljust(6) + 'mode'.ljust(7) + 'points'.rjust(9)
+              + 'wall s'.rjust(10) + 'solver s'.rjust(10)
+              + 'points/s'.rjust(11) + 'overhead ms/pt'.rjust(16))
+        for n_points in [int(float(p)) for p in args.points.split(',')]:
+            r = run_case(args.model,args.mode,n_points,args.repeat,tmp)
+            results.append(r)
+            print(r['model'].ljust(6) + r['mode'].ljust(7)
+                  + str(r['points']).rjust(9)
+                  + format(r['wall_s'],'.2f').rjust(10)
+                  + format(r['solver_s'],'.2f').rjust(10)
+                  + format(r['points_per_s'],'.0f').rjust(11)
+                  + format(r['overhead_ms_per_point'],'.3f').rjust(16))
+    finally:
+        shutil.rmtree(tmp,ignore_errors = True)
+
+    if args.json is not None:
+        with open(args.json,'w') as f:
+            json.dump({'benchmark' : 'pipeline',
+                       'created' : time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'python' : platform.python_version(),
+                       'numpy' : np.__version__,
+                       'cost' : dict(fake_backends.FAKE_COST),
+                       'results' : results},f,indent=1)
+
+
+if __name__ == '__main__':
+    main()
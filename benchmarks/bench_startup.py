@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Import time of the UWAEnvTools modules, each in a fresh interpreter.
+
+    python benchmarks/bench_startup.py [--repeat N] [--json results.json]
+
+Reports the median wall time (ms) of `import <module>` over N fresh
+processes, and which heavy packages each import pulled in. The target is
+UWAEnvTools.bathymetry well under 200 ms.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+import numpy as np
+
+MODULES = [
+    'UWAEnvTools.locations',
+    'UWAEnvTools.bathymetry',
+    'UWAEnvTools.ssp',
+    'UWAEnvTools.seabed',
+    'UWAEnvTools.source',
+    'UWAEnvTools.environment',
+    ]
+
+HEAVY = ['numpy','scipy','pandas','matplotlib','netCDF4','geopy',
+         'haversine','arlpy','pyat','pyram','numba']
+
+TARGETS_MS = {'UWAEnvTools.bathymetry' : 200.}
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_SNIPPET = """
+import sys, time, json
+t0 = time.perf_counter()
+import {module}
+t1 = time.perf_counter()
+heavy = [m for m in {heavy} if m in sys.modules]
+print(json.dumps({{'ms' : 1000 * (t1 - t0), 'loaded' : heavy}}))
+"""
+
+
+def time_import(p_module,p_repeat = 5):
+    times = []
+    loaded = []
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_ROOT + os.pathsep + env.get('PYTHONPATH','')
+    code = _SNIPPET.format(module = p_module, heavy = repr(HEAVY))
+    for n in range(p_repeat):
+        out = subprocess.run(
+            [sys.executable,'-c',code],
+            capture_output = True,
+            text = True,
+            env = env)
+        if out.returncode != 0:
+            return {'module' : p_module,
+                    'error' : out.stderr.strip().splitlines()[-1]}
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        times.append(result['ms'])
+        loaded = result['loaded']
+    return {'module' : p_module,
+            'median_ms' : float(np.median(times)),
+            'min_ms' : float(np.min(times)),
+            'loaded' : loaded,
+            'target_ms' : TARGETS_MS.get(p_module)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat',type=int,default=5)
+    parser.add_argument('--json',default=None)
+    args = parser.parse_args()
+    
+    results = [time_import(m,args.repeat) for m in MODULES]
+    for r in results:
+        if 'error' in r:
+            print(r['module'].ljust(28) + 'FAILED: ' + r['error'])
+            continue
+        line = r['module'].ljust(28) + str(round(r['median_ms'],1)).rjust(8) \
+            + ' ms   loads: ' + ', '.join(r['loaded'])
+        if r['target_ms'] is not None:
+            status = 'OK' if r['median_ms'] < r['target_ms'] else 'OVER'
+            line = line + '   [target ' + str(r['target_ms']) + ' ms: ' \
+                + status + ']'
+        print(line)
+    if args.json is not None:
+        with open(args.json,'w') as f:
+            json.dump({'benchmark' : 'startup', 'results' : results},f,indent=1)
+
+
+if __name__ == '__main__':
+    main()
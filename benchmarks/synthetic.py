@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic inputs in the formats the readers expect, so the hot paths can
+be timed without the real data files.
+
+    CHS NONNA / 2 m soundings  : write_chs_soundings
+    GEBCO-like NetCDF grid     : write_gebco_netcdf
+    Blouin SSP coefficients    : write_blouin_coefficients
+    Measured SSP csv           : write_measured_ssp
+    Seabed                     : synthetic_seabed
+    RAM result dictionaries    : synthetic_RAM_results
+
+Depths are a smooth basin so the gridding and spline fits do real work.
+Everything is seeded and repeatable.
+"""
+
+import numpy as np
+
+from UWAEnvTools.locations import Location
+from UWAEnvTools.seabed import SeaBed
+
+
+LAT_EXTENT = (48.60, 48.70)
+LON_EXTENT = (-123.55, -123.40)
+
+MONTHS = ['January','February','March','April','May','June','July',
+          'August','September','October','November','December']
+
+
+def basin_depth(p_lats,p_lons,p_lat_extent = LAT_EXTENT,p_lon_extent = LON_EXTENT):
+    """
+    Positive down, 5 m at the edges to about 105 m in the middle, with
+    some ripple.
+    """
+    u = (np.asarray(p_lats) - p_lat_extent[0]) / (p_lat_extent[1] - p_lat_extent[0])
+    v = (np.asarray(p_lons) - p_lon_extent[0]) / (p_lon_extent[1] - p_lon_extent[0])
+    bowl = np.sin(np.pi * np.clip(u,0,1)) * np.sin(np.pi * np.clip(v,0,1))
+    ripple = np.sin(20 * np.pi * u) * np.cos(14 * np.pi * v)
+    return 5 + 100 * bowl + 3 * ripple
+
+
+def dec_deg_to_CHS_DMS(p_deg,p_hemisphere):
+    """
+    e.g. 48.65 'N' -> '48-39-0.00 N', the form CHS_DMS_to_DecDeg reads.
+    The sign is dropped, the readers apply the hemisphere.
+    """
+    deg = np.abs(np.asarray(p_deg,dtype=float))
+    d = np.floor(deg).astype(int)
+    m = np.floor((deg - d) * 60).astype(int)
+    s = (deg - d - m / 60) * 3600
+    return [str(a) + '-' + str(b) + '-' + format(c,'.2f') + ' ' + p_hemisphere
+            for a,b,c in zip(d,m,s)]
+
+
+def write_chs_soundings(p_fname,
+                        p_n_points,
+                        p_format = 'CHS_2',
+                        p_lat_extent = LAT_EXTENT,
+                        p_lon_extent = LON_EXTENT,
+                        p_seed = 0):
+    """
+    Scattered soundings over the extent. A small margin of points outside
+    it is included so sub_select_by_latlon has something to drop.
+
+    'CHS_2'      : comma separated, lon, lat, depth (Bathymetry_CHS_2)
+    'CHS_10_100' : tab separated, lat, lon, depth (Bathymetry_CHS_10_100)
+    """
+    import pandas as pd
+    rng = np.random.default_rng(p_seed)
+    margin_lat = 0.05 * (p_lat_extent[1] - p_lat_extent[0])
+    margin_lon = 0.05 * (p_lon_extent[1] - p_lon_extent[0])
+    lats = rng.uniform(p_lat_extent[0] - margin_lat,p_lat_extent[1] + margin_lat,p_n_points)
+    lons = rng.uniform(p_lon_extent[0] - margin_lon,p_lon_extent[1] + margin_lon,p_n_points)
+    depths = np.round(basin_depth(lats,lons,p_lat_extent,p_lon_extent),2)
+    lat_str = dec_deg_to_CHS_DMS(lats,'N')
+    lon_str = dec_deg_to_CHS_DMS(lons,'W')
+    if p_format == 'CHS_2':
+        df = pd.DataFrame({'Longitude' : lon_str,
+                           'Latitude' : lat_str,
+                           'Depth (m)' : depths})
+        df.to_csv(p_fname,sep=',',index=False)
+    elif p_format == 'CHS_10_100':
+        df = pd.DataFrame({'Latitude' : lat_str,
+                           'Longitude' : lon_str,
+                           'Depth (m)' : depths})
+        df.to_csv(p_fname,sep='\t',index=False)
+    else:
+        raise ValueError('write_chs_soundings: unknown format ' + str(p_format))
+    return p_fname
+
+
+def write_gebco_netcdf(p_fname,
+                       p_n_lat,
+                       p_n_lon,
+                       p_lat_extent = LAT_EXTENT,
+                       p_lon_extent = LON_EXTENT):
+    """
+    lat, lon and elevation ([lat,lon], negative below sea level) as in the
+    GEBCO 2021 files, with a one cell margin around the extent.
+    """
+    import netCDF4
+    d_lat = (p_lat_extent[1] - p_lat_extent[0]) / (p_n_lat - 1)
+    d_lon = (p_lon_extent[1] - p_lon_extent[0]) / (p_n_lon - 1)
+    lats = np.linspace(p_lat_extent[0] - d_lat,p_lat_extent[1] + d_lat,p_n_lat + 2)
+    lons = np.linspace(p_lon_extent[0] - d_lon,p_lon_extent[1] + d_lon,p_n_lon + 2)
+    LA,LO = np.meshgrid(lats,lons,indexing='ij')
+    with netCDF4.Dataset(p_fname,'w') as ds:
+        ds.createDimension('lat',len(lats))
+        ds.createDimension('lon',len(lons))
+        ds.createVariable('lat','f8',('lat',))[:] = lats
+        ds.createVariable('lon','f8',('lon',))[:] = lons
+        ds.createVariable('elevation','i2',('lat','lon'))[:] = \
+            -np.round(basin_depth(LA,LO,p_lat_extent,p_lon_extent))
+    return p_fname
+
+
+def write_blouin_coefficients(p_fname,p_seed = 0):
+    """
+    One line per month, Month [c0, c1, c2, c3], as read_coefficients reads.
+    """
+    rng = np.random.default_rng(p_seed)
+    with open(p_fname,'w') as f:
+        f.write('Third order coefficients, c(z) = c0 + c1 z + c2 z^2 + c3 z^3\n')
+        for n,month in enumerate(MONTHS):
+            season = np.cos(2 * np.pi * (n - 7) / 12) # warmest in August
+            coeffs = [1470 + 15 * season + rng.normal(0,0.5),
+                      -0.2 * season + rng.normal(0,0.01),
+                      0.002 * season,
+                      -0.000005]
+            f.write(month + ' ' + str([float(c) for c in coeffs]) + '\n')
+    return p_fname
+
+
+def write_measured_ssp(p_fname,p_n_depths,p_max_depth = 100.):
+    """
+    A mean SSP csv as SSP_Measured.generate_mean_from_ssps writes it.
+    """
+    import pandas as pd
+    depths = np.linspace(0,p_max_depth,p_n_depths)
+    df = pd.DataFrame({'Depth (m)' : depths,
+                       'Sound speed(m/s)' : 1480 - 0.05 * depths})
+    df.to_csv(p_fname,index=False)
+    return p_fname
+
+
+def synthetic_location(p_fname_bathy,
+                       p_ssp_file = '',
+                       p_lat_extent = LAT_EXTENT,
+                       p_lon_extent = LON_EXTENT):
+    """
+    A Location with the members the bathymetry and environments read,
+    without going through one of the hard coded location strings.
+    """
+    location = Location.__new__(Location)
+    location.location_title = 'Synthetic'
+    location.LAT = 0.5 * (p_lat_extent[0] + p_lat_extent[1])
+    location.LON = 0.5 * (p_lon_extent[0] + p_lon_extent[1])
+    location.LAT_EXTENT_TUPLE = tuple(p_lat_extent)
+    location.LON_EXTENT_TUPLE = tuple(p_lon_extent)
+    location.fname_bathy = p_fname_bathy
+    location.ssp_file = p_ssp_file
+    location.bottom_id = 'Sand-silt'
+    location.COURSE_DISTANCE = 300
+    return location
+
+
+def synthetic_seabed(p_bathymetry,p_bottom_id = 'Sand-silt'):
+    """
+    A uniform SeaBed without the sediment table file, for use in place of
+    set_seabed_common (assign it to env.bottom_profile, then set_seabed).
+    """
+    bottom_profile = SeaBed(p_bathymetry.lat_basis_trimmed,
+                            p_bathymetry.lon_basis_trimmed,
+                            p_bathymetry.z_interped)
+    bottom_profile.sediment_dictionary = {
+        p_bottom_id : {'M_z' : 5.0,'Rho' : 1.6,'c' : 1620.,'alpha' : 0.9}}
+    bottom_profile.assign_single_bottom_type(p_bottom_id)
+    return bottom_profile
+
+
+def synthetic_RAM_results(p_n_runs,p_n_ranges,p_seed = 0):
+    """
+    Result dictionaries shaped as calculate_exact_TLs builds them in LINE
+    mode (PyRAM output plus X, Y, TX Lat, TX Lon).
+    """
+    rng = np.random.default_rng(p_seed)
+    results = []
+    for n in range(p_n_runs):
+        r = np.linspace(1,1000,p_n_ranges)
+        phi = rng.uniform(0,2 * np.pi)
+        results.append({'Ranges' : r,
+                        'TL Line' : 20 * np.log10(r) + rng.normal(0,1,p_n_ranges),
+                        'X' : r * np.cos(phi),
+                        'Y' : r * np.sin(phi),
+                        'TX Lat' : LAT_EXTENT[0] + rng.uniform() * 0.1,
+                        'TX Lon' : LON_EXTENT[0] + rng.uniform() * 0.15})
+    return results
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (REPO_ROOT,os.path.join(REPO_ROOT,'benchmarks')):
+    if path not in sys.path:
+        sys.path.insert(0,path)
+
+import bench_pipeline
+import UWAEnvTools.fake_backends as fake_backends
+from UWAEnvTools.environment import Environment_RAM
+
+
+RUN_KWARGS = {'POINT_OR_LINE_STR' : 'POINT',
+              'BASIS_SIZE_DEPTH' : bench_pipeline.BASIS_SIZE_DEPTH,
+              'BASIS_SIZE_DISTANCE' : bench_pipeline.BASIS_SIZE_DISTANCE}
+
+
+@pytest.fixture
+def ram_env(tmp_path):
+    """
+    Synthetic basin environment on the fake PyRAM backend, 4 sources.
+    """
+    fake_backends.set_fake_cost(0.)
+    fake_backends.reset_fake_stats()
+    env = bench_pipeline.make_environment(Environment_RAM,str(tmp_path),4)
+    yield env
+    env.set_guard(None)
+
+
+def bundle_environment(p_env,p_bundle_fname,p_dir = None):
+    """
+    An environment built from a bundle of p_env (bundle.py), configured
+    as p_env, writing to p_dir (default p_env's directory).
+    """
+    from UWAEnvTools.bundle import Location_Bundle
+    env = Location_Bundle(p_bundle_fname).make_environment(type(p_env))
+    env.set_hydrophone_name(p_env.hydro_name)
+    if p_dir is None:
+        p_dir = p_env.model_target_dir
+    env.set_model_save_directory(p_dir)
+    env.set_freqs_common(p_env.freqs)
+    env.set_rx_location_common(p_env.rx_latlon)
+    env.set_rx_depth_common(p_env.rx_depth)
+    env.set_source_common(p_env.source)
+    env.set_calc_params(p_env.DELTA_R_RAM)
+    env.set_output_params(p_env.RAM_OUTPUT,p_env.RAM_NDR,p_env.RAM_NDZ,
+                          p_env.RAM_ZMPLT)
+    env.set_backend(p_env.BACKEND)
+    return env
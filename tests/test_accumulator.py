@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+from UWAEnvTools.environment import Environment_RAM
+from UWAEnvTools.results import TL_Accumulator
+
+
+def ram_result(p_n,p_tx):
+    r = np.arange(1.,p_n + 1)
+    return {'X' : r,
+            'Y' : 2 * r,
+            'TL Line' : 40. + r,
+            'TX Lat' : p_tx[0],
+            'TX Lon' : p_tx[1]}
+
+
+def test_append_grows_and_broadcasts_scalars():
+    accumulator = TL_Accumulator(p_capacity = 2)
+    accumulator.append_RAM_result(ram_result(3,(48.1,-123.1)))
+    accumulator.append_RAM_result(ram_result(2,(48.2,-123.2)))
+    assert len(accumulator) == 5
+    assert accumulator.capacity >= 5
+    np.testing.assert_array_equal(accumulator.column('X'),[1.,2.,3.,1.,2.])
+    np.testing.assert_array_equal(accumulator.column('Lats TX'),
+                                  [48.1] * 3 + [48.2] * 2)
+    accumulator.trim()
+    assert accumulator.capacity == 5
+    np.testing.assert_array_equal(accumulator.column('TL'),[41.,42.,43.,41.,42.])
+
+
+def test_extra_columns_and_frames():
+    accumulator = TL_Accumulator(p_columns = TL_Accumulator.COLUMNS + ('Depth',))
+    accumulator.append_RAM_result(ram_result(2,(48.1,-123.1)),Depth = 5.)
+    accumulator.append_RAM_result(ram_result(2,(48.1,-123.1)),Depth = np.array([6.,7.]))
+    df = pd.DataFrame(accumulator.to_dict())
+    np.testing.assert_array_equal(df['Depth'],[5.,5.,6.,7.])
+    again = TL_Accumulator.from_frame(df,accumulator.columns)
+    for col in accumulator.columns:
+        np.testing.assert_array_equal(again.column(col),accumulator.column(col))
+
+
+def test_columns_are_views():
+    accumulator = TL_Accumulator(p_capacity = 4)
+    accumulator.append_RAM_result(ram_result(2,(48.1,-123.1)))
+    column = accumulator.column('TL')
+    column[0] = -1.
+    assert accumulator.column('TL')[0] == -1.
+
+
+def test_dictionaries_to_unstruc_is_unchanged():
+    results = [ram_result(3,(48.1,-123.1)),ram_result(2,(48.2,-123.2))]
+    env = Environment_RAM.__new__(Environment_RAM)
+    env.RAM_dictionaries_to_unstruc(results)
+    np.testing.assert_array_equal(env.X_unstruc,
+                                  np.concatenate([r['X'] for r in results]))
+    np.testing.assert_array_equal(env.TL_unstruc,
+                                  np.concatenate([r['TL Line'] for r in results]))
+    np.testing.assert_array_equal(env.lats_TX_unstruc,[48.1] * 3 + [48.2] * 2)
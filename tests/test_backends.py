@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import REPO_ROOT
+import UWAEnvTools.backends as backends
+
+
+def test_environment_import_loads_no_model_package():
+    code = 'import sys; import UWAEnvTools.environment; ' \
+        'print([m for m in ("pyram","arlpy","pyat","pandas") if m in sys.modules])'
+    out = subprocess.run([sys.executable,'-c',code],
+                         cwd = REPO_ROOT,
+                         capture_output = True,
+                         text = True,
+                         check = True)
+    assert out.stdout.strip() == '[]'
+
+
+def test_backends_load_once():
+    loads = []
+    def loader():
+        loads.append(1)
+        return object()
+    backends.register_backend('test_once',loader)
+    assert not backends.is_loaded('test_once')
+    backend = backends.get_backend('test_once')
+    assert backends.get_backend('test_once') is backend
+    assert len(loads) == 1
+    assert 'test_once' in backends.available_backends()
+
+
+def test_backend_errors():
+    with pytest.raises(backends.Backend_Error):
+        backends.get_backend('no_such_backend')
+    def loader():
+        raise ImportError('not installed')
+    backends.register_backend('test_missing',loader)
+    with pytest.raises(backends.Backend_Error):
+        backends.get_backend('test_missing')
+
+
+def test_lazy_module():
+    module = backends.Lazy_Module('json')
+    assert module.dumps([1]) == '[1]'
+
+
+def test_pyat_directory_from_environment(tmp_path):
+    package = tmp_path / 'pyat' / 'pyat'
+    package.mkdir(parents = True)
+    (tmp_path / 'pyat' / '__init__.py').write_text('')
+    (package / '__init__.py').write_text('')
+    (package / 'env.py').write_text('NAME = "checkout"\n')
+    code = 'import UWAEnvTools.backends as b; print(b.get_backend("pyat").NAME)'
+    out = subprocess.run([sys.executable,'-c',code],
+                         cwd = REPO_ROOT,
+                         env = dict(os.environ,UWAENVTOOLS_PYAT_DIR = str(tmp_path)),
+                         capture_output = True,
+                         text = True)
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.strip() == 'checkout'
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from scipy import interpolate
+
+from conftest import RUN_KWARGS
+from UWAEnvTools.bathymetry import spline_from_arrays, Bathymetry_Prepared
+from UWAEnvTools.bundle import bake_environment_bundle, Location_Bundle
+from UWAEnvTools.environment import Environment_RAM
+
+
+def fitted():
+    x = np.linspace(0.,1.,30)
+    y = np.linspace(0.,2.,40)
+    X,Y = np.meshgrid(x,y,indexing='ij')
+    return interpolate.RectBivariateSpline(x,y,np.sin(3 * X) * np.cos(2 * Y))
+
+
+def test_stored_spline_matches_fitted():
+    spline = fitted()
+    tx,ty = spline.get_knots()
+    kx,ky = spline.degrees
+    stored = spline_from_arrays({'tx' : tx,'ty' : ty,'c' : spline.get_coeffs(),
+                                 'kx' : kx,'ky' : ky})
+    x = np.linspace(-0.1,1.1,17) # includes points outside the domain
+    y = np.linspace(-0.2,2.2,13)
+    np.testing.assert_allclose(stored(x,y),spline(x,y),atol=1e-12)
+    xp,yp = np.random.default_rng(0).uniform(-0.1,2.1,(2,50))
+    np.testing.assert_allclose(stored(xp,yp,grid=False),
+                               spline(xp,yp,grid=False),atol=1e-12)
+    np.testing.assert_allclose(stored.ev(xp,yp),spline.ev(xp,yp),atol=1e-12)
+
+
+def test_prepared_round_trip(tmp_path):
+    lat = np.linspace(48.,48.5,20)
+    lon = np.linspace(-124.,-123.5,25)
+    LO,LA = np.meshgrid(lon,lat,indexing='ij')
+    bathy = Bathymetry_Prepared()
+    bathy.set_prepared(lat,lon,-(50. + 100 * (LA - 48.)))
+    fname = str(tmp_path / 'bathy.npz')
+    bathy.save_prepared(fname)
+    loaded = Bathymetry_Prepared()
+    loaded.load_prepared(fname)
+    lats = np.linspace(48.1,48.4,7)
+    lons = np.linspace(-123.9,-123.6,5)
+    np.testing.assert_allclose(
+        loaded.calculate_interp_bathy(lats,lons),
+        bathy.calculate_interp_bathy(lats,lons),
+        atol=1e-9)
+
+
+def test_bundle_environment_matches(ram_env,tmp_path):
+    fname = str(tmp_path / 'bundle.npz')
+    bake_environment_bundle(fname,ram_env)
+    env = Location_Bundle(fname).make_environment(Environment_RAM)
+    env.set_hydrophone_name(ram_env.hydro_name)
+    env.set_model_save_directory(ram_env.model_target_dir)
+    env.set_freqs_common(ram_env.freqs)
+    env.set_rx_location_common(ram_env.rx_latlon)
+    env.set_rx_depth_common(ram_env.rx_depth)
+    env.set_source_common(ram_env.source)
+    env.set_calc_params(ram_env.DELTA_R_RAM)
+    env.set_output_params(ram_env.RAM_OUTPUT)
+    env.set_backend(ram_env.BACKEND)
+    assert env.environment_hash(**RUN_KWARGS) \
+        == ram_env.environment_hash(**RUN_KWARGS)
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    expected = ram_env.TL_unstruc.copy()
+    env.calculate_exact_TLs(**RUN_KWARGS)
+    np.testing.assert_allclose(env.TL_unstruc,expected)
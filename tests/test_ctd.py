@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from UWAEnvTools import ctd
+from UWAEnvTools.ctd import CTD_Cast_Store, bin_cast
+
+
+def write_cast(p_dir,p_stamp,p_lat,p_lon,p_speed,p_max_depth = 20.):
+    """
+    A cast as the Pat Bay exports have it: CTD_SKIP_ROWS header lines with
+    the position, then depth in column 1 and sound speed in column 6.
+    """
+    fname = str(p_dir / ('cast_' + p_stamp + '.csv'))
+    header = ['% header line ' + str(n) for n in range(ctd.CTD_SKIP_ROWS - 2)]
+    header = header + ['% Latitude: ' + str(p_lat),'% Longitude: ' + str(p_lon)]
+    depths = np.arange(0.1,p_max_depth,0.1)
+    df = pd.DataFrame({'scan' : np.arange(len(depths)),
+                       'depth' : depths,
+                       'a' : 0.,'b' : 0.,'c' : 0.,'d' : 0.,
+                       'speed' : p_speed + 0. * depths})
+    with open(fname,'w') as f:
+        f.write('\n'.join(header) + '\n')
+    df.to_csv(fname,mode = 'a',index = False)
+    return fname
+
+
+@pytest.fixture
+def casts(tmp_path):
+    write_cast(tmp_path,'20190815_1200',48.6,-123.5,1490.)
+    write_cast(tmp_path,'20190210_0900',48.7,-123.4,1470.)
+    write_cast(tmp_path,'20180820_1000',49.5,-123.5,1480.,p_max_depth = 10.)
+    write_cast(tmp_path,'20190815_mean',48.6,-123.5,0.) # a written mean, skipped
+    return tmp_path
+
+
+def test_bin_cast():
+    binned = bin_cast(np.array([0.2,0.4,1.2,5.]),
+                      np.array([1.,3.,5.,np.nan]),
+                      np.array([0.,1.,2.,3.]))
+    np.testing.assert_array_equal(binned[:2],[2.,5.])
+    assert np.isnan(binned[2])
+
+
+def test_ingest_sorts_and_bins(casts):
+    store = CTD_Cast_Store(p_bin_size = 1.,p_max_depth = 30.)
+    assert store.ingest(str(casts),p_n_workers = 2) == 3
+    assert list(store.times) == ['201808201000','201902100900','201908151200']
+    np.testing.assert_allclose(store.lats,[49.5,48.7,48.6])
+    np.testing.assert_allclose(store.speeds[:,0],[1480.,1470.,1490.])
+    # past the end of a cast
+    assert np.isnan(store.speeds[0,15]) and np.isfinite(store.speeds[1,15])
+    assert np.all(np.isnan(store.speeds[:,25]))
+
+
+def test_select_and_statistics(casts):
+    store = CTD_Cast_Store(p_bin_size = 1.,p_max_depth = 30.)
+    store.ingest(str(casts))
+    assert list(store.select('2019')) == [False,True,True]
+    assert list(store.select(p_months = [8])) == [True,False,True]
+    assert list(store.select(p_lat_tuple = (48.,49.))) == [False,True,True]
+    mean,std = store.mean(p_chunk = 2)
+    np.testing.assert_allclose(mean[0],1480.)
+    np.testing.assert_allclose(std[0],np.std([1470.,1480.,1490.]),rtol=1e-5)
+    np.testing.assert_allclose(mean[15],1480.) # two casts reach 15 m
+    assert np.isnan(mean[25])
+    np.testing.assert_allclose(store.percentile(50)[0],1480.)
+    profiles = store.seasonal_profiles()
+    assert sorted(profiles.keys()) == [2,8]
+    np.testing.assert_allclose(profiles[8][0],1485.)
+
+
+def test_save_load_round_trip(casts,tmp_path):
+    store = CTD_Cast_Store(p_bin_size = 1.,p_max_depth = 30.)
+    store.ingest(str(casts))
+    fname = str(tmp_path / 'casts.npz')
+    store.save(fname)
+    loaded = CTD_Cast_Store.load(fname)
+    np.testing.assert_array_equal(loaded.speeds,store.speeds)
+    np.testing.assert_array_equal(loaded.times,store.times)
+    np.testing.assert_array_equal(loaded.depths,store.depths)
+    assert len(loaded) == 3
@@ -0,0 +1,100 @@
+import numpy as np
+
+from UWAEnvTools.bathymetry import Bathymetry_Prepared, Depth_Index
+from UWAEnvTools.tiles import Bathymetry_Tiled, build_tile_pyramid
+
+
+LAT = np.linspace(48.,48.5,71)
+LON = np.linspace(-124.,-123.,91)
+
+
+def rough_z():
+    rng = np.random.default_rng(3)
+    LO,LA = np.meshgrid(LON,LAT,indexing='ij')
+    z = -60. - 80. * np.sin(7 * LA) * np.cos(5 * LO) + rng.normal(0.,5.,LO.shape)
+    z[:4,:4] = np.nan # no data corner
+    return z
+
+
+def prepared():
+    bathy = Bathymetry_Prepared()
+    bathy.set_prepared(LAT,LON,rough_z())
+    return bathy
+
+
+def nodes_in(p_z,p_i,p_j,p_T):
+    return p_z[p_i * p_T:p_i * p_T + p_T + 1,p_j * p_T:p_j * p_T + p_T + 1]
+
+
+def test_tile_summaries():
+    z = rough_z()
+    index = Depth_Index.from_grid(LAT,LON,z,16)
+    assert index.z_min.shape == (6,5)
+    for i in range(6):
+        for j in range(5):
+            np.testing.assert_allclose(index.z_min[i,j],np.nanmin(nodes_in(z,i,j,16)))
+            np.testing.assert_allclose(index.z_max[i,j],np.nanmax(nodes_in(z,i,j,16)))
+
+
+def test_region_bounds_the_nodes():
+    bathy = prepared()
+    z = rough_z()
+    np.testing.assert_allclose(bathy.z_range_in_region(),(np.nanmin(z),np.nanmax(z)))
+    lat_extent,lon_extent = (48.1,48.3),(-123.7,-123.4)
+    z_min,z_max = bathy.z_range_in_region(lat_extent,lon_extent)
+    inside = z[(LON >= lon_extent[0]) & (LON <= lon_extent[1])][:,
+               (LAT >= lat_extent[0]) & (LAT <= lat_extent[1])]
+    assert z_min <= np.nanmin(inside) and z_max >= np.nanmax(inside)
+
+
+def test_transect_bounds_the_nodes_it_crosses():
+    bathy = prepared()
+    z = rough_z()
+    rx,tx = (48.05,-123.95),(48.45,-123.1)
+    z_min,z_max = bathy.z_range_along_transect(rx,tx)
+    lats = np.linspace(rx[0],tx[0],500)
+    lons = np.linspace(rx[1],tx[1],500)
+    i = np.rint((lons - LON[0]) / (LON[1] - LON[0])).astype(int)
+    j = np.rint((lats - LAT[0]) / (LAT[1] - LAT[0])).astype(int)
+    assert z_min <= np.nanmin(z[i,j]) and z_max >= np.nanmax(z[i,j])
+    # and is tighter than the whole grid for a short line
+    short = bathy.z_range_along_transect((48.25,-123.5),(48.26,-123.49))
+    assert short[1] - short[0] < np.nanmax(z) - np.nanmin(z)
+
+
+def test_prepared_round_trip_keeps_the_index(tmp_path):
+    bathy = prepared()
+    bathy.get_depth_index(8)
+    fname = str(tmp_path / 'bathy.npz')
+    bathy.save_prepared(fname)
+    loaded = Bathymetry_Prepared()
+    loaded.load_prepared(fname)
+    assert loaded.depth_index.tile_size == 8
+    np.testing.assert_array_equal(loaded.depth_index.z_min,bathy.depth_index.z_min)
+    np.testing.assert_array_equal(loaded.depth_index.z_max,bathy.depth_index.z_max)
+    for key,value in bathy.spline_arrays().items():
+        np.testing.assert_array_equal(loaded.spline_arrays()[key],value)
+
+
+def test_constant_depth_without_refit():
+    bathy = prepared()
+    knots = bathy.spline_arrays()
+    bathy.set_constant_depth(-25.)
+    z = bathy.calculate_interp_bathy(np.linspace(48.,48.5,11),
+                                     np.linspace(-124.,-123.,13))
+    np.testing.assert_allclose(z,-25.,atol=1e-9)
+    np.testing.assert_array_equal(bathy.spline_arrays()['tx'],knots['tx'])
+    assert bathy.z_range_in_region() == (-25.,-25.)
+
+
+def test_tiled_index_matches_the_grid_index(tmp_path):
+    z = rough_z()
+    store = build_tile_pyramid(str(tmp_path / 'pyramid'),LAT,LON,z,16)
+    bathy = Bathymetry_Tiled()
+    bathy.set_tile_store(store)
+    index = bathy.get_depth_index()
+    expected = Depth_Index.from_grid(LAT,LON,z.astype(np.float32),16)
+    np.testing.assert_allclose(index.z_min,expected.z_min)
+    np.testing.assert_allclose(index.z_max,expected.z_max)
+    np.testing.assert_allclose(bathy.z_range_in_region(),
+                               (np.nanmin(z),np.nanmax(z)),rtol=1e-6)
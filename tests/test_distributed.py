@@ -0,0 +1,111 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import REPO_ROOT
+from UWAEnvTools.distributed import Directory_Queue, Task_Queue
+
+
+def make_queue(p_dir,**kwargs):
+    return Directory_Queue(str(p_dir),**kwargs)
+
+
+def expire(p_queue,p_task):
+    old = time.time() - 2 * p_queue.lease_s
+    os.utime(p_queue._claim_fname(p_task),(old,old))
+
+
+def test_put_refuses_queued_tasks(tmp_path):
+    q = make_queue(tmp_path)
+    assert q.put({'id' : 'a'})
+    assert not q.put({'id' : 'a'}) # pending
+    task = q.claim('w')
+    assert not q.put({'id' : 'a'}) # claimed
+    q.complete(task)
+    assert not q.put({'id' : 'a'}) # done
+    assert q.counts()['done'] == 1
+
+
+def test_put_requeues_failed_task(tmp_path):
+    q = make_queue(tmp_path,p_max_attempts = 1)
+    q.put({'id' : 'a'})
+    q.fail(q.claim('w'),ValueError('bad input'))
+    assert q.counts()['failed'] == 1
+    assert q.put({'id' : 'a'})
+    assert q.counts() == {'pending' : 1,'claimed' : 0,'done' : 0,'failed' : 0}
+
+
+def test_claim_lease_starts_at_claim(tmp_path):
+    q = make_queue(tmp_path,p_lease_s = 60)
+    q.put({'id' : 'a'})
+    old = time.time() - 120
+    os.utime(q._fname('pending','a'),(old,old)) # queued long ago
+    task = q.claim('w')
+    assert q.requeue_expired() == 0
+    assert q.heartbeat(task)
+
+
+def test_expired_claim_is_requeued(tmp_path):
+    q = make_queue(tmp_path,p_lease_s = 60)
+    q.put({'id' : 'a'})
+    task = q.claim('dead')
+    expire(q,task)
+    assert q.requeue_expired() == 1
+    assert q.counts()['pending'] == 1
+    assert not q.heartbeat(task)
+    again = q.claim('w')
+    assert again['attempts'] == 2
+    assert again['claim'] != task['claim']
+
+
+def test_stale_claim_does_not_touch_newer_claim(tmp_path):
+    q = make_queue(tmp_path,p_lease_s = 60)
+    q.put({'id' : 'a'})
+    stale = q.claim('slow')
+    expire(q,stale)
+    q.requeue_expired()
+    fresh = q.claim('w')
+    # the slow worker wakes up: its heartbeat fails, and the requeue
+    # scan leaves the fresh claim alone
+    assert not q.heartbeat(stale)
+    assert q.requeue_expired() == 0
+    assert q.heartbeat(fresh)
+    q.complete(fresh)
+    assert q.counts() == {'pending' : 0,'claimed' : 0,'done' : 1,'failed' : 0}
+    assert 'claim' not in q.tasks('done')[0]
+
+
+def test_max_attempts_fails_task(tmp_path):
+    q = make_queue(tmp_path,p_lease_s = 60,p_max_attempts = 2)
+    q.put({'id' : 'a'})
+    for n in range(2):
+        expire(q,q.claim('dead'))
+    assert q.claim('w') is None
+    assert q.counts()['failed'] == 1
+    assert q.tasks('failed')[0]['attempts'] == 3
+
+
+def test_fail_retries_then_gives_up(tmp_path):
+    q = make_queue(tmp_path,p_max_attempts = 2)
+    q.put({'id' : 'a'})
+    q.fail(q.claim('w'),ValueError('bad input'))
+    assert q.counts()['pending'] == 1
+    q.fail(q.claim('w'),ValueError('bad input'))
+    assert q.counts()['failed'] == 1
+    assert q.tasks('failed')[0]['error_kind'] == 'input'
+
+
+def test_task_queue_is_abstract(tmp_path):
+    with pytest.raises(TypeError):
+        Task_Queue()
+    assert isinstance(make_queue(tmp_path),Task_Queue)
+
+
+def test_import_does_not_load_pandas():
+    code = 'import sys; import UWAEnvTools.distributed;' \
+        'sys.exit(int("pandas" in sys.modules))'
+    out = subprocess.run([sys.executable,'-c',code],cwd = REPO_ROOT,timeout = 120)
+    assert out.returncode == 0
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from conftest import RUN_KWARGS
+from UWAEnvTools import events
+
+
+def failing_run(p_model = None):
+    raise RuntimeError('solver crashed')
+
+
+@pytest.mark.parametrize('p_multi_depth',[False,True])
+def test_failed_run_ends_progress_and_restores_output(ram_env,p_multi_depth):
+    received = []
+    ram_env.set_event_stream(events.Event_Stream(p_callback = received.append))
+    ram_env.run_model = failing_run
+    output = (ram_env.RAM_OUTPUT,ram_env.RAM_NDR,ram_env.RAM_NDZ,ram_env.RAM_ZMPLT)
+    with pytest.raises(RuntimeError):
+        if p_multi_depth:
+            ram_env.calculate_exact_TLs_multi_depth([10.,20.],**RUN_KWARGS)
+        else:
+            ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    kinds = [event['event'] for event in received]
+    assert events.EVENT_FAILURE in kinds
+    assert kinds[-1] == events.EVENT_RUN_END
+    assert (ram_env.RAM_OUTPUT,ram_env.RAM_NDR,ram_env.RAM_NDZ,ram_env.RAM_ZMPLT) \
+        == output
+
+
+def test_run_writes_one_line_per_event(ram_env,tmp_path):
+    fname = str(tmp_path / 'events.jsonl')
+    stream = events.Event_Stream(fname)
+    ram_env.set_event_stream(stream)
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    stream.close()
+    with open(fname) as f:
+        received = [json.loads(line) for line in f]
+    n_points = len(ram_env.source.course)
+    assert [event['event'] for event in received] \
+        == [events.EVENT_RUN_START] + [events.EVENT_TRANSECT] * n_points \
+            + [events.EVENT_RUN_END]
+    transects = received[1:-1]
+    assert [event['index'] for event in transects] == list(range(n_points))
+    assert transects[-1]['eta_s'] == 0.
+    assert all(event['hydrophone'] == ram_env.hydro_name for event in received)
+    assert received[-1]['n_done'] == n_points
+    assert received[-1]['n_failed'] == 0
+
+
+def test_no_stream_is_a_null_tracker(ram_env,monkeypatch):
+    monkeypatch.setattr(events,'_DEFAULT',{'stream' : None,'checked' : False})
+    monkeypatch.delenv(events.ENV_VAR,raising = False)
+    assert ram_env.progress(100,4) is events.NULL_PROGRESS
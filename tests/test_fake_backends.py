@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+import UWAEnvTools.backends as backends
+import UWAEnvTools.fake_backends as fake_backends
+
+
+def fake_ram(**kwargs):
+    return fake_backends.Fake_PyRAM(
+        100.,5.,20.,
+        np.array([0.,50.]),np.array([0.]),np.array([[1500.],[1490.]]),
+        np.array([[0.,60.]]),np.array([0.]),np.array([[1700.]]),
+        np.array([[1.8]]),np.array([[0.5]]),
+        np.array([[0.,40.],[2000.,60.]]),
+        **kwargs)
+
+
+@pytest.fixture(autouse = True)
+def no_cost():
+    fake_backends.set_fake_cost(0.)
+    fake_backends.reset_fake_stats()
+    yield
+    fake_backends.set_fake_cost(0.)
+
+
+def test_registered():
+    assert backends.get_backend('fake_pyram').PyRAM is fake_backends.Fake_PyRAM
+    assert backends.get_backend('fake_arlpy').coherent == 'coherent'
+
+
+def test_pyram_output_follows_pyram_grid_rules():
+    result = fake_ram(dr = 10.,ndr = 2,dz = 0.5,ndz = 4,zmplt = 30.).run()
+    np.testing.assert_allclose(result['Ranges'],np.arange(1,101) * 20.)
+    np.testing.assert_allclose(result['Depths'],np.arange(1,16) * 2.)
+    assert result['TL Line'].shape == (100,)
+    assert result['TL Grid'].shape == (15,100)
+    assert result['CP Grid'].dtype == complex
+    # the scaling of PyRAM's output routine
+    np.testing.assert_allclose(
+        result['TL Line'],
+        -20 * np.log10(np.abs(result['CP Line'])) + 10 * np.log10(result['Ranges']))
+    assert fake_backends.FAKE_STATS['runs'] == 1
+
+
+def test_pyram_defaults():
+    model = fake_ram()
+    assert model._dr == 8 * 1500 / 100.
+    assert model._zmplt == 60.
+    assert model._rmax == 2000.
+
+
+def test_cost_is_spent_and_counted():
+    fake_backends.set_fake_cost(p_seconds_per_run = 0.02)
+    fake_ram().run()
+    fake_ram().run()
+    assert fake_backends.FAKE_STATS['runs'] == 2
+    assert fake_backends.FAKE_STATS['seconds'] >= 0.04
+    fake_backends.set_fake_cost(p_seconds_per_run = 0.01,p_mode = fake_backends.COST_SPIN)
+    fake_ram().run()
+    assert fake_backends.FAKE_STATS['seconds'] >= 0.05
+    with pytest.raises(ValueError):
+        fake_backends.set_fake_cost(p_mode = 'nap')
+
+
+def test_arlpy_pressure_frame():
+    env = fake_backends.create_env2d(frequency = 200,
+                                     rx_depth = [5.,10.,15.],
+                                     rx_range = [100.,1000.],
+                                     nbeams = 3)
+    assert env['bottom_absorption'] == 0.1 # arlpy's default
+    df = fake_backends.compute_transmission_loss(env,mode = 'coherent')
+    assert df.shape == (3,2)
+    assert list(df.index) == [5.,10.,15.]
+    assert np.abs(df.iloc[0,0]) > np.abs(df.iloc[0,1])
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from UWAEnvTools.frequency import Frequency_Plan
+
+
+def make_plan():
+    plan = Frequency_Plan(100,400,p_tolerance = 10.,p_anchors = [100,200,400])
+    plan.refine(lambda f : np.array([np.log2(f)]))
+    return plan
+
+
+def test_excluded_anchor_is_bracketed_over():
+    plan = make_plan()
+    plan.exclude(200)
+    assert plan.bracket(150) == (100,400)
+    assert plan.bracket(200) == (100,400)
+    value = plan.interpolate([200])[200]
+    np.testing.assert_allclose(value,[np.log2(200)])
+    assert np.isnan(plan.estimate_error([150])[150])
+    assert plan.estimate_error([100])[100] == 0.
+
+
+def test_every_anchor_excluded():
+    plan = make_plan()
+    plan.exclude([100,200,400])
+    with pytest.raises(ValueError):
+        plan.bracket(150)
+
+
+def step_TL(p_f):
+    # a fast change between 200 and 300 Hz, refined by bisection
+    return np.array([0.,10.]) + (20. if p_f > 250 else 0.)
+
+
+@pytest.mark.parametrize('p_failure',['raise','nan'])
+def test_refine_excludes_failed_anchor(p_failure):
+    def TL_function(p_f):
+        if p_f == 245:
+            if p_failure == 'raise':
+                raise RuntimeError('solver crashed')
+            return np.full(2,np.nan)
+        return step_TL(p_f)
+    plan = Frequency_Plan(100,400,p_anchors = [100,200,300,400])
+    plan.refine(TL_function)
+    assert plan.failed == {245}
+    assert 245 in plan.errors
+    assert 245 in plan.anchors and 245 not in plan.usable_anchors()
+    assert all([np.isfinite(e) for e in plan.interval_error.values()])
+    f_low,f_high = plan.bracket(245)
+    assert f_low < 245 < f_high
+    values = plan.interpolate([150,245,350])
+    assert all([np.all(np.isfinite(v)) for v in values.values()])
+
+
+def test_refine_excludes_failed_starting_anchor():
+    def TL_function(p_f):
+        if p_f == 200:
+            raise RuntimeError('solver crashed')
+        return step_TL(p_f)
+    plan = Frequency_Plan(100,400,p_tolerance = 100.,p_anchors = [100,200,400])
+    plan.refine(TL_function)
+    assert plan.usable_anchors() == [100,400]
+    assert list(plan.interval_error.keys()) == [(100,400)]
@@ -0,0 +1,125 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from conftest import RUN_KWARGS
+from UWAEnvTools import guard
+from UWAEnvTools.guard import Solver_Guard, Failure_Registry
+
+
+def test_timeout_recovers_on_fallback():
+    def attempt(p_overrides):
+        if 'dr' not in p_overrides:
+            time.sleep(1.)
+        return p_overrides.get('dr')
+    g = Solver_Guard(p_timeout_s = 0.2,p_fallbacks = [{'dr' : 5.}])
+    assert g.run('key',attempt) == 5.
+    assert g.stats['recovered'] == 1
+    assert g.stats['failures'] == {guard.FAIL_TIMEOUT : 1}
+
+
+def test_timeout_given_up_is_not_registered():
+    def attempt(p_overrides):
+        time.sleep(1.)
+    g = Solver_Guard(p_timeout_s = 0.1)
+    assert g.run('key',attempt) is None
+    assert isinstance(g.last_failure,guard.Guard_Timeout)
+    assert len(g.registry) == 0
+    # the next run tries the point again
+    assert g.run('key',lambda p_overrides : 1.) == 1.
+
+
+def test_input_error_is_registered_and_skipped(tmp_path):
+    calls = []
+    def attempt(p_overrides):
+        calls.append(p_overrides)
+        raise ValueError('bad input')
+    fname = str(tmp_path / 'failed.json')
+    g = Solver_Guard(p_fallbacks = [{'dr' : 5.}],
+                     p_registry = Failure_Registry(fname))
+    assert g.run('key',attempt) is None
+    assert len(calls) == 2
+    assert 'key' in g.registry
+    assert g.run('key',attempt) is None
+    assert len(calls) == 2
+    assert g.stats['skipped'] == 1
+    assert 'key' in Failure_Registry(fname)
+
+
+def test_unclassified_error_is_not_registered():
+    calls = []
+    def attempt(p_overrides):
+        calls.append(p_overrides)
+        raise RuntimeError('backend hiccup')
+    g = Solver_Guard(p_fallbacks = [{'dr' : 5.}])
+    assert g.run('key',attempt) is None
+    assert len(calls) == 2
+    assert g.stats['failures'] == {guard.FAIL_ERROR : 2}
+    assert 'key' not in g.registry
+    assert g.run('key',lambda p_overrides : 1.) == 1.
+
+
+def test_register_on_can_include_timeouts():
+    g = Solver_Guard(p_timeout_s = 0.1,
+                     p_register_on = guard.REGISTER_DEFAULT + (guard.FAIL_TIMEOUT,))
+    assert g.run('key',lambda p_overrides : time.sleep(1.)) is None
+    assert 'key' in g.registry
+
+
+def test_invalid_result_falls_back():
+    g = Solver_Guard(p_fallbacks = [{'dr' : 5.}])
+    result = g.run('key',
+                   lambda p_overrides : p_overrides.get('dr',np.nan),
+                   np.isfinite)
+    assert result == 5.
+
+
+def test_fallback_does_not_change_later_transects(ram_env):
+    """
+    A fallback dr is used only by its own attempt: the attempt abandoned
+    on the timeout and every later transect run at the configured dr.
+    """
+    original = ram_env.run_model
+    drs = []
+    def slow_first(p_model = None):
+        model = ram_env.pyram_obj if p_model is None else p_model
+        drs.append(model._dr)
+        if len(drs) == 1:
+            time.sleep(1.)
+        return original(p_model)
+    ram_env.run_model = slow_first
+    g = Solver_Guard(p_timeout_s = 0.3,p_fallbacks = [{'dr' : 2.}])
+    ram_env.set_guard(g)
+    dr = ram_env.DELTA_R_RAM
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    time.sleep(1.) # let the abandoned attempt finish
+    assert ram_env.DELTA_R_RAM == dr
+    assert g.stats['recovered'] == 1
+    assert drs[:2] == [dr,2.]
+    assert all([d == dr for d in drs[2:]])
+    df = pd.read_csv(ram_env.results_fname(ram_env.freqs[0]),index_col=0)
+    assert np.all(np.isfinite(df['TL']))
+
+
+def test_multi_depth_given_up_point_is_nan(ram_env):
+    original = ram_env.run_model
+    calls = []
+    def fail_first(p_model = None):
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError('bad input')
+        return original(p_model)
+    ram_env.run_model = fail_first
+    ram_env.set_guard(Solver_Guard())
+    depths = np.array([10.,20.,30.])
+    output = (ram_env.RAM_OUTPUT,ram_env.RAM_NDZ)
+    ram_env.calculate_exact_TLs_multi_depth(depths,**RUN_KWARGS)
+    assert (ram_env.RAM_OUTPUT,ram_env.RAM_NDZ) == output
+    df = pd.read_csv(ram_env.results_fname(ram_env.freqs[0],'_depths'),
+                     index_col=0)
+    first = df[(df['Lats TX'] == df['Lats TX'].iloc[0]) 
+               & (df['Lons TX'] == df['Lons TX'].iloc[0])]
+    assert len(first) == len(depths)
+    assert np.all(np.isnan(first['TL']))
+    assert np.all(np.isfinite(df['TL'].iloc[len(depths):]))
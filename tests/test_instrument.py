@@ -0,0 +1,82 @@
+import json
+import time
+
+import numpy as np
+import pytest
+
+from conftest import RUN_KWARGS
+from UWAEnvTools import instrument
+
+
+@pytest.fixture(autouse = True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(instrument,'_STATE',{'enabled' : False,
+                                             'memory' : False,
+                                             'report' : instrument.Report(),
+                                             'runs' : [],
+                                             'tracing' : False})
+    yield
+    instrument.disable()
+
+
+def test_off_by_default_costs_nothing():
+    assert instrument.stage(instrument.STAGE_SOLVER) is instrument._NULL_STAGE
+    with instrument.stage(instrument.STAGE_SOLVER):
+        pass
+    instrument.record(instrument.STAGE_SOLVER_REPORTED,1.)
+    assert instrument.report().stages == {}
+
+
+def test_nested_stages_are_inclusive():
+    instrument.enable()
+    with instrument.run('nested') as report:
+        for n in range(3):
+            with instrument.stage(instrument.STAGE_ENVIRONMENT):
+                with instrument.stage(instrument.STAGE_BASIS):
+                    time.sleep(0.01)
+        instrument.record(instrument.STAGE_SOLVER_REPORTED,0.5,0.25)
+    stats = report.stages
+    assert stats[instrument.STAGE_ENVIRONMENT]['count'] == 3
+    assert stats[instrument.STAGE_BASIS]['count'] == 3
+    assert stats[instrument.STAGE_ENVIRONMENT]['wall_s'] \
+        >= stats[instrument.STAGE_BASIS]['wall_s'] >= 0.03
+    assert stats[instrument.STAGE_SOLVER_REPORTED]['cpu_s'] == 0.25
+    assert instrument.runs() == [report]
+    assert 'nested' in report.summary_table()
+
+
+def test_memory_peaks_reach_the_parent():
+    instrument.enable(p_memory = True)
+    with instrument.run() as report:
+        with instrument.stage(instrument.STAGE_ENVIRONMENT):
+            with instrument.stage(instrument.STAGE_BASIS):
+                block = np.ones(2**20) # 8 MB
+                del block
+    stats = report.stages
+    assert stats[instrument.STAGE_BASIS]['peak_bytes'] >= 2**23
+    assert stats[instrument.STAGE_ENVIRONMENT]['peak_bytes'] \
+        >= stats[instrument.STAGE_BASIS]['peak_bytes']
+
+
+def test_run_ends_when_it_raises(tmp_path):
+    instrument.enable()
+    with pytest.raises(RuntimeError):
+        with instrument.run('failed'):
+            with instrument.stage(instrument.STAGE_WRITE):
+                raise RuntimeError('disk full')
+    assert [r.name for r in instrument.runs()] == ['failed']
+    assert instrument.runs()[0].stages[instrument.STAGE_WRITE]['count'] == 1
+    fname = str(tmp_path / 'runs.json')
+    instrument.export_json(fname)
+    with open(fname) as f:
+        assert json.load(f)['runs'][0]['name'] == 'failed'
+
+
+def test_model_run_stages(ram_env):
+    instrument.enable()
+    with instrument.run('RAM') as report:
+        ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    n_points = len(ram_env.source.course)
+    assert report.stages[instrument.STAGE_SOLVER]['count'] == n_points
+    assert report.stages[instrument.STAGE_ENVIRONMENT]['count'] == n_points
+    assert report.stages[instrument.STAGE_WRITE]['count'] >= 1
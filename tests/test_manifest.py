@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import RUN_KWARGS
+from UWAEnvTools import manifest
+from UWAEnvTools.bundle import bake_environment_bundle
+from UWAEnvTools.manifest import Manifest_Planner, Manifest_Error, Task_Graph, \
+    execute
+
+
+def test_re_added_stage_is_cached_only_if_both_are():
+    for first,second in [(True,False),(False,True),(True,True)]:
+        graph = Task_Graph()
+        key = graph.add(manifest.STAGE_BATHYMETRY,{'a' : 1},p_cached = first)
+        assert graph.add(manifest.STAGE_BATHYMETRY,{'a' : 1},p_cached = second) == key
+        assert graph.stages[key].cached == (first and second)
+        assert graph.requested[manifest.STAGE_BATHYMETRY] == 2
+        assert len(graph.stages) == 1
+
+
+def two_ssp_manifest(p_dir):
+    location = {'location' : 'Patricia Bay',
+                'receivers' : [{'name' : 'North','lat' : 48.65,'lon' : -123.5,
+                                'depth' : 20.}],
+                'sources' : {'points' : [[48.62,-123.48],[48.64,-123.46]]}}
+    return {'name' : 'two ssp',
+            'output_dir' : str(p_dir),
+            'frequencies' : [100],
+            'models' : [{'backend' : 'fake_pyram'}],
+            'locations' : [dict(location,ssp = {'class' : 'Blouin_2015'}),
+                           dict(location,ssp = {'class' : 'Munk'})]}
+
+
+def test_shared_bathymetry_runs_for_an_unbaked_bundle(tmp_path):
+    graph = Manifest_Planner().plan(two_ssp_manifest(tmp_path))
+    assert len(graph.by_kind(manifest.STAGE_BATHYMETRY)) == 1
+    assert len(graph.by_kind(manifest.STAGE_SSP)) == 2
+    bundles = graph.by_kind(manifest.STAGE_BUNDLE)
+    assert len(bundles) == 2
+    # the Blouin bundle is already baked, the Munk one is not
+    baked = bundles[0].inputs['fname']
+    os.makedirs(os.path.dirname(baked))
+    open(baked,'w').close()
+    graph = Manifest_Planner().plan(two_ssp_manifest(tmp_path))
+    cached = dict([(s.key,s.cached) for s in graph.stages.values()])
+    bundle_blouin,bundle_munk = graph.by_kind(manifest.STAGE_BUNDLE)
+    assert cached[bundle_blouin.key] and not cached[bundle_munk.key]
+    # everything the Munk bundle is made from runs
+    for key in bundle_munk.depends:
+        assert not cached[key]
+    ssp_blouin,ssp_munk = graph.by_kind(manifest.STAGE_SSP)
+    assert cached[ssp_blouin.key] and not cached[ssp_munk.key]
+
+
+def test_plan_deduplicates_runs(tmp_path):
+    m = two_ssp_manifest(tmp_path)
+    m['locations'] = m['locations'][:1]
+    m['locations'][0]['receivers'] = m['locations'][0]['receivers'] * 2
+    m['frequencies'] = [100,200,100]
+    graph = Manifest_Planner().plan(m)
+    assert graph.requested[manifest.STAGE_RUN] == 6
+    assert len(graph.by_kind(manifest.STAGE_RUN)) == 2
+    assert len(graph.by_kind(manifest.STAGE_TRANSECTS)) == 1
+    assert graph.estimate()[manifest.STAGE_RUN] > 0
+    assert 'Plan: two ssp' in graph.summary(4)
+
+
+def test_plan_rejects_bad_manifests(tmp_path):
+    with pytest.raises(Manifest_Error):
+        Manifest_Planner().plan({'locations' : []})
+    m = two_ssp_manifest(tmp_path)
+    m['models'] = [{'backend' : 'fake_pyram','bogus' : 1}]
+    with pytest.raises(Manifest_Error):
+        Manifest_Planner().plan(m)
+    m = two_ssp_manifest(tmp_path)
+    del m['locations'][0]['receivers']
+    with pytest.raises(Manifest_Error):
+        Manifest_Planner().plan(m)
+
+
+def test_execute_matches_a_direct_run(ram_env,tmp_path):
+    fname = str(tmp_path / 'bundle.npz')
+    bake_environment_bundle(fname,ram_env)
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    m = {'name' : 'bench',
+         'output_dir' : str(tmp_path / 'out'),
+         'frequencies' : ram_env.freqs,
+         'models' : [{'name' : 'fake',
+                      'backend' : 'fake_pyram',
+                      'dr' : ram_env.DELTA_R_RAM,
+                      'mode' : RUN_KWARGS['POINT_OR_LINE_STR'],
+                      'basis_size_depth' : RUN_KWARGS['BASIS_SIZE_DEPTH'],
+                      'basis_size_distance' : RUN_KWARGS['BASIS_SIZE_DISTANCE']}],
+         'locations' : [{'bundle' : fname,
+                         'receivers' : [{'name' : ram_env.hydro_name,
+                                         'lat' : ram_env.rx_latlon[0],
+                                         'lon' : ram_env.rx_latlon[1],
+                                         'depth' : ram_env.rx_depth}],
+                         'sources' : {'points' : [list(tx) for tx in ram_env.source.course],
+                                      'depth' : ram_env.source.depth}}]}
+    graph = Manifest_Planner().plan(m)
+    assert graph.by_kind(manifest.STAGE_BUNDLE)[0].cached
+    envs = execute(graph,p_verbose = False)
+    env = envs[(fname,ram_env.hydro_name,'fake')]
+    np.testing.assert_allclose(env.TL_unstruc,ram_env.TL_unstruc)
+    assert os.path.exists(env.results_fname(ram_env.freqs[0]))
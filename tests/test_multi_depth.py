@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import RUN_KWARGS
+from UWAEnvTools import events
+from UWAEnvTools.environment import Environment_RAM
+from UWAEnvTools.results import Result_Store
+
+
+DEPTHS = [5.,12.,30.]
+
+
+def grid_result(p_depths,p_cp):
+    return {'Depths' : np.asarray(p_depths,dtype=float),
+            'Ranges' : np.array([100.,200.]),
+            'CP Grid' : np.asarray(p_cp,dtype=complex)}
+
+
+def test_TL_at_depths_interpolates_to_the_surface():
+    result = grid_result([2.,4.],[[1.,1.],[0.5,0.5]])
+    TL = Environment_RAM.TL_at_depths(result,np.array([1.,2.,3.,5.]))
+    spreading = 10 * np.log10(result['Ranges'])
+    np.testing.assert_allclose(TL[0],-20 * np.log10(0.5) + spreading)
+    np.testing.assert_allclose(TL[1],spreading)
+    np.testing.assert_allclose(TL[2],-20 * np.log10(0.75) + spreading)
+    assert np.all(np.isnan(TL[3]))
+
+
+def test_TL_at_depths_needs_a_grid():
+    with pytest.raises(ValueError):
+        Environment_RAM.TL_at_depths(grid_result([2.],[[1.,1.]]),np.array([1.]))
+
+
+def test_multi_depth_rejects_surface_depths(ram_env):
+    with pytest.raises(ValueError):
+        ram_env.calculate_exact_TLs_multi_depth([0.,10.],**RUN_KWARGS)
+
+
+@pytest.mark.parametrize('p_mode',['POINT','LINE'])
+def test_multi_depth_rows(ram_env,p_mode):
+    kwargs = dict(RUN_KWARGS,POINT_OR_LINE_STR = p_mode)
+    ram_env.calculate_exact_TLs_multi_depth(DEPTHS,**kwargs)
+    assert ram_env.RAM_OUTPUT == Environment_RAM.OUTPUT_LINE
+    fname = ram_env.results_fname(ram_env.freqs[0],'_depths')
+    df = pd.read_csv(fname,index_col=0)
+    n_sources = len(ram_env.source.valid_course(ram_env.rx_latlon))
+    for depth in DEPTHS:
+        rows = df[df['Depth'] == depth]
+        assert len(rows.groupby(['Lats TX','Lons TX'])) == n_sources
+        if p_mode == 'POINT':
+            assert len(rows) == n_sources
+    np.testing.assert_array_equal(ram_env.depths_unstruc,df['Depth'].values)
+    # the bottom at 30 m is below the shallow synthetic grid
+    assert np.all(np.isfinite(df[df['Depth'] < 30.]['TL']))
+    meta = Result_Store().read_meta(fname)
+    assert meta['env_hash'] != ram_env.environment_hash(**kwargs)
+    assert meta['n_rows'] == len(df)
+
+
+def test_multi_depth_incremental_resume(ram_env):
+    received = []
+    ram_env.set_event_stream(events.Event_Stream(p_callback = received.append))
+    ram_env.calculate_exact_TLs_multi_depth(DEPTHS,**RUN_KWARGS)
+    fname = ram_env.results_fname(ram_env.freqs[0],'_depths')
+    first = pd.read_csv(fname,index_col=0)
+    ram_env.calculate_exact_TLs_multi_depth(DEPTHS,INCREMENTAL = True,**RUN_KWARGS)
+    plans = [e for e in received if e['event'] == events.EVENT_PLAN]
+    assert len(plans) == 1 and plans[0]['n_missing'] == 0
+    pd.testing.assert_frame_equal(pd.read_csv(fname,index_col=0),first)
+    # other depths are another environment: everything is run again
+    ram_env.calculate_exact_TLs_multi_depth([5.],INCREMENTAL = True,**RUN_KWARGS)
+    plans = [e for e in received if e['event'] == events.EVENT_PLAN]
+    assert plans[-1]['n_missing'] == plans[-1]['n_requested']
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from conftest import RUN_KWARGS
+from UWAEnvTools.environment import Environment_RAM
+
+
+def run_first_transect(p_env):
+    course = p_env.source.valid_course(p_env.rx_latlon)
+    p_env.prepare_transects([course],RUN_KWARGS['BASIS_SIZE_DISTANCE'])
+    p_env.create_environment_model(
+        p_env.rx_latlon,
+        course[0],
+        TX_DEPTH = p_env.source.depth,
+        FREQ_TO_RUN = p_env.freqs[0],
+        RX_DEPTH = p_env.rx_depth,
+        BASIS_SIZE_DEPTH = RUN_KWARGS['BASIS_SIZE_DEPTH'],
+        BASIS_SIZE_DISTANCE = RUN_KWARGS['BASIS_SIZE_DISTANCE'])
+    return p_env.run_model()
+
+
+def test_line_output_drops_the_grids(ram_env):
+    ram_env.set_output_params(Environment_RAM.OUTPUT_FULL)
+    full = run_first_transect(ram_env)
+    ram_env.set_output_params(Environment_RAM.OUTPUT_LINE)
+    line = run_first_transect(ram_env)
+    assert 'TL Grid' not in line and 'CP Grid' not in line
+    assert full['TL Grid'].shape == (len(full['Depths']),len(full['Ranges']))
+    np.testing.assert_array_equal(line['Ranges'],full['Ranges'])
+    np.testing.assert_allclose(line['TL Line'],full['TL Line'])
+
+
+def test_grid_output_is_thinned(ram_env):
+    ram_env.set_output_params(Environment_RAM.OUTPUT_FULL)
+    full = run_first_transect(ram_env)
+    ram_env.set_output_params(Environment_RAM.OUTPUT_GRID,
+                              p_ndr = 2,
+                              p_ndz = 3,
+                              p_zmplt = 12.)
+    grid = run_first_transect(ram_env)
+    np.testing.assert_allclose(grid['Ranges'],full['Ranges'][1::2])
+    depths = full['Depths'][2::3]
+    np.testing.assert_allclose(grid['Depths'],depths[depths <= 12.])
+    assert grid['CP Grid'].shape == (len(grid['Depths']),len(grid['Ranges']))
+
+
+def test_line_point_results_match_full(ram_env):
+    ram_env.set_output_params(Environment_RAM.OUTPUT_FULL)
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    full = ram_env.TL_unstruc.copy()
+    ram_env.set_output_params(Environment_RAM.OUTPUT_LINE)
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    np.testing.assert_allclose(ram_env.TL_unstruc,full)
+
+
+def test_output_settings(ram_env):
+    ram_env.set_output_params()
+    assert ram_env.get_output_kwargs() == dict()
+    full_hash = ram_env.environment_hash(**RUN_KWARGS)
+    ram_env.set_output_params(Environment_RAM.OUTPUT_LINE,p_ndr = 2)
+    assert ram_env.get_output_kwargs() == {'ndr' : 2,'zmplt' : 0}
+    assert ram_env.environment_hash(**RUN_KWARGS) != full_hash
+    with pytest.raises(ValueError):
+        ram_env.set_output_params('SOME')
@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+
+import bench_pipeline
+from conftest import RUN_KWARGS
+from UWAEnvTools import events
+from UWAEnvTools.bathymetry import Bathymetry_Prepared, TRANSECT_OK, \
+    TRANSECT_OUT_OF_DOMAIN, TRANSECT_SOURCE_ON_LAND, TRANSECT_CROSSES_LAND
+from UWAEnvTools.environment import Environment_ARL
+from UWAEnvTools.results import source_key
+from UWAEnvTools.source import Source
+
+
+RX = (0.5,0.5)
+# one source in each quadrant around RX: SW, NW, SE, NE
+QUADRANTS = [(0.2,0.2),(0.8,0.2),(0.2,0.8),(0.8,0.8)]
+
+
+def island_bathymetry(p_islands):
+    """
+    50 m of water over [0,1] x [0,1], with land in a 0.06 square around
+    each of p_islands.
+    """
+    basis = np.linspace(0.,1.,101)
+    LO,LA = np.meshgrid(basis,basis,indexing='ij')
+    z = np.full(LO.shape,-50.)
+    for lat,lon in p_islands:
+        z[(np.abs(LA - lat) <= 0.03) & (np.abs(LO - lon) <= 0.03)] = 5.
+    bathy = Bathymetry_Prepared()
+    bathy.set_prepared(basis,basis,z)
+    return bathy
+
+
+def check(p_bathy,p_sources,p_rx = RX,p_n = 100):
+    sources = np.array(p_sources)
+    return p_bathy.check_transects(p_rx,sources[:,0],sources[:,1],p_n)
+
+
+def test_open_water_is_ok_in_every_quadrant():
+    codes = check(island_bathymetry([]),QUADRANTS)
+    assert list(codes) == [TRANSECT_OK] * 4
+
+
+def test_source_on_land_in_every_quadrant():
+    codes = check(island_bathymetry(QUADRANTS),QUADRANTS)
+    assert list(codes) == [TRANSECT_SOURCE_ON_LAND] * 4
+
+
+def test_crossing_land_in_every_quadrant():
+    midpoints = [((RX[0] + lat) / 2,(RX[1] + lon) / 2) for lat,lon in QUADRANTS]
+    codes = check(island_bathymetry(midpoints),QUADRANTS)
+    assert list(codes) == [TRANSECT_CROSSES_LAND] * 4
+
+
+def test_land_off_the_line_is_ok():
+    # on the other diagonal of the NW and SE transects' bounding boxes
+    bathy = island_bathymetry([(0.5,0.2),(0.8,0.5),(0.2,0.5),(0.5,0.8)])
+    codes = check(bathy,[(0.8,0.2),(0.2,0.8)])
+    assert list(codes) == [TRANSECT_OK] * 2
+
+
+def test_receiver_end_is_not_tested():
+    # the island stops short of the first sample past the receiver
+    bathy = island_bathymetry([])
+    bathy.z_interped[50,50] = 5.
+    assert list(check(bathy,[(0.5,0.9),(0.5,0.1)],p_n = 10)) \
+        == [TRANSECT_OK] * 2
+
+
+def test_out_of_domain():
+    codes = check(island_bathymetry([]),[(1.2,0.5),(0.5,-0.1),(0.8,0.8)])
+    assert list(codes) == [TRANSECT_OUT_OF_DOMAIN] * 2 + [TRANSECT_OK]
+
+
+def make_source():
+    source = Source()
+    source.set_depth(2.)
+    source.course = [(0.8,0.8),(0.2,0.2),(0.8,0.2),(1.2,0.5)]
+    return source
+
+
+def test_prefilter_drop_removes_points_invalid_for_every_receiver():
+    bathy = island_bathymetry([(0.2,0.2)])
+    source = make_source()
+    source.prefilter_course(bathy,[RX,(0.1,0.1)],p_mode = 'drop')
+    # (0.2,0.2) is on land for both, (1.2,0.5) out of the grid for both
+    assert source.course == [(0.8,0.8),(0.8,0.2)]
+    assert source.valid_course(RX) == [(0.8,0.8),(0.8,0.2)]
+    # the line from (0.1,0.1) to (0.8,0.8) crosses the island
+    assert source.valid_course((0.1,0.1)) == [(0.8,0.2)]
+
+
+def test_prefilter_flag_keeps_the_course():
+    bathy = island_bathymetry([(0.2,0.2)])
+    source = make_source()
+    course = list(source.course)
+    source.prefilter_course(bathy,[RX],p_mode = 'flag')
+    assert source.course == course
+    assert list(source.course_mask(RX)) == [True,False,True,False]
+    assert source.valid_course(RX) == [(0.8,0.8),(0.8,0.2)]
+    # not prefiltered for this receiver
+    assert source.valid_course((0.1,0.1)) == course
+
+
+def test_prefilter_emits_counts_per_receiver():
+    seen = []
+    stream = events.Event_Stream(p_callback = seen.append)
+    source = make_source()
+    report = source.prefilter_course(island_bathymetry([(0.2,0.2)]),
+                                     [RX],
+                                     p_mode = 'flag',
+                                     p_event_stream = stream)
+    assert report == source.prefilter_report
+    assert len(seen) == 1
+    event = seen[0]
+    assert event['event'] == events.EVENT_PREFILTER
+    assert (event['rx_lat'],event['rx_lon']) == RX
+    assert event['n_points'] == 4
+    assert event['n_dropped'] == 0
+    assert event['n_skipped'] == 2
+    assert event['n_on_land'] == 1
+    assert event['n_out_of_domain'] == 1
+    assert event['n_crossing_land'] == 0
+
+
+def test_prefilter_checks_its_arguments():
+    source = make_source()
+    with pytest.raises(ValueError):
+        source.prefilter_course(island_bathymetry([]),[RX],p_mode = 'mask')
+    source.prefilter_course(island_bathymetry([]),[RX],p_mode = 'flag')
+    source.course = source.course[:2]
+    with pytest.raises(ValueError):
+        source.valid_course(RX)
+
+
+def test_ARL_writes_nan_for_flagged_points(tmp_path):
+    env = bench_pipeline.make_environment(Environment_ARL,str(tmp_path),4)
+    valid = np.array([True,False,True,True])
+    env.source.course_valid = {source_key(*env.rx_latlon) : valid}
+    env.calculate_exact_TLs(N_BEAMS = 0,
+                            BASIS_SIZE_DEPTH = RUN_KWARGS['BASIS_SIZE_DEPTH'],
+                            BASIS_SIZE_DISTANCE = RUN_KWARGS['BASIS_SIZE_DISTANCE'])
+    assert len(env.TL) == 4
+    assert list(np.isnan(env.TL)) == list(~valid)
+    assert [(la,lo) for la,lo in zip(env.LAT,env.LON)] == env.source.course
+    env.LAT_N_PTS,env.LON_N_PTS = 2,2
+    X,Y,surface = env.reshape_1d_to_surface()
+    assert surface.shape == (2,2)
+    assert np.isnan(surface[0,1])
+    env.LAT_N_PTS = 3
+    with pytest.raises(ValueError):
+        env.reshape_1d_to_surface()
@@ -0,0 +1,69 @@
+import os
+import pstats
+import tracemalloc
+
+import pytest
+
+from conftest import RUN_KWARGS
+from UWAEnvTools.profiling import Profiler
+
+
+class Worker():
+
+    def work(self,p_n):
+        return sum(range(p_n))
+
+    def fail(self):
+        raise RuntimeError('solver crashed')
+
+
+def names(p_profiler):
+    return sorted([os.path.basename(f) for f in p_profiler.files])
+
+
+def test_profile_method_numbers_calls_and_restores(tmp_path):
+    worker = Worker()
+    profiler = Profiler(str(tmp_path),'t_',p_memory = False)
+    profiler.profile_method(worker,'work')
+    assert worker.work(10) == 45
+    worker.work(20)
+    assert names(profiler) == ['t_work.pstats','t_work_1.pstats']
+    stats = profiler.merged_stats('work')
+    assert isinstance(stats,pstats.Stats)
+    profiler.restore_all()
+    assert 'work' not in worker.__dict__
+    assert worker.work(3) == 3
+
+
+def test_failed_call_still_writes_and_stops(tmp_path):
+    worker = Worker()
+    profiler = Profiler(str(tmp_path),p_memory = True)
+    profiler.profile_method(worker,'fail')
+    with pytest.raises(RuntimeError):
+        worker.fail()
+    assert names(profiler) == ['fail.pstats','fail.tracemalloc']
+    assert profiler._active is None
+    assert not tracemalloc.is_tracing() # only traced during the call
+    tracemalloc.Snapshot.load(profiler.files[1])
+    profiler.restore_all()
+
+
+def test_sample_transects(ram_env,tmp_path):
+    profiler = Profiler(str(tmp_path),p_memory = False)
+    profiler.sample_transects(ram_env,p_every_n = 2,p_name = 'tx')
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    assert names(profiler) == ['tx_000000.pstats','tx_000002.pstats']
+    profiler.restore_all()
+    assert 'create_environment_model' not in ram_env.__dict__
+    assert 'run_model' not in ram_env.__dict__
+
+
+def test_transects_inside_a_whole_call_are_not_sampled(ram_env,tmp_path):
+    profiler = Profiler(str(tmp_path),p_memory = False)
+    profiler.profile_method(ram_env,'calculate_exact_TLs','all')
+    profiler.sample_transects(ram_env,p_every_n = 1,p_name = 'tx')
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    assert names(profiler) == ['all.pstats']
+    profiler.restore_all()
+    assert ram_env.__dict__.keys().isdisjoint(
+        ['calculate_exact_TLs','create_environment_model','run_model'])
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+from conftest import RUN_KWARGS
+import UWAEnvTools.fake_backends as fake_backends
+from UWAEnvTools.results import Result_Store, Incremental_Planner, source_key
+
+
+def frame(p_lats,p_TL):
+    return pd.DataFrame({'X' : np.zeros(len(p_lats)),
+                         'Y' : np.zeros(len(p_lats)),
+                         'TL' : p_TL,
+                         'Lats TX' : p_lats,
+                         'Lons TX' : np.full(len(p_lats),-123.4)})
+
+
+def test_read_needs_the_same_hash(tmp_path):
+    store = Result_Store()
+    fname = str(tmp_path / 'r.csv')
+    frame([48.1,48.2],[50.,60.]).to_csv(fname)
+    assert store.read(fname,'a') is None # no sidecar
+    store.write_meta(fname,'a',2)
+    assert len(store.read(fname,'a')) == 2
+    assert store.read(fname,'b') is None
+    assert store.completed_sources(fname,'a') \
+        == {source_key(48.1,-123.4),source_key(48.2,-123.4)}
+
+
+def test_merge_write_replaces_recomputed_sources(tmp_path):
+    store = Result_Store()
+    fname = str(tmp_path / 'r.csv')
+    store.merge_write(fname,frame([48.1,48.2],[50.,60.]),'a')
+    df = store.merge_write(fname,frame([48.2,48.3],[61.,70.]),'a')
+    assert sorted(df['TL']) == [50.,61.,70.]
+    # rows of another environment are not kept
+    df = store.merge_write(fname,frame([48.4],[80.]),'b')
+    assert list(df['TL']) == [80.]
+    assert store.read_meta(fname) == {'env_hash' : 'b','n_rows' : 1}
+
+
+def test_parts_merge(tmp_path):
+    store = Result_Store()
+    fname = str(tmp_path / 'r.csv')
+    store.write_part(fname,'0',frame([48.1],[50.]),'a')
+    store.write_part(fname,'1',frame([48.2],[60.]),'a')
+    store.write_part(fname,'2',frame([48.3],[70.]),'old')
+    assert store.part_sources(fname,'a') \
+        == {source_key(48.1,-123.4),source_key(48.2,-123.4)}
+    df = store.merge_parts(fname,'a')
+    assert sorted(df['TL']) == [50.,60.]
+    assert len(store.part_fnames(fname)) == 1 # the other environment's
+
+
+def test_planner_lists_missing_runs(tmp_path):
+    store = Result_Store()
+    course = [(48.1,-123.4),(48.2,-123.4),(48.3,-123.4)]
+    def fname(p_freq):
+        return str(tmp_path / (str(p_freq) + '.csv'))
+    store.merge_write(fname(100),frame([48.1,48.3],[50.,70.]),'a')
+    planner = Incremental_Planner(store)
+    todo = planner.plan(fname,[100,200],course,'a')
+    assert todo == {100 : [course[1]],200 : course}
+    assert planner.counts(todo,course) == (4,6)
+
+
+def test_incremental_run_resumes(ram_env):
+    freq = ram_env.freqs[0]
+    fname = ram_env.results_fname(freq)
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    full = pd.read_csv(fname,index_col=0)
+    n = len(full)
+    # an interrupted run: only the first rows made it to the file
+    store = Result_Store()
+    env_hash = store.read_meta(fname)['env_hash']
+    full.iloc[:1].to_csv(fname)
+    store.write_meta(fname,env_hash,1)
+
+    fake_backends.reset_fake_stats()
+    ram_env.calculate_exact_TLs(INCREMENTAL = True,**RUN_KWARGS)
+    assert fake_backends.FAKE_STATS['runs'] == n - 1
+    resumed = pd.read_csv(fname,index_col=0)
+    pd.testing.assert_frame_equal(
+        resumed.sort_values(['Lats TX','Lons TX']).reset_index(drop=True),
+        full.sort_values(['Lats TX','Lons TX']).reset_index(drop=True))
+    np.testing.assert_allclose(np.sort(ram_env.TL_unstruc),np.sort(full['TL']))
+
+    # nothing left, then a new frequency is the only work
+    fake_backends.reset_fake_stats()
+    ram_env.calculate_exact_TLs(INCREMENTAL = True,**RUN_KWARGS)
+    assert fake_backends.FAKE_STATS['runs'] == 0
+    ram_env.set_freqs_common([freq,2 * freq])
+    ram_env.calculate_exact_TLs(INCREMENTAL = True,**RUN_KWARGS)
+    assert fake_backends.FAKE_STATS['runs'] == n
+
+    # another range step is another environment, so everything reruns
+    fake_backends.reset_fake_stats()
+    ram_env.set_calc_params(2 * ram_env.DELTA_R_RAM)
+    ram_env.calculate_exact_TLs(INCREMENTAL = True,**RUN_KWARGS)
+    assert fake_backends.FAKE_STATS['runs'] == 2 * n
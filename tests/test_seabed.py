@@ -0,0 +1,166 @@
+import numpy as np
+import pytest
+
+from UWAEnvTools.seabed import SeaBed, Sediment_Map, Sediment_Raster, \
+    contains_points
+
+
+SEDIMENTS = {'Sand-silt' : {'M_z' : 5.,'Rho' : 1.7,'c' : 1650.,'alpha' : 0.8},
+             'Clay' : {'M_z' : 9.,'Rho' : 1.4,'c' : 1520.,'alpha' : 0.1},
+             'Gravel' : {'M_z' : -1.,'Rho' : 2.,'c' : 1800.,'alpha' : 0.6}}
+
+
+def grid_points(p_n = 200):
+    lat,lon = np.meshgrid(np.linspace(0.0005,0.9995,p_n),
+                          np.linspace(0.0005,0.9995,p_n),
+                          indexing='ij')
+    return lat.ravel(),lon.ravel()
+
+
+def truth(p_polygons,p_lats,p_lons):
+    """
+    Type index per point straight from the polygons, later ones winning.
+    """
+    result = np.full(len(p_lats),-1)
+    for type_index,poly_lats,poly_lons in p_polygons:
+        result[contains_points(poly_lats,poly_lons,p_lats,p_lons)] = type_index
+    return result
+
+
+def check(p_map,p_cell_size = 0.1):
+    p_map.build_index((0.,1.),(0.,1.),p_cell_size)
+    lats,lons = grid_points()
+    np.testing.assert_array_equal(p_map.classify(lats,lons),
+                                  truth(p_map.polygons,lats,lons))
+
+
+def test_thin_zone_between_cell_corners():
+    # narrower than a cell and between the corner rows, so no cell it
+    # crosses has a corner inside
+    m = Sediment_Map()
+    m.add_polygon('sand',[0.42,0.42,0.47,0.47],[0.02,0.98,0.98,0.02])
+    check(m)
+    assert m.classify([0.45],[0.5])[0] == 0
+
+
+def test_concave_notch():
+    m = Sediment_Map()
+    m.add_polygon('mud',
+                  [0.05,0.95,0.95,0.53,0.53,0.57,0.57,0.95,0.95,0.05],
+                  [0.05,0.05,0.43,0.43,0.95,0.95,0.47,0.47,0.95,0.95])
+    check(m)
+    assert m.classify([0.7],[0.45])[0] == -1
+
+
+def test_polygon_smaller_than_a_cell():
+    m = Sediment_Map()
+    m.add_polygon('gravel',[0.52,0.52,0.58],[0.52,0.58,0.55])
+    check(m)
+    assert m.classify([0.54],[0.55])[0] == 0
+
+
+def test_overlapping_polygons_later_wins():
+    m = Sediment_Map()
+    m.add_polygon('mud',[0.1,0.1,0.9,0.9],[0.1,0.9,0.9,0.1])
+    m.add_polygon('sand',[0.33,0.33,0.67,0.67],[0.21,0.77,0.77,0.21])
+    m.add_polygon('mud',[0.44,0.44,0.46,0.46],[0.3,0.7,0.7,0.3])
+    check(m)
+    assert list(m.classify([0.5,0.45,0.2],[0.5,0.5,0.2])) == [1,0,0]
+
+
+def write_asc(p_fname,p_header,p_rows):
+    with open(p_fname,'w') as f:
+        for key,value in p_header:
+            f.write(key + ' ' + str(value) + '\n')
+        for row in p_rows:
+            f.write(' '.join([str(v) for v in row]) + '\n')
+
+
+ROWS = [[0,1,1],
+        [0,0,-9999]]
+
+
+def test_asc_header_by_key(tmp_path):
+    fname = str(tmp_path / 'types.asc')
+    write_asc(fname,
+              [('NCOLS',3),('nrows',2),('cellsize',0.5),
+               ('xllcorner',-124.),('YLLCORNER',48.),
+               ('NODATA_value',-9999)],
+              ROWS)
+    m = Sediment_Map()
+    m.read_raster_asc(fname,['mud','sand'])
+    # north row first in the file
+    result = m.classify([48.75,48.75,48.25,48.25],[-123.75,-123.25,-123.75,-122.75])
+    assert list(result) == [0,1,0,-1]
+
+
+def test_asc_centre_origin_without_nodata(tmp_path):
+    fname = str(tmp_path / 'types.asc')
+    write_asc(fname,
+              [('cellsize',0.5),('xllcenter',-123.75),('yllcenter',48.25),
+               ('ncols',3),('nrows',2)],
+              ROWS)
+    m = Sediment_Map()
+    m.read_raster_asc(fname,['mud','sand'])
+    assert (m.lat_0,m.lon_0) == (48.,-124.)
+    assert m.classify([48.25],[-122.75])[0] == -1 # -9999 is still no data
+
+
+def test_asc_shape_mismatch(tmp_path):
+    fname = str(tmp_path / 'types.asc')
+    write_asc(fname,
+              [('ncols',4),('nrows',2),('xllcorner',0.),('yllcorner',0.),
+               ('cellsize',1.)],
+              ROWS)
+    with pytest.raises(ValueError):
+        Sediment_Map().read_raster_asc(fname,['mud','sand'])
+
+
+def uniform_seabed(p_shape = (300,400)):
+    seabed = SeaBed(np.zeros(p_shape[1]),np.zeros(p_shape[0]),np.zeros(p_shape))
+    seabed.sediment_dictionary = SEDIMENTS
+    seabed.assign_single_bottom_type('Sand-silt')
+    return seabed
+
+
+def test_uniform_seabed_is_scalar():
+    seabed = uniform_seabed()
+    rho = seabed.bottom_type_profile['Rho']
+    assert rho.shape == (300,400)
+    assert rho[0][0] == 1.7 and rho[12,34] == 1.7
+    assert rho.strides == (0,0) # a view of one value, not the grid
+    assert not rho.flags.writeable
+    profile = seabed.sample_along(np.zeros(5),np.zeros(5))
+    np.testing.assert_array_equal(profile['c'],np.full(5,1650.))
+    np.testing.assert_array_equal(seabed.transect((0.,0.),(1.,1.),7)['alpha'],
+                                  np.full(7,0.8))
+
+
+def test_raster_map_falls_back_to_uniform():
+    seabed = uniform_seabed()
+    basis = np.linspace(0.,1.,11)
+    types = np.full((11,11),-1,dtype=int) # [lon,lat]
+    types[:5,:] = 0   # west half clay
+    types[6:,:5] = 1  # south east gravel
+    seabed.set_map(Sediment_Raster(basis,basis,types,['Clay','Gravel']))
+    lats = np.array([0.5,0.2,0.8,0.5])
+    lons = np.array([0.2,0.8,0.8,1.5])
+    profile = seabed.sample_along(lats,lons)
+    # clay, gravel, no data, outside the raster
+    np.testing.assert_array_equal(profile['Rho'],[1.4,2.,1.7,1.7])
+    result = seabed.sample_transects((0.5,0.1),[(0.5,0.9)],3)
+    np.testing.assert_array_equal(result['c'],[[1520.,1650.,1650.]])
+    np.testing.assert_array_equal(seabed.transect((0.5,0.1),(0.5,0.9),3)['c'],
+                                  [1520.,1650.,1650.])
+    seabed.set_map(None)
+    np.testing.assert_array_equal(seabed.sample_along(lats,lons)['Rho'],
+                                  np.full(4,1.7))
+
+
+def test_map_types_are_checked():
+    seabed = uniform_seabed()
+    basis = np.linspace(0.,1.,3)
+    with pytest.raises(KeyError):
+        seabed.set_map(Sediment_Raster(basis,basis,np.zeros((3,3)),['Mud']))
+    with pytest.raises(ValueError):
+        Sediment_Raster(basis,basis[:2],np.zeros((3,3)),['Clay'])
@@ -0,0 +1,150 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import REPO_ROOT, RUN_KWARGS, bundle_environment
+from UWAEnvTools.bathymetry import Bathymetry_Prepared
+from UWAEnvTools.bundle import bake_environment_bundle, Location_Bundle
+from UWAEnvTools import shared
+from UWAEnvTools.shared import (Shared_Bathymetry, attach_bathymetry,
+                                detach_bathymetry, BACKEND_SHM, BACKEND_MEMMAP)
+from UWAEnvTools.distributed import (Directory_Queue, make_tasks, submit,
+                                     run_workers, merge_results)
+from UWAEnvTools.workers import Environment_Cache, Worker_Pool, environment_spec
+
+
+def make_bathymetry():
+    lat = np.linspace(48.,48.5,20)
+    lon = np.linspace(-124.,-123.5,25)
+    LO,LA = np.meshgrid(lon,lat,indexing='ij')
+    bathy = Bathymetry_Prepared()
+    bathy.set_prepared(lat,lon,-(50. + 100 * (LA - 48.) + 20 * (LO + 124.)))
+    return bathy
+
+
+@pytest.mark.parametrize('p_backend',[BACKEND_SHM,BACKEND_MEMMAP])
+def test_attach_detach_round_trip(p_backend,tmp_path):
+    bathy = make_bathymetry()
+    lats = np.linspace(48.1,48.4,7)
+    lons = np.linspace(-123.9,-123.6,5)
+    with Shared_Bathymetry(p_backend,str(tmp_path)) as owner:
+        descriptor = owner.publish(bathy)
+        attached = attach_bathymetry(descriptor)
+        np.testing.assert_array_equal(attached.z_interped,bathy.z_interped)
+        assert not attached.z_interped.flags.writeable
+        np.testing.assert_allclose(attached.calculate_interp_bathy(lats,lons),
+                                   bathy.calculate_interp_bathy(lats,lons))
+        detach_bathymetry(attached)
+        assert attached.shared_handle is None
+        assert attached.z_interped == 'not set'
+        # a second worker can still attach after the first detached
+        again = attach_bathymetry(descriptor)
+        np.testing.assert_array_equal(again.lat_basis_trimmed,bathy.lat_basis_trimmed)
+        detach_bathymetry(again)
+    assert owner.descriptor is None
+    with pytest.raises(FileNotFoundError):
+        attach_bathymetry(descriptor)
+
+
+def test_environment_cache_uses_shared_grid(ram_env,tmp_path):
+    fname = str(tmp_path / 'bundle.npz')
+    bake_environment_bundle(fname,ram_env)
+    spec = environment_spec(ram_env,fname)
+    env_hash = ram_env.environment_hash(**RUN_KWARGS)
+    with Shared_Bathymetry() as owner:
+        descriptor = owner.publish(Location_Bundle(fname).bathymetry)
+        cache = Environment_Cache({spec['bundle'] : descriptor})
+        env,warm = cache.checked_environment(spec,env_hash,RUN_KWARGS)
+        assert not warm
+        assert env.bathymetry.shared_handle is not None
+        assert cache.bundle(spec['bundle']).bathymetry is env.bathymetry
+
+
+def depth_at(p_bathymetry,p_latlon):
+    return float(np.ravel(p_bathymetry.calculate_interp_bathy(
+        [p_latlon[0]],[p_latlon[1]]))[0])
+
+
+def worker_depth(p_latlon):
+    return depth_at(shared.get_worker_bathymetry(),p_latlon)
+
+
+WORKERS = '''
+import sys
+import multiprocessing
+sys.path.insert(0,'tests')
+from test_shared import make_bathymetry, depth_at, worker_depth
+from UWAEnvTools import shared
+
+if __name__ == '__main__':
+    bathy = make_bathymetry()
+    points = [(48.1,-123.9),(48.3,-123.7)]
+    expected = [depth_at(bathy,p) for p in points]
+    with shared.Shared_Bathymetry() as owner:
+        descriptor = owner.publish(bathy)
+        for method in ('fork','spawn'):
+            context = multiprocessing.get_context(method)
+            with context.Pool(2,shared.init_worker_bathymetry,(descriptor,)) as pool:
+                assert pool.map(worker_depth,points) == expected
+        # nor does a process with a resource tracker of its own
+        import subprocess
+        code = 'import sys; sys.path.insert(0,".");' \
+            'from UWAEnvTools import shared;' \
+            'shared.detach_bathymetry(shared.attach_bathymetry(' \
+            + repr(descriptor) + '))'
+        subprocess.run([sys.executable,'-c',code],check = True)
+        # the workers exiting did not remove it
+        shared.detach_bathymetry(shared.attach_bathymetry(descriptor))
+    print('ok')
+'''
+
+
+def test_pool_workers_attach():
+    out = subprocess.run([sys.executable,'-c',WORKERS],
+                         cwd = REPO_ROOT,
+                         capture_output = True,
+                         text = True,
+                         timeout = 120)
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.strip() == 'ok'
+    # no leaked or doubly removed segments reported by the resource tracker
+    assert 'resource_tracker' not in out.stderr, out.stderr
+
+
+def test_worker_pool_shares_bathymetry(ram_env,tmp_path):
+    fname = str(tmp_path / 'bundle.npz')
+    bake_environment_bundle(fname,ram_env)
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    expected = ram_env.TL_unstruc.copy()
+    env = bundle_environment(ram_env,fname)
+    with Worker_Pool(p_n_workers = 2,
+                     p_backends = ('fake_pyram',),
+                     p_modules = (),
+                     p_bundles = (fname,),
+                     p_share_bathymetry = True) as pool:
+        assert len(pool.shared) == 1
+        env.calculate_exact_TLs(RUNNER = pool.transect_runner(env,fname),
+                                **RUN_KWARGS)
+    assert pool.shared[0].descriptor is None # closed with the pool
+    np.testing.assert_allclose(env.TL_unstruc,expected)
+
+
+def test_run_workers_share_bathymetry(ram_env,tmp_path):
+    fname = str(tmp_path / 'bundle.npz')
+    bake_environment_bundle(fname,ram_env)
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    expected = pd.read_csv(ram_env.results_fname(ram_env.freqs[0]),index_col=0)
+    os.makedirs(str(tmp_path / 'dist'))
+    env = bundle_environment(ram_env,fname,str(tmp_path / 'dist') + os.sep)
+    queue = Directory_Queue(str(tmp_path / 'queue'))
+    submit(queue,make_tasks(env,fname,p_chunk_size = 1,**RUN_KWARGS))
+    assert run_workers(queue,2,p_poll_s = 0.1) == len(expected)
+    merge_results(queue)
+    result = pd.read_csv(env.results_fname(env.freqs[0]),index_col=0)
+    pd.testing.assert_frame_equal(
+        result.sort_values(['Lats TX','Lons TX']).reset_index(drop=True),
+        expected.sort_values(['Lats TX','Lons TX']).reset_index(drop=True))
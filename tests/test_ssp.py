@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import synthetic
+from UWAEnvTools.ssp import SSP, SSP_Blouin_2015, SSP_Munk
+
+
+DEPTHS = np.linspace(0.,120.,241)
+
+
+def blouin(p_tmp_path,p_depths = DEPTHS):
+    ssp = SSP_Blouin_2015()
+    ssp.set_depths(p_depths)
+    ssp.read_profile(synthetic.write_blouin_coefficients(
+        str(p_tmp_path / 'blouin.txt')))
+    return ssp
+
+
+def test_blouin_table_matches_the_polynomials(tmp_path):
+    ssp = blouin(tmp_path)
+    assert ssp.months == synthetic.MONTHS
+    assert ssp.table.shape == (12,len(DEPTHS))
+    for month in synthetic.MONTHS:
+        expected = [ssp.third_order_estimate(ssp.coefficients[month],z)
+                    for z in DEPTHS]
+        np.testing.assert_allclose(ssp.dict[month],expected)
+    np.testing.assert_array_equal(ssp.get_summer(),ssp.dict['August'])
+    np.testing.assert_array_equal(ssp.get_winter(),ssp.dict['February'])
+
+
+def test_blouin_scalar_depth(tmp_path):
+    ssp = blouin(tmp_path,np.array([10.]))
+    coeffs = ssp.coefficients['May']
+    assert ssp.dict['May'][0] == pytest.approx(
+        sum([c * 10. ** n for n,c in enumerate(coeffs)]))
+
+
+def test_blouin_needs_depths(tmp_path):
+    with pytest.raises(SSP.SSP_Error):
+        SSP_Blouin_2015().read_profile(synthetic.write_blouin_coefficients(
+            str(tmp_path / 'blouin.txt')))
+
+
+def test_munk_matches_pointwise():
+    ssp = SSP_Munk()
+    ssp.set_depths(np.linspace(0.,5000.,101))
+    ssp.read_profile()
+    expected = [ssp.munk(float(z)) for z in ssp.depths]
+    np.testing.assert_allclose(ssp.get_summer(),expected)
+    # the sound channel axis
+    assert ssp.depths[np.argmin(ssp.get_winter())] == pytest.approx(1300.,abs=50.)
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+from UWAEnvTools.tiles import Tile_Store, Bathymetry_Tiled, build_tile_pyramid
+
+
+LAT = np.linspace(48.,48.5,81)
+LON = np.linspace(-124.,-123.,101)
+TILE = 16
+
+
+def planar(p_lats,p_lons):
+    # bilinear sampling of a plane is exact
+    return -100. - 40. * (p_lats - 48.) + 25. * (p_lons + 124.)
+
+
+def grid_z():
+    LO,LA = np.meshgrid(LON,LAT,indexing='ij')
+    return planar(LA,LO) # [lon,lat]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return build_tile_pyramid(str(tmp_path / 'pyramid'),LAT,LON,grid_z(),TILE)
+
+
+def test_levels_halve_until_one_tile(store):
+    assert [(L['n_lon'],L['n_lat']) for L in store.levels] \
+        == [(101,81),(51,41),(26,21),(13,11)]
+    np.testing.assert_allclose(store.levels[1]['d_lat'],
+                               2 * store.levels[0]['d_lat'])
+    lat_basis,lon_basis = store.basis(0)
+    np.testing.assert_allclose(lat_basis,LAT)
+    np.testing.assert_allclose(lon_basis,LON)
+
+
+def test_read_window_across_tiles(store):
+    z = grid_z()
+    window = store.read_window(0,10,40,5,20)
+    np.testing.assert_allclose(window,z[10:41,5:21],rtol=1e-6)
+    # NaN outside the level
+    window = store.read_window(0,-2,3,78,82)
+    assert np.all(np.isnan(window[:2]))
+    assert np.all(np.isnan(window[:,3:]))
+    np.testing.assert_allclose(window[2:,:3],z[0:4,78:81],rtol=1e-6)
+
+
+def test_sample_is_bilinear_and_nan_outside(store):
+    rng = np.random.default_rng(1)
+    lats = rng.uniform(LAT[0],LAT[-1],200)
+    lons = rng.uniform(LON[0],LON[-1],200)
+    np.testing.assert_allclose(store.sample(lats,lons),planar(lats,lons),rtol=1e-5)
+    outside = store.sample([47.9,48.2],[-123.5,-122.9])
+    assert np.all(np.isnan(outside))
+
+
+def test_coarser_levels_agree_away_from_the_edges(store):
+    lats = np.linspace(48.1,48.4,9)
+    lons = np.linspace(-123.8,-123.2,9)
+    for L in range(1,len(store.levels)):
+        np.testing.assert_allclose(store.sample(lats,lons,L),
+                                   planar(lats,lons),
+                                   rtol=1e-4)
+
+
+def test_level_for_spacing(store):
+    d_lat,d_lon = store.levels[0]['d_lat'],store.levels[0]['d_lon']
+    assert store.level_for_spacing(d_lat / 2,d_lon / 2) == 0
+    assert store.level_for_spacing(2.5 * d_lat,2.5 * d_lon) == 1
+    assert store.level_for_spacing(np.inf,np.inf) == len(store.levels) - 1
+
+
+def test_lat_first_source_matches(store,tmp_path):
+    other = build_tile_pyramid(str(tmp_path / 'lat_first'),
+                               LAT,LON,grid_z().T,TILE,p_lat_first = True)
+    assert other.levels == store.levels
+    for L,level in enumerate(store.levels):
+        np.testing.assert_array_equal(
+            other.read_window(L,0,level['n_lon'] - 1,0,level['n_lat'] - 1),
+            store.read_window(L,0,level['n_lon'] - 1,0,level['n_lat'] - 1))
+
+
+def test_cache_is_bounded(store):
+    store = Tile_Store(store.dir,p_cache_tiles = 2)
+    store.get_tile(0,0,0)
+    store.get_tile(0,1,0)
+    store.get_tile(0,0,0) # hit, now most recent
+    store.get_tile(0,2,0) # evicts (0,1,0)
+    assert list(store.cache.keys()) == [(0,0,0),(0,2,0)]
+    assert (store.hits,store.misses) == (1,3)
+    store.get_tile(0,1,0)
+    assert store.misses == 4
+
+
+def test_bathymetry_tiled(store):
+    bathy = Bathymetry_Tiled()
+    bathy.read_bathy(store.dir)
+    coarsest = store.levels[-1]
+    assert np.shape(bathy.z_interped) == (coarsest['n_lon'],coarsest['n_lat'])
+    # a fine transect samples level 0
+    lats = np.linspace(48.1,48.3,400)
+    lons = np.linspace(-123.9,-123.3,400)
+    np.testing.assert_allclose(bathy.calculate_interp_bathy(lats,lons,p_grid = False),
+                               planar(lats,lons),
+                               rtol=1e-5)
+    assert bathy.level_for_basis(lats,lons) == 0
+    assert bathy.level_for_basis(lats[::80],lons[::80]) == 2
+    # grids come back [lon,lat]
+    z = bathy.calculate_interp_bathy(lats[:3],lons[:5])
+    assert z.shape == (5,3)
+    with pytest.raises(TypeError):
+        bathy.spline_arrays()
+
+
+def test_bathymetry_tiled_constant_depth(store,tmp_path):
+    bathy = Bathymetry_Tiled()
+    bathy.read_bathy(store.dir)
+    bathy.set_constant_depth(-30.,str(tmp_path / 'constant'))
+    z = bathy.calculate_interp_bathy(np.linspace(48.,48.5,7),
+                                     np.linspace(-124.,-123.,9))
+    np.testing.assert_allclose(z,-30.)
+    # the pyramid it was built from is untouched
+    np.testing.assert_allclose(store.sample([48.25],[-123.5]),
+                               planar(48.25,-123.5),rtol=1e-5)
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from conftest import RUN_KWARGS, bundle_environment
+from UWAEnvTools.bundle import bake_environment_bundle
+from UWAEnvTools.workers import Environment_Cache, Worker_Pool, Worker_Error, \
+    environment_spec
+
+
+@pytest.fixture
+def bundled(ram_env,tmp_path):
+    """
+    ram_env, its bundle file name and an environment built from the bundle.
+    """
+    fname = str(tmp_path / 'bundle.npz')
+    bake_environment_bundle(fname,ram_env)
+    return ram_env, fname, bundle_environment(ram_env,fname)
+
+
+def make_pool(p_fname,p_n_workers = 2):
+    return Worker_Pool(p_n_workers = p_n_workers,
+                       p_backends = ('fake_pyram',),
+                       p_modules = (),
+                       p_bundles = (p_fname,))
+
+
+def test_submit_and_collect_match_serial(bundled):
+    ram_env, fname, env = bundled
+    env_hash = env.environment_hash(**RUN_KWARGS)
+    course = env.source.course
+    freq = env.freqs[0]
+    env.prepare_transects(course,RUN_KWARGS['BASIS_SIZE_DISTANCE'])
+    expected = env.run_transects(freq,course,env_hash,**RUN_KWARGS).to_dict()
+    spec = environment_spec(env,fname)
+    with make_pool(fname) as pool:
+        ids = [pool.submit(spec,freq,course[:2],env_hash,**RUN_KWARGS),
+               pool.submit(spec,freq,course[2:],env_hash,**RUN_KWARGS)]
+        finished = pool.collect(ids)
+        assert sorted(finished.keys()) == ids
+        for key in expected.keys():
+            np.testing.assert_allclose(
+                np.concatenate([finished[t][key] for t in ids]),
+                expected[key])
+        assert pool.stats['tasks'] == 2
+        assert pool.stats['points'] == len(course)
+
+
+def test_runner_matches_serial(bundled):
+    ram_env, fname, env = bundled
+    ram_env.calculate_exact_TLs(**RUN_KWARGS)
+    with make_pool(fname) as pool:
+        env.calculate_exact_TLs(RUNNER = pool.transect_runner(env,fname,1),
+                                **RUN_KWARGS)
+    np.testing.assert_allclose(env.TL_unstruc,ram_env.TL_unstruc)
+
+
+def test_multi_depth_runner_matches_serial(bundled):
+    ram_env, fname, env = bundled
+    depths = [5.,10.]
+    ram_env.calculate_exact_TLs_multi_depth(depths,**RUN_KWARGS)
+    with make_pool(fname) as pool:
+        env.calculate_exact_TLs_multi_depth(
+            depths,
+            RUNNER = pool.transect_runner(env,fname),
+            **RUN_KWARGS)
+    np.testing.assert_allclose(env.depths_unstruc,ram_env.depths_unstruc)
+    np.testing.assert_allclose(env.TL_unstruc,ram_env.TL_unstruc)
+
+
+def test_failed_task_leaves_nothing_behind(bundled):
+    ram_env, fname, env = bundled
+    env_hash = env.environment_hash(**RUN_KWARGS)
+    course = env.source.course
+    freq = env.freqs[0]
+    spec = environment_spec(env,fname)
+    bad = dict(spec)
+    bad['bundle'] = fname + '.missing'
+    # one worker, so the results come back in order
+    with make_pool(fname,1) as pool:
+        ids = [pool.submit(spec,freq,course[:1],env_hash,**RUN_KWARGS),
+               pool.submit(bad,freq,course[1:2],env_hash,**RUN_KWARGS),
+               pool.submit(spec,freq,course[2:],env_hash,**RUN_KWARGS)]
+        with pytest.raises(Worker_Error) as error:
+            pool.collect(ids)
+        assert 'task ' + str(ids[1]) in str(error.value)
+        assert pool._finished == {}
+        assert pool._abandoned == {ids[2]}
+        # the next job gets its own results only
+        later = pool.submit(spec,freq,course[:1],env_hash,**RUN_KWARGS)
+        assert list(pool.collect([later]).keys()) == [later]
+        assert pool._finished == {}
+        assert pool._abandoned == set()
+        assert pool._failed == {}
+
+
+def test_hash_mismatch_fails_the_task(bundled):
+    ram_env, fname, env = bundled
+    spec = environment_spec(env,fname)
+    cache = Environment_Cache()
+    with pytest.raises(Worker_Error):
+        cache.checked_environment(spec,'not the hash',RUN_KWARGS)
+    env_hash = env.environment_hash(**RUN_KWARGS)
+    built,warm = cache.checked_environment(spec,env_hash,RUN_KWARGS)
+    assert warm # built by the failed check, kept
+    with make_pool(fname,1) as pool:
+        task = pool.submit(spec,env.freqs[0],env.source.course,'not the hash',
+                           **RUN_KWARGS)
+        with pytest.raises(Worker_Error) as error:
+            pool.collect([task])
+        assert 'does not match' in str(error.value)